@@ -4,6 +4,7 @@ from phenomedb.models import *
 import datetime
 from phenomedb.query_factory import *
 from phenomedb.utilities import configure_logging
+from phenomedb.task_data import TaskData, align_sample_metadata
 import re
 import numpy as np
 import pandas as pd
@@ -14,6 +15,9 @@ import pathlib
 from pyChemometrics.ChemometricsPCA import ChemometricsPCA
 from pyChemometrics.ChemometricsScaler import ChemometricsScaler
 import subprocess
+from phenomedb import r_worker_pool
+from phenomedb import r_bridge
+from phenomedb import mwas
 import nPYc
 
 
@@ -98,6 +102,8 @@ class AnalysisTask(Task):
     columns_to_include = ['Project','Unique Batch','Unique Correction Batch','Run Order','Acquired Time']
     sample_types = None
     assay_roles = None
+    #: The artefacts loaded from the upstream TaskRun output, None loads them all
+    upstream_artefacts = ('sample_metadata','feature_metadata','intensity_data')
 
     def __init__(self,query_factory=None,saved_query_model='AnnotatedFeature',saved_query_id=None,task_run_id=None,username=None,correction_type=None,
                  exclude_na_metadata_samples=False,exclude_na_metadata_columns=False,output_dir=None,db_env=None,db_session=None,execution_date=None,
@@ -248,82 +254,40 @@ class AnalysisTask(Task):
         if self.task_run_id and not self.task_run:
             self.task_run = self.db_session.query(TaskRun).filter(TaskRun.id == self.task_run_id).first()
         if self.task_run:
-            self.cache.set(self.task_run.get_task_data_cache_key(),
-                           utils.convert_to_json_safe(self.clean_data_for_jsonb(self.data)), ex=86400)
+            self.cache.set(self.task_run.get_task_data_cache_key(), self.data, ex=86400)
 
         self.logger.info(".....done")
 
     def load_data_from_upstream(self):
+        """Load the data from the upstream TaskRun output. Only the upstream_artefacts are loaded, and the sample
+        metadata columns the upstream task dropped are put back in from its untransformed sample metadata.
+
+        :raises Exception: If the upstream TaskRun data or output is not cached
+        """
 
         self.upstream_task_run = self.db_session.query(TaskRun).filter(TaskRun.id==self.upstream_task_run_id).first()
 
         if not self.cache.exists(self.upstream_task_run.get_task_data_cache_key()):
             raise Exception('The upstream task run cache does not exist!! Please re-run the pipeline from the previous task: %s' % self.upstream_task_run_id)
 
-        upstream_data = self.upstream_task_run.get_task_data(self.cache)
-        upstream_output = self.upstream_task_run.get_task_output(self.cache)
+        names = list(self.upstream_artefacts) if self.upstream_artefacts is not None else None
+        upstream_output = self.upstream_task_run.get_task_output(self.cache,names=names)
+        if upstream_output is None:
+            raise Exception('The upstream task run has no output!! Please re-run the pipeline from the previous task: %s' % self.upstream_task_run_id)
+        upstream_output = TaskData(upstream_output)
 
         self.data = upstream_output
 
         # Just put the columns back in, not any missing rows!
+        if 'sample_metadata' in upstream_output.keys():
+            upstream_data = self.upstream_task_run.get_task_data(self.cache,names=['untransformed_sample_metadata'])
+            if upstream_data is not None and 'untransformed_sample_metadata' in upstream_data.keys():
+                self.logger.info("Found upstream sample metadata")
+                self.data['sample_metadata'] = align_sample_metadata(upstream_output.get_dataframe('sample_metadata'),
+                                                                     TaskData(upstream_data).get_dataframe('untransformed_sample_metadata'))
+                return
 
-        # put the missing columns back in!
-        if 'sample_metadata' in upstream_output.keys() and 'untransformed_sample_metadata' in upstream_data.keys():
-            self.logger.info("Found upstream sample metadata")
-            sample_metadata = pd.DataFrame.from_dict(upstream_output['sample_metadata'])
-            sample_metadata = sample_metadata.where(pd.notnull(sample_metadata), None)
-            untransformed_sample_metadata = pd.DataFrame.from_dict(upstream_data['untransformed_sample_metadata'])
-            untransformed_sample_metadata = untransformed_sample_metadata.where(pd.notnull(untransformed_sample_metadata), None)
-
-            if sample_metadata.shape[1] != untransformed_sample_metadata.shape[1] and sample_metadata.shape[0] == \
-                    untransformed_sample_metadata.shape[0]:
-                # rows match but not columns, so iterate over the columns and add them
-                p = 0
-                while p < len(untransformed_sample_metadata.columns):
-                    column = untransformed_sample_metadata.columns[p]
-                    if column not in sample_metadata.columns:
-                        sample_metadata[column] = untransformed_sample_metadata[column]
-                    p = p + 1
-            elif sample_metadata.shape != untransformed_sample_metadata.shape:
-                # rows and/or columns do not match, so iterate over them all
-                if 'Sample File Name' in sample_metadata.columns and 'Sample File Name' in sample_metadata.columns:
-                    lookup_key = 'Sample File Name'
-                elif 'Sample ID' in sample_metadata.columns and 'Sample ID' in sample_metadata.columns:
-                    lookup_key = 'Sample ID'
-                else:
-                    lookup_key = None
-
-                # add the missing columns
-                missing_columns = []
-                p = 0
-                while p < len(untransformed_sample_metadata.columns):
-                    column = untransformed_sample_metadata.columns[p]
-                    if column not in sample_metadata.columns:
-                        sample_metadata[column] = None
-                        missing_columns.append(column)
-                    p = p + 1
-
-                # make the column order the same
-                sample_metadata = sample_metadata[untransformed_sample_metadata.columns]
-
-                if lookup_key:
-                    i = 0
-                    while i < sample_metadata.shape[0]:
-                        # upstream_data['untransformed_sample_metadata']
-                        try:
-                            # try and match the row index. if it matches, overwrite the sample metadata missing columns
-                            untransformed_row_index = \
-                            np.where(untransformed_sample_metadata.loc[:, lookup_key] == sample_metadata.loc[
-                                str(i), lookup_key])[0][0]
-                            sample_metadata.loc[str(i), missing_columns] = untransformed_sample_metadata.loc[
-                                str(untransformed_row_index), missing_columns]
-                        except Exception as err:
-                            # if it doesn't exist, do nothing!
-                            pass
-                        i = i + 1
-            self.data['sample_metadata'] = utils.convert_to_json_safe(self.clean_data_for_jsonb(sample_metadata.to_dict()))
-        else:
-            self.logger.info("Did not find upstream sample metadata!")
+        self.logger.info("Did not find upstream sample metadata!")
 
     def load_data_from_query_factory(self):
 
@@ -413,17 +377,10 @@ class AnalysisTask(Task):
        #         combined_dataframe.loc[:,colname] = combined_dataframe.loc[:,colname].dt.strftime('%Y-%m-%d %H:%M:%S')
        # combined_dataframe = combined_dataframe.where(pd.notnull(combined_dataframe), None)
        # self.data['combined_data'] = combined_dataframe.to_dict()
-        for colname, colvalue in sample_metadata.iteritems():
-            if np.issubdtype(sample_metadata.dtypes[colname],np.datetime64):
-                sample_metadata.loc[:,colname] = sample_metadata.loc[:,colname].dt.strftime('%Y-%m-%d %H:%M:%S')
-        sample_metadata = sample_metadata.where(pd.notnull(sample_metadata), None)
-        self.data['sample_metadata'] = sample_metadata.to_dict()
-        self.data['intensity_data'] = intensity_data.tolist()
-        for colname, colvalue in feature_metadata.iteritems():
-            if np.issubdtype(feature_metadata.dtypes[colname],np.datetime64):
-                feature_metadata.loc[:,colname] = feature_metadata.loc[:,colname].dt.strftime('%Y-%m-%d %H:%M:%S')
-        feature_metadata = feature_metadata.where(pd.notnull(feature_metadata), None)
-        self.data['feature_metadata'] = feature_metadata.to_dict()
+        # Stored natively, see phenomedb.task_data.TaskData
+        self.data['sample_metadata'] = sample_metadata
+        self.data['intensity_data'] = np.asarray(intensity_data)
+        self.data['feature_metadata'] = feature_metadata
 
 
     def is_unique(self, colvalue):
@@ -445,7 +402,9 @@ class AnalysisTask(Task):
             self.task_run.args = args
             self.db_session.flush()
 
-        self.results = utils.convert_to_json_safe(self.clean_data_for_jsonb(self.results))
+        # TaskData results are cached natively, see phenomedb.task_data.TaskData
+        if not isinstance(self.results,TaskData):
+            self.results = utils.convert_to_json_safe(self.clean_data_for_jsonb(self.results))
         self.saved_output = self.results
         self.output = self.results
 
@@ -453,7 +412,7 @@ class AnalysisTask(Task):
         if self.task_run_id and not self.task_run:
             self.task_run = self.db_session.query(TaskRun).filter(TaskRun.id == self.task_run_id).first()
         if self.task_run:
-            self.cache.set(self.task_run.get_task_data_cache_key(), utils.convert_to_json_safe(self.clean_data_for_jsonb(self.data)), ex=86400)
+            self.cache.set(self.task_run.get_task_data_cache_key(), self.data, ex=86400)
 
         self.logger.info("Done")
 
@@ -527,7 +486,7 @@ class RunPCA(AnalysisTask):
         """Run the PCA analysis using the specified options.
         """
 
-        intensity_data = np.matrix(self.data['intensity_data'])
+        intensity_data = np.asmatrix(self.data.get_array('intensity_data'))
 
         self.max_components = min(intensity_data.shape)
         self.logger.info("Updated max components to min(intensity_data.shape) %s" % self.max_components)
@@ -559,7 +518,7 @@ class RunPCA(AnalysisTask):
         sorted_loadings_features = []
         sorted_loadings_feature_ids = []
         sorted_loadings = []
-        feature_metadata = pd.DataFrame.from_dict(self.data['feature_metadata'])
+        feature_metadata = self.data.get_dataframe('feature_metadata')
         loadings_feature_names = feature_metadata['feature_name'].tolist()
         loadings_feature_ids = feature_metadata['feature_id'].tolist()
         component = 0
@@ -594,6 +553,8 @@ class RAnalysisTask(AnalysisTask):
     r_script_path = None
     #r_script_folder = config['R']['script_directory']
     r_template = None
+    # 'pool' or 'subprocess', None for the config R backend
+    r_backend = None
     for_npyc = False
 
     def __init__(self,query_factory=None,saved_query_id=None,username=None,task_run_id=None,scaling=None,transform=None,db_env=None,db_session=None,execution_date=None,
@@ -737,6 +698,20 @@ class RAnalysisTask(AnalysisTask):
 
         return {}
 
+    def write_input_frame(self,name,dataframe):
+        """Write an input frame for the R script to the job folder as Feather. Read it in the template with
+        phenomedb_read_frame().
+
+        :param name: The name of the frame, ie 'sample_metadata'.
+        :type name: str
+        :param dataframe: The frame, or a 2D array.
+        :type dataframe: :class:`pandas.DataFrame` or :class:`numpy.ndarray`
+        :return: The file path.
+        :rtype: str
+        """
+
+        return r_bridge.write_frame(dataframe,self.job_folder + name + ".feather")
+
     def write_out_script(self):
 
         f = open(self.r_script_path, "w")
@@ -747,10 +722,11 @@ class RAnalysisTask(AnalysisTask):
 
         try:
             self.logger.info('Running R script: %s' % self.r_script_path)
-            #cmd = ['R', 'CMD', 'BATCH','--no-save', self.r_script_path]
-            cmd = ['Rscript','--no-save', self.r_script_path]
-            x = subprocess.check_output(cmd,universal_newlines=True,cwd=self.job_folder)
-            self.logger.info(x)
+            if not self.run_R_script_on_pool():
+                #cmd = ['R', 'CMD', 'BATCH','--no-save', self.r_script_path]
+                cmd = ['Rscript','--no-save', self.r_script_path]
+                x = subprocess.check_output(cmd,universal_newlines=True,cwd=self.job_folder)
+                self.logger.info(x)
             self.r_output = self.read_R_out_file()
             self.args['r_output'] = self.r_output.replace("'\n'","").replace("'","")
             self.logger.info(self.r_output)
@@ -762,26 +738,47 @@ class RAnalysisTask(AnalysisTask):
             self.output = "R script failed: %s %s %s" % (self.r_script_path,err,self.r_output)
             raise Exception("R script failed: %s %s %s" % (self.r_script_path,err,self.r_output))
 
+    def run_R_script_on_pool(self):
+        """Run the R script on the R worker pool server, if the R backend is 'pool' and the server is running.
+
+        :return: True if the script was run on the pool, False if it has to be run with Rscript.
+        :rtype: bool
+        """
+
+        backend = self.r_backend if self.r_backend else config['R'].get('backend','subprocess')
+        if backend != 'pool':
+            return False
+
+        response = r_worker_pool.run_script(self.r_script_path,self.job_folder,self.r_script_path + "out")
+        if response is None:
+            self.logger.info('R worker pool not running, running the R script with Rscript')
+            return False
+
+        self.logger.info('R script ran on the R worker pool in %.2fs' % response['seconds'])
+        if response['status'] != 'success':
+            raise Exception(response['message'])
+        return True
+
     def load_results(self):
+        """Load the results of the R script: results.json, plus the frames it wrote as Feather. A data frame or
+        matrix output is the results itself, and the data frames of a list output are added by name.
+        """
 
         results_file_path = self.output_folder + "results.json"
         if os.path.exists(results_file_path):
-            with open(results_file_path) as json_file:
-                results = json.load(json_file)
-                if isinstance(results,list) and len(results) == 1:
-                    if isinstance(results[0],str):
-                        self.results = json.loads(results[0])
-                    else:
-                        self.results = results[0]
-                else:
-                    if isinstance(results,str):
-                        self.results = json.loads(results)
-                    else:
-                        self.results = results
+            self.results = r_bridge.read_results_json(results_file_path)
         else:
             self.logger.info("No results? %s" % results_file_path)
             self.results = None
 
+        frames = r_bridge.read_output_frames(self.output_folder)
+        if 'output' in frames:
+            self.results = frames['output']
+        elif len(frames) > 0:
+            if not isinstance(self.results,dict):
+                self.results = {}
+            self.results.update(frames)
+
     def read_R_out_file(self):
 
 
@@ -1167,33 +1164,28 @@ class RunPCPR2(RAnalysisTask):
 
         # 1. Write out data to /tmp/phenomedb/R_jobs/<self.job_name>/input/
 
-        intensity_file_path = self.job_folder + "intensity.csv"
-        #pd.DataFrame(self.query_factory.intensity_data).to_csv(intensity_file_path,header=False,index=False)
-        intensity_data = np.matrix(self.data['intensity_data'])
-        pd.DataFrame(intensity_data).to_csv(intensity_file_path,index=False)
+        intensity_data = self.data.get_array('intensity_data')
+        intensity_file_path = self.write_input_frame('intensity',intensity_data)
 
-        sample_metadata_file_path = self.job_folder + "sample_metadata.csv"
-        #self.query_factory.dataframes[self.sample_metadata_key].to_csv(sample_metadata_file_path,index=False)
-        sample_metadata = dict(self.data['sample_metadata'])
+        sample_metadata = self.data.get_dataframe('sample_metadata')
 
         # Strip out the unwanted columns
-
-        for colname in self.data['sample_metadata'].keys():
+        columns_to_drop = []
+        for colname in sample_metadata.columns:
             if colname in self.columns_to_include \
                 or (re.search('h_metadata::', colname) and self.include_harmonised_metadata) \
                     or (re.search('metadata::', colname) and self.include_metadata):
                 pass
             elif colname not in self.columns_to_include or colname in self.columns_to_exclude:
-                del sample_metadata[colname]
+                columns_to_drop.append(colname)
 
-            if colname in sample_metadata.keys() and self.exclude_one_factor_columns:
-                series = pd.Series(self.data['sample_metadata'][colname])
-                if self.is_unique(series.values):
-                    del sample_metadata[colname]
+            if colname not in columns_to_drop and self.exclude_one_factor_columns:
+                if self.is_unique(sample_metadata[colname].values):
+                    columns_to_drop.append(colname)
 
-        self.stripped_sample_metadata = pd.DataFrame.from_dict(sample_metadata)
+        self.stripped_sample_metadata = sample_metadata.drop(columns=columns_to_drop)
 
-        self.stripped_sample_metadata.to_csv(sample_metadata_file_path, index=False)
+        sample_metadata_file_path = self.write_input_frame('sample_metadata',self.stripped_sample_metadata)
 
         # 2. Load vars into template_data
 
@@ -1205,26 +1197,9 @@ class RunPCPR2(RAnalysisTask):
 
     def load_results(self):
 
-        #self.results = self.load_tabular_file(self.output_folder + 'results.json').to_dict()
-
-        results_file_path = self.output_folder + "results.json"
-        if os.path.exists(results_file_path):
-            with open(results_file_path) as json_file:
-                results = json.load(json_file)
-                if isinstance(results,list) and len(results) == 1:
-                    if isinstance(results[0],str):
-                        self.results = json.loads(results[0])
-                    else:
-                        self.results = results[0]
-                else:
-                    if isinstance(results,str):
-                        self.results = json.loads(results)
-                    else:
-                        self.results = results
-                self.add_Z_order()
-        else:
-            self.logger.info("No results? %s" % results_file_path)
-            self.results = None
+        super().load_results()
+        if self.results is not None:
+            self.add_Z_order()
 
     def add_Z_order(self):
 
@@ -1247,9 +1222,10 @@ class NPYCTask(AnalysisTask):
         self.run_analysis()
 
     def load_npyc_dataset(self):
-        sample_metadata = pd.DataFrame.from_dict(self.data['sample_metadata'])
-        intensity_data = np.matrix(self.data['intensity_data'])
-        feature_metadata = pd.DataFrame.from_dict(self.data['feature_metadata'])
+        sample_metadata = self.data.get_dataframe('sample_metadata').copy()
+        # nPYc changes the intensity data in place
+        intensity_data = np.asmatrix(self.data.get_array('intensity_data',writable=True))
+        feature_metadata = self.data.get_dataframe('feature_metadata').copy()
         self.npyc_dataset = self.query_factory.load_npyc_dataset(sample_metadata,feature_metadata,intensity_data,self.assay_platform)
 
 class RunNPYCReport(NPYCTask):
@@ -1446,8 +1422,8 @@ class RunWilcoxonRankTest(RAnalysisTask):
 
     def method_specific_steps(self):
 
-        query_one_features = pd.DataFrame.from_dict(self.data['feature_metadata'])
-        query_one_intensities = np.matrix(self.data['intensity_data'])
+        query_one_features = self.data.get_dataframe('feature_metadata')
+        query_one_intensities = np.asmatrix(self.data.get_array('intensity_data'))
         query_one_dataframe = pd.DataFrame(columns=query_one_features['harmonised_annotation_id'])
         i = 0
         while i < query_one_features.shape[0]:
@@ -1468,10 +1444,8 @@ class RunWilcoxonRankTest(RAnalysisTask):
             query_two_dataframe[query_two_features['harmonised_annotation_id']] = query_two_intensities[i,:]
             i = i + 1
 
-        self.query_one_file_path = self.job_folder + "query_one.csv"
-        query_one_dataframe.to_csv(self.query_one_file_path, index=False)
-        self.query_two_file_path = self.job_folder + "query_two.csv"
-        query_two_dataframe.to_csv(self.query_two_file_path, index=False)
+        self.query_one_file_path = self.write_input_frame('query_one',query_one_dataframe)
+        self.query_two_file_path = self.write_input_frame('query_two',query_two_dataframe)
 
         template_data = {'query_one_file_path': self.query_one_file_path,
                          'query_two_file_path': self.query_one_file_path}
@@ -1499,6 +1473,12 @@ class RunMWAS(RAnalysisTask):
     :type model_Y_max: boolean
     :param bootstrap: Whether to save the models as well as the summary statistics/coefficients, default False
     :type bootstrap: boolean
+    :param backend: Which MWAS engine to use, 'R' (MWASTools) or 'python' (vectorised, linear, pearson and spearman only), default 'R'
+    :type backend: str
+    :param bootstrap_resamples: The number of bootstrap resamples of the python backend, default 1000
+    :type bootstrap_resamples: int
+    :param max_workers: The number of processes the python backend bootstraps with, defaults to None (the number of CPUs)
+    :type max_workers: int, optional
     :param query_factory: QueryFactory, a handle to the :class:`phenomedb.query_factory.QueryFactory` object that defined the cohort, defaults to None
     :type query_factory: :class:`phenomedb.query_factory.QueryFactory`, optional
     :param saved_query_model: The output model of the query, defaults to 'AnnotatedFeature'
@@ -1581,7 +1561,8 @@ class RunMWAS(RAnalysisTask):
     def __init__(self,query_factory=None,saved_query_id=None,username=None,task_run_id=None,comment=None,model_Y_variable=None,
                  model_X_variables=None,reload_cache=False,method='linear',correction_type=None,scaling=None,transform=None,upstream_task_run_id=None,pipeline_run_id=None,
                  include_harmonised_metadata=True,db_env=None,db_session=None,execution_date=None,multiple_correction='BH',features_to_include=None,
-                 bootstrap=False,save_models=False,exclude_features_not_in_all_projects=True,harmonise_annotations=True,model_Y_ci=None,model_Y_min=None,model_Y_max=None):
+                 bootstrap=False,save_models=False,exclude_features_not_in_all_projects=True,harmonise_annotations=True,model_Y_ci=None,model_Y_min=None,model_Y_max=None,
+                 backend='R',bootstrap_resamples=1000,max_workers=None):
 
         if model_X_variables and isinstance(model_X_variables,list):
             columns_to_include = model_X_variables
@@ -1615,18 +1596,40 @@ class RunMWAS(RAnalysisTask):
         self.args['model_Y_max'] = model_Y_max
         self.features_to_include = features_to_include
         self.args['features_to_include'] = features_to_include
+
+        if backend not in ['R','python']:
+            raise Exception("Unknown MWAS backend %s, use R or python" % backend)
+        if backend == 'python' and method not in mwas.METHODS:
+            raise Exception("MWAS method %s is not supported by the python backend, use one of %s" % (method,mwas.METHODS))
+        self.backend = backend
+        self.args['backend'] = backend
+        self.bootstrap_resamples = int(bootstrap_resamples)
+        self.args['bootstrap_resamples'] = bootstrap_resamples
+        self.max_workers = int(max_workers) if max_workers else None
+        self.args['max_workers'] = max_workers
         self.get_class_name(self)
 
+    def run_analysis(self):
 
-    def method_specific_steps(self):
+        if self.backend == 'python':
+            sample_metadata, mwas_data = self.prepare_mwas_data()
+            self.results = mwas.run_mwas(mwas_data.to_numpy(),sample_metadata,list(mwas_data.columns),self.model_Y_variable,
+                                         model_X_variables=self.model_X_variables,method=self.method,
+                                         multiple_correction=self.multiple_correction,bootstrap=self.bootstrap,
+                                         bootstrap_resamples=self.bootstrap_resamples,max_workers=self.max_workers)
+        else:
+            super().run_analysis()
 
-        # 1. Write out data to /tmp/phenomedb/R_jobs/<self.job_name>/<files>
+    def prepare_mwas_data(self):
+        """Filter the samples to the Y range and the features to features_to_include, and build the MWAS data.
 
-        # 2. Load vars into template_data
+        :return: The sample metadata, and the MWAS data (samples x features, with the harmonised_annotation_ids as columns).
+        :rtype: tuple
+        """
 
-        feature_metadata = pd.DataFrame.from_dict(self.data['feature_metadata'])
-        sample_metadata = pd.DataFrame.from_dict(self.data['sample_metadata'])
-        intensity_data = np.matrix(self.data['intensity_data'])
+        feature_metadata = self.data.get_dataframe('feature_metadata')
+        sample_metadata = self.data.get_dataframe('sample_metadata')
+        intensity_data = np.asmatrix(self.data.get_array('intensity_data'))
         Y_min = None
         Y_max = None
         if self.model_Y_min is not None and utils.is_number(self.model_Y_min):
@@ -1646,61 +1649,43 @@ class RunMWAS(RAnalysisTask):
         elif Y_max is not None and Y_min is None:
             Y_min = sample_metadata[self.model_Y_variable].min()
         if Y_min is not None and Y_max is not None:
-            samples_to_drop = []
-            i = 0
-            while i < sample_metadata.shape[0]:
-                Y = sample_metadata.loc[i,self.model_Y_variable]
-                if Y < Y_min or Y > Y_max:
-                    samples_to_drop.append(i)
-                i = i + 1
+            Y = sample_metadata.loc[:,self.model_Y_variable]
+            samples_to_drop = list(sample_metadata.index[((Y < Y_min) | (Y > Y_max)).to_numpy()])
             self.logger.info("Dropping %s samples that outside min and max range %s %s" % (len(samples_to_drop),Y_min,Y_max))
             sample_metadata = sample_metadata.drop(index=samples_to_drop)
             sample_metadata.reset_index(drop=True, inplace=True)
             intensity_data = np.delete(intensity_data, samples_to_drop, 0)
-            self.data['sample_metadata'] = sample_metadata.to_dict()
-
-        mwas_data = pd.DataFrame()
-        mwas_data.loc[:, 'Sample'] = sample_metadata.loc[:, 'Sample ID']
+            self.data['sample_metadata'] = sample_metadata
+
+        harmonised_annotation_ids = feature_metadata.loc[:,'harmonised_annotation_id']
+        if self.features_to_include is None:
+            features_included = np.ones(feature_metadata.shape[0],dtype=bool)
+        elif isinstance(self.features_to_include, list):
+            features_included = (harmonised_annotation_ids.isin(self.features_to_include)
+                                 | harmonised_annotation_ids.astype(str).isin(self.features_to_include)).to_numpy()
+        else:
+            features_included = np.zeros(feature_metadata.shape[0],dtype=bool)
 
-        features_to_drop = []
-        feature_row_index = 0
-        while feature_row_index < feature_metadata.shape[0]:
+        intensity_data = np.asarray(intensity_data)[:,features_included]
+        mwas_data = pd.DataFrame(intensity_data,columns=harmonised_annotation_ids[features_included].to_numpy())
 
-            if str(feature_row_index) in feature_metadata.index:
-                feature_index = str(feature_row_index)
-            else:
-                feature_index = feature_row_index
-
-            if self.features_to_include is None \
-                or (isinstance(self.features_to_include, list) \
-                and (feature_metadata.loc[feature_index,'harmonised_annotation_id'] in self.features_to_include \
-                    or str(feature_metadata.loc[feature_index,'harmonised_annotation_id']) in self.features_to_include)):
-                mwas_data.insert(len(mwas_data.columns),
-                                 feature_metadata.loc[feature_index, 'harmonised_annotation_id'],
-                                 intensity_data[:, feature_row_index])
-            else:
-                #feature_metadata = sample_metadata.drop(index=samples_to_drop)
-                #sample_metadata.reset_index(drop=True, inplace=True)
-                #intensity_data = np.delete(intensity_data, samples_to_drop, 0)
-                features_to_drop.append(feature_index)
-            feature_row_index = feature_row_index + 1
-
-        feature_metadata = feature_metadata.drop(index=features_to_drop)
-        feature_metadata.reset_index(drop=True, inplace=True)
-        intensity_data = np.delete(intensity_data, features_to_drop, 1)
+        features_to_drop = list(feature_metadata.index[~features_included])
+        feature_metadata = feature_metadata.loc[features_included].reset_index(drop=True)
         self.logger.info("Dropped the following feature indexes: %s" % features_to_drop)
-        self.data['intensity_data'] = intensity_data.tolist()
-        self.data['feature_metadata'] = feature_metadata.to_dict()
+        self.data['intensity_data'] = intensity_data
+        self.data['feature_metadata'] = feature_metadata
 
-        mwas_data = mwas_data.drop('Sample', axis=1)
+        return sample_metadata, mwas_data
 
-        #self.data['intensity_data'] = intensity_data.tolist()
-        #self.data['feature_metadata'] = feature_metadata.tolist()
+    def method_specific_steps(self):
 
-        self.sample_metadata_file_path = self.job_folder + "sample_metadata.csv"
-        sample_metadata.to_csv(self.sample_metadata_file_path, index=False)
-        self.data_file_path = self.job_folder + "mwas_data.csv"
-        mwas_data.to_csv(self.data_file_path, index=False)
+        # 1. Write out data to /tmp/phenomedb/R_jobs/<self.job_name>/<files>
+
+        sample_metadata, mwas_data = self.prepare_mwas_data()
+        self.sample_metadata_file_path = self.write_input_frame('sample_metadata',sample_metadata)
+        self.data_file_path = self.write_input_frame('mwas_data',mwas_data)
+
+        # 2. Load vars into template_data
 
         template_data = {'model_Y_variable': self.model_Y_variable,
                          'model_X_variables': self.model_X_variables,
@@ -1721,11 +1706,14 @@ class RunMWAS(RAnalysisTask):
 
         self.logger.info("Saving results.....")
 
-        results = {'mwas_results':self.results['mwastable']}
-        if 'mwasestimates' in self.results.keys() or '':
+        # mwastable is read from Feather, so the results are kept as TaskData
+        results = TaskData({'mwas_results':self.results['mwastable']})
+        if 'mwasestimates' in self.results.keys():
             results['mwas_estimates'] = self.results['mwasestimates']
         if 'mwassummaries' in self.results.keys():
             results['mwas_summaries'] = self.results['mwassummaries']
+        if 'mwasbootstraps' in self.results.keys():
+            results['mwas_bootstraps'] = self.results['mwasbootstraps']
         self.results = results
         super().save_results()
         self.logger.info("Save complete...!")
\ No newline at end of file
@@ -0,0 +1,419 @@
+"""Feature annotation resolver. Builds the feature metadata of the feature: columns of a combined dataframe.
+
+All the FeatureMetadata or HarmonisedAnnotations, their Compounds, external database references and classes for a
+set of columns are loaded in a handful of IN queries, and the feature metadata is built as one DataFrame, rather than
+querying and appending once per column.
+
+The compound fields of HarmonisedAnnotations rarely change, so they are memoised in the cache, as one
+harmonised_annotation_id -> fields dict under FeatureAnnotation::<hash of the fields and class types>, read and written
+once per resolve, and shared across SavedQueries.
+Tasks, views and API endpoints that write to the tables in :data:`CACHE_SOURCE_MODELS` call :func:`delete_cache`.
+"""
+
+import hashlib
+import json
+import logging
+from collections import OrderedDict
+from enum import Enum
+
+import pandas as pd
+from sqlalchemy.orm import joinedload
+
+import phenomedb.utilities as utils
+from phenomedb.exceptions import UnharmonisedAnnotationException
+from phenomedb.models import Annotation, AnnotationCompound, Assay, Compound, CompoundClass, CompoundClassCompound, \
+    CompoundExternalDB, ExternalDB, FeatureDataset, FeatureMetadata, HarmonisedAnnotation
+
+CACHE_KEY_PREFIX = 'FeatureAnnotation::'
+
+#: The models the memoised compound fields are built from
+CACHE_SOURCE_MODELS = (AnnotationCompound, Compound, CompoundClass, CompoundClassCompound, CompoundExternalDB, ExternalDB)
+
+#: Compound field -> Compound attribute. Any other compound field is an ExternalDB name
+COMPOUND_FIELDS = OrderedDict([('Compound Name', 'name'),
+                               ('Chemical Formula', 'chemical_formula'),
+                               ('Monoisotopic Mass', 'monoisotopic_mass'),
+                               ('InChI', 'inchi'),
+                               ('InChI Key', 'inchi_key'),
+                               ('SMILES', 'smiles'),
+                               ('IUPAC', 'iupac')])
+
+#: CompoundClass attribute -> column suffix
+COMPOUND_CLASS_LEVELS = OrderedDict([('kingdom', ' Kingdom'),
+                                     ('category', ' Category'),
+                                     ('main_class', ' Main Class'),
+                                     ('sub_class', ' Sub Class'),
+                                     ('direct_parent', ' Direct Parent')])
+
+#: FeatureMetadata attributes that are not copied into the feature metadata
+FEATURE_METADATA_EXCLUDED_FIELDS = ['annotation',
+                                    'annotation_parameters',
+                                    'feature_dataset',
+                                    'feature_metadata',
+                                    'feature_metadatas',
+                                    'quantification_type',
+                                    'calibration_method']
+
+
+def get_quantification_type(assay):
+    """Get the quantification type of an Assay as a string.
+
+    :param assay: The Assay.
+    :type assay: :class:`phenomedb.models.Assay`
+    :return: 'relative', 'absolute' or 'unknown'
+    :rtype: str
+    """
+
+    if assay.quantification_type in [Assay.QuantificationType.relative, Assay.QuantificationType.relative.value]:
+        return 'relative'
+    elif assay.quantification_type in [Assay.QuantificationType.absolute, Assay.QuantificationType.absolute.value]:
+        return 'absolute'
+    else:
+        return 'unknown'
+
+
+def get_value(value):
+    """Get the value of an Enum, or the value itself.
+
+    :param value: The value.
+    :type value: object
+    :return: The value.
+    :rtype: object
+    """
+
+    if isinstance(value, Enum):
+        return value.value
+    else:
+        return value
+
+
+def delete_cache(cache):
+    """Delete the memoised compound fields of every HarmonisedAnnotation.
+
+    :param cache: The cache.
+    :type cache: :class:`phenomedb.cache.Cache`
+    """
+
+    cache.delete_keys_by_regex('^' + CACHE_KEY_PREFIX)
+
+
+def delete_cache_if_source(cache, table_class):
+    """Delete the memoised compound fields if a model is one they are built from.
+
+    :param cache: The cache.
+    :type cache: :class:`phenomedb.cache.Cache`
+    :param table_class: The model written to.
+    :type table_class: class
+    """
+
+    if table_class in CACHE_SOURCE_MODELS:
+        delete_cache(cache)
+
+
+class FeatureAnnotationResolver:
+    """Resolves feature: column names to feature metadata.
+
+    :param db_session: The db_session.
+    :type db_session: :class:`sqlalchemy.orm.Session`
+    :param compound_fields_to_include: The compound fields to include, Compound attributes or ExternalDB names.
+    :type compound_fields_to_include: list
+    :param compound_class_types_to_include: The CompoundClass types to include.
+    :type compound_class_types_to_include: list
+    :param cache: The cache to memoise the compound fields in, defaults to None (not memoised)
+    :type cache: :class:`phenomedb.cache.Cache`, optional
+    :param logger: The logger, defaults to None
+    :type logger: :class:`logging.Logger`, optional
+    :param chunk_size: The maximum number of ids per IN query, defaults to 10000
+    :type chunk_size: int, optional
+    """
+
+    def __init__(self, db_session, compound_fields_to_include, compound_class_types_to_include, cache=None,
+                 logger=None, chunk_size=10000):
+        self.db_session = db_session
+        self.compound_fields_to_include = list(compound_fields_to_include)
+        self.compound_class_types_to_include = list(compound_class_types_to_include)
+        self.cache = cache
+        self.logger = logger if logger is not None else logging.getLogger(__name__)
+        self.chunk_size = chunk_size
+        options = json.dumps([self.compound_fields_to_include, self.compound_class_types_to_include])
+        self.options_hash = hashlib.md5(options.encode('utf-8')).hexdigest()
+
+    def get_cache_key(self):
+        """Get the cache key of the memoised compound fields, for the compound fields and class types.
+
+        :return: The cache key.
+        :rtype: str
+        """
+
+        return '%s%s' % (CACHE_KEY_PREFIX, self.options_hash)
+
+    def chunk(self, ids):
+        """Split ids into chunks of at most chunk_size.
+
+        :param ids: The ids.
+        :type ids: list
+        :return: The chunks.
+        :rtype: generator
+        """
+
+        ids = list(ids)
+        for start in range(0, len(ids), self.chunk_size):
+            yield ids[start:start + self.chunk_size]
+
+    def resolve(self, colnames, harmonise_annotations=False):
+        """Resolve feature: column names to feature metadata.
+
+        Columns without a harmonised annotation, when harmonise_annotations is True, are logged and skipped.
+
+        :param colnames: The feature: column names.
+        :type colnames: list
+        :param harmonise_annotations: Whether the columns are HarmonisedAnnotations, defaults to False
+        :type harmonise_annotations: bool, optional
+        :raises Exception: If a FeatureMetadata or HarmonisedAnnotation does not exist.
+        :return: The resolved column names, and the feature metadata, one row per resolved column.
+        :rtype: tuple(list, :class:`pandas.DataFrame`)
+        """
+
+        breakdowns = []
+        for colname in colnames:
+            try:
+                feature_metadata_id, harmonised_annotation_id, assay, annotation_method, cpd_name, version, unit = \
+                    utils.breakdown_annotation_id(colname, harmonise_annotations=harmonise_annotations)
+            except UnharmonisedAnnotationException as err:
+                self.logger.exception(err)
+                continue
+            breakdowns.append({'feature_id': colname,
+                               'feature_metadata_id': int(feature_metadata_id) if feature_metadata_id else None,
+                               'harmonised_annotation_id': int(harmonised_annotation_id) if harmonised_annotation_id else None,
+                               'assay': assay,
+                               'annotation_method': annotation_method,
+                               'version': version,
+                               'unit': unit})
+
+        resolved_colnames = [breakdown['feature_id'] for breakdown in breakdowns]
+        if len(breakdowns) == 0:
+            return resolved_colnames, pd.DataFrame()
+
+        columns = pd.DataFrame(breakdowns)
+
+        if harmonise_annotations:
+            annotation_rows = self.build_harmonised_annotation_rows(columns['harmonised_annotation_id'].unique().tolist())
+            feature_metadata = columns.drop(columns=['feature_metadata_id', 'version']) \
+                .merge(annotation_rows, on='harmonised_annotation_id', how='left')
+            feature_metadata['_compound_key'] = feature_metadata['harmonised_annotation_id'].astype(float)
+        else:
+            if columns['feature_metadata_id'].isnull().any():
+                raise Exception("Expected a FeatureMetadata ID %s" %
+                                columns.loc[columns['feature_metadata_id'].isnull(), 'feature_id'].tolist())
+            annotation_rows = self.build_feature_metadata_rows(columns['feature_metadata_id'].astype(int).unique().tolist())
+            feature_metadata = columns.drop(columns=['harmonised_annotation_id']) \
+                .merge(annotation_rows, on='feature_metadata_id', how='left')
+            if 'annotation_id' in feature_metadata.columns:
+                feature_metadata['annotation_version'] = feature_metadata['version'].where(
+                    feature_metadata['annotation_id'].notnull())
+            feature_metadata = feature_metadata.drop(columns=['version'])
+
+        compound_keys = feature_metadata['_compound_key'].dropna().astype(int).unique().tolist()
+        compound_records = self.load_compound_records(compound_keys)
+        if len(compound_records) > 0:
+            compound_rows = pd.DataFrame.from_dict(compound_records, orient='index')
+            compound_rows['_compound_key'] = compound_rows.index.astype(float)
+            feature_metadata = feature_metadata.merge(compound_rows, on='_compound_key', how='left')
+
+        feature_metadata = feature_metadata.drop(columns=['_compound_key'])
+        feature_metadata['Feature Name'] = feature_metadata['feature_name']
+
+        return resolved_colnames, feature_metadata
+
+    def build_harmonised_annotation_rows(self, harmonised_annotation_ids):
+        """Load HarmonisedAnnotations and build their rows.
+
+        :param harmonised_annotation_ids: The HarmonisedAnnotation ids.
+        :type harmonised_annotation_ids: list
+        :raises Exception: If a HarmonisedAnnotation does not exist.
+        :return: One row per HarmonisedAnnotation.
+        :rtype: :class:`pandas.DataFrame`
+        """
+
+        rows = []
+        for ids in self.chunk(harmonised_annotation_ids):
+            harmonised_annotations = self.db_session.query(HarmonisedAnnotation) \
+                .options(joinedload(HarmonisedAnnotation.assay)) \
+                .filter(HarmonisedAnnotation.id.in_(ids)).all()
+            for harmonised_annotation in harmonised_annotations:
+                rows.append({'harmonised_annotation_id': harmonised_annotation.id,
+                             'feature_name': harmonised_annotation.cpd_name,
+                             'cpd_id': harmonised_annotation.cpd_id,
+                             'annotated_by': harmonised_annotation.annotated_by,
+                             'confidence_score': harmonised_annotation.confidence_score,
+                             'annotation_multi_compound_operator': get_value(harmonised_annotation.multi_compound_operator),
+                             'QuantificationType': get_quantification_type(harmonised_annotation.assay)})
+
+        missing = set(harmonised_annotation_ids) - set([row['harmonised_annotation_id'] for row in rows])
+        if len(missing) > 0:
+            raise Exception("Unknown HarmonisedAnnotation ids %s" % sorted(missing))
+
+        return pd.DataFrame(rows)
+
+    def build_feature_metadata_rows(self, feature_metadata_ids):
+        """Load FeatureMetadatas, with their Annotations and Assays, and build their rows.
+
+        :param feature_metadata_ids: The FeatureMetadata ids.
+        :type feature_metadata_ids: list
+        :raises Exception: If a FeatureMetadata does not exist.
+        :return: One row per FeatureMetadata.
+        :rtype: :class:`pandas.DataFrame`
+        """
+
+        fields = [column.key for column in FeatureMetadata.__table__.columns
+                  if column.key not in FEATURE_METADATA_EXCLUDED_FIELDS]
+
+        rows = []
+        for ids in self.chunk(feature_metadata_ids):
+            feature_metadatas = self.db_session.query(FeatureMetadata) \
+                .options(joinedload(FeatureMetadata.feature_dataset).joinedload(FeatureDataset.assay),
+                         joinedload(FeatureMetadata.annotation).joinedload(Annotation.harmonised_annotation)) \
+                .filter(FeatureMetadata.id.in_(ids)).all()
+            for feature_metadata in feature_metadatas:
+                row = {}
+                for field in fields:
+                    value = getattr(feature_metadata, field)
+                    if value is not None:
+                        row[field] = get_value(value)
+                row['feature_metadata_id'] = feature_metadata.id
+                row['feature_name'] = feature_metadata.feature_name
+                if feature_metadata.rt_average is not None and feature_metadata.mz_average is not None:
+                    row['rt'] = feature_metadata.rt_average
+                    row['mz'] = feature_metadata.mz_average
+                row['quantification_type'] = get_quantification_type(feature_metadata.feature_dataset.assay)
+                if feature_metadata.calibration_method is not None:
+                    row['calibration_method'] = get_value(feature_metadata.calibration_method)
+                annotation = feature_metadata.annotation
+                if annotation:
+                    row['cpd_name'] = annotation.cpd_name
+                    row['cpd_id'] = annotation.cpd_id
+                    row['annotation_id'] = annotation.id
+                    row['annotated_by'] = annotation.annotated_by
+                    row['confidence_score'] = annotation.confidence_score
+                    row['annotation_multi_compound_operator'] = get_value(annotation.multi_compound_operator)
+                    if annotation.harmonised_annotation:
+                        row['harmonised_cpd_name'] = annotation.harmonised_annotation.cpd_name
+                        row['_compound_key'] = annotation.harmonised_annotation.id
+                rows.append(row)
+
+        missing = set(feature_metadata_ids) - set([row['feature_metadata_id'] for row in rows])
+        if len(missing) > 0:
+            raise Exception("Unknown FeatureMetadata ids %s" % sorted(missing))
+
+        feature_metadata = pd.DataFrame(rows)
+        if '_compound_key' not in feature_metadata.columns:
+            feature_metadata['_compound_key'] = None
+        feature_metadata['_compound_key'] = feature_metadata['_compound_key'].astype(float)
+        return feature_metadata
+
+    def load_compound_records(self, harmonised_annotation_ids):
+        """Get the compound fields of HarmonisedAnnotations, from the cache or the database.
+
+        HarmonisedAnnotations without compounds are not returned.
+
+        :param harmonised_annotation_ids: The HarmonisedAnnotation ids.
+        :type harmonised_annotation_ids: list
+        :return: harmonised_annotation_id -> {column: value}
+        :rtype: dict
+        """
+
+        # str(harmonised_annotation_id) -> record, so the keys survive serialization
+        cached_records = None
+        if self.cache:
+            cached_records = self.cache.get(self.get_cache_key())
+        if cached_records is None:
+            cached_records = {}
+
+        records = {}
+        missing = []
+        for harmonised_annotation_id in harmonised_annotation_ids:
+            record = cached_records.get(str(harmonised_annotation_id))
+            if record is None:
+                missing.append(harmonised_annotation_id)
+            else:
+                records[harmonised_annotation_id] = record
+
+        self.logger.debug("Compound records %s cached, %s to build" % (len(records), len(missing)))
+
+        if len(missing) > 0:
+            built_records = self.build_compound_records(missing)
+            for harmonised_annotation_id in missing:
+                record = built_records.get(harmonised_annotation_id, {})
+                cached_records[str(harmonised_annotation_id)] = record
+                records[harmonised_annotation_id] = record
+            if self.cache:
+                self.cache.set(self.get_cache_key(), cached_records)
+
+        return {harmonised_annotation_id: record for harmonised_annotation_id, record in records.items() if record}
+
+    def build_compound_records(self, harmonised_annotation_ids):
+        """Build the compound fields of HarmonisedAnnotations from the database.
+
+        A single compound has unprefixed columns, multiple compounds are prefixed c1#, c2#, etc.
+
+        :param harmonised_annotation_ids: The HarmonisedAnnotation ids.
+        :type harmonised_annotation_ids: list
+        :return: harmonised_annotation_id -> {column: value}
+        :rtype: dict
+        """
+
+        annotation_compounds = OrderedDict()
+        compounds = {}
+        for ids in self.chunk(harmonised_annotation_ids):
+            query = self.db_session.query(AnnotationCompound.harmonised_annotation_id, Compound) \
+                .join(Compound, AnnotationCompound.compound_id == Compound.id) \
+                .filter(AnnotationCompound.harmonised_annotation_id.in_(ids)) \
+                .order_by(AnnotationCompound.id)
+            for harmonised_annotation_id, compound in query.all():
+                annotation_compounds.setdefault(harmonised_annotation_id, []).append(compound.id)
+                compounds[compound.id] = compound
+
+        external_db_names = [field for field in self.compound_fields_to_include if field not in COMPOUND_FIELDS.keys()]
+        db_refs = {}
+        compound_classes = {}
+        for ids in self.chunk(compounds.keys()):
+            if len(external_db_names) > 0:
+                query = self.db_session.query(CompoundExternalDB.compound_id, ExternalDB.name,
+                                              CompoundExternalDB.database_ref) \
+                    .join(ExternalDB, CompoundExternalDB.external_db_id == ExternalDB.id) \
+                    .filter(CompoundExternalDB.compound_id.in_(ids), ExternalDB.name.in_(external_db_names)) \
+                    .order_by(CompoundExternalDB.id)
+                for compound_id, external_db_name, database_ref in query.all():
+                    db_refs.setdefault((compound_id, external_db_name), database_ref)
+            if len(self.compound_class_types_to_include) > 0:
+                query = self.db_session.query(CompoundClassCompound.compound_id, CompoundClass) \
+                    .join(CompoundClass, CompoundClassCompound.compound_class_id == CompoundClass.id) \
+                    .filter(CompoundClassCompound.compound_id.in_(ids),
+                            CompoundClass.type.in_(self.compound_class_types_to_include)) \
+                    .order_by(CompoundClassCompound.id)
+                for compound_id, compound_class in query.all():
+                    compound_classes.setdefault((compound_id, get_value(compound_class.type)), compound_class)
+
+        records = {}
+        for harmonised_annotation_id, compound_ids in annotation_compounds.items():
+            record = {}
+            for i, compound_id in enumerate(compound_ids, start=1):
+                col_prefix = '' if len(compound_ids) == 1 else 'c%s#' % i
+                compound = compounds[compound_id]
+                record[col_prefix + 'PhenomeDB ID'] = compound.id
+                for field in self.compound_fields_to_include:
+                    if field in COMPOUND_FIELDS:
+                        record[col_prefix + field] = getattr(compound, COMPOUND_FIELDS[field])
+                    else:
+                        record[col_prefix + field] = db_refs.get((compound_id, field))
+                for class_type in self.compound_class_types_to_include:
+                    compound_class = compound_classes.get((compound_id, class_type))
+                    if compound_class is None:
+                        continue
+                    class_type_stripped = class_type.replace("_class", "")
+                    for attr, suffix in COMPOUND_CLASS_LEVELS.items():
+                        if getattr(compound_class, attr):
+                            record[col_prefix + class_type_stripped + suffix] = getattr(compound_class, attr)
+            records[harmonised_annotation_id] = record
+
+        return records
@@ -9,6 +9,22 @@ if os.environ['PHENOMEDB_PATH'] not in sys.path:
 
 from phenomedb.models import *
 from phenomedb.config import config
+from phenomedb.cache import Cache
+from phenomedb import annotation_resolver
+
+class FeatureAnnotationSourceApi(ModelRestApi):
+    """ModelRestApi for the models the memoised feature annotations are built from. Writes delete the memoised
+    annotations, see :func:`phenomedb.annotation_resolver.delete_cache`.
+    """
+
+    def post_add(self, item):
+        annotation_resolver.delete_cache(Cache())
+
+    def post_update(self, item):
+        annotation_resolver.delete_cache(Cache())
+
+    def post_delete(self, item):
+        annotation_resolver.delete_cache(Cache())
 
 class Project(ModelRestApi):
     resource_name = 'project'
@@ -75,27 +91,27 @@ class FeatureMetadata(ModelRestApi):
     datamodel = SQLAInterface(FeatureMetadata)
     class_permission_name = "ModelAPI"
 
-class Compound(ModelRestApi):
+class Compound(FeatureAnnotationSourceApi):
     resource_name = 'compound'
     datamodel = SQLAInterface(Compound)
     class_permission_name = "ModelAPI"
 
-class ExternalDB(ModelRestApi):
+class ExternalDB(FeatureAnnotationSourceApi):
     resource_name = 'external_db'
     datamodel = SQLAInterface(ExternalDB)
     class_permission_name = "ModelAPI"
 
-class CompoundExternalDB(ModelRestApi):
+class CompoundExternalDB(FeatureAnnotationSourceApi):
     resource_name = 'compound_external_db'
     datamodel = SQLAInterface(CompoundExternalDB)
     class_permission_name = "ModelAPI"
 
-class CompoundClass(ModelRestApi):
+class CompoundClass(FeatureAnnotationSourceApi):
     resource_name = 'compound_class'
     datamodel = SQLAInterface(CompoundClass)
     class_permission_name = "ModelAPI"
 
-class CompoundClassCompound(ModelRestApi):
+class CompoundClassCompound(FeatureAnnotationSourceApi):
     resource_name = 'compound_class_compound'
     datamodel = SQLAInterface(CompoundClassCompound)
     class_permission_name = "ModelAPI"
@@ -115,7 +131,7 @@ class MetadataValue(ModelRestApi):
     datamodel = SQLAInterface(MetadataValue)
     class_permission_name = "ModelAPI"
 
-class AnnotationCompound(ModelRestApi):
+class AnnotationCompound(FeatureAnnotationSourceApi):
     resource_name = 'annotation_compound'
     datamodel = SQLAInterface(AnnotationCompound)
     class_permission_name = "ModelAPI"
@@ -9,6 +9,7 @@ from flask import request, make_response, render_template_string, jsonify
 import os
 from phenomedb.config import config
 from phenomedb.cache import Cache
+from phenomedb import annotation_resolver
 
 class PhenomeDBBaseView(AppBuilderBaseView):
     """The base view for all PhenomeDB views, for common methods and db_session usage.
@@ -636,6 +637,7 @@ class PhenomeDBBaseView(AppBuilderBaseView):
                 .filter(table_class.id.in_(ids)) \
                 .delete(synchronize_session='fetch')
             self.db_session.commit()
+            annotation_resolver.delete_cache_if_source(self.cache, table_class)
         except:
             self.db_session.rollback()
             raise
@@ -688,6 +690,7 @@ class PhenomeDBBaseView(AppBuilderBaseView):
             # insert with ORM magic
             self.db_session.add(entity)
             self.db_session.commit()
+            annotation_resolver.delete_cache_if_source(self.cache, table_class)
             id = entity.id
             print("new row has id", id)
         except:
@@ -711,6 +714,7 @@ class PhenomeDBBaseView(AppBuilderBaseView):
             entity = self.db_session.query(table_class).filter_by(id=id).one()
             self.db_session.delete(entity)
             self.db_session.commit()
+            annotation_resolver.delete_cache_if_source(self.cache, table_class)
         except:
             self.db_session.rollback()
             raise
@@ -734,6 +738,7 @@ class PhenomeDBBaseView(AppBuilderBaseView):
             # do the update based on the dictionary
             entity_query.update(update_dict)
             self.db_session.commit()
+            annotation_resolver.delete_cache_if_source(self.cache, table_class)
         except:
             self.db_session.rollback()
             raise
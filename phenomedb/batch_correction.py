@@ -9,6 +9,113 @@ import nPYc
 import math
 import shutil
 import re
+import io
+from phenomedb import matrix_store
+from phenomedb.task_data import TaskData
+
+def update_corrected_intensities(db_session,annotated_feature_ids,corrected_intensities,correction_type,logger=None,chunk_size=100000):
+    """Write batch corrected intensities back to their AnnotatedFeatures in bulk.
+
+    The (annotated_feature_id, corrected_intensity) pairs are staged into a temporary table with COPY, and applied with one
+    UPDATE ... FROM per chunk, inside the session transaction. Infinite intensities are skipped, and NaN intensities are set
+    to NULL.
+
+    :param db_session: The db_session to use
+    :type db_session: :class:`sqlalchemy.orm.Session`
+    :param annotated_feature_ids: The AnnotatedFeature ids, samples x features
+    :type annotated_feature_ids: :class:`numpy.ndarray`
+    :param corrected_intensities: The corrected intensities, samples x features
+    :type corrected_intensities: :class:`numpy.ndarray`
+    :param correction_type: The correction type, LOESS_SR or LOESS_LTR
+    :type correction_type: :class:`phenomedb.models.FeatureDataset.CorrectionType` or str
+    :param logger: The logger to report progress to, defaults to None
+    :type logger: :class:`logging.Logger`, optional
+    :param chunk_size: The number of rows staged and updated at a time, defaults to 100000
+    :type chunk_size: int, optional
+    :raises Exception: If the correction type is not LOESS_SR or LOESS_LTR
+    :raises Exception: If the shapes do not match
+    :raises Exception: If the number of rows updated is not the number of rows staged
+    :return: The number of AnnotatedFeatures updated
+    :rtype: int
+    """
+
+    if correction_type in [FeatureDataset.CorrectionType.LOESS_SR,FeatureDataset.CorrectionType.LOESS_SR.value]:
+        column = 'sr_corrected_intensity'
+    elif correction_type in [FeatureDataset.CorrectionType.LOESS_LTR,FeatureDataset.CorrectionType.LOESS_LTR.value]:
+        column = 'ltr_corrected_intensity'
+    else:
+        raise Exception("correction_type must be LOESS_SR or LOESS_LTR, not %s" % correction_type)
+
+    annotated_feature_ids = np.asarray(annotated_feature_ids,dtype=float)
+    corrected_intensities = np.asarray(corrected_intensities,dtype=float)
+    if annotated_feature_ids.shape != corrected_intensities.shape:
+        raise Exception("The AnnotatedFeature id matrix and corrected intensity data shapes do not match %s != %s" % (annotated_feature_ids.shape,corrected_intensities.shape))
+
+    annotated_feature_ids = annotated_feature_ids.ravel()
+    corrected_intensities = corrected_intensities.ravel()
+    to_update = ~np.isinf(corrected_intensities) & ~np.isnan(annotated_feature_ids)
+    rows = pd.DataFrame({'annotated_feature_id': annotated_feature_ids[to_update].astype(np.int64),
+                         'corrected_intensity': corrected_intensities[to_update]})
+    # An AnnotatedFeature could appear twice in the matrix, in which case the last value wins, as it did when set one at a time
+    rows = rows.drop_duplicates(subset='annotated_feature_id',keep='last')
+
+    # Flush pending ORM changes first, so the UPDATE sees them and the session does not overwrite it afterwards
+    db_session.flush()
+    cursor = db_session.connection().connection.cursor()
+    cursor.execute("CREATE TEMPORARY TABLE IF NOT EXISTS corrected_intensity_staging "
+                   "(annotated_feature_id integer PRIMARY KEY, corrected_intensity double precision) ON COMMIT DROP")
+
+    updated_count = 0
+    chunk_start = 0
+    while chunk_start < rows.shape[0]:
+        chunk = rows.iloc[chunk_start:chunk_start + chunk_size]
+        buffer = io.StringIO()
+        chunk.to_csv(buffer,header=False,index=False,na_rep='\\N')
+        buffer.seek(0)
+
+        cursor.execute("TRUNCATE corrected_intensity_staging")
+        cursor.copy_expert("COPY corrected_intensity_staging (annotated_feature_id, corrected_intensity) FROM STDIN WITH (FORMAT csv, NULL '\\N')",buffer)
+        cursor.execute("UPDATE annotated_feature SET %s = corrected_intensity_staging.corrected_intensity "
+                       "FROM corrected_intensity_staging WHERE annotated_feature.id = corrected_intensity_staging.annotated_feature_id" % column)
+        if cursor.rowcount != chunk.shape[0]:
+            raise Exception("Updated %s AnnotatedFeatures, expected %s" % (cursor.rowcount,chunk.shape[0]))
+
+        updated_count = updated_count + cursor.rowcount
+        chunk_start = chunk_start + chunk_size
+        if logger:
+            logger.info("Updated AnnotatedFeature.%s %s/%s" % (column,updated_count,rows.shape[0]))
+
+    cursor.execute("TRUNCATE corrected_intensity_staging")
+    cursor.close()
+
+    # The ORM copies of the AnnotatedFeatures are now out of date
+    db_session.expire_all()
+
+    return updated_count
+
+def update_matrix_store(matrix_store_update,logger=None):
+    """Update the corrected intensities of a FeatureDataset matrix store, after :func:`update_corrected_intensities` has been committed.
+
+    :param matrix_store_update: The (feature_dataset_id, annotated_feature_ids, corrected_intensities, correction_type), or None
+    :type matrix_store_update: tuple
+    :param logger: The logger to report progress to, defaults to None
+    :type logger: :class:`logging.Logger`, optional
+    """
+
+    if matrix_store_update is None or not matrix_store.is_enabled():
+        return
+
+    feature_dataset_id, annotated_feature_ids, corrected_intensities, correction_type = matrix_store_update
+    store = matrix_store.MatrixStore(feature_dataset_id,logger=logger)
+    if not store.exists():
+        return
+    try:
+        store.update_corrected_intensities(annotated_feature_ids,corrected_intensities,correction_type)
+    except Exception as err:
+        # The store is rebuilt from the AnnotatedFeatures instead
+        if logger:
+            logger.exception("Matrix store update failed, deleting it: %s" % err)
+        store.delete()
 
 class RunNPYCBatchCorrection(NPYCTask):
     """RunNPYCBatchCorrection. Run a batch correction using the nPYc-toolbox methods.
@@ -18,6 +125,7 @@ class RunNPYCBatchCorrection(NPYCTask):
     """
 
     sample_types = None
+    matrix_store_update = None
 
     def __init__(self,username=None,task_run_id=None,query_factory=None,saved_query_id=None,save_correction=False,comment=None,
                  samples_to_exclude=[],exclude_on='Run Order',exclusion_comments={},pipeline_run_id=None,
@@ -173,7 +281,7 @@ class RunNPYCBatchCorrection(NPYCTask):
                                                                  correction_type=self.correction_type,
                                                                  db_env=self.db_env)
 
-        self.results = {'original_annotated_feature_id_matrix':self.query_factory.dataframes[self.feature_id_matrix_key],
+        self.results = TaskData({'original_annotated_feature_id_matrix':self.query_factory.dataframes[self.feature_id_matrix_key],
                             'original_sample_metadata':self.query_factory.dataframes[self.sample_metadata_key],
                             'original_feature_metadata':self.query_factory.dataframes[self.feature_metadata_key],
                             'original_intensity_data':self.query_factory.dataframes[self.intensity_data_key],
@@ -181,7 +289,7 @@ class RunNPYCBatchCorrection(NPYCTask):
                             'corrected_feature_metadata':self.corrected_npyc_dataset.featureMetadata,
                             'corrected_intensity_data':self.corrected_npyc_dataset.intensityData,
                             'feature_dataset_id':self.feature_dataset.id,
-                            }
+                            })
 
         super().save_results()
 
@@ -216,47 +324,32 @@ class RunNPYCBatchCorrection(NPYCTask):
                 self.feature_dataset.ltr_correction_params = self.args
                 self.feature_dataset.ltr_correction_task_run_id = self.task_run.id
 
-            annotated_feature_list = self.db_session.query(AnnotatedFeature).filter(
-                AnnotatedFeature.id.in_(self.query_factory.dataframes[self.feature_id_matrix_key].flatten().tolist())).all()
-
-            annotated_feature_dict = {}
-            for annotated_feature in annotated_feature_list:
-                annotated_feature_dict[annotated_feature.id] = annotated_feature
-
-            for row_index, sample_row in self.corrected_npyc_dataset.sampleMetadata.iterrows():
-
-                for col_index, feature_column in self.corrected_npyc_dataset.featureMetadata.iterrows():
-                    row_int = int(row_index)
-                    col_int = int(col_index)
+            update_corrected_intensities(self.db_session,
+                                         self.query_factory.dataframes[self.feature_id_matrix_key],
+                                         self.corrected_npyc_dataset.intensityData,
+                                         self.batch_correction_type,
+                                         logger=self.logger)
+            self.matrix_store_update = (self.feature_dataset.id,
+                                        self.query_factory.dataframes[self.feature_id_matrix_key],
+                                        self.corrected_npyc_dataset.intensityData,
+                                        self.batch_correction_type)
 
-                    # Need to check exactly what happens with the exclusions - its possible the shape of the dataframes will be different!
-
-                    #if math.isinf(self.corrected_npyc_dataset.intensityData[row_int, col_int]):
-                    #ß    bp = True
-                    if self.batch_correction_type in [FeatureDataset.CorrectionType.LOESS_SR,
-                                                                            FeatureDataset.CorrectionType.LOESS_SR.value]\
-                            and not math.isinf(self.corrected_npyc_dataset.intensityData[row_int, col_int]):
-                        annotated_feature_dict[self.query_factory.dataframes[self.feature_id_matrix_key][
-                            row_int, col_int]].sr_corrected_intensity = \
-                            self.corrected_npyc_dataset.intensityData[row_int, col_int]
-                    elif self.batch_correction_type in [FeatureDataset.CorrectionType.LOESS_LTR,
-                                                                              FeatureDataset.CorrectionType.LOESS_LTR.value] \
-                            and not math.isinf(self.corrected_npyc_dataset.intensityData[row_int, col_int]):
-                        annotated_feature_dict[self.query_factory.dataframes[self.feature_id_matrix_key][
-                            row_int, col_int]].ltr_corrected_intensity = \
-                            self.corrected_npyc_dataset.intensityData[row_int, col_int]
+        self.output = {'task_run_id':self.task_run.id}
 
-                    # self.logger.debug("Added/updated %s" % corrected_annotated_feature)
+        self.logger.info("Save complete...!")
 
-            # self.db_session.add_all(corrected_annotated_features)
-            self.db_session.flush()
+    def post_commit_actions(self):
+        """Update the corrected intensities of the FeatureDataset matrix store, once they are committed
+        """
 
-        self.output = {'task_run_id':self.task_run.id}
+        update_matrix_store(self.matrix_store_update,logger=self.logger)
 
-        self.logger.info("Save complete...!")
+        super().post_commit_actions()
 
 class SaveBatchCorrection(Task):
 
+    matrix_store_update = None
+
     def __init__(self,correction_data_task_run_id=None,username=None,task_run_id=None,db_env=None,db_session=None,execution_date=None,pipeline_run_id=None):
 
         super().__init__(username=username,task_run_id=task_run_id,db_env=db_env,db_session=db_session,execution_date=execution_date,pipeline_run_id=pipeline_run_id)
@@ -285,7 +378,7 @@ class SaveBatchCorrection(Task):
             comment = correction_data_task_run.args['comment']
         else:
             comment = None
-        correction_data_task_run_output = correction_data_task_run.get_task_output(self.cache)
+        correction_data_task_run_output = TaskData(correction_data_task_run.get_task_output(self.cache))
         if 'corrected_sample_metadata' not in correction_data_task_run_output:
             raise Exception("TaskRun.results has no corrected_sample_metadata")
         if 'corrected_feature_metadata' not in correction_data_task_run_output:
@@ -311,51 +404,40 @@ class SaveBatchCorrection(Task):
             feature_dataset.ltr_correction_params = correction_data_task_run.args
             feature_dataset.ltr_correction_task_run_id = self.correction_data_task_run_id
 
-        corrected_sample_metadata = pd.DataFrame.from_dict(correction_data_task_run_output['corrected_sample_metadata'])
-        corrected_feature_metadata = pd.DataFrame.from_dict(correction_data_task_run_output['corrected_feature_metadata'])
-        corrected_intensity_data = np.matrix(correction_data_task_run_output['corrected_intensity_data'])
-        original_annotated_feature_id_matrix = np.matrix(correction_data_task_run_output['original_annotated_feature_id_matrix'])
-        original_sample_metadata = pd.DataFrame.from_dict(correction_data_task_run_output['original_sample_metadata'])
-        original_feature_metadata = pd.DataFrame.from_dict(correction_data_task_run_output['original_feature_metadata'])
-        original_intensity_data = np.matrix(correction_data_task_run_output['original_intensity_data'])
+        corrected_sample_metadata = correction_data_task_run_output.get_dataframe('corrected_sample_metadata')
+        corrected_feature_metadata = correction_data_task_run_output.get_dataframe('corrected_feature_metadata')
+        corrected_intensity_data = correction_data_task_run_output.get_array('corrected_intensity_data')
+        original_annotated_feature_id_matrix = correction_data_task_run_output.get_array('original_annotated_feature_id_matrix')
+        original_sample_metadata = correction_data_task_run_output.get_dataframe('original_sample_metadata')
+        original_feature_metadata = correction_data_task_run_output.get_dataframe('original_feature_metadata')
+        original_intensity_data = correction_data_task_run_output.get_array('original_intensity_data')
 
         if np.shape(corrected_intensity_data) != np.shape(original_intensity_data):
             raise Exception("Sample and Feature Exclusions are not yet implemented!")
 
-        annotated_feature_list = self.db_session.query(AnnotatedFeature).filter(AnnotatedFeature.id.in_(original_annotated_feature_id_matrix.flatten().tolist()[0])).all()
-
-        annotated_feature_dict = {}
-        for annotated_feature in annotated_feature_list:
-            annotated_feature_dict[annotated_feature.id] = annotated_feature
-
-        for row_index, sample_row in corrected_sample_metadata.iterrows():
-
-            for col_index, feature_column in original_feature_metadata.iterrows():
-
-                row_int = int(row_index)
-                col_int = int(col_index)
-
-                # Need to check exactly what happens with the exclusions - its possible the shape of the dataframes will be different!
-
-                if correction_data_task_run.args['correction_type'] in [FeatureDataset.CorrectionType.LOESS_SR,
-                                         FeatureDataset.CorrectionType.LOESS_SR.value]\
-                        and not math.isinf(corrected_intensity_data[row_int,col_int]):
-                    annotated_feature_dict[original_annotated_feature_id_matrix[row_int,col_int]].sr_corrected_intensity = corrected_intensity_data[row_int,col_int]
-                elif correction_data_task_run.args['correction_type'] in [FeatureDataset.CorrectionType.LOESS_LTR,
-                                       FeatureDataset.CorrectionType.LOESS_LTR.value]\
-                        and not math.isinf(corrected_intensity_data[row_int,col_int]):
-                    annotated_feature_dict[original_annotated_feature_id_matrix[row_int,col_int]].ltr_corrected_intensity = corrected_intensity_data[row_int,col_int]
+        updated_count = update_corrected_intensities(self.db_session,
+                                                     original_annotated_feature_id_matrix,
+                                                     corrected_intensity_data,
+                                                     correction_data_task_run.args['correction_type'],
+                                                     logger=self.logger)
+        self.logger.info("Corrected features updated")
+        self.matrix_store_update = (feature_dataset.id,
+                                    original_annotated_feature_id_matrix,
+                                    corrected_intensity_data,
+                                    correction_data_task_run.args['correction_type'])
+
+        self.output = {'updated_annotated_features': updated_count}
+        #self.saved_output = {'harmonised_dataset_id':self.harmonised_dataset.id}
 
-                #self.logger.debug("Added/updated %s" % corrected_annotated_feature)
+        self.logger.info("Save complete...!")
 
-        #self.db_session.add_all(corrected_annotated_features)
-        self.db_session.flush()
-        self.logger.info("Corrected features added/flushed")
+    def post_commit_actions(self):
+        """Update the corrected intensities of the FeatureDataset matrix store, once they are committed
+        """
 
-        self.output = None
-        #self.saved_output = {'harmonised_dataset_id':self.harmonised_dataset.id}
+        update_matrix_store(self.matrix_store_update,logger=self.logger)
 
-        self.logger.info("Save complete...!")
+        super().post_commit_actions()
 
 
 class RunNPYCBatchCorrectionReportsForExistingCorrectedFeatureDataset(NPYCTask):
@@ -529,17 +611,13 @@ class RunCombatCorrection(RAnalysisTask):
 
         # 1. Write out data to /tmp/phenomedb/R_jobs/<self.job_name>/<files>
 
-        intensity_file_path = self.job_folder + "intensity.csv"
-        # pd.DataFrame(self.query_factory.intensity_data).to_csv(intensity_file_path,header=False,index=False)
-        intensity_data = np.matrix(self.data['intensity_data'])
-        pd.DataFrame(intensity_data).to_csv(intensity_file_path, index=False)
+        intensity_data = self.data.get_array('intensity_data')
+        intensity_file_path = self.write_input_frame('intensity',intensity_data)
 
-        sample_metadata_file_path = self.job_folder + "sample_metadata.csv"
-        # self.query_factory.dataframes[self.sample_metadata_key].to_csv(sample_metadata_file_path,index=False)
-        sample_metadata = pd.DataFrame.from_dict(self.data['sample_metadata'])
+        sample_metadata = self.data.get_dataframe('sample_metadata')
         if 'Sample ID' in sample_metadata.columns:
             sample_metadata = sample_metadata.drop('Sample ID',axis=1)
-        sample_metadata.to_csv(sample_metadata_file_path, index=False)
+        sample_metadata_file_path = self.write_input_frame('sample_metadata',sample_metadata)
 
         # 2. Load vars into template_data
 
@@ -563,10 +641,10 @@ class RunCombatCorrection(RAnalysisTask):
 
         self.logger.info("Saving results.....")
 
-        self.results = {#'combined_data':self.clean_data_for_jsonb(self.data['combined_data']),
-                        'sample_metadata':utils.convert_to_json_safe(self.clean_data_for_jsonb(self.data['sample_metadata'])),
-                        'feature_metadata':utils.convert_to_json_safe(self.clean_data_for_jsonb(self.data['feature_metadata'])),
-                        'intensity_data':utils.convert_to_json_safe(self.clean_data_for_jsonb(self.results))}
+        self.results = TaskData({#'combined_data':self.clean_data_for_jsonb(self.data['combined_data']),
+                        'sample_metadata':self.data.get_dataframe('sample_metadata'),
+                        'feature_metadata':self.data.get_dataframe('feature_metadata'),
+                        'intensity_data':np.asarray(self.results,dtype=float)})
 
         super().save_results()
         self.logger.info("Save complete...!")
@@ -619,21 +697,18 @@ class RunDBnormCorrection(RAnalysisTask):
 
         # 1. Write out data to /tmp/phenomedb/R_jobs/<self.job_name>/<files>
 
-        intensity_file_path = self.job_folder + "intensity.csv"
-        intensity_data = np.matrix(self.data['intensity_data'])
-        pd.DataFrame(intensity_data).to_csv(intensity_file_path, index=False)
+        intensity_data = self.data.get_array('intensity_data')
+        intensity_file_path = self.write_input_frame('intensity',intensity_data)
 
-        sample_metadata_file_path = self.job_folder + "sample_metadata.csv"
-        sample_metadata = pd.DataFrame.from_dict(self.data['sample_metadata'])
-        sample_metadata.to_csv(sample_metadata_file_path, index=False)
+        sample_metadata = self.data.get_dataframe('sample_metadata')
+        sample_metadata_file_path = self.write_input_frame('sample_metadata',sample_metadata)
 
         batch_dataframe = sample_metadata[[self.batch_variable]].copy()
 
-        dbnorm_file_path = self.job_folder + "dbnorm_dataframe.csv"
         dbnorm_dataframe = pd.concat([batch_dataframe,
-                                      pd.DataFrame(np.matrix(self.data['intensity_data']))
+                                      pd.DataFrame(intensity_data)
                                       ], ignore_index=True, axis=1)
-        dbnorm_dataframe.to_csv(dbnorm_file_path, index=False)
+        dbnorm_file_path = self.write_input_frame('dbnorm_dataframe',dbnorm_dataframe)
 
         self.task_run_folder = config['DATA']['app_data'] + (
                 "task_runs/task_run_%s/" % (self.task_run.id))
@@ -783,16 +858,14 @@ class RunNormResidualsMM(RAnalysisTask):
 
         # 1. Write out data to /tmp/phenomedb/R_jobs/<self.job_name>/<files>
 
-        intensity_file_path = self.job_folder + "intensity.csv"
-        intensity_data = np.matrix(self.data['intensity_data'])
-        pd.DataFrame(intensity_data).to_csv(intensity_file_path, index=False)
+        intensity_data = np.asmatrix(self.data.get_array('intensity_data'))
 
         self.identifier_column = 'Sample File Name'
         #self.columns_fixed_to_correct = ['Project','Unique Batch']
         #self.columns_fixed_to_keep = ['h_metadata::Age','h_metadata::Sex']
 
-        sample_metadata = pd.DataFrame.from_dict(self.data['sample_metadata'])
-        feature_metadata = pd.DataFrame.from_dict(self.data['feature_metadata'])
+        sample_metadata = self.data.get_dataframe('sample_metadata')
+        feature_metadata = self.data.get_dataframe('feature_metadata')
         self.combined_dataframe = utils.build_combined_dataframe_from_seperate(intensity_data, sample_metadata, feature_metadata)
 
         metabo = pd.DataFrame()
@@ -835,10 +908,8 @@ class RunNormResidualsMM(RAnalysisTask):
 
             p = p + 1
 
-        metabo_file_path = self.job_folder + "metabo.csv"
-        metabo.to_csv(metabo_file_path, index=False)
-        others_file_path = self.job_folder + "others.csv"
-        others.to_csv(others_file_path, index=False)
+        metabo_file_path = self.write_input_frame('metabo',metabo)
+        others_file_path = self.write_input_frame('others',others)
 
         aux = pd.DataFrame(columns=['Name','Class','Type'])
         i = 0
@@ -874,8 +945,7 @@ class RunNormResidualsMM(RAnalysisTask):
                 feature_class = 'Unknown'
             aux.loc[i] = [unique_column_name,feature_class,feature_type]
             i = i + 1
-        aux_file_path = self.job_folder + "aux.csv"
-        aux.to_csv(aux_file_path,index=False)
+        aux_file_path = self.write_input_frame('aux',aux)
 
         # 2. Load vars into template_data
 
@@ -901,8 +971,8 @@ class RunNormResidualsMM(RAnalysisTask):
 
         self.logger.info("Saving results.....")
 
-        corrected_intensity_data = np.matrix(self.data['intensity_data'])
-        feature_metadata_original = pd.DataFrame.from_dict(self.data['feature_metadata'])
+        corrected_intensity_data = np.asmatrix(self.data.get_array('intensity_data',writable=True))
+        feature_metadata_original = self.data.get_dataframe('feature_metadata')
         corrected_data_from_R = pd.DataFrame.from_dict(self.results['data'])
         corrected_data_from_R = corrected_data_from_R.set_index(self.identifier_column.replace(' ','.'))
         corrected_data_from_R = corrected_data_from_R.reindex(index=self.combined_dataframe[self.identifier_column])
@@ -934,10 +1004,10 @@ class RunNormResidualsMM(RAnalysisTask):
 
             p = p + 1
 
-        self.results = {'combined_data':utils.convert_to_json_safe(self.clean_data_for_jsonb(self.combined_dataframe)),
-                        'intensity_data':utils.convert_to_json_safe(self.clean_data_for_jsonb(corrected_intensity_data)),
-                        'sample_metadata':utils.convert_to_json_safe(self.clean_data_for_jsonb(self.data['sample_metadata'])),
-                        'feature_metadata':utils.convert_to_json_safe(self.clean_data_for_jsonb(self.data['feature_metadata']))}
+        self.results = TaskData({'combined_data':self.combined_dataframe,
+                        'intensity_data':np.nan_to_num(np.asarray(corrected_intensity_data)),
+                        'sample_metadata':self.data.get_dataframe('sample_metadata'),
+                        'feature_metadata':self.data.get_dataframe('feature_metadata')})
 
         super().save_results()
         self.logger.info("Save complete...!")
\ No newline at end of file
@@ -5,12 +5,76 @@ import redis
 import os
 from pathlib import Path
 import pandas as pd
-import pyarrow as pa
 import json
 import re
 import requests
 from sqlalchemy.dialects import postgresql
 import sys
+import time
+import uuid
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from phenomedb import cache_serializers
+from phenomedb import cache_policies
+from phenomedb import matrix_store
+from phenomedb.task_data import TaskData
+
+#: The estimated peak memory of building a dataframe, per matching AnnotatedFeature: the fetched rows, the dense
+#: intensity and AnnotatedFeature id matrices, and the combined and feature_id_combined dataframes
+ESTIMATED_BYTES_PER_ANNOTATED_FEATURE = 256
+
+
+def build_saved_query_dataframe(saved_query_id,db_env,load_dataframe_args):
+    """Build the dataframe of a SavedQuery. Runs in the worker processes of :class:`CreateSavedQueryDataframeCache`.
+
+    :param saved_query_id: The ID of the SavedQuery
+    :type saved_query_id: int
+    :param db_env: The db_env to use, 'PROD' or 'TEST'
+    :type db_env: str
+    :param load_dataframe_args: The :meth:`phenomedb.query_factory.QueryFactory.load_dataframe` arguments
+    :type load_dataframe_args: dict
+    :return: The result, with saved_query_id, status, seconds, and shape or error
+    :rtype: dict
+    """
+
+    from phenomedb.query_factory import QueryFactory
+
+    started = time.time()
+    result = {'saved_query_id':saved_query_id}
+    try:
+        query_factory = QueryFactory(saved_query_id=saved_query_id,db_env=db_env)
+        dataframe = query_factory.load_dataframe(**load_dataframe_args)
+        result['status'] = 'success'
+        result['shape'] = list(dataframe.shape)
+    except Exception as err:
+        result['status'] = 'error'
+        result['error'] = str(err)
+    result['seconds'] = round(time.time() - started,3)
+    return result
+
+
+def get_next_saved_query_id(pending,estimated_bytes,running_ids,memory_budget_bytes=None):
+    """Get the next pending SavedQuery whose estimated memory fits in the memory budget alongside the running ones.
+    If nothing is running the first pending SavedQuery is always returned, so a SavedQuery over the budget still runs, on its own.
+
+    :param pending: The pending SavedQuery ids, in order
+    :type pending: list
+    :param estimated_bytes: SavedQuery id -> estimated bytes
+    :type estimated_bytes: dict
+    :param running_ids: The running SavedQuery ids
+    :type running_ids: list
+    :param memory_budget_bytes: The memory budget, defaults to None (no budget)
+    :type memory_budget_bytes: float, optional
+    :return: The SavedQuery id, or None if none fit
+    :rtype: int
+    """
+
+    running_bytes = sum(estimated_bytes[saved_query_id] for saved_query_id in running_ids)
+    for saved_query_id in pending:
+        if memory_budget_bytes is None or len(running_ids) == 0 \
+                or running_bytes + estimated_bytes[saved_query_id] <= memory_budget_bytes:
+            return saved_query_id
+    return None
 
 class CreateSavedQueryDataframeCache(Task):
     """Task to Create a SavedQuery Dataframe Cache.
@@ -38,6 +102,14 @@ class CreateSavedQueryDataframeCache(Task):
     :type execution_date: str, optional
     :param pipeline_run_id: The Pipeline run ID
     :type pipeline_run_id: str, optional
+    :param incremental: Whether to refresh the cached dataframe incrementally if it is stale, rather than rebuild it, defaults to False
+    :type incremental: bool, optional
+    :param saved_query_ids: Batch mode, the IDs of the SavedQueries (a list, or comma-separated), defaults to None
+    :type saved_query_ids: list or str, optional
+    :param max_workers: Batch mode, the number of processes to build the SavedQueries across, defaults to 1
+    :type max_workers: int, optional
+    :param memory_budget_mb: Batch mode, the estimated memory the concurrently built SavedQueries can use, in MB, defaults to None (no budget)
+    :type memory_budget_mb: float, optional
 
     """
 
@@ -45,12 +117,20 @@ class CreateSavedQueryDataframeCache(Task):
 
     def __init__(self,username=None,task_run_id=None,saved_query_id=None,class_level=None,class_type=None,
                 output_model='AnnotatedFeature',master_unit=None,correction_type=None,db_env=None,db_session=None,
-                 execution_date=None,reload_cache=True,pipeline_run_id=None,upstream_task_run_id=None):
+                 execution_date=None,reload_cache=True,pipeline_run_id=None,upstream_task_run_id=None,incremental=False,
+                 saved_query_ids=None,max_workers=1,memory_budget_mb=None):
         
         super().__init__(task_run_id=task_run_id,username=username,db_env=db_env,db_session=db_session,
                          execution_date=execution_date,pipeline_run_id=pipeline_run_id,upstream_task_run_id=upstream_task_run_id)
 
         self.saved_query_id = saved_query_id
+        if isinstance(saved_query_ids,str):
+            saved_query_ids = [int(float(saved_query_id)) for saved_query_id in saved_query_ids.split(',') if saved_query_id.strip() != '']
+        self.saved_query_ids = saved_query_ids
+        self.max_workers = int(float(max_workers)) if max_workers else 1
+        self.memory_budget_mb = float(memory_budget_mb) if memory_budget_mb else None
+        self.class_level = class_level
+        self.class_type = class_type
 
         if master_unit is not None:
             self.convert_units = True
@@ -60,6 +140,7 @@ class CreateSavedQueryDataframeCache(Task):
         self.output_model = output_model
         self.correction_type = correction_type
         self.reload_cache = reload_cache
+        self.incremental = incremental
         self.args['master_unit'] = master_unit
         self.args['saved_query_id'] = saved_query_id
         self.args['output_model'] = output_model
@@ -67,13 +148,39 @@ class CreateSavedQueryDataframeCache(Task):
         self.args['class_type'] = class_type
         self.args['correction_type'] = correction_type
         self.args['reload_cache'] = reload_cache
+        self.args['incremental'] = incremental
+        self.args['saved_query_ids'] = saved_query_ids
+        self.args['max_workers'] = self.max_workers
+        self.args['memory_budget_mb'] = self.memory_budget_mb
 
         self.get_class_name(self)
 
+    def get_load_dataframe_args(self):
+        """Get the :meth:`phenomedb.query_factory.QueryFactory.load_dataframe` arguments
+
+        :return: The arguments
+        :rtype: dict
+        """
+
+        return {'reload_cache':self.reload_cache and not self.incremental,
+                'type':'combined',
+                'output_model':self.output_model,
+                'class_type':self.class_type,
+                'class_level':self.class_level,
+                'convert_units':self.convert_units,
+                'master_unit':self.master_unit,
+                'correction_type':self.correction_type,
+                'harmonise_annotations':True,
+                'incremental':self.incremental}
+
     def process(self):
         """Process method, loads the SavedQuery, QueryFactory, and generates the dataframe cache
         """        
 
+        if self.saved_query_ids:
+            self.build_saved_queries()
+            return
+
         self.saved_query = self.db_session.query(SavedQuery).filter(SavedQuery.id==self.saved_query_id).first()
 
         from phenomedb.query_factory import QueryFactory
@@ -83,10 +190,7 @@ class CreateSavedQueryDataframeCache(Task):
         self.logger.info("QueryFactory QueryDict: %s" % query_factory.query_dict)
         self.logger.info("QueryFactory SQLAlchemy: %s" % query_factory.get_code_string())
         self.logger.info("QueryFactory query: %s" % query_factory.query)
-        self.logger.info(
-            "QueryFactory parameterised query: %s" % query_factory.query.statement.compile(dialect=postgresql.dialect(),
-                                                                                           compile_kwargs={
-                                                                                               "literal_binds": True}))
+        self.logger.info("QueryFactory parameterised query: %s %s" % query_factory.get_sql())
 
         #query_factory.load_dataframe(reload_cache=True,type='combined',output_model=self.output_model,
         #                             class_type=self.class_type,class_level=self.class_level,
@@ -98,10 +202,7 @@ class CreateSavedQueryDataframeCache(Task):
         #                                                                      correction_type=self.correction_type,db_env=self.db_env,
         #                                                                      harmonise_annotations=False)
 
-        query_factory.load_dataframe(reload_cache=self.reload_cache, type='combined', output_model=self.output_model,
-                                     class_type=self.class_type, class_level=self.class_level,
-                                     convert_units=self.convert_units, master_unit=self.master_unit,
-                                     correction_type=self.correction_type, harmonise_annotations=True)
+        query_factory.load_dataframe(**self.get_load_dataframe_args())
 
         self.output = "Harmonised %s dataframe cached" % query_factory.get_dataframe_key(type='combined',
                                                                                            model=self.output_model,
@@ -111,6 +212,108 @@ class CreateSavedQueryDataframeCache(Task):
                                                                                            db_env=self.db_env,
                                                                                            harmonise_annotations=True)
 
+    def build_saved_queries(self):
+        """Batch mode, builds the dataframes of the SavedQueries.
+
+        The FeatureDatasets the SavedQueries share are fetched once, into their matrix stores (see :mod:`phenomedb.matrix_store`),
+        then the per-query dataframes are built across max_workers processes, admitting SavedQueries while their estimated
+        memory fits in memory_budget_mb. Per-query progress and timings are reported in the TaskRun output.
+        """
+
+        from phenomedb.query_factory import QueryFactory
+
+        started = time.time()
+        estimated_bytes = {}
+        feature_dataset_ids = set()
+        self.progress = {}
+        for saved_query_id in self.saved_query_ids:
+            query_factory = QueryFactory(saved_query_id=saved_query_id,db_env=self.db_env,db_session=self.db_session)
+            matched_counts = query_factory.get_feature_dataset_counts()
+            feature_dataset_ids.update(feature_dataset_id for feature_dataset_id in matched_counts.keys() if feature_dataset_id is not None)
+            estimated_bytes[saved_query_id] = sum(matched_counts.values()) * ESTIMATED_BYTES_PER_ANNOTATED_FEATURE
+            self.progress[saved_query_id] = {'saved_query_id':saved_query_id,
+                                             'status':'pending',
+                                             'estimated_mb':round(estimated_bytes[saved_query_id] / 1e6,3)}
+
+        self.prepare_matrix_stores(feature_dataset_ids)
+
+        load_dataframe_args = self.get_load_dataframe_args()
+        pending = list(self.saved_query_ids)
+        memory_budget_bytes = self.memory_budget_mb * 1e6 if self.memory_budget_mb else None
+
+        if self.max_workers <= 1:
+            for saved_query_id in pending:
+                self.progress[saved_query_id]['status'] = 'running'
+                self.record_result(build_saved_query_dataframe(saved_query_id,self.db_env,load_dataframe_args),started)
+        else:
+            # database.py creates its engines at import, so the workers are spawned rather than forked
+            with ProcessPoolExecutor(max_workers=self.max_workers,mp_context=multiprocessing.get_context('spawn')) as executor:
+                running = {}
+                while len(pending) > 0 or len(running) > 0:
+                    while len(pending) > 0 and len(running) < self.max_workers:
+                        saved_query_id = get_next_saved_query_id(pending,estimated_bytes,list(running.values()),memory_budget_bytes)
+                        if saved_query_id is None:
+                            break
+                        pending.remove(saved_query_id)
+                        self.progress[saved_query_id]['status'] = 'running'
+                        running[executor.submit(build_saved_query_dataframe,saved_query_id,self.db_env,load_dataframe_args)] = saved_query_id
+                    done, not_done = wait(list(running.keys()),return_when=FIRST_COMPLETED)
+                    for future in done:
+                        saved_query_id = running.pop(future)
+                        try:
+                            result = future.result()
+                        except Exception as err:
+                            result = {'saved_query_id':saved_query_id,'status':'error','error':str(err)}
+                        self.record_result(result,started)
+
+        failed = [saved_query_id for saved_query_id, progress in self.progress.items() if progress['status'] != 'success']
+        self.output = "%s/%s SavedQuery dataframes cached in %ss" % (len(self.saved_query_ids) - len(failed),
+                                                                      len(self.saved_query_ids),
+                                                                      self.saved_output['seconds'])
+        if len(failed) > 0:
+            raise Exception("SavedQuery dataframes failed: %s" % failed)
+
+    def prepare_matrix_stores(self,feature_dataset_ids):
+        """Build the matrix stores of the FeatureDatasets that are not current, so the SavedQueries sharing them fetch them once.
+
+        :param feature_dataset_ids: The FeatureDataset ids
+        :type feature_dataset_ids: set
+        """
+
+        if not matrix_store.is_enabled() or len(feature_dataset_ids) == 0:
+            return
+
+        counts = matrix_store.get_feature_dataset_counts(self.db_session,feature_dataset_ids)
+        for feature_dataset_id, (count, max_id) in counts.items():
+            store = matrix_store.MatrixStore(feature_dataset_id,logger=self.logger)
+            if not store.is_current(count,max_id):
+                store.build(self.db_session)
+                self.logger.info("FeatureDataset %s matrix store built" % feature_dataset_id)
+
+    def record_result(self,result,started):
+        """Record the result of a SavedQuery, and report the progress to the TaskRun output.
+
+        :param result: The result, from :func:`build_saved_query_dataframe`
+        :type result: dict
+        :param started: The time the batch started
+        :type started: float
+        """
+
+        self.progress[result['saved_query_id']].update(result)
+        completed = len([progress for progress in self.progress.values() if progress['status'] in ['success','error']])
+        if result['status'] == 'success':
+            self.logger.info("%s/%s SavedQuery %s dataframe cached, shape %s, %ss" % (completed,len(self.progress),result['saved_query_id'],
+                                                                                     result.get('shape'),result.get('seconds')))
+        else:
+            self.logger.error("%s/%s SavedQuery %s dataframe failed: %s" % (completed,len(self.progress),result['saved_query_id'],
+                                                                            result.get('error')))
+        self.saved_output = {'saved_queries':list(self.progress.values()),
+                             'completed':completed,
+                             'total':len(self.progress),
+                             'seconds':round(time.time() - started,3)}
+        if self.task_run:
+            self.cache.set(self.task_run.get_task_output_cache_key(),self.saved_output)
+
 class CreateSavedQuerySummaryStatsCache(Task):
     """Task to Create a SavedQuery Summary Stats Cache.
     Takes a SavedQuery, and generates the cache for the summary stats
@@ -129,15 +332,19 @@ class CreateSavedQuerySummaryStatsCache(Task):
     :type execution_date: str, optional
     :param pipeline_run_id: The Pipeline run ID
     :type pipeline_run_id: str, optional
+    :param incremental: Whether to recalculate only the projects updated since the cached summary stats were calculated, defaults to False
+    :type incremental: bool, optional
 
     """    
 
-    def __init__(self,username=None,task_run_id=None,saved_query_id=None,db_env=None,db_session=None,execution_date=None,pipeline_run_id=None,upstream_task_run_id=None):
+    def __init__(self,username=None,task_run_id=None,saved_query_id=None,db_env=None,db_session=None,execution_date=None,pipeline_run_id=None,upstream_task_run_id=None,incremental=False):
  
         self.saved_query_id = saved_query_id
+        self.incremental = incremental
 
         super().__init__(username=username,task_run_id=task_run_id,db_env=db_env,db_session=db_session,execution_date=execution_date,pipeline_run_id=pipeline_run_id,upstream_task_run_id=upstream_task_run_id)
         self.args['saved_query_id'] = saved_query_id
+        self.args['incremental'] = incremental
 
         self.get_class_name(self)
 
@@ -150,7 +357,7 @@ class CreateSavedQuerySummaryStatsCache(Task):
         from phenomedb.query_factory import QueryFactory
         query_factory = QueryFactory(saved_query=self.saved_query,db_env=self.db_env)
 
-        query_factory.load_summary_statistics()
+        query_factory.load_summary_statistics(incremental=self.incremental)
 
         self.output = "SavedQuery %s:%s summary statistics cached" % (self.saved_query.id, self.saved_query.name)
 
@@ -188,11 +395,33 @@ class Cache:
         This means we reduce the memory footprint without losing the performance of the cache (ie not having to load from database).
 
         Methods to get, set, and expire objects
+
+        Values are serialized by :mod:`phenomedb.cache_serializers`; DataFrames are stored as Feather or Parquet
+        (config CACHE dataframe_format), NumPy arrays as NPY, :class:`phenomedb.task_data.TaskData` as a manifest and its
+        Feather/NPY blobs, and anything else is pickled.
+
+        Which keys exist on disk is tracked by the key index, a redis hash of key -> {size, mtime, format}. Writers
+        update single fields of the hash, so it is safe with concurrent workers, and lookups are O(1).
+        reconcile_index() rebuilds it from the cache directory.
+
+        Reads record access times, counts and per-namespace hits, used by :mod:`phenomedb.cache_policies` for
+        eviction and the :class:`phenomedb.cache_policies.CacheStats` report.
     '''
 
     cache_directory = config['DATA']['cache']
-    file_cache_key = 'CacheFiles'
-    context = pa.default_serialization_context()
+    index_key = 'CacheIndex'
+    access_time_key = 'CacheAccessTimes'
+    access_count_key = 'CacheAccessCounts'
+    hits_key = 'CacheHits'
+    internal_keys = [index_key, access_time_key, access_count_key, hits_key]
+    dataframe_format = config.get('CACHE', 'dataframe_format', fallback='feather')
+    compression = config.get('CACHE', 'compression', fallback='uncompressed')
+    memory_map = config.get('CACHE', 'memory_map', fallback='true').lower() == 'true'
+    # Values larger than redis_chunk_threshold are written to redis as redis_chunk_size parts under a manifest key
+    redis_chunk_threshold = config.getint('CACHE', 'redis_chunk_threshold', fallback=64*1024*1024)
+    redis_chunk_size = config.getint('CACHE', 'redis_chunk_size', fallback=16*1024*1024)
+    # How many chunks to send or fetch per pipeline round trip
+    redis_chunk_batch = 4
     redis_cache = redis.Redis(host=config['REDIS']['host'],
                               port=config['REDIS']['port'],
                               #username=config['REDIS']['user'],
@@ -205,27 +434,16 @@ class Cache:
         self.logger = utils.configure_logging('phenomedb.cache','phenomedb.log')
 
         Path(self.cache_directory).mkdir(parents=True, exist_ok=True)
-        # If the file_cache_key does not exist, build it from the cache directory
-        # The file cache is a list of which files exist on disk, so we don't have to look up everytime
-
-        if not self.redis_cache.exists(self.file_cache_key) or not self.redis_cache.get(self.file_cache_key):
-            self.generate_file_cache_list()
-        else:
-            self.load_file_cache_list()
-        #self.generate_file_cache_list()
+        # If the index does not exist (new cache, or redis was flushed), build it from the cache directory
+        if not self.redis_cache.exists(self.index_key):
+            self.reconcile_index()
 
     def delete_test_keys(self):
         """Delete any key with TEST in the name
         """
 
         self.logger.debug('Delete test keys called')
-        keys_for_deletion = []
-        for key in self.redis_cache.keys():
-            if re.search("TEST",key.decode('utf-8')):
-                keys_for_deletion.append(key)
-        for key in self.file_cache_list:
-            if re.search("TEST", key):
-                keys_for_deletion.append(key)
+        keys_for_deletion = [key for key in self.get_index_keys() if re.search("TEST", key)]
         for key in keys_for_deletion:
             self.delete(key)
         self.logger.info("Deleted following cache keys: %s" % keys_for_deletion)
@@ -238,60 +456,49 @@ class Cache:
         """
 
         self.logger.debug('Delete keys by regex %s' % regex)
-        keys_for_deletion = []
-        for key in self.redis_cache.keys():
-            if re.search(regex, key.decode('utf-8')):
-                keys_for_deletion.append(key)
-        for key in self.file_cache_list:
-            if re.search(regex, key):
-                keys_for_deletion.append(key)
+        keys_for_deletion = [key for key in self.get_index_keys() if re.search(regex, key)]
         for key in keys_for_deletion:
-            self.delete(str(key))
+            self.delete(key)
 
     def get_keys_dict(self,include_task_cache=False,include_analysis_view_cache=False):
-        """Builds a dictionary of the keys in the cache
+        """Builds a dictionary of the keys in the cache, from the key index
 
         :param include_task_cache: Whether to include the task cache, defaults to False
         :type include_task_cache: bool, optional
         :param include_analysis_view_cache: Whether to include the analysis_view_cache, defaults to False
         :type include_analysis_view_cache: bool, optional
-        :return: a dictionary of the keys in the cache
+        :return: a dictionary of the keys in the cache, key -> {redis, file, size, mtime, format}
         :rtype: dict
         """
 
         all_keys = {}
-        for key in self.redis_cache.keys():
-            utf8_key = key.decode('utf-8')
+        for key, entry in self.get_index().items():
             # if not all, ignore the Tasks
-            include = True
-            if re.search('^Task\w+',utf8_key) and include_task_cache is False:
-                include = False
-            elif re.search('analysis_view_table_row_', utf8_key) and include_analysis_view_cache is False:
-                include = False
-
-            if include is True:
-                if utf8_key not in all_keys.keys():
-                    all_keys[utf8_key] = {'redis':True}
-                else:
-                    all_keys[utf8_key]['redis'] = True
-
-        for file_key in self.file_cache_list:
-            key = file_key.replace("__","::").replace(".cache","")
-            # if not include_task_cache, ignore the Tasks
-            include = True
-            if re.search('^Task\w+', file_key) and include_task_cache is False:
-                include = False
-            elif re.search('analysis_view_table_row_', file_key) and include_analysis_view_cache is False:
-                include = False
-
-            if include is True:
-                if key not in all_keys.keys():
-                    all_keys[key] = {'file':True}
-                else:
-                    all_keys[key]['file'] = True
+            if re.search('^Task\w+',key) and include_task_cache is False:
+                continue
+            elif re.search('analysis_view_table_row_', key) and include_analysis_view_cache is False:
+                continue
+            all_keys[key] = dict(entry, file=True)
+
+        for key, in_redis in self.get_redis_membership(list(all_keys.keys())).items():
+            all_keys[key]['redis'] = in_redis
 
         return all_keys
 
+    def get_redis_membership(self,keys):
+        """Check which keys are in redis, in one round trip
+
+        :param keys: The keys to check
+        :type keys: list
+        :return: key -> whether it is in redis
+        :rtype: dict
+        """
+
+        pipeline = self.redis_cache.pipeline(transaction=False)
+        for key in keys:
+            pipeline.exists(key)
+        return {key: bool(in_redis) for key, in_redis in zip(keys, pipeline.execute())}
+
     def get_cache_keys_dataframe(self,include_task_cache=False,include_analysis_view_cache=False):
         """Get a dataframe of the keys in the cache (used to store a persistent record on disk)
 
@@ -303,25 +510,15 @@ class Cache:
         :rtype: :class:`pandas.DataFrame`
         """
 
-        self.generate_file_cache_list()
-
-        df = pd.DataFrame(columns=['key','redis','file'])
-
         all_keys = self.get_keys_dict(include_task_cache=include_task_cache,include_analysis_view_cache=include_analysis_view_cache)
 
-        print(all_keys)
-
+        rows = []
         for key, data in all_keys.items():
-            if 'redis' in data.keys():
-                redis = data['redis']
-            else:
-                redis = None
-            if 'file' in data.keys():
-                file = data['file']
-            else:
-                file = None
-            row = {'key':key,'redis':redis,'file':file}
-            df = df.append(row,ignore_index=True)
+            rows.append({'key':key,'redis':data['redis'],'file':data['file'],'size':data.get('size'),
+                         'mtime':data.get('mtime'),'format':data.get('format')})
+
+        df = pd.DataFrame(rows,columns=['key','redis','file','size','mtime','format'])
+        df['mtime'] = pd.to_datetime(df['mtime'],unit='s')
 
         return df
 
@@ -350,7 +547,7 @@ class Cache:
                     self.logger.info('Failed to delete %s. Reason: %s' % (file_path, e))
                     raise
 
-        self.generate_file_cache_list()
+        self.reconcile_index()
 
         db_session = db.get_db_session()
         for saved_query in db_session.query(SavedQuery).all():
@@ -361,41 +558,208 @@ class Cache:
         self.logger.info("SavedQuery cache states reset")
 
 
-    def load_file_cache_list(self):
-        """Loads the file cache list from redis
-        """        
-        if self.redis_cache.exists(self.file_cache_key):
-            self.file_cache_list = self.context.deserialize(self.redis_cache.get(self.file_cache_key))
+    def get_index(self):
+        """Get the whole key index
+
+        :return: key -> {size, mtime, format}
+        :rtype: dict
+        """
+        return {key.decode('utf-8'): json.loads(entry) for key, entry in self.redis_cache.hgetall(self.index_key).items()}
+
+    def get_index_keys(self):
+        """Get the keys in the key index
+
+        :return: The keys that exist on disk
+        :rtype: list
+        """
+        return [key.decode('utf-8') for key in self.redis_cache.hkeys(self.index_key)]
+
+    def get_index_entry(self,key):
+        """Get the key index entry for a key
+
+        :param key: The key of the item
+        :type key: str
+        :return: {size, mtime, format}, or None if the key is not on disk
+        :rtype: dict
+        """
+        entry = self.redis_cache.hget(self.index_key,key)
+        if entry is None:
+            return None
+        return json.loads(entry)
+
+    def build_index_entry(self,key,format=None):
+        """Build the key index entry from the key's file
+
+        :param key: The key of the item
+        :type key: str
+        :param format: The serialization format, defaults to None (read from the file header)
+        :type format: str, optional
+        :return: {size, mtime, format}
+        :rtype: dict
+        """
+
+        file_path = self.key_file_path(key)
+        stat = os.stat(file_path)
+        if format is None:
+            with open(file_path, 'rb') as f:
+                format = cache_serializers.get_format(f.read(cache_serializers.HEADER_LENGTH))
+        return {'size': stat.st_size, 'mtime': stat.st_mtime, 'format': format if format is not None else 'legacy'}
+
+    def index_file(self,key,format=None):
+        """Add or update the key index entry for a key
+
+        :param key: The key of the item
+        :type key: str
+        :param format: The serialization format, defaults to None (read from the file header)
+        :type format: str, optional
+        """
+        self.redis_cache.hset(self.index_key,key,json.dumps(self.build_index_entry(key,format=format)))
+
+    def file_exists(self,key):
+        """Check whether the key exists on disk, using the key index.
+
+        Files written without updating the index (ie by an older version) are found with a single stat and indexed.
+
+        :param key: The key of the item
+        :type key: str
+        :return: Whether the key exists on disk
+        :rtype: bool
+        """
+
+        if self.redis_cache.hexists(self.index_key,key):
+            return True
+        elif os.path.isfile(self.key_file_path(key)):
+            self.index_file(key)
+            return True
         else:
-            self.generate_file_cache_list()
+            return False
+
+    def key_from_filename(self,filename):
+        """Get the key for a cache filename (the inverse of key_filename)
+
+        :param filename: The filename
+        :type filename: str
+        :return: The key
+        :rtype: str
+        """
+        return filename[:-len(".cache")].replace("__","::")
+
+    def record_access(self,key,tier):
+        """Record an access of a key, for eviction and the hit rate
+
+        :param key: The key of the item
+        :type key: str
+        :param tier: Where the item was found, 'redis', 'file' or 'miss'
+        :type tier: str
+        """
+
+        pipeline = self.redis_cache.pipeline(transaction=False)
+        if tier != 'miss':
+            pipeline.hset(self.access_time_key,key,time.time())
+            pipeline.hincrby(self.access_count_key,key,1)
+        pipeline.hincrby(self.hits_key,"%s:%s" % (cache_policies.get_namespace(key),tier),1)
+        pipeline.execute()
+
+    def get_access_stats(self,keys):
+        """Get the last access time and access count of keys
+
+        :param keys: The keys
+        :type keys: list
+        :return: key -> {last_access, count}, last_access is None if the key has not been read
+        :rtype: dict
+        """
+
+        if len(keys) == 0:
+            return {}
+        access_times = self.redis_cache.hmget(self.access_time_key,keys)
+        access_counts = self.redis_cache.hmget(self.access_count_key,keys)
+        return {key: {'last_access': float(access_time) if access_time is not None else None,
+                      'count': int(access_count) if access_count is not None else 0}
+                for key, access_time, access_count in zip(keys, access_times, access_counts)}
+
+    def get_hit_counts(self):
+        """Get the hit counts, by namespace and tier
+
+        :return: '<namespace>:<tier>' -> count
+        :rtype: dict
+        """
+        return {field.decode('utf-8'): int(count) for field, count in self.redis_cache.hgetall(self.hits_key).items()}
+
+    def get_ttl(self,key):
+        """Get the configured redis expiry for a key, by namespace (CACHE memory_ttl_<namespace>), falling back to
+        REDIS memory_expired_seconds
+
+        :param key: The key of the item
+        :type key: str
+        :return: The expiry in seconds
+        :rtype: int
+        """
 
-        self.logger.debug("File cache lists: %s" % self.file_cache_list)
+        default = config.getint('REDIS','memory_expired_seconds',fallback=86400)
+        return config.getint('CACHE','memory_ttl_%s' % cache_policies.get_namespace(key),fallback=default)
 
-    def get(self,key):
+    def get(self,key,track_access=True):
         """Get an object from the cache. Checks Redis first, then the FileCache
 
         :param key: The key of the item to retrieve
         :type key: str
+        :param track_access: Whether to record the access for eviction and hit rates, defaults to True
+        :type track_access: bool, optional
         :return: The object to return
         :rtype: object
         """
 
         self.logger.debug('Get called %s' % key)
 
-        if self.redis_cache.exists(key):
-            return self.context.deserialize(self.redis_cache.get(key))
+        serialized_value = self.get_redis(key)
+        if serialized_value is not None:
+            if track_access:
+                self.record_access(key,'redis')
+            return cache_serializers.deserialize(serialized_value)
+        elif self.file_exists(key):
+            if track_access:
+                self.record_access(key,'file')
+            return self.load_cache_from_file(key)
+        # Else, return None (the cache does not exist on disk or in redis)
         else:
-            self.load_file_cache_list()
-            # If the the key is in the file_cache_list, return it
-            if self.key_filename(key) not in self.file_cache_list:
-                self.generate_file_cache_list()
-
-            if self.key_filename(key) in self.file_cache_list:
-                return self.load_cache_from_file(key)
-            # Else, return None (the cache does not exist on disk or in redis)
-            else:
-                self.logger.info("No item found in cache %s" % key)
-                return None
+            if track_access:
+                self.record_access(key,'miss')
+            self.logger.info("No item found in cache %s" % key)
+            return None
+
+    def get_task_data(self,key,names=None,track_access=True):
+        """Get task data (see :class:`phenomedb.task_data.TaskData`), deserializing only the named artefacts.
+
+        With names, the memory-mapped file is read in preference to redis, so only the pages of the named artefacts
+        are read.
+
+        :param key: The key of the item to retrieve
+        :type key: str
+        :param names: The names of the artefacts, ie ['sample_metadata','intensity_data'], defaults to None (all)
+        :type names: list, optional
+        :param track_access: Whether to record the access for eviction and hit rates, defaults to True
+        :type track_access: bool, optional
+        :return: The task data, or None if the key does not exist
+        :rtype: :class:`phenomedb.task_data.TaskData`
+        """
+
+        if names is not None and self.memory_map and self.file_exists(key):
+            buffer = cache_serializers.read_buffer(self.key_file_path(key),memory_map=True)
+            if cache_serializers.get_format(buffer) is not None:
+                if track_access:
+                    self.record_access(key,'file')
+                return cache_serializers.deserialize_task_data(buffer,names=names)
+
+        serialized_value = self.get_redis(key)
+        if serialized_value is not None:
+            if track_access:
+                self.record_access(key,'redis')
+            return cache_serializers.deserialize_task_data(serialized_value,names=names)
+
+        value = self.get(key,track_access=track_access)
+        if value is None:
+            return None
+        return TaskData((name, item) for name, item in value.items() if names is None or name in names)
 
     def set(self,key,value,ex=None):
         """Set an object in the cache.
@@ -404,6 +768,8 @@ class Cache:
         :type key: str
         :param value: The item to set
         :type value: object
+        :param ex: The redis expiry in seconds, or 'no-expiry', defaults to None (the namespace expiry, see get_ttl)
+        :type ex: int or str, optional
         """
 
         self.logger.debug('Set called %s %s %s %s' % (key,value,type(value),ex))
@@ -411,37 +777,178 @@ class Cache:
         # This is a hack for now for misusing the ex parameter. Need to unfoorbar this.
         if ex == 'no-expiry':
             ex = None
-        elif not ex:
-            ex = 60*60*2
-        elif not isinstance(ex,int):
-            ex = 60*60*2
+        elif not ex or not isinstance(ex,int):
+            ex = self.get_ttl(key)
+
+
+        if isinstance(value, pd.DataFrame) and 'dataframe' not in key.lower():
+            raise Exception("If caching a pandas DataFrame, then 'dataframe' or 'DataFrame' must be part of the key: %s \n columns: %s" % (key,value.columns))
 
+        # The file and redis hold the same bytes, so a file can be pushed back into redis without re-serializing.
+        # The parts are views onto the value where possible, so large values are not copied
+        serialized_parts = cache_serializers.serialize_parts(value,dataframe_format=self.dataframe_format,compression=self.compression)
 
         # Write out to disk first (slow and more likely to fail, plus has better redundancy because if its not in redis, it will load from disk
+        cache_serializers.write_file(self.key_file_path(key),serialized_parts)
+        self.index_file(key,format=cache_serializers.get_format(serialized_parts[0]))
+        self.set_redis(key,serialized_parts,ex=ex)
+        self.redis_cache.hset(self.access_time_key,key,time.time())
+
+    def chunk_key(self,key,chunk,generation=None):
+        """Get the redis key of a chunk of a chunked value
+
+        :param key: The key of the item
+        :type key: str
+        :param chunk: The chunk number
+        :type chunk: int
+        :param generation: The generation of the value, from its manifest, defaults to None (chunks written before
+            generations)
+        :type generation: str, optional
+        :return: The chunk key
+        :rtype: str
+        """
+        if generation is None:
+            return "%s::chunk::%s" % (key,chunk)
+        return "%s::chunk::%s::%s" % (key,generation,chunk)
 
-        if isinstance(value, pd.DataFrame):
+    def set_redis(self,key,serialized_value,ex=None):
+        """Set a serialized value in redis. Values over redis_chunk_threshold are split into redis_chunk_size chunks,
+        written with pipelines, and a manifest is set under the key once all the chunks are written.
 
-            if 'dataframe' not in key.lower():
-                raise Exception("If caching a pandas DataFrame, then 'dataframe' or 'DataFrame' must be part of the key: %s \n columns: %s" % (key,value.columns))
+        Each write of a chunked value has its own generation, recorded in the manifest, so a reader never assembles a
+        value from the chunks of two writes. The chunks of the previous generation are deleted once the manifest is
+        swapped, and a reader still fetching them falls back to the file cache.
 
-            # write out a csv format file
-            value.to_csv(str(Path(self.cache_directory + self.key_filename(key)).absolute()),index=False)
-            self.redis_cache.set(key,self.context.serialize(value).to_buffer().to_pybytes(),ex=ex)
+        :param key: The key of the item
+        :type key: str
+        :param serialized_value: The serialized value, or its parts
+        :type serialized_value: bytes or list
+        :param ex: The expiry in seconds, defaults to None
+        :type ex: int, optional
+        """
 
+        if not isinstance(serialized_value, list):
+            serialized_value = [serialized_value]
+        size = cache_serializers.get_size(serialized_value)
+        previous_manifest = self.get_manifest(key)
+
+        if size <= self.redis_chunk_threshold:
+            self.redis_cache.set(key,b''.join(serialized_value),ex=ex)
         else:
-            # write out a binary format file
-            serialized_value = self.context.serialize(value).to_buffer().to_pybytes()
-            f = open(str(Path(self.cache_directory + self.key_filename(key)).absolute()), "wb")
-            f.write(serialized_value)
-            f.close()
-            self.redis_cache.set(key,serialized_value,ex=ex)
+            generation = uuid.uuid4().hex
+            pipeline = self.redis_cache.pipeline(transaction=False)
+            chunks = 0
+            for chunk in cache_serializers.iter_chunks(serialized_value,self.redis_chunk_size):
+                pipeline.set(self.chunk_key(key,chunks,generation),chunk,ex=ex)
+                chunks += 1
+                if chunks % self.redis_chunk_batch == 0:
+                    pipeline.execute()
+            pipeline.execute()
+            self.redis_cache.set(key,cache_serializers.serialize_manifest(size,chunks,self.redis_chunk_size,generation),ex=ex)
+
+        # Remove the chunks of the previous value
+        if previous_manifest is not None:
+            self.delete_chunks(key,previous_manifest)
+
+    def delete_redis(self,key):
+        """Delete a key from redis, including its chunks, but not from the file cache
+
+        :param key: The key of the item
+        :type key: str
+        """
+
+        manifest = self.get_manifest(key)
+        self.redis_cache.delete(key)
+        if manifest is not None:
+            self.delete_chunks(key,manifest)
+
+    def delete_chunks(self,key,manifest):
+        """Delete the chunks of one generation of a chunked value from redis
+
+        :param key: The key of the item
+        :type key: str
+        :param manifest: The manifest of the generation
+        :type manifest: dict
+        """
+
+        if manifest['chunks'] > 0:
+            self.redis_cache.delete(*[self.chunk_key(key,chunk,manifest.get('generation'))
+                                      for chunk in range(manifest['chunks'])])
 
-        # Get the latest file cache list
-        self.load_file_cache_list()
+    def get_manifest(self,key):
+        """Get the manifest of a chunked value in redis
 
-        if key not in self.file_cache_list:
-            self.file_cache_list.append(key)
-            self.redis_cache.set(self.file_cache_key,self.context.serialize(self.file_cache_list).to_buffer().to_pybytes())
+        :param key: The key of the item
+        :type key: str
+        :return: The manifest {size, chunks, chunk_size, generation}, or None if the value is not chunked
+        :rtype: dict
+        """
+
+        header = self.redis_cache.getrange(key,0,cache_serializers.HEADER_LENGTH - 1)
+        if cache_serializers.get_format(header) != cache_serializers.MANIFEST:
+            return None
+        serialized_manifest = self.redis_cache.get(key)
+        if serialized_manifest is None or cache_serializers.get_format(serialized_manifest) != cache_serializers.MANIFEST:
+            # Replaced since the header was read
+            return None
+        return cache_serializers.deserialize_manifest(serialized_manifest)
+
+    def get_chunk_count(self,key):
+        """Get the number of chunks of a chunked value in redis
+
+        :param key: The key of the item
+        :type key: str
+        :return: The number of chunks, 0 if the value is not chunked
+        :rtype: int
+        """
+
+        manifest = self.get_manifest(key)
+        if manifest is None:
+            return 0
+        return manifest['chunks']
+
+    def get_redis(self,key):
+        """Get a serialized value from redis. Chunked values are read in pipelined batches into one preallocated
+        buffer, from the chunks of the generation in the manifest.
+
+        :param key: The key of the item
+        :type key: str
+        :return: The serialized value, or None if it is not in redis (or a chunk has expired or been replaced)
+        :rtype: bytes or :class:`pyarrow.Buffer`
+        """
+
+        serialized_value = self.redis_cache.get(key)
+        if serialized_value is None or cache_serializers.get_format(serialized_value) != cache_serializers.MANIFEST:
+            return serialized_value
+
+        manifest = cache_serializers.deserialize_manifest(serialized_value)
+        buffer = bytearray(manifest['size'])
+        view = memoryview(buffer)
+        offset = 0
+        for batch_start in range(0,manifest['chunks'],self.redis_chunk_batch):
+            pipeline = self.redis_cache.pipeline(transaction=False)
+            for chunk in range(batch_start,min(batch_start + self.redis_chunk_batch,manifest['chunks'])):
+                pipeline.get(self.chunk_key(key,chunk,manifest.get('generation')))
+            for chunk_value in pipeline.execute():
+                if chunk_value is None:
+                    self.logger.info("Chunk of %s has expired or been replaced, falling back to the file cache" % key)
+                    return None
+                view[offset:offset + len(chunk_value)] = chunk_value
+                offset += len(chunk_value)
+        if offset != manifest['size']:
+            self.logger.info("Chunks of %s do not match the manifest, falling back to the file cache" % key)
+            return None
+        return buffer
+
+    def serialize(self,value):
+        """Serialize a value in the configured cache format
+
+        :param value: The value to serialize
+        :type value: object
+        :return: The serialized value
+        :rtype: bytes
+        """
+        return cache_serializers.serialize(value,dataframe_format=self.dataframe_format,compression=self.compression)
 
     def key_filename(self,key):
         """Get the filename for the key
@@ -453,6 +960,16 @@ class Cache:
         """        
         return key.replace("::",'__') + ".cache"
 
+    def key_file_path(self,key):
+        """Get the absolute file path for the key
+
+        :param key: The key of the item.
+        :type key: str
+        :return: The file path for the key
+        :rtype: str
+        """
+        return str(Path(self.cache_directory + self.key_filename(key)).absolute())
+
     def delete(self,key):
         """Delete a key from the cache
 
@@ -462,20 +979,18 @@ class Cache:
 
         self.logger.debug('Delete called %s' % key)
 
-        # Remove it from the redis cache
-        if self.redis_cache.exists(key):
-            self.redis_cache.delete(key)
-
-        self.load_file_cache_list()
-        # Remove it from the file cache, and remove from the file_cache redis list
-        if self.key_filename(key) in self.file_cache_list:
-            file_path = str(Path(self.cache_directory + self.key_filename(key)).absolute())
-            if os.path.exists(file_path):
-                os.remove(file_path)
-            self.file_cache_list.remove(self.key_filename(key))
-            #self.redis_cache.set(self.file_cache_key,self.context.serialize(self.file_cache_list).to_buffer().to_pybytes())
+        # Remove it from the redis cache, the key index and the access stats
+        self.delete_redis(key)
+        pipeline = self.redis_cache.pipeline(transaction=False)
+        pipeline.hdel(self.index_key,key)
+        pipeline.hdel(self.access_time_key,key)
+        pipeline.hdel(self.access_count_key,key)
+        pipeline.execute()
 
-        self.generate_file_cache_list()
+        # Remove it from the file cache
+        file_path = self.key_file_path(key)
+        if os.path.exists(file_path):
+            os.remove(file_path)
 
     def exists(self,key):
         """Check whether the key exists in the cache
@@ -491,15 +1006,7 @@ class Cache:
         if self.redis_cache.exists(key):
             return True
         else:
-            self.load_file_cache_list()
-            if self.key_filename(key) in self.file_cache_list:
-                return True
-            else:
-                self.generate_file_cache_list()
-                if self.key_filename(key) in self.file_cache_list:
-                    return True
-                else:
-                    return False
+            return self.file_exists(key)
 
     def load_cache_from_file(self,key):
         """Load the cache from the file
@@ -512,53 +1019,82 @@ class Cache:
 
         self.logger.debug('Load cache from file called %s' % key)
 
-        ex = config['REDIS']['memory_expired_seconds']
-        if not isinstance(ex, int):
-            ex = 86400
+        ex = self.get_ttl(key)
 
         try:
 
-            if 'dataframe' in key.lower() and 'intensity_data' not in key.lower():
-
-                value = pd.read_csv(str(Path(self.cache_directory + self.key_filename(key)).absolute()))
-                self.logger.debug("Loaded from file cache %s %s" % (key,value))
-                self.logger.debug("memory_expired_seconds %s" % config['REDIS']['memory_expired_seconds'])
-                self.redis_cache.set(key,self.context.serialize(value).to_buffer().to_pybytes(),ex=ex)
+            buffer = cache_serializers.read_buffer(self.key_file_path(key),memory_map=self.memory_map)
 
+            if cache_serializers.get_format(buffer) is not None:
+                value = cache_serializers.deserialize(buffer)
+                self.set_redis(key,buffer,ex=ex)
             else:
+                value = self.load_legacy_value(key,buffer)
+                self.set_redis(key,self.serialize(value),ex=ex)
 
-                f = open(str(Path(self.cache_directory + self.key_filename(key)).absolute()), "rb")
-                serialized_value = f.read()
-                f.close()
-                if isinstance(serialized_value,bytes):
-                    self.redis_cache.set(key,serialized_value,ex=ex)
-                    value = self.context.deserialize(serialized_value)
-                    self.logger.debug("Loaded from file cache %s %s" % (key, value))
-                else:
-                    raise Exception("Unknown file cache data type: %s %s" % (key,type(serialized_value)))
-
+            self.logger.debug("Loaded from file cache %s %s" % (key, value))
             return value
         except Exception as err:
-            bp = True
             raise Exception(err)
 
-    def generate_file_cache_list(self):
-        """Generate the file cache list and store in redis for quick reference
-        """        
+    def load_legacy_value(self,key,buffer):
+        """Load a value from a file written before the cache serializers. DataFrames (except intensity_data) were
+        written as csv, and everything else with the pyarrow serialization context.
 
-        # Get all the files in the cache directory
-        files = (file for file in os.listdir(self.cache_directory)
-                 if os.path.isfile(os.path.join(self.cache_directory, file)))
+        :param key: The key of the item
+        :type key: str
+        :param buffer: The file contents
+        :type buffer: :class:`pyarrow.Buffer`
+        :return: The object to return
+        :rtype: object
+        """
 
-        # file keys is an array of the keys that exist on the disk - so we don't have to look up the keys from disk everytime
-        file_keys = []
-        for file in files:
-            file_path = Path(self.cache_directory + file)
-            if file not in file_keys:
-                file_keys.append(file)
+        if 'dataframe' in key.lower() and 'intensity_data' not in key.lower():
+            return pd.read_csv(self.key_file_path(key))
+        else:
+            return cache_serializers.legacy_deserialize(buffer)
 
-        self.redis_cache.set(self.file_cache_key,self.context.serialize(file_keys).to_buffer().to_pybytes())
-        self.file_cache_list = file_keys
+    def reconcile_index(self):
+        """Reconcile the key index with the files in the cache directory. Adds missing files, updates changed ones,
+        and removes entries whose files no longer exist.
+
+        :return: The number of index entries added, updated, removed and unchanged
+        :rtype: dict
+        """
+
+        counts = {'added': 0, 'updated': 0, 'removed': 0, 'unchanged': 0}
+        index = self.get_index()
+        pipeline = self.redis_cache.pipeline(transaction=False)
+
+        on_disk = set()
+        for file in os.listdir(self.cache_directory):
+            # .tmp files are partial writes
+            if not file.endswith('.cache') or not os.path.isfile(os.path.join(self.cache_directory, file)):
+                continue
+            key = self.key_from_filename(file)
+            on_disk.add(key)
+            try:
+                if key in index:
+                    stat = os.stat(self.key_file_path(key))
+                    if stat.st_size == index[key]['size'] and stat.st_mtime == index[key]['mtime']:
+                        counts['unchanged'] += 1
+                        continue
+                    counts['updated'] += 1
+                else:
+                    counts['added'] += 1
+                pipeline.hset(self.index_key, key, json.dumps(self.build_index_entry(key)))
+            except FileNotFoundError:
+                # Deleted by another worker since the listdir
+                on_disk.discard(key)
+
+        for key in index.keys():
+            if key not in on_disk:
+                pipeline.hdel(self.index_key, key)
+                counts['removed'] += 1
+
+        pipeline.execute()
+        self.logger.info("Cache index reconciled: %s" % counts)
+        return counts
 
 class RemoveUntransformedDataFromCache(Task):
     """Goes through all the task cache and removes the untransformed data from the output cache, which was causing bloat 
@@ -589,58 +1125,22 @@ class RemoveUntransformedDataFromCache(Task):
 
 
     def process(self):
-        import time
-
-        task_run_query = self.db_session.query(TaskRun.id).filter(TaskRun.module_name.in_(['phenomedb.analysis',
-                                                                                   'phenomedb.batch_correction',
-                                                                                   'phenomedb.pipelines']))
-        if self.lowest_finished is not None and utils.is_number(self.lowest_finished):
-            task_run_query = task_run_query.filter(TaskRun.id < self.lowest_finished)
-
-        task_run_ids = task_run_query.order_by(TaskRun.id.desc()).all()
+        """Process method. Runs the :class:`phenomedb.cache_policies.RemoveUntransformedDataPolicy`
+        """
 
-        for task_run_id in task_run_ids:
-            try:
-                task_run = self.db_session.query(TaskRun).filter(TaskRun.id==task_run_id).first()
-                if self.cache.exists(task_run.get_task_data_cache_key()):
-
-                    task_run_data = self.cache.get(task_run.get_task_data_cache_key())
-                    #output = dict(task_run.output)
-
-                    # Just put the columns back in, not any missing rows!
-                    updated = False
-                    # put the missing columns back in!
-                    if 'untransformed_intensity_data' in task_run_data.keys():
-                        del(task_run_data['untransformed_intensity_data'])
-                        updated = True
-
-                    if 'untransformed_feature_metadata' in task_run_data.keys():
-                        del(task_run_data['untransformed_feature_metadata'])
-                        updated = True
-
-                    if updated is True:
-                        self.cache.set(task_run.get_task_data_cache_key(),task_run_data)
-                        self.logger.info("%s updated" % task_run.id)
-                    else:
-                        self.logger.info("%s ignored" % task_run.id)
-
-                    self.cache.redis_cache.delete(task_run.get_task_data_cache_key())
-                else:
-                    self.logger.info("%s no cache" % task_run.id)
-            except Exception as err:
-                self.logger.exception(err)
-            time.sleep(0.4)
+        engine = cache_policies.CachePolicyEngine(self.cache, policies=[
+            cache_policies.RemoveUntransformedDataPolicy(lowest_finished=self.lowest_finished)])
+        self.output = engine.run(db_session=self.db_session, logger=self.logger)
 
 class MoveTaskOutputToCache(Task):
     """Move the task output to the cache. This was created to move the :class:`phenomedb.models.TaskRun` output to the cache, to free up database space and simplify data restore
 
-    :param Task: _description_
-    :type Task: _type_
-    :raises Exception: _description_
+    :param highest_finished: Only TaskRuns with a higher ID, defaults to None
+    :type highest_finished: int, optional
+    :param update_db: Whether to remove the output from the database once cached, defaults to False
+    :type update_db: bool, optional
     """
 
-    task_output_sizes = {}
-
     def __init__(self, username=None, task_run_id=None, highest_finished=None, update_db=False, db_env=None, db_session=None,
                  execution_date=None, pipeline_run_id=None, upstream_task_run_id=None):
         super().__init__(task_run_id=task_run_id, username=username, db_env=db_env, db_session=db_session,
@@ -655,51 +1155,186 @@ class MoveTaskOutputToCache(Task):
         self.args['update_db'] = update_db
 
     def process(self):
-        import time
+        """Process method. Runs the :class:`phenomedb.cache_policies.MoveTaskOutputPolicy`
+        """
+
+        engine = cache_policies.CachePolicyEngine(self.cache, policies=[
+            cache_policies.MoveTaskOutputPolicy(highest_finished=self.highest_finished, update_db=self.update_db)])
+        self.output = engine.run(db_session=self.db_session, logger=self.logger)
+
+class MigrateCacheFormat(Task):
+    """Convert the file and redis cache from the legacy formats (csv DataFrames and the deprecated pyarrow
+    serialization context) to the :mod:`phenomedb.cache_serializers` formats, in place.
+
+    Must be run with a pyarrow version that still has the serialization context (<= 11).
+
+    :param dry_run: Only count the legacy items, defaults to False
+    :type dry_run: bool, optional
+    :param task_run_id: The TaskRun ID
+    :type task_run_id: float, optional
+    :param username: The username of the user running the job, defaults to None
+    :type username: str, optional
+    :param db_env: The db_env to use, 'PROD' or 'TEST', default 'PROD'
+    :type db_env: str, optional
+    :param db_session: The db_session to use
+    :type db_session: object, optional
+    :param execution_date: The date of execution, str format.
+    :type execution_date: str, optional
+    :param pipeline_run_id: The Pipeline run ID
+    :type pipeline_run_id: str, optional
+    """
+
+    def __init__(self, username=None, task_run_id=None, dry_run=False, db_env=None, db_session=None,
+                 execution_date=None, pipeline_run_id=None, upstream_task_run_id=None):
+        super().__init__(task_run_id=task_run_id, username=username, db_env=db_env, db_session=db_session,
+                         execution_date=execution_date, pipeline_run_id=pipeline_run_id,
+                         upstream_task_run_id=upstream_task_run_id)
+
+        if isinstance(dry_run, str):
+            dry_run = dry_run.lower() == 'true'
+        self.dry_run = dry_run
+        self.args['dry_run'] = dry_run
+
+        self.get_class_name(self)
+
+    def process(self):
+        """Process method. Converts every legacy file in the cache directory, then every legacy value in redis.
+        """
 
-        task_run_query = self.db_session.query(TaskRun.id).filter(TaskRun.output != None)#.filter(TaskRun.id <= 1146)
-        if self.highest_finished is not None and utils.is_number(self.highest_finished):
-            task_run_query = task_run_query.filter(TaskRun.id > self.highest_finished)
+        self.counts = {'files_converted': 0, 'files_skipped': 0, 'files_failed': 0,
+                       'redis_converted': 0, 'redis_skipped': 0, 'redis_failed': 0,
+                       'bytes_before': 0, 'bytes_after': 0}
 
-        task_run_ids = task_run_query.order_by(TaskRun.id.asc()).all()
-        #task_run_ids = task_run_query.order_by(TaskRun.id.desc()).all()
+        self.cache.reconcile_index()
+        for key in self.cache.get_index_keys():
+            try:
+                self.migrate_file(key)
+            except Exception as err:
+                self.counts['files_failed'] += 1
+                self.logger.exception("Failed to migrate %s: %s" % (key, err))
 
-        for task_run_id_struct in task_run_ids:
-            task_run_id = task_run_id_struct[0]
+        for redis_key in self.cache.redis_cache.scan_iter():
+            key = redis_key.decode('utf-8')
+            if key in self.cache.internal_keys or '::chunk::' in key:
+                continue
+            try:
+                self.migrate_redis_key(key)
+            except Exception as err:
+                self.counts['redis_failed'] += 1
+                self.logger.exception("Failed to migrate redis %s: %s" % (key, err))
 
-            task_run = self.db_session.query(TaskRun).filter(TaskRun.id == task_run_id).first()
+        self.logger.info("Cache migration: %s" % self.counts)
+        self.output = self.counts
 
-            if task_run.output is not None and (not self.cache.exists(task_run.get_task_output_cache_key()) or self.update_db is True):
+    def migrate_file(self, key):
+        """Migrate the file for one key
 
-                output = dict(task_run.output)
+        :param key: The cache key
+        :type key: str
+        """
 
-                self.cache.set(task_run.get_task_output_cache_key(),output)
+        file_path = self.cache.key_file_path(key)
+        buffer = cache_serializers.read_buffer(file_path, memory_map=False)
+        if cache_serializers.get_format(buffer) is not None:
+            self.counts['files_skipped'] += 1
+            return
+
+        serialized_value = self.cache.serialize(self.cache.load_legacy_value(key, buffer))
+        self.counts['bytes_before'] += buffer.size
+        self.counts['bytes_after'] += len(serialized_value)
+        if not self.dry_run:
+            cache_serializers.write_file(file_path, serialized_value)
+            self.cache.index_file(key)
+        self.counts['files_converted'] += 1
+        self.logger.info("Migrated %s %s -> %s bytes" % (key, buffer.size, len(serialized_value)))
+
+    def migrate_redis_key(self, key):
+        """Migrate the redis value for one key, keeping its expiry
+
+        :param key: The cache key
+        :type key: str
+        """
 
-                self.cache.redis_cache.delete(task_run.get_task_output_cache_key())
+        data = self.cache.redis_cache.get(key)
+        if data is None or cache_serializers.get_format(data) is not None:
+            self.counts['redis_skipped'] += 1
+            return
 
-                if self.cache.get(task_run.get_task_output_cache_key()) != output:
-                    raise Exception('Cache is not the same as expected %s != %s' % (self.cache.get(task_run.get_task_output_cache_key()),output))
+        serialized_value = self.cache.serialize(cache_serializers.legacy_deserialize(data))
+        if not self.dry_run:
+            ttl = self.cache.redis_cache.ttl(key)
+            self.cache.set_redis(key, serialized_value, ex=ttl if ttl is not None and ttl > 0 else None)
+        self.counts['redis_converted'] += 1
 
-                self.cache.redis_cache.delete(task_run.get_task_output_cache_key())
+class ReconcileCacheIndex(Task):
+    """Reconcile the :class:`Cache` key index with the files in the cache directory.
 
-                self.logger.info("%s output created" % task_run_id)
+    :param task_run_id: The TaskRun ID
+    :type task_run_id: float, optional
+    :param username: The username of the user running the job, defaults to None
+    :type username: str, optional
+    :param db_env: The db_env to use, 'PROD' or 'TEST', default 'PROD'
+    :type db_env: str, optional
+    :param db_session: The db_session to use
+    :type db_session: object, optional
+    :param execution_date: The date of execution, str format.
+    :type execution_date: str, optional
+    :param pipeline_run_id: The Pipeline run ID
+    :type pipeline_run_id: str, optional
+    """
 
-                if self.update_db is True:
-                    task_run.output = None
-                    self.db_session.flush()
-                    output_size_bytes = utils.total_size(output)
-                    self.task_output_sizes[task_run_id] = {'task_run_id': task_run_id,
-                                                           'output_size_bytes': output_size_bytes}
+    def __init__(self, username=None, task_run_id=None, db_env=None, db_session=None,
+                 execution_date=None, pipeline_run_id=None, upstream_task_run_id=None):
+        super().__init__(task_run_id=task_run_id, username=username, db_env=db_env, db_session=db_session,
+                         execution_date=execution_date, pipeline_run_id=pipeline_run_id,
+                         upstream_task_run_id=upstream_task_run_id)
 
-                    self.logger.info("TaskRun.output size %s" % self.task_output_sizes[task_run_id]['output_size_bytes'])
+        self.get_class_name(self)
 
-            else:
-                self.logger.info("%s output exists or is None" % task_run_id)
+    def process(self):
+        """Process method. Reconciles the index and reports the changes
+        """
+
+        self.output = self.cache.reconcile_index()
+
+class EnforceCachePolicies(Task):
+    """Apply the configured cache quotas (CACHE memory_quota_<namespace> and disk_quota_<namespace>), evicting by
+    the CACHE eviction_strategy, and report the :class:`phenomedb.cache_policies.CacheStats`.
+
+    :param dry_run: Only report what would be evicted, defaults to False
+    :type dry_run: bool, optional
+    :param task_run_id: The TaskRun ID
+    :type task_run_id: float, optional
+    :param username: The username of the user running the job, defaults to None
+    :type username: str, optional
+    :param db_env: The db_env to use, 'PROD' or 'TEST', default 'PROD'
+    :type db_env: str, optional
+    :param db_session: The db_session to use
+    :type db_session: object, optional
+    :param execution_date: The date of execution, str format.
+    :type execution_date: str, optional
+    :param pipeline_run_id: The Pipeline run ID
+    :type pipeline_run_id: str, optional
+    """
 
-            time.sleep(0.2)
+    def __init__(self, username=None, task_run_id=None, dry_run=False, db_env=None, db_session=None,
+                 execution_date=None, pipeline_run_id=None, upstream_task_run_id=None):
+        super().__init__(task_run_id=task_run_id, username=username, db_env=db_env, db_session=db_session,
+                         execution_date=execution_date, pipeline_run_id=pipeline_run_id,
+                         upstream_task_run_id=upstream_task_run_id)
+
+        if isinstance(dry_run, str):
+            dry_run = dry_run.lower() == 'true'
+        self.dry_run = dry_run
+        self.args['dry_run'] = dry_run
+
+        self.get_class_name(self)
+
+    def process(self):
+        """Process method. Runs the quota policies and reports the cache stats
+        """
 
-        if self.update_db is True:
-            df = pd.DataFrame.from_dict(self.task_output_sizes, orient='index')
-            self.logger.info(self.task_output_sizes)
-            self.logger.info(df)
-            #df.to_csv(str(Path(config['DATA']['app_data'] + "/output/task_output_cache_differences.csv").absolute()),index=False)
+        engine = cache_policies.CachePolicyEngine(self.cache)
+        self.output = {'policies': engine.run(db_session=self.db_session, dry_run=self.dry_run, logger=self.logger),
+                       'stats': cache_policies.CacheStats(self.cache).collect()}
+        self.logger.info("Cache stats: %s" % self.output['stats'])
@@ -0,0 +1,403 @@
+"""Cache policies, applied to the :class:`phenomedb.cache.Cache` by the :class:`CachePolicyEngine`.
+
+Keys are grouped into namespaces (SavedQuery dataframes, task data, task output, view rows, other), and each namespace
+has its own memory (redis) and disk byte quota, configured in the CACHE section of config.ini. 0 means no quota.
+
+Access times and counts are recorded by :meth:`phenomedb.cache.Cache.get`, and used to evict the least recently
+(lru) or least frequently (lfu) used keys first.
+"""
+
+import re
+import time
+from collections import OrderedDict
+
+import pandas as pd
+
+from phenomedb.config import config
+
+#: Namespace -> key regex. The first match wins, anything unmatched is 'other'
+NAMESPACES = OrderedDict([('saved_query_dataframe', '^SavedQuery(AnnotatedFeatureID)?Dataframe::'),
+                          ('task_data', '^TaskData::'),
+                          ('task_output', '^TaskOutput::'),
+                          ('view_rows', 'analysis_view_table_row_'),
+                          ('feature_annotation', '^FeatureAnnotation::'),
+                          ('other', '')])
+
+
+def get_namespace(key):
+    """Get the namespace of a cache key.
+
+    :param key: The cache key.
+    :type key: str
+    :return: The namespace.
+    :rtype: str
+    """
+
+    for namespace, regex in NAMESPACES.items():
+        if re.search(regex, key):
+            return namespace
+
+
+class CachePolicy:
+    """Base class for cache policies.
+
+    :param namespace: The namespace the policy applies to, defaults to None (all)
+    :type namespace: str, optional
+    """
+
+    name = None
+
+    def __init__(self, namespace=None):
+        self.namespace = namespace
+
+    def get_keys(self, cache):
+        """Get the indexed keys the policy applies to.
+
+        :param cache: The cache.
+        :type cache: :class:`phenomedb.cache.Cache`
+        :return: key -> index entry {size, mtime, format}
+        :rtype: dict
+        """
+
+        return {key: entry for key, entry in cache.get_index().items()
+                if self.namespace is None or get_namespace(key) == self.namespace}
+
+    def apply(self, cache, db_session=None, dry_run=False, logger=None):
+        """Apply the policy.
+
+        :param cache: The cache.
+        :type cache: :class:`phenomedb.cache.Cache`
+        :param db_session: The db_session, for policies that need it, defaults to None
+        :type db_session: object, optional
+        :param dry_run: Report what would change without changing it, defaults to False
+        :type dry_run: bool, optional
+        :param logger: The logger, defaults to None
+        :type logger: :class:`logging.Logger`, optional
+        :return: A summary of what the policy did.
+        :rtype: dict
+        """
+        raise NotImplementedError
+
+
+class QuotaEvictionPolicy(CachePolicy):
+    """Evict keys from a namespace until it is within its memory and disk quotas.
+
+    Memory eviction only removes the redis copy (it can be reloaded from disk); disk eviction deletes the key.
+
+    :param namespace: The namespace
+    :type namespace: str
+    :param memory_quota: The redis byte quota, 0 for none, defaults to 0
+    :type memory_quota: int, optional
+    :param disk_quota: The file byte quota, 0 for none, defaults to 0
+    :type disk_quota: int, optional
+    :param strategy: 'lru' or 'lfu', defaults to 'lru'
+    :type strategy: str, optional
+    """
+
+    name = 'quota'
+
+    def __init__(self, namespace, memory_quota=0, disk_quota=0, strategy='lru'):
+        super().__init__(namespace=namespace)
+        if strategy not in ['lru', 'lfu']:
+            raise Exception("Unknown cache eviction strategy %s" % strategy)
+        self.memory_quota = memory_quota
+        self.disk_quota = disk_quota
+        self.strategy = strategy
+
+    def get_eviction_order(self, cache, keys):
+        """Order keys by eviction priority, first to evict first.
+
+        Keys that have never been read are ordered by their file mtime.
+
+        :param cache: The cache.
+        :type cache: :class:`phenomedb.cache.Cache`
+        :param keys: key -> index entry
+        :type keys: dict
+        :return: The ordered keys.
+        :rtype: list
+        """
+
+        access_stats = cache.get_access_stats(list(keys.keys()))
+        last_access = {key: stats['last_access'] if stats['last_access'] is not None else keys[key]['mtime']
+                       for key, stats in access_stats.items()}
+        if self.strategy == 'lfu':
+            return sorted(keys.keys(), key=lambda key: (access_stats[key]['count'], last_access[key]))
+        return sorted(keys.keys(), key=lambda key: last_access[key])
+
+    def apply(self, cache, db_session=None, dry_run=False, logger=None):
+
+        result = {'namespace': self.namespace, 'memory_evicted_keys': 0, 'memory_evicted_bytes': 0,
+                  'disk_evicted_keys': 0, 'disk_evicted_bytes': 0}
+        if not self.memory_quota and not self.disk_quota:
+            return result
+
+        keys = self.get_keys(cache)
+        in_redis = cache.get_redis_membership(list(keys.keys()))
+        disk_bytes = sum(entry['size'] for entry in keys.values())
+        memory_bytes = sum(entry['size'] for key, entry in keys.items() if in_redis[key])
+
+        for key in self.get_eviction_order(cache, keys):
+            size = keys[key]['size']
+            if self.disk_quota and disk_bytes > self.disk_quota:
+                if not dry_run:
+                    cache.delete(key)
+                disk_bytes -= size
+                result['disk_evicted_keys'] += 1
+                result['disk_evicted_bytes'] += size
+                if in_redis[key]:
+                    memory_bytes -= size
+            elif self.memory_quota and memory_bytes > self.memory_quota and in_redis[key]:
+                if not dry_run:
+                    cache.delete_redis(key)
+                memory_bytes -= size
+                result['memory_evicted_keys'] += 1
+                result['memory_evicted_bytes'] += size
+            elif (not self.disk_quota or disk_bytes <= self.disk_quota) and \
+                    (not self.memory_quota or memory_bytes <= self.memory_quota):
+                break
+
+        if logger is not None:
+            logger.info("Cache quota %s: %s" % (self.namespace, result))
+        return result
+
+
+class RemoveUntransformedDataPolicy(CachePolicy):
+    """Remove the untransformed data from cached task data, which was causing bloat.
+
+    :param lowest_finished: Only TaskRuns with a lower ID, defaults to None (all)
+    :type lowest_finished: int, optional
+    """
+
+    name = 'remove_untransformed_data'
+    untransformed_keys = ['untransformed_intensity_data', 'untransformed_feature_metadata']
+    #: The modules of the TaskRuns whose task data has untransformed data
+    module_names = ['phenomedb.analysis', 'phenomedb.batch_correction', 'phenomedb.pipelines']
+
+    def __init__(self, lowest_finished=None):
+        super().__init__(namespace='task_data')
+        self.lowest_finished = lowest_finished
+
+    def apply(self, cache, db_session=None, dry_run=False, logger=None):
+
+        from phenomedb.models import TaskRun
+        import phenomedb.utilities as utils
+
+        if db_session is None:
+            raise Exception("RemoveUntransformedDataPolicy requires a db_session")
+
+        task_run_query = db_session.query(TaskRun.id).filter(TaskRun.module_name.in_(self.module_names))
+        if self.lowest_finished is not None and utils.is_number(self.lowest_finished):
+            task_run_query = task_run_query.filter(TaskRun.id < self.lowest_finished)
+        task_run_ids = set(task_run_id for task_run_id, in task_run_query.all())
+
+        result = {'updated': 0, 'ignored': 0, 'failed': 0}
+        keys = {}
+        for key in self.get_keys(cache).keys():
+            try:
+                task_run_id = int(key.split('::')[1])
+            except (IndexError, ValueError):
+                # Not the task data of a TaskRun, ie TaskData::TEST0
+                continue
+            if task_run_id in task_run_ids:
+                keys[key] = task_run_id
+
+        for key in sorted(keys.keys(), key=lambda key: -keys[key]):
+            try:
+                task_run_data = cache.get(key, track_access=False)
+                if isinstance(task_run_data, dict) \
+                        and any(k in task_run_data.keys() for k in self.untransformed_keys):
+                    for untransformed_key in self.untransformed_keys:
+                        task_run_data.pop(untransformed_key, None)
+                    if not dry_run:
+                        cache.set(key, task_run_data)
+                    result['updated'] += 1
+                else:
+                    result['ignored'] += 1
+                # Only needed on disk
+                if not dry_run:
+                    cache.delete_redis(key)
+            except Exception as err:
+                result['failed'] += 1
+                if logger is not None:
+                    logger.exception(err)
+
+        return result
+
+
+class MoveTaskOutputPolicy(CachePolicy):
+    """Move :class:`phenomedb.models.TaskRun` output from the database to the cache, to free up database space and
+    simplify data restore.
+
+    :param highest_finished: Only TaskRuns with a higher ID, defaults to None (all)
+    :type highest_finished: int, optional
+    :param update_db: Whether to remove the output from the database once cached, defaults to False
+    :type update_db: bool, optional
+    """
+
+    name = 'move_task_output'
+
+    def __init__(self, highest_finished=None, update_db=False):
+        super().__init__(namespace='task_output')
+        self.highest_finished = highest_finished
+        self.update_db = update_db
+
+    def apply(self, cache, db_session=None, dry_run=False, logger=None):
+
+        from phenomedb.models import TaskRun
+        import phenomedb.utilities as utils
+
+        if db_session is None:
+            raise Exception("MoveTaskOutputPolicy requires a db_session")
+
+        result = {'moved': 0, 'skipped': 0, 'output_size_bytes': 0}
+        task_run_query = db_session.query(TaskRun.id).filter(TaskRun.output != None)
+        if self.highest_finished is not None and utils.is_number(self.highest_finished):
+            task_run_query = task_run_query.filter(TaskRun.id > self.highest_finished)
+
+        for task_run_id, in task_run_query.order_by(TaskRun.id.asc()).all():
+
+            task_run = db_session.query(TaskRun).filter(TaskRun.id == task_run_id).first()
+            if task_run.output is None or (cache.exists(task_run.get_task_output_cache_key()) and self.update_db is not True):
+                result['skipped'] += 1
+                continue
+
+            output = dict(task_run.output)
+            if dry_run:
+                result['moved'] += 1
+                continue
+
+            cache.set(task_run.get_task_output_cache_key(), output)
+            cache.delete_redis(task_run.get_task_output_cache_key())
+            if cache.get(task_run.get_task_output_cache_key(), track_access=False) != output:
+                raise Exception('Cache is not the same as expected %s != %s' % (cache.get(task_run.get_task_output_cache_key()), output))
+            cache.delete_redis(task_run.get_task_output_cache_key())
+            result['moved'] += 1
+
+            if self.update_db is True:
+                task_run.output = None
+                db_session.flush()
+                result['output_size_bytes'] += utils.total_size(output)
+
+            if logger is not None:
+                logger.info("%s output created" % task_run_id)
+
+        return result
+
+
+class CacheStats:
+    """Per-namespace report of the cache: key counts, memory and disk bytes against quota, and hit rates.
+
+    :param cache: The cache.
+    :type cache: :class:`phenomedb.cache.Cache`
+    """
+
+    def __init__(self, cache):
+        self.cache = cache
+
+    def collect(self):
+        """Collect the stats.
+
+        :return: namespace -> stats
+        :rtype: dict
+        """
+
+        index = self.cache.get_index()
+        in_redis = self.cache.get_redis_membership(list(index.keys()))
+        hits = self.cache.get_hit_counts()
+
+        stats = OrderedDict()
+        for namespace in NAMESPACES.keys():
+            stats[namespace] = {'keys': 0, 'disk_bytes': 0, 'memory_keys': 0, 'memory_bytes': 0,
+                                'disk_quota': get_quota('disk', namespace),
+                                'memory_quota': get_quota('memory', namespace),
+                                'redis_hits': hits.get('%s:redis' % namespace, 0),
+                                'file_hits': hits.get('%s:file' % namespace, 0),
+                                'misses': hits.get('%s:miss' % namespace, 0)}
+        for key, entry in index.items():
+            namespace_stats = stats[get_namespace(key)]
+            namespace_stats['keys'] += 1
+            namespace_stats['disk_bytes'] += entry['size']
+            if in_redis[key]:
+                namespace_stats['memory_keys'] += 1
+                namespace_stats['memory_bytes'] += entry['size']
+        for namespace_stats in stats.values():
+            requests = namespace_stats['redis_hits'] + namespace_stats['file_hits'] + namespace_stats['misses']
+            namespace_stats['hit_rate'] = (namespace_stats['redis_hits'] + namespace_stats['file_hits']) / requests \
+                if requests > 0 else None
+        return stats
+
+    def to_dataframe(self):
+        """Get the stats as a dataframe, one row per namespace.
+
+        :return: The stats.
+        :rtype: :class:`pandas.DataFrame`
+        """
+        return pd.DataFrame.from_dict(self.collect(), orient='index')
+
+
+def get_quota(tier, namespace):
+    """Get the configured byte quota for a namespace.
+
+    :param tier: 'memory' or 'disk'
+    :type tier: str
+    :param namespace: The namespace
+    :type namespace: str
+    :return: The quota in bytes, 0 for none.
+    :rtype: int
+    """
+    return config.getint('CACHE', '%s_quota_%s' % (tier, namespace), fallback=0)
+
+
+class CachePolicyEngine:
+    """Applies a list of policies to the cache, in order.
+
+    :param cache: The cache.
+    :type cache: :class:`phenomedb.cache.Cache`
+    :param policies: The policies, defaults to None (the configured quota policies)
+    :type policies: list, optional
+    """
+
+    def __init__(self, cache, policies=None):
+        self.cache = cache
+        if policies is None:
+            policies = self.get_quota_policies()
+        self.policies = policies
+
+    @staticmethod
+    def get_quota_policies():
+        """Get a :class:`QuotaEvictionPolicy` for each namespace with a configured quota.
+
+        :return: The policies.
+        :rtype: list
+        """
+
+        strategy = config.get('CACHE', 'eviction_strategy', fallback='lru')
+        policies = []
+        for namespace in NAMESPACES.keys():
+            memory_quota = get_quota('memory', namespace)
+            disk_quota = get_quota('disk', namespace)
+            if memory_quota or disk_quota:
+                policies.append(QuotaEvictionPolicy(namespace, memory_quota=memory_quota, disk_quota=disk_quota,
+                                                    strategy=strategy))
+        return policies
+
+    def run(self, db_session=None, dry_run=False, logger=None):
+        """Apply the policies.
+
+        :param db_session: The db_session, for policies that need it, defaults to None
+        :type db_session: object, optional
+        :param dry_run: Report what would change without changing it, defaults to False
+        :type dry_run: bool, optional
+        :param logger: The logger, defaults to None
+        :type logger: :class:`logging.Logger`, optional
+        :return: The result of each policy, in order.
+        :rtype: list
+        """
+
+        results = []
+        for policy in self.policies:
+            start = time.time()
+            result = policy.apply(self.cache, db_session=db_session, dry_run=dry_run, logger=logger)
+            results.append({'policy': policy.name, 'namespace': policy.namespace, 'result': result,
+                            'seconds': time.time() - start})
+        return results
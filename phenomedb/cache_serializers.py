@@ -0,0 +1,518 @@
+"""Serializers for the :class:`phenomedb.cache.Cache` Redis and file tiers.
+
+Every serialized value starts with a 16 byte header naming the serializer that wrote it, so DataFrames (Arrow
+IPC/Feather or Parquet), NumPy arrays (NPY), task data (NPY and Feather blobs, see :class:`TaskDataSerializer`) and
+everything else (pickle) can share the same keyspace, and the payload of a memory-mapped file can be read without
+copying.
+
+Values written by the deprecated pyarrow serialization context, or as CSV, have no header. They are still readable
+here and can be converted in place with :class:`phenomedb.cache.MigrateCacheFormat`.
+"""
+
+import io
+import json
+import os
+import pickle
+import tempfile
+from abc import ABC, abstractmethod
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.feather as feather
+import pyarrow.parquet as pq
+
+from phenomedb.task_data import TaskData
+
+MAGIC = b'PHENOMEDB'
+HEADER_LENGTH = 16
+#: The format name of a redis manifest for a value stored in chunks
+MANIFEST = 'chunked'
+
+
+class CacheSerializer(ABC):
+    """Base class for cache serializers.
+
+    :param compression: The compression codec, where the format supports one, defaults to 'uncompressed'.
+    :type compression: str, optional
+    """
+
+    #: Unique name written to the header, at most 7 ASCII characters
+    name = None
+
+    def __init__(self, compression='uncompressed'):
+        self.compression = compression
+
+    @abstractmethod
+    def accepts(self, value):
+        """Whether this serializer can write the value.
+
+        :param value: The value.
+        :type value: object
+        :rtype: bool
+        """
+        pass
+
+    @abstractmethod
+    def dumps(self, value):
+        """Serialize the value, without the header.
+
+        :param value: The value.
+        :type value: object
+        :return: The payload.
+        :rtype: bytes or :class:`pyarrow.Buffer`
+        """
+        pass
+
+    @abstractmethod
+    def loads(self, buffer):
+        """Deserialize the payload.
+
+        :param buffer: The payload, possibly memory-mapped.
+        :type buffer: :class:`pyarrow.Buffer`
+        :return: The value.
+        :rtype: object
+        """
+        pass
+
+    def dump_parts(self, value):
+        """Serialize the value, without the header, as a list of buffers to be written in order.
+
+        Serializers that can avoid copying the value into one contiguous buffer override this.
+
+        :param value: The value.
+        :type value: object
+        :return: The payload parts.
+        :rtype: list
+        """
+        return [self.dumps(value)]
+
+    def header(self):
+        """Get the header for this serializer.
+
+        :return: The 16 byte header.
+        :rtype: bytes
+        """
+        return MAGIC + self.name.ljust(HEADER_LENGTH - len(MAGIC)).encode('ascii')
+
+
+class FeatherSerializer(CacheSerializer):
+    """Arrow IPC (Feather v2) for DataFrames. Uncompressed files can be read zero-copy from a memory map."""
+
+    name = 'feather'
+
+    def accepts(self, value):
+        return isinstance(value, pd.DataFrame)
+
+    def dumps(self, value):
+        sink = pa.BufferOutputStream()
+        feather.write_feather(value, sink, compression=self.compression)
+        return sink.getvalue()
+
+    def loads(self, buffer):
+        return feather.read_table(pa.BufferReader(buffer)).to_pandas()
+
+
+class ParquetSerializer(CacheSerializer):
+    """Parquet for DataFrames. Smaller on disk than Feather, but always decoded on read."""
+
+    name = 'parquet'
+
+    def accepts(self, value):
+        return isinstance(value, pd.DataFrame)
+
+    def dumps(self, value):
+        sink = pa.BufferOutputStream()
+        compression = 'NONE' if self.compression == 'uncompressed' else self.compression
+        pq.write_table(pa.Table.from_pandas(value), sink, compression=compression)
+        return sink.getvalue()
+
+    def loads(self, buffer):
+        return pq.read_table(pa.BufferReader(buffer)).to_pandas()
+
+
+class NumpySerializer(CacheSerializer):
+    """NPY for non-object NumPy arrays. Reads are zero-copy views onto the (read-only) buffer."""
+
+    name = 'npy'
+
+    def accepts(self, value):
+        # Subclasses such as np.matrix are pickled so that they keep their type
+        return type(value) is np.ndarray and not value.dtype.hasobject
+
+    def dumps(self, value):
+        return b''.join(memoryview(part).cast('B') for part in self.dump_parts(value))
+
+    def dump_parts(self, value):
+        # The NPY header, then the array's own memory, so large matrices are not copied
+        header_data = np.lib.format.header_data_from_array_1_0(value)
+        if header_data['fortran_order']:
+            data = value.T
+        else:
+            data = np.ascontiguousarray(value)
+        stream = io.BytesIO()
+        try:
+            np.lib.format.write_array_header_1_0(stream, header_data)
+        except ValueError:
+            np.lib.format.write_array_header_2_0(stream, header_data)
+        return [stream.getvalue(), memoryview(data).cast('B')]
+
+    def loads(self, buffer):
+        stream = io.BytesIO(memoryview(buffer)[:min(buffer.size, 65536)])
+        version = np.lib.format.read_magic(stream)
+        if version == (1, 0):
+            shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(stream)
+        else:
+            shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(stream)
+        count = int(np.prod(shape))
+        array = np.frombuffer(buffer, dtype=dtype, count=count, offset=stream.tell())
+        return array.reshape(shape, order='F' if fortran_order else 'C')
+
+
+class TaskDataSerializer(CacheSerializer):
+    """:class:`phenomedb.task_data.TaskData` containers. The DataFrames and NumPy arrays are each serialized as Feather or
+    NPY (see :func:`serialize_parts`) after a pickled manifest of the other values, so they are read as views onto the
+    buffer, as they would be on their own.
+
+    The payload is the manifest length (8 bytes, little-endian), the manifest, then the blobs, each starting on an
+    ALIGNMENT byte boundary.
+    """
+
+    name = 'taskdat'
+    ALIGNMENT = 64
+
+    def accepts(self, value):
+        return isinstance(value, TaskData)
+
+    def dumps(self, value):
+        return b''.join(memoryview(part).cast('B') for part in self.dump_parts(value))
+
+    def dump_parts(self, value):
+        values = {}
+        blobs = []
+        blob_parts = []
+        offset = 0
+        for key, item in value.items():
+            if isinstance(item, (pd.DataFrame, np.ndarray)):
+                if isinstance(item, np.ndarray):
+                    # np.matrix and other subclasses are stored as plain arrays
+                    item = np.asarray(item)
+                parts = serialize_parts(item, compression=self.compression)
+                length = get_size(parts)
+                padding = self.get_padding(length)
+                blobs.append((key, offset, length))
+                blob_parts.extend(parts + [b'\0' * padding])
+                offset = offset + length + padding
+            else:
+                values[key] = item
+
+        manifest = pickle.dumps({'keys': list(value.keys()), 'values': values, 'blobs': blobs}, protocol=5)
+        header = len(manifest).to_bytes(8, 'little')
+        return [header, manifest, b'\0' * self.get_padding(len(header) + len(manifest))] + blob_parts
+
+    def loads(self, buffer, names=None):
+        """Deserialize the payload.
+
+        :param buffer: The payload, possibly memory-mapped.
+        :type buffer: :class:`pyarrow.Buffer`
+        :param names: The names of the artefacts to deserialize, defaults to None (all). The blobs of the others are
+            not read.
+        :type names: list, optional
+        :return: The task data.
+        :rtype: :class:`phenomedb.task_data.TaskData`
+        """
+
+        view = memoryview(buffer)
+        manifest_length = int.from_bytes(view[:8], 'little')
+        manifest = pickle.loads(view[8:8 + manifest_length])
+        start = 8 + manifest_length + self.get_padding(8 + manifest_length)
+
+        keys = [key for key in manifest['keys'] if names is None or key in names]
+        blobs = {key: deserialize(buffer.slice(start + offset, length)) for key, offset, length in manifest['blobs']
+                 if key in keys}
+        return TaskData((key, blobs[key] if key in blobs else manifest['values'][key]) for key in keys)
+
+    def get_padding(self, length):
+        """Get the padding to the next ALIGNMENT byte boundary.
+
+        :param length: The length written so far.
+        :type length: int
+        :return: The number of padding bytes.
+        :rtype: int
+        """
+        return -length % self.ALIGNMENT
+
+
+class PickleSerializer(CacheSerializer):
+    """Pickle protocol 5, for dictionaries, lists and anything the columnar formats cannot hold."""
+
+    name = 'pickle'
+
+    def accepts(self, value):
+        return True
+
+    def dumps(self, value):
+        return pickle.dumps(value, protocol=5)
+
+    def loads(self, buffer):
+        return pickle.loads(memoryview(buffer))
+
+
+serializers = {serializer.name: serializer for serializer in [FeatherSerializer, ParquetSerializer,
+                                                              NumpySerializer, TaskDataSerializer, PickleSerializer]}
+
+
+def get_format(buffer):
+    """Get the name of the serializer that wrote the buffer.
+
+    :param buffer: The serialized value.
+    :type buffer: bytes or :class:`pyarrow.Buffer`
+    :return: The serializer name, or None if the buffer has no header (legacy format).
+    :rtype: str
+    """
+
+    header = memoryview(buffer)[:HEADER_LENGTH].tobytes()
+    if len(header) == HEADER_LENGTH and header.startswith(MAGIC):
+        return header[len(MAGIC):].decode('ascii').strip()
+    else:
+        return None
+
+
+def get_candidate_serializers(value, dataframe_format='feather', compression='uncompressed'):
+    """Get the serializers to try for the value, most specific first. Pickle is always the last resort.
+
+    :param value: The value.
+    :type value: object
+    :param dataframe_format: The DataFrame format, 'feather' or 'parquet', defaults to 'feather'.
+    :type dataframe_format: str, optional
+    :param compression: The compression codec, defaults to 'uncompressed'.
+    :type compression: str, optional
+    :return: The serializers.
+    :rtype: list
+    """
+
+    if dataframe_format not in ['feather', 'parquet']:
+        raise Exception("Unknown cache dataframe_format %s" % dataframe_format)
+
+    candidates = [serializers[dataframe_format](compression=compression), NumpySerializer(),
+                  TaskDataSerializer(compression=compression)]
+    return [serializer for serializer in candidates if serializer.accepts(value)] + [PickleSerializer()]
+
+
+def serialize(value, dataframe_format='feather', compression='uncompressed'):
+    """Serialize a value with its header, into one contiguous buffer. See :func:`serialize_parts`.
+
+    :param value: The value.
+    :type value: object
+    :param dataframe_format: The DataFrame format, 'feather' or 'parquet', defaults to 'feather'.
+    :type dataframe_format: str, optional
+    :param compression: The compression codec, defaults to 'uncompressed'.
+    :type compression: str, optional
+    :return: The serialized value.
+    :rtype: bytes
+    """
+
+    return b''.join(serialize_parts(value, dataframe_format=dataframe_format, compression=compression))
+
+
+def serialize_parts(value, dataframe_format='feather', compression='uncompressed'):
+    """Serialize a value with its header, as a list of byte buffers (the header first) that together make up the
+    serialized value. Writing the parts in turn avoids copying large values into one buffer.
+
+    DataFrames that Arrow cannot represent (for example object columns mixing floats and strings) fall back to pickle.
+
+    :param value: The value.
+    :type value: object
+    :param dataframe_format: The DataFrame format, 'feather' or 'parquet', defaults to 'feather'.
+    :type dataframe_format: str, optional
+    :param compression: The compression codec, defaults to 'uncompressed'.
+    :type compression: str, optional
+    :return: The serialized value parts, as bytes-like objects.
+    :rtype: list
+    """
+
+    for serializer in get_candidate_serializers(value, dataframe_format=dataframe_format, compression=compression):
+        try:
+            payload_parts = serializer.dump_parts(value)
+        except (pa.ArrowException, ValueError, TypeError):
+            if isinstance(serializer, PickleSerializer):
+                raise
+            continue
+        return [serializer.header()] + [memoryview(part).cast('B') for part in payload_parts]
+
+
+def get_size(parts):
+    """Get the total size of serialized value parts.
+
+    :param parts: The parts, as bytes-like objects.
+    :type parts: list
+    :return: The size in bytes.
+    :rtype: int
+    """
+    return sum(memoryview(part).nbytes for part in parts)
+
+
+def iter_chunks(parts, chunk_size):
+    """Split serialized value parts into chunks of chunk_size bytes (the last may be smaller). Chunks are views onto
+    the parts where possible; only chunks that span two parts are copied.
+
+    :param parts: The parts, as bytes-like objects.
+    :type parts: list
+    :param chunk_size: The chunk size in bytes.
+    :type chunk_size: int
+    :return: A generator of chunks.
+    :rtype: generator
+    """
+
+    pending = []
+    pending_size = 0
+    for part in parts:
+        view = memoryview(part).cast('B')
+        offset = 0
+        while offset < view.nbytes:
+            take = min(chunk_size - pending_size, view.nbytes - offset)
+            pending.append(view[offset:offset + take])
+            pending_size += take
+            offset += take
+            if pending_size == chunk_size:
+                yield pending[0] if len(pending) == 1 else b''.join(pending)
+                pending = []
+                pending_size = 0
+    if pending_size > 0:
+        yield pending[0] if len(pending) == 1 else b''.join(pending)
+
+
+def deserialize(data):
+    """Deserialize a value, in either the current or the legacy pyarrow serialization format.
+
+    :param data: The serialized value.
+    :type data: bytes or :class:`pyarrow.Buffer`
+    :return: The value.
+    :rtype: object
+    """
+
+    buffer = data if isinstance(data, pa.Buffer) else pa.py_buffer(data)
+    format = get_format(buffer)
+    if format is None:
+        return legacy_deserialize(buffer)
+    elif format not in serializers:
+        raise Exception("Unknown cache serialization format %s" % format)
+    return serializers[format]().loads(buffer.slice(HEADER_LENGTH))
+
+
+def deserialize_task_data(data, names=None):
+    """Deserialize task data, only deserializing the named artefacts. Values other than
+    :class:`phenomedb.task_data.TaskData` (ie task data cached as JSON) are deserialized whole and then filtered.
+
+    :param data: The serialized value.
+    :type data: bytes or :class:`pyarrow.Buffer`
+    :param names: The names of the artefacts, defaults to None (all).
+    :type names: list, optional
+    :return: The task data.
+    :rtype: :class:`phenomedb.task_data.TaskData`
+    """
+
+    buffer = data if isinstance(data, pa.Buffer) else pa.py_buffer(data)
+    if get_format(buffer) == TaskDataSerializer.name:
+        return TaskDataSerializer().loads(buffer.slice(HEADER_LENGTH), names=names)
+
+    value = deserialize(buffer)
+    if value is None:
+        return None
+    return TaskData((key, item) for key, item in value.items() if names is None or key in names)
+
+
+def serialize_manifest(size, chunks, chunk_size, generation=None):
+    """Serialize the manifest of a value stored in chunks.
+
+    :param size: The total size of the serialized value.
+    :type size: int
+    :param chunks: The number of chunks.
+    :type chunks: int
+    :param chunk_size: The size of each chunk (except the last).
+    :type chunk_size: int
+    :param generation: The id of the write the chunks belong to, part of their keys, defaults to None.
+    :type generation: str, optional
+    :return: The serialized manifest.
+    :rtype: bytes
+    """
+    return MAGIC + MANIFEST.ljust(HEADER_LENGTH - len(MAGIC)).encode('ascii') + \
+        json.dumps({'size': size, 'chunks': chunks, 'chunk_size': chunk_size, 'generation': generation}).encode('utf-8')
+
+
+def deserialize_manifest(data):
+    """Deserialize the manifest of a value stored in chunks.
+
+    :param data: The serialized manifest.
+    :type data: bytes
+    :return: {size, chunks, chunk_size, generation}. The generation is None for manifests written before generations.
+    :rtype: dict
+    """
+    manifest = json.loads(bytes(data[HEADER_LENGTH:]).decode('utf-8'))
+    manifest.setdefault('generation', None)
+    return manifest
+
+
+def legacy_deserialize(buffer):
+    """Deserialize a value written by the deprecated pyarrow serialization context.
+
+    :param buffer: The serialized value.
+    :type buffer: bytes or :class:`pyarrow.Buffer`
+    :raises Exception: If this pyarrow no longer has the serialization context.
+    :return: The value.
+    :rtype: object
+    """
+
+    if not hasattr(pa, 'default_serialization_context'):
+        raise Exception("Cache value is in the legacy pyarrow serialization format, which pyarrow %s cannot read. "
+                        "Run cache.MigrateCacheFormat with an older pyarrow to convert it." % pa.__version__)
+    return pa.default_serialization_context().deserialize(buffer)
+
+
+def read_buffer(file_path, memory_map=True):
+    """Read a cache file into a buffer.
+
+    :param file_path: The file path.
+    :type file_path: str
+    :param memory_map: Whether to memory map the file rather than read it, defaults to True.
+    :type memory_map: bool, optional
+    :return: The file contents.
+    :rtype: :class:`pyarrow.Buffer`
+    """
+
+    if memory_map:
+        source = pa.memory_map(file_path, 'r')
+    else:
+        source = pa.OSFile(file_path, 'rb')
+    buffer = source.read_buffer()
+    if not memory_map:
+        source.close()
+    return buffer
+
+
+def write_file(file_path, serialized_value):
+    """Write a serialized value to disk, atomically replacing any existing file.
+
+    Readers holding a memory map of the old file keep a valid view of it.
+
+    :param file_path: The file path.
+    :type file_path: str
+    :param serialized_value: The serialized value, or its parts (see :func:`serialize_parts`).
+    :type serialized_value: bytes or list
+    """
+
+    if not isinstance(serialized_value, list):
+        serialized_value = [serialized_value]
+    # A temp file of its own, so concurrent writers of the same key do not write into each other's file
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(file_path), suffix='.tmp')
+    try:
+        # mkstemp creates the file readable by its owner only; cache files are shared with the other services
+        os.fchmod(fd, 0o644)
+        with os.fdopen(fd, 'wb') as f:
+            for part in serialized_value:
+                f.write(part)
+        os.replace(tmp_path, file_path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
@@ -0,0 +1,270 @@
+"""CompoundClass aggregation. Aggregates the feature: columns of an AnnotatedFeature dataframe by CompoundClass.
+
+The classes of every feature are loaded in one query per class type, and held as a sparse feature x class membership
+matrix per class level. Sums and means of every class are then matrix products of the intensities and the membership,
+and min, max and median are reductions over each class's columns, so every class is computed at once rather than per
+sample per class. Several class levels, and aggregate functions, can be computed from one parent dataframe in one call.
+"""
+
+import logging
+import warnings
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+import phenomedb.utilities as utils
+from phenomedb.models import Annotation, AnnotationCompound, CompoundClass, CompoundClassCompound, FeatureMetadata
+
+AGGREGATE_FUNCTIONS = ['sum', 'mean', 'min', 'max', 'median']
+
+CLASS_LEVELS = ['kingdom', 'category', 'main_class', 'sub_class', 'direct_parent']
+
+
+def get_class_type(class_type):
+    """Get a CompoundClassType from its name.
+
+    :param class_type: The class type, ie 'hmdb', 'lipidmaps', 'classyfire'.
+    :type class_type: str or :class:`phenomedb.models.CompoundClass.CompoundClassType`
+    :raises Exception: If the class type is not known.
+    :return: The class type.
+    :rtype: :class:`phenomedb.models.CompoundClass.CompoundClassType`
+    """
+
+    if isinstance(class_type, CompoundClass.CompoundClassType):
+        return class_type
+    try:
+        return CompoundClass.CompoundClassType(class_type)
+    except ValueError:
+        raise Exception("Unknown CompoundClass Type %s" % class_type)
+
+
+def get_class_level(class_level):
+    """Get a class level from its label, ie 'Main Class' -> 'main_class'.
+
+    :param class_level: The class level.
+    :type class_level: str
+    :raises Exception: If the class level is not known.
+    :return: The class level.
+    :rtype: str
+    """
+
+    class_level = class_level.lower().replace(" ", "_")
+    if class_level not in CLASS_LEVELS:
+        raise Exception("Class level %s must be one of %s " % (class_level, CLASS_LEVELS))
+    return class_level
+
+
+class ClassMembership:
+    """The CompoundClass membership of a set of features at one class level.
+
+    :param class_level: The class level.
+    :type class_level: str
+    :param feature_colnames: The feature: column names, the rows of the matrix.
+    :type feature_colnames: list
+    :param class_column_names: The compound_class: column names, the columns of the matrix.
+    :type class_column_names: list
+    :param matrix: The features x classes membership matrix, 1 where the feature is in the class.
+    :type matrix: :class:`scipy.sparse.csr_matrix`
+    """
+
+    def __init__(self, class_level, feature_colnames, class_column_names, matrix):
+        self.class_level = class_level
+        self.feature_colnames = feature_colnames
+        self.class_column_names = class_column_names
+        self.matrix = matrix
+
+    def get_feature_map(self):
+        """Get the features of each class.
+
+        :return: class column name -> [feature column names]
+        :rtype: dict
+        """
+
+        matrix = self.matrix.tocsc()
+        return OrderedDict((class_column_name, [self.feature_colnames[i] for i in matrix[:, j].indices])
+                           for j, class_column_name in enumerate(self.class_column_names))
+
+
+class CompoundClassAggregator:
+    """Aggregates feature intensities by CompoundClass.
+
+    :param db_session: The db_session.
+    :type db_session: :class:`sqlalchemy.orm.Session`
+    :param class_type: The class type, ie 'hmdb', 'lipidmaps', 'classyfire'.
+    :type class_type: str or :class:`phenomedb.models.CompoundClass.CompoundClassType`
+    :param harmonise_annotations: Whether the feature columns are HarmonisedAnnotations, defaults to False
+    :type harmonise_annotations: bool, optional
+    :param logger: The logger, defaults to None
+    :type logger: :class:`logging.Logger`, optional
+    :param chunk_size: The maximum number of ids per IN query, defaults to 10000
+    :type chunk_size: int, optional
+    """
+
+    def __init__(self, db_session, class_type, harmonise_annotations=False, logger=None, chunk_size=10000):
+        self.db_session = db_session
+        self.class_type = get_class_type(class_type)
+        self.harmonise_annotations = harmonise_annotations
+        self.logger = logger if logger is not None else logging.getLogger(__name__)
+        self.chunk_size = chunk_size
+
+    def load_feature_classes(self, feature_colnames):
+        """Load the CompoundClasses of the class type of each feature, in one query per id type.
+
+        :param feature_colnames: The feature: column names.
+        :type feature_colnames: list
+        :return: feature column name -> [CompoundClass], ordered by id
+        :rtype: dict
+        """
+
+        harmonised_annotation_ids = {}
+        feature_metadata_ids = {}
+        for colname in feature_colnames:
+            feature_metadata_id, harmonised_annotation_id, assay, annotation_method, cpd_name, version, unit = \
+                utils.breakdown_annotation_id(colname, harmonise_annotations=self.harmonise_annotations)
+            if harmonised_annotation_id:
+                harmonised_annotation_ids.setdefault(int(harmonised_annotation_id), []).append(colname)
+            elif feature_metadata_id:
+                feature_metadata_ids.setdefault(int(feature_metadata_id), []).append(colname)
+
+        feature_classes = {}
+        for id_column, query, colnames_by_id in [(AnnotationCompound.harmonised_annotation_id,
+                                                  self.db_session.query(AnnotationCompound.harmonised_annotation_id, CompoundClass)
+                                                  .select_from(AnnotationCompound),
+                                                  harmonised_annotation_ids),
+                                                 (FeatureMetadata.id,
+                                                  self.db_session.query(FeatureMetadata.id, CompoundClass)
+                                                  .select_from(FeatureMetadata)
+                                                  .join(Annotation, FeatureMetadata.annotation_id == Annotation.id)
+                                                  .join(AnnotationCompound, AnnotationCompound.harmonised_annotation_id == Annotation.harmonised_annotation_id),
+                                                  feature_metadata_ids)]:
+            ids = list(colnames_by_id.keys())
+            for start in range(0, len(ids), self.chunk_size):
+                results = query.join(CompoundClassCompound, CompoundClassCompound.compound_id == AnnotationCompound.compound_id) \
+                    .join(CompoundClass, CompoundClassCompound.compound_class_id == CompoundClass.id) \
+                    .filter(id_column.in_(ids[start:start + self.chunk_size]), CompoundClass.type == self.class_type) \
+                    .order_by(CompoundClass.id).all()
+                for id, compound_class in results:
+                    for colname in colnames_by_id[id]:
+                        feature_classes.setdefault(colname, []).append(compound_class)
+
+        return feature_classes
+
+    def load_memberships(self, feature_colnames, class_levels=None):
+        """Build the class membership matrices of the features.
+
+        Each feature is a member of the first of its classes (by id) with a value at the class level.
+
+        :param feature_colnames: The feature: column names.
+        :type feature_colnames: list
+        :param class_levels: The class levels, defaults to None (all of :data:`CLASS_LEVELS`)
+        :type class_levels: list, optional
+        :return: class level -> :class:`ClassMembership`
+        :rtype: dict
+        """
+
+        if class_levels is None:
+            class_levels = CLASS_LEVELS
+        class_levels = [get_class_level(class_level) for class_level in class_levels]
+
+        feature_colnames = list(feature_colnames)
+        feature_classes = self.load_feature_classes(feature_colnames)
+
+        memberships = OrderedDict()
+        for class_level in class_levels:
+            class_column_names = OrderedDict()
+            rows = []
+            cols = []
+            for i, colname in enumerate(feature_colnames):
+                for compound_class in feature_classes.get(colname, []):
+                    if getattr(compound_class, class_level) is not None:
+                        class_column_name = "compound_class:%s::%s:%s:%s:noUnit" % (compound_class.id, compound_class.type.value,
+                                                                                    class_level, getattr(compound_class, class_level))
+                        rows.append(i)
+                        cols.append(class_column_names.setdefault(class_column_name, len(class_column_names)))
+                        break
+
+            matrix = sparse.csr_matrix((np.ones(len(rows)), (rows, cols)),
+                                       shape=(len(feature_colnames), len(class_column_names)))
+            memberships[class_level] = ClassMembership(class_level, feature_colnames, list(class_column_names.keys()), matrix)
+            self.logger.info("%s %s: %s of %s features in %s classes" % (self.class_type.value, class_level, len(rows),
+                                                                        len(feature_colnames), len(class_column_names)))
+
+        return memberships
+
+    @staticmethod
+    def aggregate_intensities(intensities, membership, aggregate_function):
+        """Aggregate an intensity matrix by class. Missing values are ignored, as pandas does.
+
+        :param intensities: The samples x features intensities.
+        :type intensities: :class:`numpy.ndarray`
+        :param membership: The class membership of the features.
+        :type membership: :class:`ClassMembership`
+        :param aggregate_function: One of :data:`AGGREGATE_FUNCTIONS`
+        :type aggregate_function: str
+        :raises Exception: If the aggregate function is not known.
+        :return: The samples x classes aggregates.
+        :rtype: :class:`numpy.ndarray`
+        """
+
+        matrix = membership.matrix
+        if aggregate_function in ['sum', 'mean']:
+            measured = ~np.isnan(intensities)
+            sums = np.asarray(matrix.T.dot(np.where(measured, intensities, 0).T)).T
+            if aggregate_function == 'sum':
+                return sums
+            counts = np.asarray(matrix.T.dot(measured.T.astype(float))).T
+            with np.errstate(invalid='ignore', divide='ignore'):
+                return np.where(counts > 0, sums / counts, np.nan)
+
+        elif aggregate_function in ['min', 'max', 'median']:
+            reduce = {'min': np.nanmin, 'max': np.nanmax, 'median': np.nanmedian}[aggregate_function]
+            matrix = matrix.tocsc()
+            aggregates = np.full((intensities.shape[0], matrix.shape[1]), np.nan)
+            with warnings.catch_warnings():
+                # All-NaN classes are NaN
+                warnings.simplefilter('ignore', category=RuntimeWarning)
+                for j in range(matrix.shape[1]):
+                    aggregates[:, j] = reduce(intensities[:, matrix.indices[matrix.indptr[j]:matrix.indptr[j + 1]]], axis=1)
+            return aggregates
+
+        else:
+            raise Exception("Unknown aggregation function %s, must be one of %s" % (aggregate_function, AGGREGATE_FUNCTIONS))
+
+    def aggregate(self, dataframe, class_levels=None, aggregate_functions=None, memberships=None):
+        """Aggregate the feature: columns of a dataframe by class, at each class level and aggregate function.
+
+        The non-feature columns are kept, followed by one compound_class: column per class.
+
+        :param dataframe: The combined AnnotatedFeature dataframe.
+        :type dataframe: :class:`pandas.DataFrame`
+        :param class_levels: The class levels, defaults to None (all of :data:`CLASS_LEVELS`)
+        :type class_levels: list, optional
+        :param aggregate_functions: The aggregate functions, defaults to None (['mean'])
+        :type aggregate_functions: list, optional
+        :param memberships: Memberships from :meth:`load_memberships`, defaults to None (loaded)
+        :type memberships: dict, optional
+        :return: (class level, aggregate function) -> aggregated dataframe
+        :rtype: dict
+        """
+
+        if aggregate_functions is None:
+            aggregate_functions = ['mean']
+
+        feature_colnames = [colname for colname in dataframe.columns if colname.startswith('feature:')]
+        other_colnames = [colname for colname in dataframe.columns if not colname.startswith('feature:')]
+        if memberships is None:
+            memberships = self.load_memberships(feature_colnames, class_levels=class_levels)
+
+        intensities = dataframe.loc[:, feature_colnames].to_numpy(dtype=float)
+
+        dataframes = OrderedDict()
+        for class_level, membership in memberships.items():
+            for aggregate_function in aggregate_functions:
+                aggregates = self.aggregate_intensities(intensities, membership, aggregate_function)
+                dataframes[(class_level, aggregate_function)] = pd.concat(
+                    [dataframe.loc[:, other_colnames],
+                     pd.DataFrame(aggregates, columns=membership.class_column_names, index=dataframe.index)], axis=1)
+
+        return dataframes
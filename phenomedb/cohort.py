@@ -0,0 +1,65 @@
+"""Cohort materialisation. Writes the matching ids of a query into an indexed temporary table.
+
+Downstream queries then join against the table, rather than re-running the query or shipping the ids as an IN (...)
+list with every statement. Temporary tables belong to a connection, so the table is created, and must be queried,
+on the session's connection, ie with db_session.execute() or pd.read_sql(statement, db_session.connection()).
+"""
+
+import logging
+import uuid
+
+from sqlalchemy import Column, Integer, MetaData, Table, func, select, text
+
+
+class CohortTable:
+    """A temporary table of the ids of an output model matching a query.
+
+    :param db_session: The db_session, the table is created on its connection.
+    :type db_session: :class:`sqlalchemy.orm.Session`
+    :param output_model: The output model name, ie 'SampleAssay'.
+    :type output_model: str
+    :param ids_select: The select of the matching ids.
+    :type ids_select: :class:`sqlalchemy.sql.Select`
+    :param logger: The logger, defaults to None
+    :type logger: :class:`logging.Logger`, optional
+    """
+
+    def __init__(self, db_session, output_model, ids_select, logger=None):
+        self.db_session = db_session
+        self.output_model = output_model
+        self.ids_select = ids_select
+        self.logger = logger if logger is not None else logging.getLogger(__name__)
+        self.name = "cohort_%s_%s" % (output_model.lower(), uuid.uuid4().hex[:12])
+        self.table = Table(self.name, MetaData(), Column('id', Integer, primary_key=True), prefixes=['TEMPORARY'])
+        self.row_count = None
+
+    def materialise(self):
+        """Create the table and insert the matching ids, with an INSERT ... SELECT on the server.
+
+        :return: The cohort table.
+        :rtype: :class:`CohortTable`
+        """
+
+        connection = self.db_session.connection()
+        self.table.create(connection)
+        connection.execute(self.table.insert().from_select(['id'], self.ids_select.order_by(None)))
+        # Temporary tables are not analysed by autovacuum
+        connection.execute(text("ANALYZE %s" % self.name))
+        self.row_count = connection.execute(select(func.count()).select_from(self.table)).scalar()
+        self.logger.info("%s cohort materialised, %s ids in %s" % (self.output_model, self.row_count, self.name))
+        return self
+
+    def select_ids(self):
+        """Get the select of the ids, to join or IN against.
+
+        :return: The select.
+        :rtype: :class:`sqlalchemy.sql.Select`
+        """
+
+        return select(self.table.c.id)
+
+    def drop(self):
+        """Drop the table."""
+
+        self.table.drop(self.db_session.connection(), checkfirst=True)
+        self.logger.debug("%s dropped" % self.name)
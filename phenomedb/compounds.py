@@ -2,6 +2,7 @@ import numpy as np
 import pandas as pd
 from phenomedb.models import *
 from phenomedb.task import Task
+from phenomedb import annotation_resolver
 import requests
 import json
 from pathlib import Path
@@ -93,6 +94,13 @@ class CompoundTask(Task):
         self.load_data()
         self.loop_and_map_data()
 
+    def post_commit_actions(self):
+        """Delete the memoised compound fields of the feature annotations, as the compounds may have changed.
+        """
+
+        annotation_resolver.delete_cache(self.cache)
+        super().post_commit_actions()
+
     def load_data(self):
         """Load the databases + the ExternalDB.ids
         """        
@@ -59,6 +59,23 @@ if 'PHENOMEDB__REDIS__MEMORY_EXPIRED_SECONDS' in os.environ:
 if 'PHENOMEDB__REDIS__DISK_EXPIRED_SECONDS' in os.environ:
      config['REDIS']['disk_expired_seconds'] = os.environ['PHENOMEDB__REDIS__DISK_EXPIRED_SECONDS']
 
+if not config.has_section('CACHE'):
+     config.add_section('CACHE')
+
+# The CACHE section has per-namespace keys (ie disk_quota_task_data), so any PHENOMEDB__CACHE__ variable is used
+for environment_variable, value in os.environ.items():
+     if environment_variable.startswith('PHENOMEDB__CACHE__'):
+          config['CACHE'][environment_variable[len('PHENOMEDB__CACHE__'):].lower()] = value
+
+if 'PHENOMEDB__R__BACKEND' in os.environ:
+     config['R']['backend'] = os.environ['PHENOMEDB__R__BACKEND']
+
+if 'PHENOMEDB__R__POOL_SOCKET' in os.environ:
+     config['R']['pool_socket'] = os.environ['PHENOMEDB__R__POOL_SOCKET']
+
+if 'PHENOMEDB__R__POOL_SIZE' in os.environ:
+     config['R']['pool_size'] = os.environ['PHENOMEDB__R__POOL_SIZE']
+
 if 'PHENOMEDB__WEBSERVER__URL' in os.environ:
      config['WEBSERVER']['url'] = os.environ['PHENOMEDB__WEBSERVER__URL']
 
@@ -131,6 +148,15 @@ if 'PHENOMEDB__DATA__NGINX_CACHE' in os.environ:
 if 'PHENOMEDB__DATA__TASK_DIRECTORY' in os.environ:
      config['DATA']['task_directory'] = os.environ['PHENOMEDB__DATA__TASK_DIRECTORY']
 
+if 'PHENOMEDB__DATA__MATRIX_STORE' in os.environ:
+     config['DATA']['matrix_store'] = os.environ['PHENOMEDB__DATA__MATRIX_STORE']
+
+if not config.has_section('MATRIX_STORE'):
+     config.add_section('MATRIX_STORE')
+
+if 'PHENOMEDB__MATRIX_STORE__ENABLED' in os.environ:
+     config['MATRIX_STORE']['enabled'] = os.environ['PHENOMEDB__MATRIX_STORE__ENABLED']
+
 if 'PHENOMEDB__R__SCRIPT_DIRECTORY' in os.environ:
      config['R']['script_directory'] = os.environ['PHENOMEDB__R__SCRIPT_DIRECTORY']
 
@@ -0,0 +1,142 @@
+"""Incremental SavedQuery dataframe refresh.
+
+A combined AnnotatedFeature dataframe built by :meth:`phenomedb.query_factory.QueryFactory.build_annotated_feature_dataframe_bulk`
+is cached with its build state: the SampleAssay ids it was built from and the AnnotatedFeature id high-water mark.
+Imports add the SampleAssays they touched to the build state as stale. On refresh, the SampleAssays that are new, no
+longer match, have AnnotatedFeatures above the high-water mark, or are stale are found, and only the rows of their
+samples are rebuilt and spliced into the cached dataframe.
+"""
+
+import numpy as np
+import pandas as pd
+
+#: The column prefixes of the feature and metadata columns, which only exist while a row has a value for them
+VALUE_COLUMN_PREFIXES = ('feature:', 'metadata::', 'h_metadata::')
+
+#: The values the builder gives the rows without a value, by column prefix. The h_metadata:: defaults depend on the
+#: HarmonisedMetadataField datatype, see :func:`get_harmonised_metadata_default`
+COLUMN_DEFAULTS = {'feature:': 0.0, 'metadata::': 0}
+
+
+def get_harmonised_metadata_default(datatype):
+    """Get the value the builder gives the rows without a value of an h_metadata:: column.
+
+    :param datatype: The HarmonisedMetadataField datatype, 'text', 'numeric' or 'datetime'.
+    :type datatype: str
+    :return: The default.
+    :rtype: object
+    """
+
+    return {'text': '', 'numeric': 0}.get(datatype, np.nan)
+
+
+def get_column_default(column, column_defaults=None):
+    """Get the value the builder gives the rows without a value of a column.
+
+    :param column: The column name.
+    :type column: str
+    :param column_defaults: column name -> default, for the h_metadata:: columns, defaults to None
+    :type column_defaults: dict, optional
+    :return: The default, NaN if it has none.
+    :rtype: object
+    """
+
+    if column_defaults and column in column_defaults:
+        return column_defaults[column]
+    for prefix, default in COLUMN_DEFAULTS.items():
+        if column.startswith(prefix):
+            return default
+    return np.nan
+
+
+def get_build_state(sample_assay_max_ids):
+    """Get the build state of a dataframe.
+
+    :param sample_assay_max_ids: SampleAssay id -> the maximum id of its matching AnnotatedFeatures.
+    :type sample_assay_max_ids: dict
+    :return: The build state, with sample_assay_ids, annotated_feature_max_id, and stale_sample_assay_ids.
+    :rtype: dict
+    """
+
+    return {'sample_assay_ids': sorted(int(sample_assay_id) for sample_assay_id in sample_assay_max_ids.keys()),
+            'annotated_feature_max_id': int(max(sample_assay_max_ids.values())) if len(sample_assay_max_ids) > 0 else 0,
+            'stale_sample_assay_ids': []}
+
+
+def add_stale_sample_assay_ids(build_state, sample_assay_ids):
+    """Add SampleAssay ids to the stale SampleAssay ids of a build state.
+
+    :param build_state: The build state, see :func:`get_build_state`.
+    :type build_state: dict
+    :param sample_assay_ids: The SampleAssay ids.
+    :type sample_assay_ids: list
+    :return: The updated build state.
+    :rtype: dict
+    """
+
+    build_state = dict(build_state)
+    build_state['stale_sample_assay_ids'] = sorted(set(build_state.get('stale_sample_assay_ids', []))
+                                                   | set(int(sample_assay_id) for sample_assay_id in sample_assay_ids))
+    return build_state
+
+
+def get_changed_sample_assay_ids(build_state, sample_assay_max_ids):
+    """Get the SampleAssays whose rows have to be rebuilt.
+
+    :param build_state: The build state the dataframe was built from, see :func:`get_build_state`.
+    :type build_state: dict
+    :param sample_assay_max_ids: The current SampleAssay id -> the maximum id of its matching AnnotatedFeatures.
+    :type sample_assay_max_ids: dict
+    :return: The ids of the new, removed, changed and stale SampleAssays.
+    :rtype: list
+    """
+
+    built = set(build_state['sample_assay_ids'])
+    current = set(sample_assay_max_ids.keys())
+    changed = (current ^ built) | {sample_assay_id for sample_assay_id, max_id in sample_assay_max_ids.items()
+                                   if max_id > build_state['annotated_feature_max_id']}
+    changed = changed | (set(build_state.get('stale_sample_assay_ids', [])) & (current | built))
+    return sorted(changed)
+
+
+def splice_dataframe(dataframe, update, unique_names, sort_by=None, sort_by_ascending=True, column_defaults=None):
+    """Replace the rows of a dataframe with the rebuilt rows.
+
+    Feature and metadata columns that no longer have a row are dropped, and new columns are appended, with the
+    builder's default for the existing rows (see :func:`get_column_default`), as a full rebuild gives them.
+
+    :param dataframe: The cached dataframe.
+    :type dataframe: :class:`pandas.DataFrame`
+    :param update: The rebuilt rows, or None if there are none.
+    :type update: :class:`pandas.DataFrame`
+    :param unique_names: The Unique Names of the rows to replace.
+    :type unique_names: list
+    :param sort_by: The columns to sort by, defaults to None
+    :type sort_by: list, optional
+    :param sort_by_ascending: The sort orders, defaults to True
+    :type sort_by_ascending: bool or tuple, optional
+    :param column_defaults: column name -> default of the new h_metadata:: columns, defaults to None
+    :type column_defaults: dict, optional
+    :return: The spliced dataframe.
+    :rtype: :class:`pandas.DataFrame`
+    """
+
+    kept = dataframe.loc[~dataframe['Unique Name'].isin(unique_names)]
+    if update is None:
+        update = pd.DataFrame()
+
+    columns = [column for column in dataframe.columns
+               if column in update.columns or not column.startswith(VALUE_COLUMN_PREFIXES) or kept[column].notnull().any()]
+    new_columns = [column for column in update.columns if column not in dataframe.columns]
+    columns = columns + new_columns
+
+    spliced = kept.reindex(columns=columns)
+    for column in new_columns:
+        spliced[column] = get_column_default(column, column_defaults)
+    if len(update) > 0:
+        spliced = pd.concat([spliced, update.reindex(columns=columns)], ignore_index=True)
+    else:
+        spliced = spliced.reset_index(drop=True)
+    if sort_by:
+        spliced = spliced.sort_values(sort_by, ascending=sort_by_ascending, ignore_index=True)
+    return spliced
@@ -11,7 +11,7 @@ import pandas as pd
 import datetime
 import re
 import json
-from sqlalchemy import func
+from sqlalchemy import func, bindparam
 import math
 from pathlib import Path
 from dateutil import parser
@@ -21,6 +21,7 @@ import json
 import redis
 import requests
 from phenomedb.query_factory import *
+from phenomedb import matrix_store
 from libchebipy._chebi_entity import ChebiEntity
 
 class ImportTask(Task):
@@ -113,6 +114,67 @@ class ImportTask(Task):
 
             raise Exception("Project not recognised: " + self.project_name)
 
+    def get_imported_sample_assay_ids(self):
+        """Get the ids of the SampleAssays the import may have added or changed, by default every SampleAssay of the project
+
+        :return: The SampleAssay ids
+        :rtype: list
+        """
+
+        return [sample_assay_id for sample_assay_id, in self.db_session.query(SampleAssay.id) \
+                    .join(Sample, SampleAssay.sample_id == Sample.id) \
+                    .join(Subject, Sample.subject_id == Subject.id) \
+                    .join(Project, Subject.project_id == Project.id) \
+                    .filter(func.lower(Project.name) == self.project_name.lower()).all()]
+
+    def mark_stale_saved_queries(self):
+        """Mark the cached dataframes of the SavedQueries that match the imported SampleAssays as stale, so they are refreshed incrementally when next loaded
+
+        :return: The ids of the stale SavedQueries
+        :rtype: list
+        """
+
+        stale_saved_query_ids = []
+        if not self.project_name:
+            return stale_saved_query_ids
+
+        sample_assay_ids = self.get_imported_sample_assay_ids()
+        if len(sample_assay_ids) == 0:
+            return stale_saved_query_ids
+
+        for saved_query in self.db_session.query(SavedQuery).filter(SavedQuery.cache_state != None).all():
+            if not saved_query.cache_state:
+                continue
+            query_factory = QueryFactory(saved_query=saved_query,db_env=self.db_env,db_session=self.db_session)
+            if query_factory.mark_cache_stale(sample_assay_ids):
+                stale_saved_query_ids.append(saved_query.id)
+
+        self.logger.info("Stale SavedQueries: %s" % stale_saved_query_ids)
+        return stale_saved_query_ids
+
+    def write_matrix_store(self):
+        """Write the matrix store of the imported FeatureDataset, see :mod:`phenomedb.matrix_store`
+        """
+
+        if self.feature_dataset is not None and self.feature_dataset.id and matrix_store.is_enabled():
+            matrix_store.MatrixStore(self.feature_dataset.id,logger=self.logger).build(self.db_session)
+
+    def post_commit_actions(self):
+        """Writes the FeatureDataset matrix store and marks the cached SavedQuery dataframes stale
+        """
+
+        try:
+            self.write_matrix_store()
+        except Exception as err:
+            self.logger.exception("Writing the matrix store failed: %s" % err)
+
+        try:
+            self.mark_stale_saved_queries()
+        except Exception as err:
+            self.logger.exception("Marking the stale SavedQueries failed: %s" % err)
+
+        super().post_commit_actions()
+
     def get_annotated_feature(self,feature_metadata_id,sample_assay_id):
         """Get a annotated_feature by feature metadata id and sample_assay.id
 
@@ -1318,8 +1380,11 @@ class AnnotationImportTask(ImportTask):
     :type validate: boolean
     :param pipeline_run_id: The Pipeline run ID
     :type pipeline_run_id: str, optional
+    :param bulk_import: Whether to write the AnnotatedFeatures in bulk (batched inserts and updates) rather than one at a time, default True
+    :type bulk_import: boolean, optional
     """
    
+    bulk_import_batch_size = 10000
     first_feature_column_index = None
     dataset = None
     feature_name_row_index = None
@@ -1332,10 +1397,15 @@ class AnnotationImportTask(ImportTask):
     version = None
     feature_metadata = None
 
-    def __init__(self,project_name=None,task_run_id=None,username=None,db_env=None,db_session=None,execution_date=None,validate=True,pipeline_run_id=None):
+    def __init__(self,project_name=None,task_run_id=None,username=None,db_env=None,db_session=None,execution_date=None,validate=True,pipeline_run_id=None,bulk_import=True):
         
         super().__init__(project_name=project_name,task_run_id=task_run_id,username=username,db_env=db_env,db_session=db_session,execution_date=execution_date,validate=validate,pipeline_run_id=pipeline_run_id)
 
+        if isinstance(bulk_import,str):
+            bulk_import = bulk_import.lower() == 'true'
+        self.bulk_import = bulk_import
+        self.args['bulk_import'] = bulk_import
+
     def process(self):
         """The annotation import process method
         """        
@@ -1351,6 +1421,20 @@ class AnnotationImportTask(ImportTask):
         self.load_dataset()
         self.map_and_add_dataset_data()
 
+    def get_imported_sample_assay_ids(self):
+        """Get the ids of the SampleAssays with AnnotatedFeatures in the imported FeatureDataset
+
+        :return: The SampleAssay ids
+        :rtype: list
+        """
+
+        if not self.feature_dataset or not self.feature_dataset.id:
+            return super().get_imported_sample_assay_ids()
+
+        return [sample_assay_id for sample_assay_id, in self.db_session.query(AnnotatedFeature.sample_assay_id) \
+                    .join(FeatureMetadata, AnnotatedFeature.feature_metadata_id == FeatureMetadata.id) \
+                    .filter(FeatureMetadata.feature_dataset_id == self.feature_dataset.id).distinct().all()]
+
     def create_saved_query(self):
         """Create a SavedQuery for the dataset for downstream analysis
         """
@@ -1588,19 +1672,7 @@ class AnnotationImportTask(ImportTask):
         else:
             unit_text = 'mg/dL'
         unit = self.get_or_add_unit(unit_text)
-        above_uloq = False
-        below_lloq = False
-        # Try casting the value to a float, if it doesn't work, its <LLOQ or >ULOQ
-        try:
-            intensity = float(self.dataset.iloc[sample_row_index,feature_index])
-            comment = None
-        except:
-            intensity = None
-            comment = str(self.dataset.iloc[sample_row_index,feature_index])
-            if comment == '<LLOQ':
-                below_lloq = True
-            if comment == '>ULOQ':
-                above_uloq = True
+        intensity, below_lloq, above_uloq, comment = utils.parse_intensity(self.dataset.iloc[sample_row_index,feature_index],missing_below_lloq=False)
 
         if annotated_feature is None:
             annotated_feature = AnnotatedFeature( feature_metadata_id = feature_metadata.id,
@@ -1627,6 +1699,130 @@ class AnnotationImportTask(ImportTask):
 
         return annotated_feature
 
+    def get_unified_feature_column_indices(self):
+        """Get the feature column indices of a unified dataset, from the first feature column to the first unnamed or empty column
+
+        :return: The column indices
+        :rtype: list
+        """
+
+        feature_column_indices = []
+        feature_column_index = self.first_feature_column_index
+        while(feature_column_index < len(self.dataset.iloc[0,:])):
+            if re.match('Unnamed',self.dataset.columns[feature_column_index]):
+                break
+            if not self.dataset.iloc[self.feature_name_row_index, feature_column_index]:
+                break
+            feature_column_indices.append(feature_column_index)
+            feature_column_index = feature_column_index + 1
+
+        return feature_column_indices
+
+    def bulk_add_or_update_unified_annotated_features(self,sample_assays):
+        """Add or update the AnnotatedFeatures of a unified dataset in bulk
+
+        :param sample_assays: The dataset row index -> :class:`phenomedb.models.SampleAssay`
+        :type sample_assays: dict
+        """
+
+        feature_column_indices = self.get_unified_feature_column_indices()
+        feature_metadata_ids = []
+        unit_ids = []
+        for feature_column_index in feature_column_indices:
+            feature_name = self.dataset.iloc[self.feature_name_row_index,feature_column_index].strip()
+            feature_metadata_ids.append(self.feature_metadatas[feature_name].id)
+            if self.unit_row_index:
+                unit_ids.append(self.get_or_add_unit(self.dataset.iloc[self.unit_row_index,feature_column_index]).id)
+            else:
+                unit_ids.append(self.get_or_add_unit('mg/dL').id)
+
+        # If rows share a SampleAssay, the last row is imported, as when importing one row at a time
+        sample_assay_row_indices = {sample_assay.id: sample_row_index for sample_row_index,sample_assay in sample_assays.items()}
+        self.bulk_add_or_update_annotated_features(list(sample_assay_row_indices.keys()),
+                                                   feature_metadata_ids,
+                                                   self.dataset.iloc[list(sample_assay_row_indices.values()),feature_column_indices],
+                                                   unit_ids,
+                                                   missing_below_lloq=False)
+
+    def get_annotated_feature_ids(self,sample_assay_ids):
+        """Get the ids of the existing AnnotatedFeatures of the SampleAssays, in one query
+
+        :param sample_assay_ids: The SampleAssay ids
+        :type sample_assay_ids: list
+        :return: A dataframe with columns annotated_feature_id, feature_metadata_id, and sample_assay_id, one row per (feature_metadata_id, sample_assay_id)
+        :rtype: :class:`pandas.DataFrame`
+        """
+
+        rows = self.db_session.query(AnnotatedFeature.id,AnnotatedFeature.feature_metadata_id,AnnotatedFeature.sample_assay_id) \
+            .filter(AnnotatedFeature.sample_assay_id.in_(sample_assay_ids)) \
+            .order_by(AnnotatedFeature.id).all()
+
+        annotated_feature_ids = pd.DataFrame(rows,columns=['annotated_feature_id','feature_metadata_id','sample_assay_id']).astype(int)
+        return annotated_feature_ids.drop_duplicates(subset=['feature_metadata_id','sample_assay_id'],keep='first')
+
+    def bulk_add_or_update_annotated_features(self,sample_assay_ids,feature_metadata_ids,intensity_data,unit_ids,sr_corrected_data=None,
+                                              missing_below_lloq=True):
+        """Add or update AnnotatedFeatures in bulk. Existing AnnotatedFeatures are found in one query, the intensities are parsed in one pass, and
+        the rows are written with batched inserts and updates of bulk_import_batch_size rows.
+
+        :param sample_assay_ids: The SampleAssay id of each intensity row
+        :type sample_assay_ids: list
+        :param feature_metadata_ids: The FeatureMetadata id of each intensity column
+        :type feature_metadata_ids: list
+        :param intensity_data: The raw intensity cells, samples x features
+        :type intensity_data: :class:`pandas.DataFrame` or :class:`numpy.ndarray`
+        :param unit_ids: The Unit id of each intensity column, or one Unit id for all
+        :type unit_ids: list or int
+        :param sr_corrected_data: The raw SR corrected intensity cells, samples x features, defaults to None
+        :type sr_corrected_data: :class:`pandas.DataFrame` or :class:`numpy.ndarray`, optional
+        :param missing_below_lloq: Whether missing intensities are below the LLOQ, see :func:`phenomedb.utilities.parse_intensity_array`, defaults to True
+        :type missing_below_lloq: bool, optional
+        :raises Exception: If the intensity data shape does not match the ids
+        :return: The number of AnnotatedFeatures added and updated
+        :rtype: tuple
+        """
+
+        intensities, below_lloq, above_uloq, comments = utils.parse_intensity_array(intensity_data,missing_below_lloq=missing_below_lloq)
+        sample_count, feature_count = intensities.shape
+        if sample_count != len(sample_assay_ids) or feature_count != len(feature_metadata_ids):
+            raise Exception("The intensity data shape does not match the ids %s != [%s,%s]" % (intensities.shape,len(sample_assay_ids),len(feature_metadata_ids)))
+
+        comment_values = np.full(sample_count * feature_count,None,dtype=object)
+        for (sample_index,feature_index),comment in comments.items():
+            comment_values[sample_index * feature_count + feature_index] = comment
+
+        rows = pd.DataFrame({'sample_assay_id': np.repeat(np.asarray(sample_assay_ids,dtype=int),feature_count),
+                             'feature_metadata_id': np.tile(np.asarray(feature_metadata_ids,dtype=int),sample_count),
+                             'unit_id': np.tile(np.broadcast_to(np.asarray(unit_ids,dtype=int),(feature_count,)),sample_count),
+                             'intensity': intensities.ravel(),
+                             'comment': comment_values,
+                             'below_lloq': below_lloq.ravel(),
+                             'above_uloq': above_uloq.ravel()})
+        if sr_corrected_data is not None:
+            rows['sr_corrected_intensity'] = utils.parse_intensity_array(sr_corrected_data)[0].ravel()
+
+        rows = rows.merge(self.get_annotated_feature_ids(sample_assay_ids),how='left',on=['feature_metadata_id','sample_assay_id'])
+        # The merge makes the ids floats, and id = 1.0 would not use the primary key index
+        rows['annotated_feature_id'] = rows['annotated_feature_id'].astype('Int64')
+        rows = rows.astype(object).where(pd.notnull(rows),None)
+        is_update = pd.notnull(rows['annotated_feature_id']).to_numpy()
+        inserts = rows.loc[~is_update].drop(columns='annotated_feature_id').to_dict('records')
+        updates = rows.loc[is_update].to_dict('records')
+
+        # Make sure the SampleAssays and FeatureMetadatas exist before writing rows that reference them
+        self.db_session.flush()
+
+        table = AnnotatedFeature.__table__
+        update_statement = table.update().where(table.c.id == bindparam('annotated_feature_id'))
+        for statement,records,action in [(table.insert(),inserts,'Added'),(update_statement,updates,'Updated')]:
+            i = 0
+            while i < len(records):
+                self.db_session.execute(statement,records[i:i + self.bulk_import_batch_size])
+                i = i + self.bulk_import_batch_size
+                self.logger.info("%s AnnotatedFeatures %s/%s" % (action,min(i,len(records)),len(records)))
+
+        return len(inserts), len(updates)
+
     def add_or_update_sample_assay(self,sample,sample_row_index,dataset):
         """Get or add a new sample_assay
 
@@ -1764,6 +1960,8 @@ class ImportBrukerIVDRAnnotations(AnnotationImportTask):
     :type validate: boolean
     :param pipeline_run_id: The Pipeline run ID
     :type pipeline_run_id: str, optional
+    :param bulk_import: Whether to write the AnnotatedFeatures in bulk rather than one at a time, default True
+    :type bulk_import: boolean, optional
     
         """        
 
@@ -1773,9 +1971,9 @@ class ImportBrukerIVDRAnnotations(AnnotationImportTask):
     minimum_columns = []
 
     def __init__(self,project_name=None,annotation_method=None,version=None,is_latest=True,unified_csv_path=None,pipeline_run_id=None,
-                 sample_matrix=None,task_run_id=None,username=None,db_env=None,db_session=None,execution_date=None,validate=True):
+                 sample_matrix=None,task_run_id=None,username=None,db_env=None,db_session=None,execution_date=None,validate=True,bulk_import=True):
         
-        super().__init__(project_name=project_name,task_run_id=task_run_id,username=username,db_env=db_env,db_session=db_session,execution_date=execution_date,validate=validate,pipeline_run_id=pipeline_run_id)
+        super().__init__(project_name=project_name,task_run_id=task_run_id,username=username,db_env=db_env,db_session=db_session,execution_date=execution_date,validate=validate,pipeline_run_id=pipeline_run_id,bulk_import=bulk_import)
 
         if version:
             self.version = str(version)
@@ -2034,6 +2232,8 @@ class ImportBrukerIVDRAnnotations(AnnotationImportTask):
 
         self.get_or_add_feature_metadata_unified()
 
+        sample_assays = {}
+
         while(sample_row_index < len(self.dataset.iloc[:,0])):
 
             #if self.dataset.iloc[sample_row_index,0] == None:
@@ -2110,7 +2310,9 @@ class ImportBrukerIVDRAnnotations(AnnotationImportTask):
                 sample_assay = self.add_or_update_sample_assay(sample,sample_row_index,self.dataset)
 
                 #self.get_or_add_metadata(sample,sample_row_index)
-                if sample_assay:
+                if sample_assay and self.bulk_import:
+                    sample_assays[sample_row_index] = sample_assay
+                elif sample_assay:
                     annotated_features = []
                     feature_column_index = self.first_feature_column_index
                     while(feature_column_index < len(self.dataset.iloc[0,:])):
@@ -2130,6 +2332,9 @@ class ImportBrukerIVDRAnnotations(AnnotationImportTask):
                     self.logger.info("Imported SampleAssay AnnotatedFeatures %s/%s" % (sample_assay.getCountAnnotatedFeatures(),feature_column_index))
 
             sample_row_index = sample_row_index + 1
+
+        if sample_assays:
+            self.bulk_add_or_update_unified_annotated_features(sample_assays)
     def post_commit_actions(self):
         """ Triggers the post-commit pipelines
         """
@@ -2264,6 +2469,9 @@ class ImportBrukerIVDRAnnotations(AnnotationImportTask):
 
             feature_column_index = feature_column_index + 1
 
+        # Parse the intensities once, offset by first_feature_column_index
+        parsed_intensities = utils.parse_intensity_array(dataset.iloc[:,first_feature_column_index:],missing_below_lloq=False)
+
         sample_row_index = first_sample_row_index
         while(sample_row_index < len(dataset.iloc[:,0])):
 
@@ -2346,19 +2554,7 @@ class ImportBrukerIVDRAnnotations(AnnotationImportTask):
                     unit_name = dataset.iloc[unit_row_index,feature_column_index]
                     unit = units[unit_name]
 
-                    above_uloq = False
-                    below_lloq = False
-                    # Try casting the value to a float, if it doesn't work, its <LLOQ or >ULOQ
-                    try:
-                        intensity = float(dataset.iloc[sample_row_index,feature_column_index])
-                        comment = None
-                    except:
-                        intensity = None
-                        comment = str(dataset.iloc[sample_row_index,feature_column_index])
-                        if comment == '<LLOQ':
-                            below_lloq = True
-                        if comment == '>ULOQ':
-                            above_uloq = True
+                    intensity, below_lloq, above_uloq, comment = utils.get_parsed_intensity(parsed_intensities,(sample_row_index,feature_column_index - first_feature_column_index))
 
                     annotated_feature = self.db_session.query(AnnotatedFeature).filter(AnnotatedFeature.sample_assay_id==sample_assay.id,
                                                                                   AnnotatedFeature.feature_metadata_id==feature_metadata.id,
@@ -2415,6 +2611,8 @@ class ImportPeakPantherAnnotations(AnnotationImportTask):
     :type validate: boolean
     :param pipeline_run_id: The Pipeline run ID
     :type pipeline_run_id: str, optional
+    :param bulk_import: Whether to write the AnnotatedFeatures in bulk rather than one at a time, default True
+    :type bulk_import: boolean, optional
     """        
 
     annotation_name = 'peakPantheR'
@@ -2436,9 +2634,9 @@ class ImportPeakPantherAnnotations(AnnotationImportTask):
                  sample_matrix=None,assay_name=None,roi_version=None,batch_corrected_data_csv_path=None,
                  all_features_feature_metadata_csv_path=None,ppr_mz_csv_path=None,ppr_rt_csv_path=None,is_latest=True,
                  task_run_id=None,username=None,db_env=None,db_session=None,execution_date=None,validate=True,
-                 run_batch_correction=False):
+                 run_batch_correction=False,bulk_import=True):
         
-        super().__init__(project_name=project_name,task_run_id=task_run_id,username=username,db_env=db_env,db_session=db_session,execution_date=execution_date,validate=validate)
+        super().__init__(project_name=project_name,task_run_id=task_run_id,username=username,db_env=db_env,db_session=db_session,execution_date=execution_date,validate=validate,bulk_import=bulk_import)
 
         self.is_latest = is_latest
 
@@ -2802,6 +3000,15 @@ class ImportPeakPantherAnnotations(AnnotationImportTask):
 
         self.get_or_add_feature_metadata()
 
+        # Load the project Samples and MetadataFields once, rather than querying for each sample row
+        samples = {}
+        for sample in self.db_session.query(Sample).join(Subject,Project) \
+                .filter(Sample.sample_matrix==self.sample_matrix) \
+                .filter(Project.id==self.project.id).order_by(Sample.id).all():
+            samples.setdefault((sample.name,sample.assay_role,sample.sample_type),sample)
+        metadata_fields = self.db_session.query(MetadataField).filter(MetadataField.project_id==self.project.id).all()
+        sample_assays = {}
+
         sample_row_index = 0
         while(sample_row_index < len(self.sample_metadata.iloc[:,0])):
 
@@ -2832,12 +3039,7 @@ class ImportPeakPantherAnnotations(AnnotationImportTask):
             if sample_name == '1.13E+11':
                 bp = True
 
-            sample = self.db_session.query(Sample).join(Subject,Project) \
-                .filter(Sample.name==sample_name) \
-                .filter(Sample.assay_role==assay_role) \
-                .filter(Sample.sample_type==sample_type) \
-                .filter(Sample.sample_matrix==self.sample_matrix)\
-                .filter(Project.id==self.project.id).first()
+            sample = samples.get((sample_name,assay_role,sample_type))
 
             if not sample and subject_name:
 
@@ -2861,10 +3063,10 @@ class ImportPeakPantherAnnotations(AnnotationImportTask):
 
                 self.db_session.add(sample)
                 self.db_session.flush()
+                samples[(sample_name,assay_role,sample_type)] = sample
                 self.logger.info("Added sample %s" % sample)
 
                 if sample_type == SampleType.StudySample:
-                    metadata_fields = self.db_session.query(MetadataField).filter(MetadataField.project_id==self.project.id).all()
 
                     for metadata_field in metadata_fields:
                         if metadata_field.name in self.sample_metadata.columns:
@@ -2884,7 +3086,10 @@ class ImportPeakPantherAnnotations(AnnotationImportTask):
             if sample:
                 sample_assay = self.add_or_update_sample_assay(sample, sample_row_index, self.sample_metadata)
 
-            if sample_assay:
+            if sample_assay and self.bulk_import:
+                sample_assays[sample_row_index] = sample_assay
+
+            elif sample_assay:
 
                 self.logger.info("Added or updated sample_assay: %s, adding %s features" % (sample_assay, self.feature_metadata.shape[0]))
                 annotated_features = []
@@ -2908,13 +3113,63 @@ class ImportPeakPantherAnnotations(AnnotationImportTask):
 
             sample_row_index = sample_row_index + 1
 
+        if sample_assays:
+            self.bulk_add_or_update_not_unified_annotated_features(sample_assays)
+
         self.logger.info("All features imported!")
 
+    def get_feature_metadata_from_name(self,feature_name):
+        """Get the :class:`phenomedb.models.FeatureMetadata` of a feature name, or of its _1 or _2 variant
+
+        :param feature_name: The name of the feature
+        :type feature_name: str
+        :raises Exception: Feature name not found
+        :return: The :class:`phenomedb.models.FeatureMetadata`
+        :rtype: :class:`phenomedb.models.FeatureMetadata`
+        """
+
+        if feature_name in self.feature_metadatas.keys():
+            return self.feature_metadatas[feature_name]
+        elif feature_name + "_1" in self.feature_metadatas.keys():
+            return self.feature_metadatas[feature_name + "_1"]
+        elif feature_name + "_2" in self.feature_metadatas.keys():
+            return self.feature_metadatas[feature_name + "_2"]
+        else:
+            raise Exception("Feature name not found, nor _1, nor _2 %s " % (feature_name))
+
+    def bulk_add_or_update_not_unified_annotated_features(self,sample_assays):
+        """Add or update the AnnotatedFeatures of the intensity (and batch corrected) data in bulk
+
+        :param sample_assays: The sample metadata row index -> :class:`phenomedb.models.SampleAssay`
+        :type sample_assays: dict
+        """
+
+        feature_metadata_ids = [self.get_feature_metadata_from_name(self.feature_metadata.loc[feature_row_index,'cpdName'].strip()).id
+                                for feature_row_index in range(self.feature_metadata.shape[0])]
+
+        # If rows share a SampleAssay, the last row is imported, as when importing one row at a time
+        sample_assay_row_indices = {sample_assay.id: sample_row_index for sample_row_index,sample_assay in sample_assays.items()}
+        sample_row_indices = list(sample_assay_row_indices.values())
+        feature_indices = list(range(len(feature_metadata_ids)))
+
+        if self.batch_corrected_data_csv_path:
+            sr_corrected_data = self.batch_corrected_data.iloc[sample_row_indices,feature_indices]
+        else:
+            sr_corrected_data = None
+
+        self.bulk_add_or_update_annotated_features(list(sample_assay_row_indices.keys()),
+                                                   feature_metadata_ids,
+                                                   self.intensity_data.iloc[sample_row_indices,feature_indices],
+                                                   self.no_unit.id,
+                                                   sr_corrected_data=sr_corrected_data)
+
     def post_commit_actions(self):
         """ Triggers the post-commit pipelines
         """
         from phenomedb.pipeline_factory import PipelineFactory
 
+        super().post_commit_actions()
+
         if self.run_batch_correction == "LTR" and self.batch_corrected_data_csv_path:
             try:
                 post_import_ppr_pipline = PipelineFactory(pipeline_name='npc_post_import_ppr_pipeline')
@@ -3081,15 +3336,7 @@ class ImportPeakPantherAnnotations(AnnotationImportTask):
         if feature_name == 'LPC(20:2/0:0)':
             bp = True
 
-        if feature_name in self.feature_metadatas.keys():
-            feature_metadata = self.feature_metadatas[feature_name]
-        elif feature_name+"_1" in self.feature_metadata.keys():
-            feature_metadata = self.feature_metadatas[feature_name+"_1"]
-        elif feature_name + "_2" in self.feature_metadata.keys():
-            feature_metadata = self.feature_metadatas[feature_name + "_2"]
-        else:
-            bp = True
-            raise Exception("Feature name not found, nor _1, nor _2 %s " % (feature_name))
+        feature_metadata = self.get_feature_metadata_from_name(feature_name)
 
         self.logger.debug("Found feature_metadata %s " % feature_metadata)
 
@@ -3265,6 +3512,10 @@ class ImportPeakPantherAnnotations(AnnotationImportTask):
 
                 feature_metadatas[feature_name] = feature_metadata
 
+        parsed_intensities = utils.parse_intensity_array(intensity_data)
+        if self.batch_corrected_data_csv_path:
+            parsed_batch_corrected_intensities = utils.parse_intensity_array(batch_corrected_data)
+
         sample_row_index = 0
         while sample_row_index < sample_metadata.shape[0]:
 
@@ -3337,7 +3588,7 @@ class ImportPeakPantherAnnotations(AnnotationImportTask):
                     feature_name = feature_metadata_row['cpdName'].strip()
                     feature_metadata = feature_metadatas[feature_name]
 
-                    intensity, below_lloq, above_uloq, comment = utils.parse_intensity(intensity_data.iloc[sample_row_index,feature_row_index])
+                    intensity, below_lloq, above_uloq, comment = utils.get_parsed_intensity(parsed_intensities,(sample_row_index,feature_row_index))
 
                     annotated_feature = self.db_session.query(AnnotatedFeature).filter(
                         AnnotatedFeature.sample_assay_id == sample_assay.id,
@@ -3353,8 +3604,8 @@ class ImportPeakPantherAnnotations(AnnotationImportTask):
                     else:
                         sr_corrected_intensity = None
                         if self.batch_corrected_data_csv_path:
-                            sr_corrected_intensity, below_lloq, above_uloq, comment = utils.parse_intensity(
-                                    batch_corrected_data.iloc[sample_row_index,feature_row_index])
+                            sr_corrected_intensity, below_lloq, above_uloq, comment = utils.get_parsed_intensity(
+                                    parsed_batch_corrected_intensities,(sample_row_index,feature_row_index))
 
                         if annotated_feature.sr_corrected_intensity != sr_corrected_intensity:
                             raise ValidationError("SR Corrected intensity does not match expected %s %s" % (annotated_feature.sr_corrected_intensity,sr_corrected_intensity))
@@ -3395,6 +3646,8 @@ class ImportTargetLynxAnnotations(AnnotationImportTask):
     :type validate: boolean
     :param pipeline_run_id: The Pipeline run ID
     :type pipeline_run_id: str, optional
+    :param bulk_import: Whether to write the AnnotatedFeatures in bulk rather than one at a time, default True
+    :type bulk_import: boolean, optional
     """        
 
     assay_platform = AnalyticalPlatform.MS
@@ -3402,9 +3655,9 @@ class ImportTargetLynxAnnotations(AnnotationImportTask):
     annotation_method_name = 'TargetLynx'
     minimum_columns = ['Sample File Name']
 
-    def __init__(self,project_name=None,unified_csv_path=None,sop=None,sop_version=None,assay_name=None,sample_matrix=None,sop_file_path="",is_latest=True,task_run_id=None,username=None,db_env=None,db_session=None,execution_date=None,validate=True):
+    def __init__(self,project_name=None,unified_csv_path=None,sop=None,sop_version=None,assay_name=None,sample_matrix=None,sop_file_path="",is_latest=True,task_run_id=None,username=None,db_env=None,db_session=None,execution_date=None,validate=True,pipeline_run_id=None,bulk_import=True):
         
-        super().__init__(project_name=project_name,task_run_id=task_run_id,username=username,db_env=db_env,db_session=db_session,execution_date=execution_date,validate=validate,pipeline_run_id=pipeline_run_id)
+        super().__init__(project_name=project_name,task_run_id=task_run_id,username=username,db_env=db_env,db_session=db_session,execution_date=execution_date,validate=validate,pipeline_run_id=pipeline_run_id,bulk_import=bulk_import)
 
         self.is_latest = is_latest
         self.unified_csv_path = unified_csv_path
@@ -3537,6 +3790,8 @@ class ImportTargetLynxAnnotations(AnnotationImportTask):
 
         self.get_or_add_feature_metadata_unified()
 
+        sample_assays = {}
+
         #1. Loop over each sample and import
 
         while(sample_row_index < self.dataset.shape[0]):
@@ -3597,7 +3852,10 @@ class ImportTargetLynxAnnotations(AnnotationImportTask):
 
                 #self.get_or_add_metadata(sample,sample_row_index)
 
-                if sample_assay:
+                if sample_assay and self.bulk_import:
+                    sample_assays[sample_row_index] = sample_assay
+
+                elif sample_assay:
                 
                     annotated_features = []    
                 
@@ -3615,6 +3873,9 @@ class ImportTargetLynxAnnotations(AnnotationImportTask):
 
             sample_row_index = sample_row_index + 1
 
+        if sample_assays:
+            self.bulk_add_or_update_unified_annotated_features(sample_assays)
+
     def task_validation(self):
         """The task validation, checks the counts and values of imported data
 
@@ -3709,6 +3970,9 @@ class ImportTargetLynxAnnotations(AnnotationImportTask):
 
             feature_column_index = feature_column_index + 1
 
+        # Parse the intensities once, offset by first_feature_column_index
+        parsed_intensities = utils.parse_intensity_array(dataset.iloc[:,first_feature_column_index:],missing_below_lloq=False)
+
         sample_row_index = first_sample_row_index
         while (sample_row_index < dataset.shape[0]):
 
@@ -3780,19 +4044,8 @@ class ImportTargetLynxAnnotations(AnnotationImportTask):
                     unit_name = dataset.iloc[unit_row_index, feature_column_index]
                     unit = units[unit_name]
 
-                    above_uloq = False
-                    below_lloq = False
-                    # Try casting the value to a float, if it doesn't work, its <LLOQ or >ULOQ
-                    try:
-                        intensity = float(dataset.iloc[sample_row_index, feature_column_index])
-                        comment = None
-                    except:
-                        intensity = None
-                        comment = str(dataset.iloc[sample_row_index, feature_column_index])
-                        if comment == '<LLOQ':
-                            below_lloq = True
-                        if comment == '>ULOQ':
-                            above_uloq = True
+                    intensity, below_lloq, above_uloq, comment = utils.get_parsed_intensity(parsed_intensities,
+                                                                                            (sample_row_index, feature_column_index - first_feature_column_index))
 
                     annotated_feature = self.db_session.query(AnnotatedFeature).filter(
                         AnnotatedFeature.sample_assay_id == sample_assay.id,
@@ -4569,22 +4822,24 @@ class ImportMetabolightsXCMSAnnotations(ImportTask):
         feature_dataset = self.feature_dataset_map[metabolite_assignment_file]
 
         annotated_features = []
-        if self.metabolite_information_dataframes[metabolite_assignment_file] is not None:
-            for row in self.metabolite_information_dataframes[metabolite_assignment_file].iterrows():
+        metabolite_information = self.metabolite_information_dataframes[metabolite_assignment_file]
+        if metabolite_information is not None:
 
-                the_row = row[1].where(pd.notnull(row[1]), None)
+            # Parse the SampleAssay column once
+            if sample_assay.name in metabolite_information.columns:
+                intensities = utils.parse_intensity_metabolights_array(metabolite_information[sample_assay.name])
+            else:
+                self.logger.info("%s not in columns for %s" % (sample_assay.sample.name,metabolite_information.columns))
+                intensities = np.full(metabolite_information.shape[0],np.nan)
 
-                if sample_assay.name in the_row.keys():
+            for row_index,row in enumerate(metabolite_information.iterrows()):
 
-                    intensity = the_row[sample_assay.name]
-                else:
-                    self.logger.info("%s not in columns for %s" % (sample_assay.sample.name,
-                                                                   self.metabolite_information_dataframes[
-                                                                       metabolite_assignment_file].columns))
-                    intensity = None
+                the_row = row[1].where(pd.notnull(row[1]), None)
 
-                if intensity:
-                    intensity = utils.parse_intensity_metabolights(intensity)
+                if np.isnan(intensities[row_index]):
+                    intensity = None
+                else:
+                    intensity = float(intensities[row_index])
                 #     if unit_string is not None and unit_string not in self.units.keys():
                 #         self.units[unit_string] = self.get_or_add_unit(unit_string,unit_description=unit_string)
 
@@ -5519,20 +5774,24 @@ class ImportMetabolightsStudy(ImportTask):
         feature_dataset = self.feature_dataset_map[metabolite_assignment_file]
         
         annotated_features = []
-        if self.metabolite_information_dataframes[metabolite_assignment_file] is not None:
-            for row in self.metabolite_information_dataframes[metabolite_assignment_file].iterrows():
+        metabolite_information = self.metabolite_information_dataframes[metabolite_assignment_file]
+        if metabolite_information is not None:
 
-                the_row = row[1].where(pd.notnull(row[1]), None)
+            # Parse the SampleAssay column once
+            if sample_assay.name in metabolite_information.columns:
+                intensities = utils.parse_intensity_metabolights_array(metabolite_information[sample_assay.name])
+            else:
+                self.logger.info("%s not in columns for %s" % (sample_assay.sample.name,metabolite_information.columns))
+                intensities = np.full(metabolite_information.shape[0],np.nan)
 
-                if sample_assay.name in the_row.keys():
+            for row_index,row in enumerate(metabolite_information.iterrows()):
 
-                    intensity = the_row[sample_assay.name]
-                else:
-                    self.logger.info("%s not in columns for %s" % (sample_assay.sample.name,self.metabolite_information_dataframes[metabolite_assignment_file].columns))
-                    intensity = None
+                the_row = row[1].where(pd.notnull(row[1]), None)
 
-                if intensity:
-                    intensity = utils.parse_intensity_metabolights(intensity)
+                if np.isnan(intensities[row_index]):
+                    intensity = None
+                else:
+                    intensity = float(intensities[row_index])
                #     if unit_string is not None and unit_string not in self.units.keys():
                #         self.units[unit_string] = self.get_or_add_unit(unit_string,unit_description=unit_string)
 
@@ -0,0 +1,407 @@
+"""Persisted sample x feature matrices per FeatureDataset.
+
+The AnnotatedFeatures of a FeatureDataset are stored as NPY arrays, SampleAssays (rows) x FeatureMetadatas (columns),
+with the row and column ids as index arrays, and read back memory-mapped. A store is written when the FeatureDataset
+is imported, its corrected intensities are updated when a batch correction is saved, and
+:meth:`phenomedb.query_factory.QueryFactory.build_annotated_feature_dataframe_bulk` slices the matching rows and
+columns from the stores instead of reading the annotated_feature table.
+
+Layout::
+
+    <DATA matrix_store>/feature_dataset_<id> -> feature_dataset_<id>.<version>/
+        manifest.json                   shape, AnnotatedFeature count and maximum id, written_at
+        sample_assay_ids.npy            row index
+        feature_metadata_ids.npy        column index
+        annotated_feature_id.npy        0 where there is no AnnotatedFeature
+        unit_id.npy
+        intensity.npy, sr_corrected_intensity.npy, ltr_corrected_intensity.npy      NaN where NULL
+        below_lloq.npy, above_uloq.npy
+
+The store path is a symlink to the current version directory. Writes and updates build a new version directory and
+replace the symlink, so readers see either the previous or the new version, never a partly written one.
+"""
+
+import datetime
+import json
+import logging
+import os
+import shutil
+import uuid
+
+import numpy as np
+import pandas as pd
+from sqlalchemy import func, select
+
+from phenomedb.config import config
+from phenomedb.models import AnnotatedFeature, FeatureDataset, FeatureMetadata
+
+#: array name -> (AnnotatedFeature column, dtype, fill value)
+ARRAYS = {'annotated_feature_id': ('id', np.int64, 0),
+          'unit_id': ('unit_id', np.int64, 0),
+          'intensity': ('intensity', np.float64, np.nan),
+          'sr_corrected_intensity': ('sr_corrected_intensity', np.float64, np.nan),
+          'ltr_corrected_intensity': ('ltr_corrected_intensity', np.float64, np.nan),
+          'below_lloq': ('below_lloq', np.bool_, False),
+          'above_uloq': ('above_uloq', np.bool_, False)}
+
+INDEXES = ['sample_assay_ids', 'feature_metadata_ids']
+
+
+def get_base_path():
+    """Get the directory of the matrix stores, config DATA matrix_store, defaults to <DATA app_data>/matrix_store/
+
+    :return: The directory.
+    :rtype: str
+    """
+
+    return config.get('DATA', 'matrix_store', fallback=os.path.join(config['DATA']['app_data'], 'matrix_store'))
+
+
+def is_enabled():
+    """Whether the matrix stores are written and read, config MATRIX_STORE enabled.
+
+    :return: Whether the matrix stores are enabled.
+    :rtype: bool
+    """
+
+    return config.get('MATRIX_STORE', 'enabled', fallback='true').lower() == 'true'
+
+
+def get_correction_array_name(correction_type):
+    """Get the array of a correction type.
+
+    :param correction_type: The correction type, LOESS_SR or LOESS_LTR.
+    :type correction_type: :class:`phenomedb.models.FeatureDataset.CorrectionType` or str
+    :raises Exception: If the correction type is not LOESS_SR or LOESS_LTR.
+    :return: The array name.
+    :rtype: str
+    """
+
+    if correction_type in [FeatureDataset.CorrectionType.LOESS_SR, FeatureDataset.CorrectionType.LOESS_SR.value]:
+        return 'sr_corrected_intensity'
+    elif correction_type in [FeatureDataset.CorrectionType.LOESS_LTR, FeatureDataset.CorrectionType.LOESS_LTR.value]:
+        return 'ltr_corrected_intensity'
+    else:
+        raise Exception("correction_type must be LOESS_SR or LOESS_LTR, not %s" % correction_type)
+
+
+def get_feature_dataset_counts(db_session, feature_dataset_ids):
+    """Get the number of AnnotatedFeatures and maximum AnnotatedFeature id of FeatureDatasets, to check their stores are current.
+
+    :param db_session: The db_session.
+    :type db_session: :class:`sqlalchemy.orm.Session`
+    :param feature_dataset_ids: The FeatureDataset ids.
+    :type feature_dataset_ids: list
+    :return: FeatureDataset id -> (AnnotatedFeature count, maximum AnnotatedFeature id)
+    :rtype: dict
+    """
+
+    statement = select(FeatureMetadata.feature_dataset_id, func.count(AnnotatedFeature.id), func.max(AnnotatedFeature.id)) \
+        .select_from(AnnotatedFeature) \
+        .join(FeatureMetadata, AnnotatedFeature.feature_metadata_id == FeatureMetadata.id) \
+        .where(FeatureMetadata.feature_dataset_id.in_(list(feature_dataset_ids))) \
+        .group_by(FeatureMetadata.feature_dataset_id)
+    return {feature_dataset_id: (count, max_id) for feature_dataset_id, count, max_id in db_session.execute(statement)}
+
+
+def pivot_annotated_features(annotated_features):
+    """Pivot long AnnotatedFeature rows into the store arrays.
+
+    :param annotated_features: The AnnotatedFeatures, with sample_assay_id, feature_metadata_id and the :data:`ARRAYS` columns.
+    :type annotated_features: :class:`pandas.DataFrame`
+    :return: The index arrays and the arrays.
+    :rtype: dict
+    """
+
+    sample_assay_ids, row_codes = np.unique(annotated_features['sample_assay_id'].to_numpy(dtype=np.int64), return_inverse=True)
+    feature_metadata_ids, col_codes = np.unique(annotated_features['feature_metadata_id'].to_numpy(dtype=np.int64), return_inverse=True)
+    shape = (len(sample_assay_ids), len(feature_metadata_ids))
+
+    arrays = {'sample_assay_ids': sample_assay_ids, 'feature_metadata_ids': feature_metadata_ids}
+    for name, (column, dtype, fill_value) in ARRAYS.items():
+        values = annotated_features[column]
+        if dtype is not np.float64:
+            values = values.fillna(fill_value)
+        array = np.full(shape, fill_value, dtype=dtype)
+        array[row_codes, col_codes] = values.to_numpy(dtype=dtype)
+        arrays[name] = array
+    return arrays
+
+
+def get_positions(index, ids):
+    """Get the positions of ids in a store index array.
+
+    :param index: The index array, sorted, see :func:`pivot_annotated_features`.
+    :type index: :class:`numpy.ndarray`
+    :param ids: The ids.
+    :type ids: list
+    :return: The positions, or None if an id is not in the index.
+    :rtype: :class:`numpy.ndarray`
+    """
+
+    index = np.asarray(index)
+    ids = np.unique(np.asarray(ids, dtype=np.int64))
+    if len(ids) == 0:
+        return np.array([], dtype=np.int64)
+    if len(index) == 0:
+        return None
+    positions = np.minimum(np.searchsorted(index, ids), len(index) - 1)
+    if not np.array_equal(index[positions], ids):
+        return None
+    return positions
+
+
+def unpivot_arrays(arrays, sample_assay_ids=None, feature_metadata_ids=None):
+    """Unpivot the store arrays into long AnnotatedFeature rows, ordered by AnnotatedFeature id.
+
+    Only the block of the selected rows and columns is read from the (memory-mapped) arrays.
+
+    :param arrays: The index arrays and arrays, see :func:`pivot_annotated_features`.
+    :type arrays: dict
+    :param sample_assay_ids: Only unpivot the rows of these SampleAssays, defaults to None
+    :type sample_assay_ids: list, optional
+    :param feature_metadata_ids: Only unpivot the columns of these FeatureMetadatas, defaults to None
+    :type feature_metadata_ids: list, optional
+    :return: The AnnotatedFeatures, with annotated_feature_id, sample_assay_id, feature_metadata_id, and the :data:`ARRAYS` columns.
+    :rtype: :class:`pandas.DataFrame`
+    """
+
+    rows = np.arange(len(arrays['sample_assay_ids']))
+    if sample_assay_ids is not None:
+        rows = np.flatnonzero(np.isin(arrays['sample_assay_ids'], sample_assay_ids))
+    cols = np.arange(len(arrays['feature_metadata_ids']))
+    if feature_metadata_ids is not None:
+        cols = np.flatnonzero(np.isin(arrays['feature_metadata_ids'], feature_metadata_ids))
+    block = np.ix_(rows, cols)
+
+    annotated_feature_ids = np.asarray(arrays['annotated_feature_id'][block])
+    row_index, col_index = np.nonzero(annotated_feature_ids)
+    order = np.argsort(annotated_feature_ids[row_index, col_index], kind='stable')
+    row_index = row_index[order]
+    col_index = col_index[order]
+
+    annotated_features = pd.DataFrame({'annotated_feature_id': annotated_feature_ids[row_index, col_index],
+                                       'sample_assay_id': np.asarray(arrays['sample_assay_ids'])[rows][row_index],
+                                       'feature_metadata_id': np.asarray(arrays['feature_metadata_ids'])[cols][col_index]})
+    for name, (column, dtype, fill_value) in ARRAYS.items():
+        if name != 'annotated_feature_id':
+            annotated_features[column] = np.asarray(arrays[name][block])[row_index, col_index]
+    return annotated_features
+
+
+class MatrixStore:
+    """The persisted matrices of a FeatureDataset.
+
+    :param feature_dataset_id: The FeatureDataset id.
+    :type feature_dataset_id: int
+    :param base_path: The directory of the matrix stores, defaults to None (config DATA matrix_store)
+    :type base_path: str, optional
+    :param logger: The logger, defaults to None
+    :type logger: :class:`logging.Logger`, optional
+    """
+
+    def __init__(self, feature_dataset_id, base_path=None, logger=None):
+        self.feature_dataset_id = int(feature_dataset_id)
+        self.base_path = base_path if base_path is not None else get_base_path()
+        self.path = os.path.join(self.base_path, "feature_dataset_%s" % self.feature_dataset_id)
+        self.logger = logger if logger is not None else logging.getLogger(__name__)
+
+    def exists(self):
+        """Whether the store has been written.
+
+        :return: Whether the manifest exists.
+        :rtype: bool
+        """
+
+        return os.path.exists(os.path.join(self.path, 'manifest.json'))
+
+    def get_manifest(self):
+        """Get the manifest.
+
+        :return: The manifest, or None if the store does not exist.
+        :rtype: dict
+        """
+
+        if not self.exists():
+            return None
+        with open(os.path.join(self.path, 'manifest.json')) as manifest_file:
+            return json.load(manifest_file)
+
+    def get_version_path(self):
+        """Get the path of a new version directory of the store.
+
+        :return: The path.
+        :rtype: str
+        """
+
+        return "%s.%s" % (self.path, uuid.uuid4().hex[:8])
+
+    def swap(self, version_path):
+        """Make a version directory the current store, then delete the previous version.
+
+        The store symlink is replaced in one rename, so the store is never missing. A store written before the
+        versions, a directory at the store path, is moved aside first.
+
+        :param version_path: The version directory.
+        :type version_path: str
+        """
+
+        previous_path = None
+        if os.path.islink(self.path):
+            previous_path = os.path.realpath(self.path)
+        elif os.path.isdir(self.path):
+            previous_path = self.get_version_path()
+            os.rename(self.path, previous_path)
+
+        link_path = version_path + '.link'
+        os.symlink(os.path.basename(version_path), link_path)
+        os.replace(link_path, self.path)
+        if previous_path is not None and previous_path != os.path.realpath(version_path):
+            shutil.rmtree(previous_path, ignore_errors=True)
+
+    def write(self, arrays):
+        """Write the store. The arrays are written to a new version directory which then replaces the existing store.
+
+        :param arrays: The index arrays and arrays, see :func:`pivot_annotated_features`.
+        :type arrays: dict
+        :return: The manifest.
+        :rtype: dict
+        """
+
+        annotated_feature_ids = arrays['annotated_feature_id']
+        manifest = {'feature_dataset_id': self.feature_dataset_id,
+                    'shape': list(annotated_feature_ids.shape),
+                    'annotated_feature_count': int(np.count_nonzero(annotated_feature_ids)),
+                    'annotated_feature_max_id': int(annotated_feature_ids.max()) if annotated_feature_ids.size > 0 else 0,
+                    'written_at': datetime.datetime.now().isoformat()}
+
+        os.makedirs(self.base_path, exist_ok=True)
+        version_path = self.get_version_path()
+        os.makedirs(version_path)
+        for name in INDEXES + list(ARRAYS.keys()):
+            np.save(os.path.join(version_path, name + '.npy'), np.ascontiguousarray(arrays[name]))
+        with open(os.path.join(version_path, 'manifest.json'), 'w') as manifest_file:
+            json.dump(manifest, manifest_file)
+
+        self.swap(version_path)
+        self.logger.info("FeatureDataset %s matrix store written, %s x %s" % (self.feature_dataset_id, *manifest['shape']))
+        return manifest
+
+    def build(self, db_session):
+        """Build the store from the AnnotatedFeatures of the FeatureDataset.
+
+        :param db_session: The db_session.
+        :type db_session: :class:`sqlalchemy.orm.Session`
+        :return: The manifest.
+        :rtype: dict
+        """
+
+        statement = select(AnnotatedFeature.id, AnnotatedFeature.sample_assay_id, AnnotatedFeature.feature_metadata_id,
+                           *[getattr(AnnotatedFeature, column) for name, (column, dtype, fill_value) in ARRAYS.items() if name != 'annotated_feature_id']) \
+            .join(FeatureMetadata, AnnotatedFeature.feature_metadata_id == FeatureMetadata.id) \
+            .where(FeatureMetadata.feature_dataset_id == self.feature_dataset_id)
+        annotated_features = pd.read_sql(statement, db_session.connection())
+        return self.write(pivot_annotated_features(annotated_features))
+
+    def load(self, mmap_mode='r'):
+        """Load the arrays of the current version, memory-mapped.
+
+        :param mmap_mode: The numpy.load mmap_mode, defaults to 'r'
+        :type mmap_mode: str, optional
+        :return: The index arrays and arrays.
+        :rtype: dict
+        """
+
+        try:
+            return self.load_version(os.path.realpath(self.path), mmap_mode=mmap_mode)
+        except FileNotFoundError:
+            # The version was replaced and deleted while it was being loaded
+            return self.load_version(os.path.realpath(self.path), mmap_mode=mmap_mode)
+
+    def load_version(self, version_path, mmap_mode='r'):
+        """Load the arrays of a version directory, memory-mapped.
+
+        :param version_path: The version directory.
+        :type version_path: str
+        :param mmap_mode: The numpy.load mmap_mode, defaults to 'r'
+        :type mmap_mode: str, optional
+        :return: The index arrays and arrays.
+        :rtype: dict
+        """
+
+        return {name: np.load(os.path.join(version_path, name + '.npy'), mmap_mode=mmap_mode)
+                for name in INDEXES + list(ARRAYS.keys())}
+
+    def is_current(self, annotated_feature_count, annotated_feature_max_id):
+        """Whether the store matches the FeatureDataset's AnnotatedFeatures.
+
+        :param annotated_feature_count: The number of AnnotatedFeatures of the FeatureDataset.
+        :type annotated_feature_count: int
+        :param annotated_feature_max_id: The maximum AnnotatedFeature id of the FeatureDataset.
+        :type annotated_feature_max_id: int
+        :return: Whether the count and maximum id match the manifest.
+        :rtype: bool
+        """
+
+        manifest = self.get_manifest()
+        return manifest is not None and manifest['annotated_feature_count'] == annotated_feature_count \
+            and manifest['annotated_feature_max_id'] == annotated_feature_max_id
+
+    def update_corrected_intensities(self, annotated_feature_ids, corrected_intensities, correction_type):
+        """Update the corrected intensities of the store, as :func:`phenomedb.batch_correction.update_corrected_intensities` does the AnnotatedFeatures.
+
+        The corrected array is updated in a copy, written to a new version of the store which then replaces the current one.
+
+        :param annotated_feature_ids: The AnnotatedFeature ids, samples x features.
+        :type annotated_feature_ids: :class:`numpy.ndarray`
+        :param corrected_intensities: The corrected intensities, samples x features.
+        :type corrected_intensities: :class:`numpy.ndarray`
+        :param correction_type: The correction type, LOESS_SR or LOESS_LTR.
+        :type correction_type: :class:`phenomedb.models.FeatureDataset.CorrectionType` or str
+        :return: The number of cells updated.
+        :rtype: int
+        """
+
+        name = get_correction_array_name(correction_type)
+        annotated_feature_ids = np.asarray(annotated_feature_ids, dtype=float).ravel()
+        corrected_intensities = np.asarray(corrected_intensities, dtype=float).ravel()
+        to_update = ~np.isinf(corrected_intensities) & ~np.isnan(annotated_feature_ids) & (annotated_feature_ids > 0)
+        annotated_feature_ids = annotated_feature_ids[to_update].astype(np.int64)
+        corrected_intensities = corrected_intensities[to_update]
+
+        current_path = os.path.realpath(self.path)
+        store_ids = np.load(os.path.join(current_path, 'annotated_feature_id.npy'), mmap_mode='r').ravel()
+        if store_ids.size == 0:
+            return 0
+        order = np.argsort(store_ids, kind='stable')
+        positions = np.searchsorted(store_ids, annotated_feature_ids, sorter=order)
+        positions = np.minimum(positions, len(order) - 1)
+        in_store = store_ids[order[positions]] == annotated_feature_ids
+
+        # The corrected array is written to a new version, the other files are shared with the current one
+        array = np.load(os.path.join(current_path, name + '.npy'))
+        array.ravel()[order[positions[in_store]]] = corrected_intensities[in_store]
+        version_path = self.get_version_path()
+        os.makedirs(version_path)
+        for file_name in os.listdir(current_path):
+            if file_name != name + '.npy':
+                try:
+                    os.link(os.path.join(current_path, file_name), os.path.join(version_path, file_name))
+                except OSError:
+                    shutil.copy2(os.path.join(current_path, file_name), os.path.join(version_path, file_name))
+        np.save(os.path.join(version_path, name + '.npy'), array)
+        self.swap(version_path)
+
+        updated_count = int(in_store.sum())
+        self.logger.info("FeatureDataset %s matrix store %s updated, %s cells" % (self.feature_dataset_id, name, updated_count))
+        return updated_count
+
+    def delete(self):
+        """Delete the store."""
+
+        if os.path.islink(self.path):
+            version_path = os.path.realpath(self.path)
+            os.remove(self.path)
+            shutil.rmtree(version_path, ignore_errors=True)
+        elif os.path.exists(self.path):
+            shutil.rmtree(self.path)
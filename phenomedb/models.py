@@ -7,6 +7,8 @@ import enum
 from sqlalchemy.dialects.postgresql.json import JSONB
 from phenomedb.config import config
 from phenomedb.exceptions import NoUnitConversionError, NotImplementedUnitConversionError
+from phenomedb import unit_conversion
+import numpy as np
 #from flask_appbuilder.security.sqla.models import Role
 import requests
 import urllib.parse
@@ -125,9 +127,15 @@ class SavedQuery(Base):
     def get_cache_annotated_feature_id_key(self,key):
         return "SavedQueryAnnotatedFeatureIDDataframe::%s:%s" % (self.id,key)
 
+    def get_cache_dataframe_build_state_key(self,key):
+        return "SavedQueryDataframeBuildState::%s:%s" % (self.id,key)
+
     def get_cache_summary_stats_key(self):
         return "SavedQuerySummaryStats::%s" % (self.id)
 
+    def get_cache_summary_stats_projects_key(self):
+        return "SavedQuerySummaryStats::%s::projects" % (self.id)
+
 
 class Pipeline(Base):
 
@@ -244,20 +252,42 @@ class TaskRun(Base):
     def get_task_data_cache_key(self):
         return "TaskData::%s" % self.id
 
-    def get_task_data(self,cache):
-        if cache.exists(self.get_task_data_cache_key()):
-            return cache.get(self.get_task_data_cache_key())
-        else:
+    def get_task_data(self,cache,names=None):
+        """Get the cached task data
+
+        :param cache: The cache
+        :type cache: :class:`phenomedb.cache.Cache`
+        :param names: The names of the artefacts to load, defaults to None (all)
+        :type names: list, optional
+        :return: The task data, or None if it is not cached
+        :rtype: :class:`phenomedb.task_data.TaskData`
+        """
+        if not cache.exists(self.get_task_data_cache_key()):
             return None
+        elif names is not None:
+            return cache.get_task_data(self.get_task_data_cache_key(),names=names)
+        else:
+            return cache.get(self.get_task_data_cache_key())
 
     def get_task_output_cache_key(self):
         return "TaskOutput::%s" % self.id
 
-    def get_task_output(self,cache):
-        if cache.exists(self.get_task_output_cache_key()):
-            return cache.get(self.get_task_output_cache_key())
-        else:
+    def get_task_output(self,cache,names=None):
+        """Get the cached task output
+
+        :param cache: The cache
+        :type cache: :class:`phenomedb.cache.Cache`
+        :param names: The names of the artefacts to load, defaults to None (all)
+        :type names: list, optional
+        :return: The task output, or None if it is not cached
+        :rtype: dict or :class:`phenomedb.task_data.TaskData`
+        """
+        if not cache.exists(self.get_task_output_cache_key()):
             return None
+        elif names is not None:
+            return cache.get_task_data(self.get_task_output_cache_key(),names=names)
+        else:
+            return cache.get(self.get_task_output_cache_key())
 
     def get_task_class_object(self):
 
@@ -314,65 +344,44 @@ class Unit(Base):
     def build_search_index(self):
         return utils.flatten_model_for_search(self)
 
-    def convert(self,value,to,logger):
-
-        converted = None
-
-        if self.name == to:
-            converted = value
-
-        elif self.name == 'noUnit' \
-                or self.name == '-/-':
-            raise NoUnitConversionError('Cannot convert %s to %s' % (self.name,to))
-
-        elif self.name == 'mg/dL' and to == 'g/dL':
-            converted = value * 0.001
+    def get_conversion_factor(self,to):
+        """Get the multiplier that converts a value in this unit to the 'to' unit, from the
+        :data:`phenomedb.unit_conversion.registry`.
 
-        elif self.name == 'g/dL' and to == 'mg/dL':
-            converted = value * 1000
+        :param to: The name of the unit to convert to.
+        :type to: str
+        :raises NoUnitConversionError: If this unit is noUnit or -/-.
+        :raises NotImplementedUnitConversionError: If the conversion has not been implemented, or is not a pure
+            multiplier.
+        :return: The conversion factor.
+        :rtype: float
+        """
 
-        elif self.name == 'mg/dL' and to == 'mmol/L':
-            converted = value / 18
+        factor, offset = unit_conversion.registry.get_conversion(self.name,to)
+        if offset != 0:
+            raise NotImplementedUnitConversionError('Unit conversion is not a multiplier: %s -> %s' % (self.name,to))
+        return factor
 
-        elif self.name == 'mmol/L' and to == 'mg/dL':
-            converted = value * 18
-
-        elif self.name == 'nmol/L' and to == 'mmol/L':
-            converted = value * 0.000001
-
-        elif self.name == 'mmol/L' and to == 'nmol/L':
-            converted = value * 1000000
-
-        elif self.name == 'ng/mL' and to == 'mmol/L':
-            converted = value * 0.001
-
-        elif self.name == 'mmol/L' and to == 'ng/mL':
-            converted = value * 1000
-
-        elif self.name == 'nM' and to == 'mmol/L':
-            converted = value * 0.000001
-
-        elif self.name == 'mmol/L' and to == 'nM':
-            converted = value * 1000000
-
-        elif self.name == 'fg/µL' and to == 'mmol/L':
-            converted = value * 0.000001
-
-        elif self.name == 'mmol/L' and to == 'fg/µL':
-            converted = value / 0.000001
-
-        elif self.name == 'µM' and to == 'mmol/L':
-            converted = value * 0.001
-
-        else:
-            raise NotImplementedUnitConversionError('Unit conversion has not been implemented: %s -> %s' % (self.name,to))
-
-       # if dilution != 100:
-       #     converted = converted * (100 / dilution)
-
-        converted = utils.precision_round(converted,digits=len(str(value)))
-
-        logger.info("Converted %s %s to %s %s" % (value,self.name,converted,to))
+    def convert(self,value,to,logger):
+        """Convert a single value to the 'to' unit, rounded to the precision of the value. To convert arrays, use
+        :meth:`phenomedb.unit_conversion.UnitConversionRegistry.convert`.
+
+        :param value: The value to convert.
+        :type value: float
+        :param to: The name of the unit to convert to.
+        :type to: str
+        :param logger: The logger.
+        :type logger: :class:`logging.Logger`
+        :raises NoUnitConversionError: If this unit is noUnit or -/-.
+        :raises NotImplementedUnitConversionError: If the conversion has not been implemented.
+        :return: The converted value.
+        :rtype: float
+        """
+
+        converted = float(unit_conversion.registry.convert(np.array([value],dtype=float),self.name,to,
+                                                           match_input_precision=True)[0])
+
+        logger.debug("Converted %s %s to %s %s" % (value,self.name,converted,to))
 
         return converted
 
@@ -0,0 +1,364 @@
+"""Vectorised MWAS, the Python backend of :class:`phenomedb.analysis.RunMWAS`.
+
+The R backend (r_templates/MWAS.r) fits one MWASTools model per feature. Here the models of all the features are
+fitted at once on the intensity matrix:
+
+* linear: Y ~ feature + covariates by least squares, with the covariates partialled out of Y and every feature in one
+  step (Frisch-Waugh-Lovell), so each feature's coefficient, standard error and p-value are column-wise operations.
+* pearson and spearman: the correlation of Y with every feature (on ranks for spearman), with t-distribution p-values.
+  As with MWASTools, the covariates are not used by the correlation methods.
+
+Covariates are encoded as R's data.matrix() does, so categorical columns become their 1-based factor codes. The results
+have the schema of the R template: mwastable (_row, estimates, pvalues, adjusted_pvalues), and for linear models
+mwasestimates (the coefficient table of each feature) and mwassummaries (aic, deviance and df.residual).
+
+Bootstrap confidence intervals of the estimates of the significant features are computed across a process pool.
+"""
+
+import math
+import multiprocessing
+import re
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+from scipy import stats
+
+#: The association methods the Python backend supports
+METHODS = ('linear', 'pearson', 'spearman')
+#: The multiple testing corrections the Python backend supports, as named by R's p.adjust
+MULTIPLE_CORRECTIONS = ('BH', 'BY', 'bonferroni', 'holm', 'hochberg', 'none')
+#: The resamples each bootstrap job runs. Fixed, so the intervals for a seed do not depend on the number of workers
+BOOTSTRAP_CHUNK_SIZE = 50
+
+
+def make_r_name(name):
+    """Get the syntactic R name of a column, as make.names() does (ie 123 -> X123, 'h_metadata::Age' -> h_metadata..Age).
+
+    :param name: The column name.
+    :type name: object
+    :return: The R name.
+    :rtype: str
+    """
+
+    name = re.sub(r'[^A-Za-z0-9._]', '.', str(name))
+    if not re.match(r'[A-Za-z]|\.(?![0-9])', name):
+        name = 'X' + name
+    return name
+
+
+def encode_covariates(sample_metadata, columns):
+    """Encode sample metadata columns as a float matrix, as R's data.matrix() does: numeric columns as they are, and
+    other columns as the 1-based codes of their sorted levels.
+
+    :param sample_metadata: The sample metadata.
+    :type sample_metadata: :class:`pandas.DataFrame`
+    :param columns: The columns to encode.
+    :type columns: list
+    :return: The encoded columns, samples x columns, with NaN for missing values.
+    :rtype: :class:`numpy.ndarray`
+    """
+
+    encoded = np.empty((sample_metadata.shape[0], len(columns)))
+    for i, column in enumerate(columns):
+        values = sample_metadata.loc[:, column]
+        if pd.api.types.is_bool_dtype(values) or not pd.api.types.is_numeric_dtype(values):
+            codes = pd.Categorical(values.astype(object).where(values.notnull(), None)).codes.astype(float)
+            codes[codes < 0] = np.nan
+            encoded[:, i] = codes + 1
+        else:
+            encoded[:, i] = values.to_numpy(dtype=float)
+    return encoded
+
+
+def adjust_pvalues(pvalues, method='BH'):
+    """Adjust p-values for multiple testing, as R's p.adjust() does. Missing p-values are left out of the count.
+
+    :param pvalues: The p-values.
+    :type pvalues: :class:`numpy.ndarray`
+    :param method: The correction, one of :data:`MULTIPLE_CORRECTIONS`, defaults to 'BH'. None or '' for none.
+    :type method: str, optional
+    :raises Exception: If the correction is not supported.
+    :return: The adjusted p-values.
+    :rtype: :class:`numpy.ndarray`
+    """
+
+    pvalues = np.asarray(pvalues, dtype=float)
+    if not method or method == 'none':
+        return pvalues.copy()
+    if method not in MULTIPLE_CORRECTIONS:
+        raise Exception("Multiple correction %s is not supported by the python MWAS backend, use one of %s" % (method, MULTIPLE_CORRECTIONS))
+
+    adjusted = np.full(pvalues.shape, np.nan)
+    present = ~np.isnan(pvalues)
+    p = pvalues[present]
+    n = len(p)
+    if n == 0:
+        return adjusted
+
+    if method == 'bonferroni':
+        result = np.minimum(1, n * p)
+    elif method == 'holm':
+        order = np.argsort(p, kind='stable')
+        result = np.empty(n)
+        result[order] = np.minimum(1, np.maximum.accumulate((n - np.arange(n)) * p[order]))
+    else:
+        # hochberg, BH and BY step up from the largest p-value
+        order = np.argsort(p, kind='stable')[::-1]
+        i = np.arange(n, 0, -1)
+        if method == 'hochberg':
+            factors = n - i + 1
+        elif method == 'BH':
+            factors = n / i
+        else:
+            factors = np.sum(1 / np.arange(1, n + 1)) * n / i
+        result = np.empty(n)
+        result[order] = np.minimum(1, np.minimum.accumulate(factors * p[order]))
+
+    adjusted[present] = result
+    return adjusted
+
+
+def fit_linear(y, features, covariates):
+    """Fit y ~ feature + covariates for every feature, by least squares.
+
+    :param y: The outcome, of each sample.
+    :type y: :class:`numpy.ndarray`
+    :param features: The features, samples x features.
+    :type features: :class:`numpy.ndarray`
+    :param covariates: The covariates, samples x covariates.
+    :type covariates: :class:`numpy.ndarray`
+    :return: The coefficients, standard errors, t values and p-values (each coefficients x features, in the order
+        intercept, feature, covariates), the residual sums of squares, and the residual degrees of freedom.
+    :rtype: tuple
+    """
+
+    n = len(y)
+    design = np.column_stack([np.ones(n), covariates])
+    design_pinv = np.linalg.pinv(design)
+    df = n - design.shape[1] - 1
+
+    # Partial the intercept and covariates out of y and every feature
+    y_hat = design_pinv @ y
+    y_residuals = y - design @ y_hat
+    feature_hats = design_pinv @ features
+    feature_residuals = features - design @ feature_hats
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        feature_ss = np.sum(feature_residuals ** 2, axis=0)
+        estimates = (feature_residuals.T @ y_residuals) / feature_ss
+        rss = np.sum(y_residuals ** 2) - estimates ** 2 * feature_ss
+        rss = np.maximum(rss, 0)
+        sigma2 = rss / df if df > 0 else np.full(rss.shape, np.nan)
+
+        # The other coefficients, and their variances from the blockwise inverse of the design with the feature
+        design_coefficients = y_hat[:, None] - feature_hats * estimates
+        design_variances = (np.diag(np.linalg.pinv(design.T @ design))[:, None] + feature_hats ** 2 / feature_ss) * sigma2
+
+        coefficients = np.vstack([design_coefficients[:1], estimates, design_coefficients[1:]])
+        std_errors = np.sqrt(np.vstack([design_variances[:1], sigma2 / feature_ss, design_variances[1:]]))
+        t_values = coefficients / std_errors
+    pvalues = 2 * stats.t.sf(np.abs(t_values), df) if df > 0 else np.full(t_values.shape, np.nan)
+    return coefficients, std_errors, t_values, pvalues, rss, df
+
+
+def correlate(y, features, method='pearson'):
+    """Correlate y with every feature.
+
+    :param y: The outcome, of each sample.
+    :type y: :class:`numpy.ndarray`
+    :param features: The features, samples x features.
+    :type features: :class:`numpy.ndarray`
+    :param method: 'pearson' or 'spearman', defaults to 'pearson'.
+    :type method: str, optional
+    :return: The correlations and their p-values.
+    :rtype: tuple
+    """
+
+    if method == 'spearman':
+        y = stats.rankdata(y)
+        features = stats.rankdata(features, axis=0)
+
+    y_centred = y - y.mean()
+    features_centred = features - features.mean(axis=0)
+    df = len(y) - 2
+    with np.errstate(divide='ignore', invalid='ignore'):
+        correlations = (features_centred.T @ y_centred) / np.sqrt(np.sum(features_centred ** 2, axis=0) * np.sum(y_centred ** 2))
+        correlations = np.clip(correlations, -1, 1)
+        t_values = correlations * np.sqrt(df / (1 - correlations ** 2))
+    pvalues = 2 * stats.t.sf(np.abs(t_values), df) if df > 0 else np.full(correlations.shape, np.nan)
+    return correlations, pvalues
+
+
+def get_estimates(y, features, covariates, method):
+    """Get the estimates of every feature: the feature coefficient of linear models, or the correlation.
+
+    :return: The estimates and p-values.
+    :rtype: tuple
+    """
+
+    if method == 'linear':
+        coefficients, std_errors, t_values, pvalues, rss, df = fit_linear(y, features, covariates)
+        return coefficients[1], pvalues[1]
+    return correlate(y, features, method=method)
+
+
+def run_bootstrap_chunk(y, features, covariates, method, resamples, seed):
+    """Fit the models on bootstrap resamples of the samples. Runs in the bootstrap process pool.
+
+    :return: The estimates, resamples x features.
+    :rtype: :class:`numpy.ndarray`
+    """
+
+    rng = np.random.default_rng(seed)
+    n = len(y)
+    estimates = np.empty((resamples, features.shape[1]))
+    for i in range(resamples):
+        sample_indices = rng.integers(0, n, n)
+        estimates[i] = get_estimates(y[sample_indices], features[sample_indices], covariates[sample_indices], method)[0]
+    return estimates
+
+
+def bootstrap_estimates(y, features, covariates, method, resamples=1000, max_workers=None, seed=None, ci=0.95):
+    """Get percentile bootstrap confidence intervals of the estimates, with the resamples split across a process pool.
+
+    :param y: The outcome, of each sample.
+    :type y: :class:`numpy.ndarray`
+    :param features: The features, samples x features.
+    :type features: :class:`numpy.ndarray`
+    :param covariates: The covariates, samples x covariates.
+    :type covariates: :class:`numpy.ndarray`
+    :param method: The association method, one of :data:`METHODS`.
+    :type method: str
+    :param resamples: The number of resamples, defaults to 1000.
+    :type resamples: int, optional
+    :param max_workers: The number of processes, defaults to None (the number of CPUs). 1 runs in this process.
+    :type max_workers: int, optional
+    :param seed: The random seed, defaults to None.
+    :type seed: int, optional
+    :param ci: The confidence level, defaults to 0.95.
+    :type ci: float, optional
+    :return: The lower and upper bounds of each feature.
+    :rtype: tuple
+    """
+
+    chunk_sizes = [min(BOOTSTRAP_CHUNK_SIZE, resamples - start) for start in range(0, resamples, BOOTSTRAP_CHUNK_SIZE)]
+    seeds = np.random.SeedSequence(seed).spawn(len(chunk_sizes))
+
+    if max_workers == 1:
+        chunks = [run_bootstrap_chunk(y, features, covariates, method, chunk_size, chunk_seed)
+                  for chunk_size, chunk_seed in zip(chunk_sizes, seeds)]
+    else:
+        with ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context('spawn')) as executor:
+            futures = [executor.submit(run_bootstrap_chunk, y, features, covariates, method, chunk_size, chunk_seed)
+                       for chunk_size, chunk_seed in zip(chunk_sizes, seeds)]
+            chunks = [future.result() for future in futures]
+
+    estimates = np.vstack(chunks)
+    alpha = (1 - ci) / 2
+    return np.nanquantile(estimates, alpha, axis=0), np.nanquantile(estimates, 1 - alpha, axis=0)
+
+
+def run_mwas(intensity_data, sample_metadata, feature_names, model_Y_variable, model_X_variables=None, method='linear',
+             multiple_correction='BH', bootstrap=False, bootstrap_resamples=1000, max_workers=None, seed=None):
+    """Run an MWAS of every feature against the Y variable.
+
+    Samples with a missing Y or covariate value are left out. Features with missing values are fitted on their
+    complete samples, one at a time; the rest are fitted together.
+
+    :param intensity_data: The intensities, samples x features.
+    :type intensity_data: :class:`numpy.ndarray`
+    :param sample_metadata: The sample metadata.
+    :type sample_metadata: :class:`pandas.DataFrame`
+    :param feature_names: The name of each feature, ie the harmonised_annotation_id.
+    :type feature_names: list
+    :param model_Y_variable: The Y (outcome) column.
+    :type model_Y_variable: str
+    :param model_X_variables: The covariate columns, defaults to None.
+    :type model_X_variables: list, optional
+    :param method: The association method, one of :data:`METHODS`, defaults to 'linear'.
+    :type method: str, optional
+    :param multiple_correction: The multiple testing correction, defaults to 'BH'.
+    :type multiple_correction: str, optional
+    :param bootstrap: Whether to bootstrap the estimates of the significant features, defaults to False.
+    :type bootstrap: bool, optional
+    :param bootstrap_resamples: The number of bootstrap resamples, defaults to 1000.
+    :type bootstrap_resamples: int, optional
+    :param max_workers: The bootstrap processes, defaults to None (the number of CPUs).
+    :type max_workers: int, optional
+    :param seed: The bootstrap random seed, defaults to None.
+    :type seed: int, optional
+    :raises Exception: If the method is not supported.
+    :return: The results, as the R template returns them: mwastable, and mwasestimates and mwassummaries for linear
+        models, plus mwasbootstraps if bootstrapped.
+    :rtype: dict
+    """
+
+    if method not in METHODS:
+        raise Exception("MWAS method %s is not supported by the python MWAS backend, use one of %s" % (method, METHODS))
+    if not model_X_variables or method != 'linear':
+        model_X_variables = []
+
+    y = encode_covariates(sample_metadata, [model_Y_variable])[:, 0]
+    covariates = encode_covariates(sample_metadata, model_X_variables)
+    complete_samples = ~np.isnan(y) & ~np.isnan(covariates).any(axis=1)
+    y = y[complete_samples]
+    covariates = covariates[complete_samples]
+    features = np.asarray(intensity_data, dtype=float)[complete_samples]
+
+    row_names = [make_r_name(feature_name) for feature_name in feature_names]
+    n_coefficients = 2 + len(model_X_variables)
+    coefficients = np.full((n_coefficients, features.shape[1]), np.nan)
+    std_errors = np.full(coefficients.shape, np.nan)
+    t_values = np.full(coefficients.shape, np.nan)
+    coefficient_pvalues = np.full(coefficients.shape, np.nan)
+    rss = np.full(features.shape[1], np.nan)
+    df = np.full(features.shape[1], np.nan)
+    n_samples = np.full(features.shape[1], np.nan)
+
+    complete_features = ~np.isnan(features).any(axis=0)
+    feature_groups = [(np.flatnonzero(complete_features), np.ones(len(y), dtype=bool))]
+    feature_groups = feature_groups + [(np.array([j]), ~np.isnan(features[:, j])) for j in np.flatnonzero(~complete_features)]
+
+    for feature_indices, samples in feature_groups:
+        if len(feature_indices) == 0:
+            continue
+        if method == 'linear':
+            group = fit_linear(y[samples], features[samples][:, feature_indices], covariates[samples])
+            coefficients[:, feature_indices], std_errors[:, feature_indices], t_values[:, feature_indices], \
+                coefficient_pvalues[:, feature_indices], rss[feature_indices], df[feature_indices] = group
+        else:
+            coefficients[1, feature_indices], coefficient_pvalues[1, feature_indices] = \
+                correlate(y[samples], features[samples][:, feature_indices], method=method)
+        n_samples[feature_indices] = np.sum(samples)
+
+    mwastable = pd.DataFrame({'_row': row_names,
+                              'estimates': coefficients[1],
+                              'pvalues': coefficient_pvalues[1],
+                              'adjusted_pvalues': adjust_pvalues(coefficient_pvalues[1], multiple_correction)})
+    results = {'mwastable': mwastable}
+
+    if method == 'linear':
+        results['mwasestimates'] = {row_name: np.column_stack([coefficients[:, j], std_errors[:, j], t_values[:, j], coefficient_pvalues[:, j]]).tolist()
+                                    for j, row_name in enumerate(row_names)}
+        # The AIC of a gaussian GLM, with the residual variance as a parameter
+        aic = n_samples * (np.log(2 * math.pi * rss / n_samples) + 1) + 2 * (n_coefficients + 1)
+        aic, rss, df = aic.tolist(), rss.tolist(), df.tolist()
+        results['mwassummaries'] = {row_name: {'aic': [aic[j]], 'deviance': [rss[j]], 'df.residual': [df[j]]}
+                                    for j, row_name in enumerate(row_names)}
+
+    if bootstrap:
+        significant = np.flatnonzero(mwastable['adjusted_pvalues'].to_numpy() <= 0.05)
+        lower, upper = np.full(len(significant), np.nan), np.full(len(significant), np.nan)
+        if len(significant) > 0:
+            # Resampled from the samples that have values for all the significant features
+            bootstrap_samples = ~np.isnan(features[:, significant]).any(axis=1)
+            lower, upper = bootstrap_estimates(y[bootstrap_samples], features[bootstrap_samples][:, significant],
+                                               covariates[bootstrap_samples], method, resamples=bootstrap_resamples,
+                                               max_workers=max_workers, seed=seed)
+        results['mwasbootstraps'] = pd.DataFrame({'_row': [row_names[j] for j in significant],
+                                                  'estimates': coefficients[1, significant],
+                                                  'lower_ci': lower,
+                                                  'upper_ci': upper})
+
+    return results
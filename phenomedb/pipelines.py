@@ -508,7 +508,7 @@ class RunMWASMulti(Task):
 
     def __init__(self,saved_query_ids=None,method='pearson',correction_type=None,variable_of_interest=None,reload_cache=False,task_run_id=None,username=None,
                  upstream_task_run_id=None,model_Y_ci=None,model_Y_min=None,model_Y_max=None,multiple_correction=None,scaling=None,transform=None,
-                 execution_date=None,db_session=None,db_env=None,debug=False,pipeline_run_id=None):
+                 execution_date=None,db_session=None,db_env=None,debug=False,pipeline_run_id=None,backend=None):
 
         self.task_ids = {}
 
@@ -541,6 +541,8 @@ class RunMWASMulti(Task):
         self.args['model_Y_max'] = model_Y_max
         self.multiple_correction = multiple_correction
         self.args['multiple_correction'] = multiple_correction
+        self.backend = backend
+        self.args['backend'] = backend
 
         self.get_class_name(self)
 
@@ -556,6 +558,8 @@ class RunMWASMulti(Task):
                 'model_Y_variable': self.variable_of_interest,
                 'multiple_correction': self.multiple_correction,
                 }
+        if self.backend:
+            args['backend'] = self.backend
 
         saved_querys = self.db_session.query(SavedQuery).filter(SavedQuery.id.in_(self.saved_query_ids)).all()
 
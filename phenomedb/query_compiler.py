@@ -0,0 +1,308 @@
+"""Query compiler. Compiles a :class:`phenomedb.query_factory.QueryFactory` query_dict into SQLAlchemy expressions.
+
+The query_dict filters are converted into SQLAlchemy column expressions and the join route into (model, onclause)
+pairs, so no code string is built or evaluated. Values are bound parameters, not literals in the SQL.
+
+A :class:`CompiledQuery` is cached per query_dict hash and output model, and can produce a Core select of the full
+entities or of the ids only, or an ORM query for the existing QueryFactory methods.
+"""
+
+import hashlib
+import json
+import logging
+from collections import OrderedDict
+
+from sqlalchemy import and_, or_, not_, select
+from sqlalchemy.dialects import postgresql
+
+from phenomedb import models
+
+COMPARISON_OPERATORS = {'eq': lambda column, value: column == value,
+                        'not_eq': lambda column, value: column != value,
+                        'gt': lambda column, value: column > value,
+                        'lt': lambda column, value: column < value,
+                        'gte': lambda column, value: column >= value,
+                        'lte': lambda column, value: column <= value}
+
+FUNCTION_OPERATORS = {'between': lambda column, value: column.between(*value),
+                      'like': lambda column, value: column.like(value),
+                      'ilike': lambda column, value: column.ilike(value),
+                      'in': lambda column, value: column.in_(value)}
+
+#: The maximum number of compiled queries kept in the cache
+CACHE_SIZE = 256
+
+_compiled_queries = OrderedDict()
+
+
+def get_query_hash(query_dict, output_model):
+    """Get the hash of a query definition.
+
+    :param query_dict: The query_dict.
+    :type query_dict: dict
+    :param output_model: The output model, ie 'SampleAssay'.
+    :type output_model: str
+    :return: The md5 hash of the output model, joins and filters.
+    :rtype: str
+    """
+
+    definition = json.dumps({'model': output_model, 'joins': query_dict.get('joins', []),
+                             'filters': query_dict.get('filters', [])}, sort_keys=True, default=str)
+    return hashlib.md5(definition.encode('utf-8')).hexdigest()
+
+
+def get_model(model_name):
+    """Get a model class from its name.
+
+    :param model_name: The model name, ie 'SampleAssay'.
+    :type model_name: str
+    :raises Exception: If the model does not exist.
+    :return: The model class.
+    :rtype: :class:`phenomedb.models.Base`
+    """
+
+    model = getattr(models, model_name, None)
+    if model is None or not hasattr(model, '__table__'):
+        raise Exception("Unknown model %s" % model_name)
+    return model
+
+
+def get_column(model_name, property):
+    """Get a model column from the model and property names.
+
+    :param model_name: The model name, ie 'Project'.
+    :type model_name: str
+    :param property: The property name, ie 'name'.
+    :type property: str
+    :raises Exception: If the property does not exist.
+    :return: The column.
+    :rtype: :class:`sqlalchemy.orm.attributes.InstrumentedAttribute`
+    """
+
+    model = get_model(model_name)
+    if property not in model.__mapper__.all_orm_descriptors.keys():
+        raise Exception("Unknown property %s.%s" % (model_name, property))
+    return getattr(model, property)
+
+
+class CompiledQuery:
+    """A compiled query_dict.
+
+    :param model: The output model.
+    :type model: :class:`phenomedb.models.Base`
+    :param joins: The (model, onclause) joins, onclause None where it is inferred from the foreign keys.
+    :type joins: list
+    :param criteria: The filter expressions, one per query_dict filter.
+    :type criteria: list
+    :param query_hash: The hash of the query definition.
+    :type query_hash: str
+    """
+
+    def __init__(self, model, joins, criteria, query_hash):
+        self.model = model
+        self.joins = joins
+        self.criteria = criteria
+        self.query_hash = query_hash
+
+    def select(self, ids_only=False, limit=None, offset=None):
+        """Get the Core select statement.
+
+        :param ids_only: Whether to select the output model ids only, defaults to False
+        :type ids_only: bool, optional
+        :param limit: The limit, defaults to None
+        :type limit: int, optional
+        :param offset: The offset, defaults to None
+        :type offset: int, optional
+        :return: The select statement.
+        :rtype: :class:`sqlalchemy.sql.Select`
+        """
+
+        statement = select(self.model.id) if ids_only else select(self.model)
+        for model, onclause in self.joins:
+            statement = statement.join(model, onclause) if onclause is not None else statement.join(model)
+        statement = statement.where(*self.criteria).group_by(self.model.id).order_by(self.model.id)
+        if limit:
+            statement = statement.limit(int(limit))
+        if offset:
+            statement = statement.offset(int(offset))
+        return statement
+
+    def to_query(self, db_session):
+        """Get the ORM query, for with_entities(), count() etc.
+
+        :param db_session: The db_session.
+        :type db_session: :class:`sqlalchemy.orm.Session`
+        :return: The query.
+        :rtype: :class:`sqlalchemy.orm.Query`
+        """
+
+        query = db_session.query(self.model)
+        for model, onclause in self.joins:
+            query = query.join(model, onclause) if onclause is not None else query.join(model)
+        return query.filter(*self.criteria).group_by(self.model.id).order_by(self.model.id)
+
+    def get_sql(self, ids_only=False):
+        """Get the PostgreSQL of the select, with bound parameters.
+
+        :param ids_only: Whether to select the output model ids only, defaults to False
+        :type ids_only: bool, optional
+        :return: The SQL and the parameters.
+        :rtype: tuple(str, dict)
+        """
+
+        compiled = self.select(ids_only=ids_only).compile(dialect=postgresql.dialect())
+        return str(compiled), compiled.params
+
+
+class QueryCompiler:
+    """Compiles query_dicts into :class:`CompiledQuery` objects.
+
+    :param foreign_keys: 'ModelA-ModelB' -> ['ModelA.column', 'ModelB.column'], see QueryFactory.foreign_keys
+    :type foreign_keys: dict
+    :param logger: The logger, defaults to None
+    :type logger: :class:`logging.Logger`, optional
+    """
+
+    def __init__(self, foreign_keys, logger=None):
+        self.foreign_keys = foreign_keys
+        self.logger = logger if logger is not None else logging.getLogger(__name__)
+
+    def compile(self, query_dict, output_model, use_cache=True):
+        """Compile a query_dict. The joins must have been calculated, see QueryFactory.calculate_joins.
+
+        :param query_dict: The query_dict, with 'joins' and 'filters'.
+        :type query_dict: dict
+        :param output_model: The output model, ie 'SampleAssay'.
+        :type output_model: str
+        :param use_cache: Whether to use the compiled query cache, defaults to True
+        :type use_cache: bool, optional
+        :return: The compiled query.
+        :rtype: :class:`CompiledQuery`
+        """
+
+        query_hash = get_query_hash(query_dict, output_model)
+        if use_cache and query_hash in _compiled_queries:
+            _compiled_queries.move_to_end(query_hash)
+            return _compiled_queries[query_hash]
+
+        compiled_query = CompiledQuery(get_model(output_model),
+                                       self.compile_joins(output_model, query_dict.get('joins', [])),
+                                       [self.compile_filter(filter) for filter in query_dict.get('filters', [])],
+                                       query_hash)
+
+        if use_cache:
+            _compiled_queries[query_hash] = compiled_query
+            if len(_compiled_queries) > CACHE_SIZE:
+                _compiled_queries.popitem(last=False)
+        self.logger.debug("Compiled query %s" % query_hash)
+        return compiled_query
+
+    def get_onclause(self, output_model, join_model, previous_model):
+        """Get the join condition of a join model, from the foreign keys to the output model or previous join.
+
+        :param output_model: The output model.
+        :type output_model: str
+        :param join_model: The model to join.
+        :type join_model: str
+        :param previous_model: The previously joined model, or None.
+        :type previous_model: str
+        :return: The join condition, or None to infer it.
+        :rtype: :class:`sqlalchemy.sql.expression.BinaryExpression`
+        """
+
+        for key in [output_model + "-" + join_model, join_model + "-" + output_model,
+                    "%s-%s" % (join_model, previous_model), "%s-%s" % (previous_model, join_model)]:
+            if key in self.foreign_keys:
+                left, right = [column.split('.') for column in self.foreign_keys[key]]
+                return get_column(*left) == get_column(*right)
+        return None
+
+    def compile_joins(self, output_model, joins):
+        """Compile the join route.
+
+        :param output_model: The output model.
+        :type output_model: str
+        :param joins: The models to join, in order.
+        :type joins: list
+        :return: The (model, onclause) joins.
+        :rtype: list
+        """
+
+        compiled_joins = []
+        previous_model = None
+        for join_model in joins:
+            compiled_joins.append((get_model(join_model), self.get_onclause(output_model, join_model, previous_model)))
+            previous_model = join_model
+        return compiled_joins
+
+    def combine(self, operator, clauses):
+        """Combine clauses with a logical operator.
+
+        :param operator: 'AND' or 'OR'.
+        :type operator: str
+        :param clauses: The clauses.
+        :type clauses: list
+        :raises Exception: If the operator is unknown.
+        :return: The combined clause.
+        :rtype: :class:`sqlalchemy.sql.expression.ClauseElement`
+        """
+
+        if len(clauses) == 1:
+            return clauses[0]
+        elif operator == 'AND':
+            return and_(*clauses)
+        elif operator == 'OR':
+            return or_(*clauses)
+        else:
+            raise Exception("Unknown filter operator %s" % operator)
+
+    def compile_filter(self, filter):
+        """Compile a query_dict filter.
+
+        :param filter: The filter.
+        :type filter: dict
+        :return: The filter clause.
+        :rtype: :class:`sqlalchemy.sql.expression.ClauseElement`
+        """
+
+        return self.combine(filter['filter_operator'],
+                            [self.compile_sub_filter(sub_filter) for sub_filter in filter['sub_filters']])
+
+    def compile_sub_filter(self, sub_filter):
+        """Compile a query_dict sub filter.
+
+        :param sub_filter: The sub filter.
+        :type sub_filter: dict
+        :return: The sub filter clause.
+        :rtype: :class:`sqlalchemy.sql.expression.ClauseElement`
+        """
+
+        return self.combine(sub_filter['sub_filter_operator'],
+                            [self.compile_match(match) for match in sub_filter['matches']])
+
+    def compile_match(self, match):
+        """Compile a query_dict match.
+
+        :param match: The match, with model, property, operator and value.
+        :type match: dict
+        :raises Exception: If the operator is unknown.
+        :return: The match clause.
+        :rtype: :class:`sqlalchemy.sql.expression.ClauseElement`
+        """
+
+        column = get_column(match['model'], match['property'])
+        operator = match['operator']
+        if operator in COMPARISON_OPERATORS:
+            return COMPARISON_OPERATORS[operator](column, match['value'])
+        elif operator in FUNCTION_OPERATORS:
+            return FUNCTION_OPERATORS[operator](column, match['value'])
+        elif operator.startswith('not_') and operator[4:] in FUNCTION_OPERATORS:
+            return not_(FUNCTION_OPERATORS[operator[4:]](column, match['value']))
+        else:
+            raise Exception("Unknown match operator %s" % operator)
+
+
+def clear_cache():
+    """Clear the compiled query cache."""
+
+    _compiled_queries.clear()
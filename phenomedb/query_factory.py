@@ -6,14 +6,27 @@
 from phenomedb.models import *
 import phenomedb.utilities as utils
 import re
+import datetime
+import contextlib
 import pandas as pd
 import numpy as np
-from sqlalchemy import func
+from sqlalchemy import and_, func, or_, select
 from phenomedb.cache import Cache
 from phenomedb.exceptions import *
+from phenomedb import unit_conversion
+from phenomedb.annotation_resolver import FeatureAnnotationResolver
+from phenomedb import class_aggregation
+from phenomedb import scaling as scaling_engine
+from phenomedb import transform_pipeline
+from phenomedb.query_compiler import QueryCompiler
+from phenomedb import summary_statistics
+from phenomedb.cohort import CohortTable
+from phenomedb import dataframe_refresh
+from phenomedb import matrix_store
 from pyChemometrics.ChemometricsScaler import ChemometricsScaler
 from sqlalchemy.dialects import postgresql
 from sqlalchemy.orm.collections import InstrumentedList
+from sqlalchemy.orm import aliased
 import nPYc
 import shutil
 from sqlalchemy.sql.expression import cast
@@ -165,6 +178,9 @@ class QueryFactory:
                              'in': '.in_(',
                              'not_in': '.in_('}
 
+    # The modules of the tasks that edit data in place, which invalidate the summary statistics of every project
+    write_task_modules = ['phenomedb.task', 'phenomedb.metadata', 'phenomedb.compounds', 'phenomedb.batch_correction']
+
 
     def __init__(self, saved_query=None, saved_query_id=None, filters=None, query_dict=None,
                  db_env=None,db_session=None,project_short_label=None,
@@ -175,6 +191,7 @@ class QueryFactory:
         self.query_dict = None
         self.saved_query = None
         self.compound_class_feature_map = {}
+        self.transform_provenance = []
 
         self.query_name = query_name
         self.query_description = query_description
@@ -183,6 +200,9 @@ class QueryFactory:
         else:
             self.project_short_label = query_name
         self.query = None
+        self.compiled_query = None
+        self.cohort_tables = {}
+        self.build_state = None
         self.__code_string = None
         self.query_results = None
         self.unique_match_models = []
@@ -192,6 +212,7 @@ class QueryFactory:
         self.annotated_feature_id_matrix = None
 
         self.logger = utils.configure_logging('query_factory')
+        self.query_compiler = QueryCompiler(self.foreign_keys, logger=self.logger)
 
         self.role_id = role_id
 
@@ -641,7 +662,8 @@ class QueryFactory:
             self.__code_string = self.__code_string + str(match['value'])
 
     def generate_query(self, output_model='SampleAssay',harmonise_annotations=True):
-        """Generate the query. Builds the query code string and evaluates it.
+        """Generate the query. Compiles the query_dict into SQLAlchemy expressions (cached per query_dict hash), and
+        builds the query code string for the SavedQuery record.
 
         :raises Exception: If the query is invalid.
         """
@@ -652,16 +674,94 @@ class QueryFactory:
         self.build_query_string(output_model=self.parent_model[output_model],harmonise_annotations=harmonise_annotations)
 
         try:
-            self.query = eval('self.%s' % self.get_code_string())
+            self.compiled_query = self.query_compiler.compile(self.query_dict, self.query_dict['model'])
+            self.query = self.compiled_query.to_query(self.db_session)
+
+        except Exception as err:
+            self.logger.exception("Query not compilable - %s " % self.get_code_string())
+            raise Exception("Query not compilable - %s %s" % (self.get_code_string(), err))
+
+    def get_sql(self, ids_only=False):
+        """Get the SQL of the compiled query, with bound parameters.
+
+        :param ids_only: Whether to select the output model ids only, defaults to False.
+        :type ids_only: bool, optional
+        :return: The SQL and the parameters.
+        :rtype: tuple(str, dict)
+        """
+
+        if not self.compiled_query:
+            self.generate_query()
+
+        return self.compiled_query.get_sql(ids_only=ids_only)
+
+    @contextlib.contextmanager
+    def materialised_cohort(self, *output_models):
+        """Context manager that materialises the matching ids of each output model into an indexed temporary table.
+
+        Within the context, :meth:`get_ids_select` and :meth:`get_id_filter` join against the tables instead of
+        re-running the query. Models already materialised by an outer context are reused. The tables are dropped on
+        exit. The session must not be committed within the context, as the tables belong to its connection.
+
+        Example usage:
+            with query_factory.materialised_cohort('SampleAssay'):
+                summary = query_factory.calculate_summary_statistics()
+
+        :param output_models: The output models, defaults to 'SampleAssay'.
+        :type output_models: str
+        :return: output model -> :class:`phenomedb.cohort.CohortTable`
+        :rtype: dict
+        """
+
+        if len(output_models) == 0:
+            output_models = ('SampleAssay',)
+
+        materialised = []
+        try:
+            for output_model in output_models:
+                if output_model not in self.cohort_tables:
+                    self.generate_query(output_model=output_model)
+                    self.cohort_tables[output_model] = CohortTable(self.db_session, output_model,
+                                                                   self.compiled_query.select(ids_only=True),
+                                                                   logger=self.logger).materialise()
+                    materialised.append(output_model)
+            yield self.cohort_tables
+        finally:
+            for output_model in materialised:
+                self.cohort_tables.pop(output_model).drop()
+
+    def get_ids_select(self, output_model='SampleAssay'):
+        """Get the select of the matching ids of an output model, from the materialised cohort if there is one.
+
+        :param output_model: The output model, defaults to 'SampleAssay'.
+        :type output_model: str, optional
+        :return: The select of the ids.
+        :rtype: :class:`sqlalchemy.sql.Select`
+        """
+
+        if output_model in self.cohort_tables:
+            return self.cohort_tables[output_model].select_ids()
+
+        self.generate_query(output_model=output_model)
+        return self.compiled_query.select(ids_only=True).order_by(None)
 
-        except:
-            self.logger.exception("Query string unexecutable - %s " % self.get_code_string())
-            raise Exception("Query string unexecutable - %s " % self.get_code_string())
+    def get_id_filter(self, column, output_model='SampleAssay'):
+        """Get a filter restricting an id column to the matching ids of an output model, without an IN list.
+
+        :param column: The id column, ie AnnotatedFeature.sample_assay_id.
+        :type column: :class:`sqlalchemy.orm.attributes.InstrumentedAttribute`
+        :param output_model: The output model, defaults to 'SampleAssay'.
+        :type output_model: str, optional
+        :return: The filter.
+        :rtype: :class:`sqlalchemy.sql.expression.BinaryExpression`
+        """
+
+        return column.in_(self.get_ids_select(output_model))
 
     def execute_query(self, type="all", limit=None, offset=None):
         """Execute the query.
 
-        :param type: What kind of query, 'all', 'first', or 'count', defaults to "all".
+        :param type: What kind of query, 'all', 'first', 'count', or 'ids' (the output model ids only, without loading the entities), defaults to "all".
         :type type: str, optional
         :param limit: The query limit, defaults to None.
         :type limit: int, optional
@@ -671,7 +771,14 @@ class QueryFactory:
         :raises Exception: no query object to execute.
         """
 
-        if self.query:
+        if type == 'ids' and self.compiled_query:
+
+            self.query_results = self.db_session.execute(self.compiled_query.select(ids_only=True, limit=limit,
+                                                                                    offset=offset)).scalars().all()
+            self.logger.info('Number of ids: %s' % len(self.query_results))
+            return self.query_results
+
+        elif self.query:
 
             if limit:
                 self.query = self.query.limit(int(limit))
@@ -702,7 +809,7 @@ class QueryFactory:
     def generate_and_execute_query(self, output_model='SampleAssay', type='all', limit=None, offset=None):
         """Generate and execute the query.
 
-        :param type: What kind of query, 'all', 'first', or 'count', defaults to "all".
+        :param type: What kind of query, 'all', 'first', 'count', or 'ids', defaults to "all".
         :type type: str, optional
         :param limit: The query limit, defaults to None.
         :type limit: int, optional
@@ -715,10 +822,8 @@ class QueryFactory:
         # Hack because CompoundClass results are generated from AnnotatedFeature dataframes
 
         self.generate_query(output_model=self.parent_model[output_model])
-        self.logger.info(self.get_code_string())
-        self.logger.info(self.query.statement.compile(dialect=postgresql.dialect(),
-                           compile_kwargs={
-                               "literal_binds": True}))
+        sql, params = self.get_sql(ids_only=(type == 'ids'))
+        self.logger.info("%s %s" % (sql, params))
         self.execute_query(type=type, limit=limit, offset=offset)
         return self.query_results
 
@@ -785,288 +890,179 @@ class QueryFactory:
 
         return self.saved_query
 
-    def load_summary_statistics(self,reload_cache=False):
+    def load_summary_statistics(self,reload_cache=False,incremental=False):
+        """Load the summary statistics of the query, from the cache if the query is saved.
+
+        :param reload_cache: Whether to recalculate the summary statistics, defaults to False.
+        :type reload_cache: bool, optional
+        :param incremental: Whether to recalculate only the projects updated since the cached summary statistics were calculated, see :meth:`get_projects_updated_since`, defaults to False.
+        :type incremental: bool, optional
+        :return: The summary statistics.
+        :rtype: dict
+        """
 
         # If it is saved, it can cache the dataframe in redis
         if self.saved_query:
 
             key = self.saved_query.get_cache_summary_stats_key()
+            projects_key = self.saved_query.get_cache_summary_stats_projects_key()
+
+            if incremental and not reload_cache and self.cache.exists(projects_key):
+                cached = self.cache.get(projects_key)
+                calculated_at = datetime.datetime.now()
+                project_fingerprints = summary_statistics.calculate_project_fingerprints(self.db_session)
+                projects = self.get_projects_updated_since(datetime.datetime.fromisoformat(cached['calculated_at']),
+                                                           project_fingerprints,
+                                                           cached.get('project_fingerprints'))
+                if projects is None:
+                    self.set_summary_statistics_cache(self.calculate_project_summaries(), calculated_at,
+                                                      project_fingerprints)
+                    self.logger.info("Recalculated summary statistics for all projects, data edited since %s" % cached['calculated_at'])
+                elif len(projects) > 0 or not self.cache.exists(key):
+                    updated_project_summaries = self.calculate_project_summaries(projects=projects)
+                    project_summaries = summary_statistics.update_project_summaries(cached['projects'],
+                                                                                    updated_project_summaries,
+                                                                                    projects)
+                    self.set_summary_statistics_cache(project_summaries, calculated_at, project_fingerprints)
+                    self.logger.info("Recalculated summary statistics for projects %s" % projects)
+                else:
+                    self.summary = self.cache.get(key)
+                    self.logger.info("Got from redis %s, no projects updated" % key)
 
-            if self.cache.exists(key) and not reload_cache:
+            elif self.cache.exists(key) and not reload_cache and not incremental:
                 self.summary = self.cache.get(key)
                 self.logger.info("Got from redis %s" % key)
             else:
-                # Expires after 24 hours
-                self.calculate_summary_statistics()
-                self.logger.debug("Query Summary %s %s" % (type(self.summary),self.summary))
-                self.cache.set(key, utils.convert_to_json_safe(self.summary))
-                self.logger.info("Set into redis %s" % key)
+                calculated_at = datetime.datetime.now()
+                project_fingerprints = summary_statistics.calculate_project_fingerprints(self.db_session)
+                self.set_summary_statistics_cache(self.calculate_project_summaries(), calculated_at, project_fingerprints)
         else:
             self.calculate_summary_statistics()
 
         return self.summary
 
-    def calculate_summary_statistics(self):
-        """Calculate the summary statistics of the query.
+    def set_summary_statistics_cache(self,project_summaries,calculated_at,project_fingerprints):
+        """Combine the per-project summaries into the summary statistics, and cache both.
 
-        :return: summary: dictionary of summary statistics.
-        :rtype: dict
+        :param project_summaries: project name -> per-project summary, see :func:`phenomedb.summary_statistics.calculate_project_summaries`.
+        :type project_summaries: dict
+        :param calculated_at: When the calculation started.
+        :type calculated_at: :class:`datetime.datetime`
+        :param project_fingerprints: The project fingerprints when the calculation started, see :func:`phenomedb.summary_statistics.calculate_project_fingerprints`.
+        :type project_fingerprints: dict
         """
 
-        if not self.query:
-            self.generate_query(output_model='SampleAssay')
+        self.summary = summary_statistics.combine_project_summaries(project_summaries)
+        self.logger.debug("Query Summary %s %s" % (type(self.summary),self.summary))
+        key = self.saved_query.get_cache_summary_stats_key()
+        self.cache.set(key, utils.convert_to_json_safe(self.summary))
+        self.cache.set(self.saved_query.get_cache_summary_stats_projects_key(),
+                       {'calculated_at': calculated_at.isoformat(), 'projects': project_summaries,
+                        'project_fingerprints': project_fingerprints})
+        self.logger.info("Set into redis %s" % key)
+
+    def get_projects_updated_since(self,since,project_fingerprints,cached_project_fingerprints):
+        """Get the projects updated since a time, or None if every project must be recalculated.
+
+        The projects updated are those with successful imports finished since the time, and those whose fingerprints
+        have changed, which includes deletions. Tasks that edit data in place, see :attr:`write_task_modules`, and
+        imports without a project do not change the fingerprints, so if any have finished since the time, or there are
+        no cached fingerprints, every project is recalculated.
+
+        :param since: The time.
+        :type since: :class:`datetime.datetime`
+        :param project_fingerprints: The current project fingerprints, see :func:`phenomedb.summary_statistics.calculate_project_fingerprints`.
+        :type project_fingerprints: dict
+        :param cached_project_fingerprints: The project fingerprints at the time, or None if not cached.
+        :type cached_project_fingerprints: dict
+        :return: The project names, or None for all projects.
+        :rtype: list
+        """
 
-        print(self.query)
+        if cached_project_fingerprints is None:
+            return None
 
-        summary = {}
-        self.execute_query()
-        sample_assay_ids = [sample_assay.id for sample_assay in self.query_results]
+        write_task_count = self.db_session.query(TaskRun.id) \
+            .filter(or_(TaskRun.module_name.in_(self.write_task_modules),
+                        and_(TaskRun.module_name.like('phenomedb.imports%'),
+                             TaskRun.args['project_name'].astext == None)),
+                    TaskRun.status == TaskRun.Status.success,
+                    TaskRun.datetime_finished >= since) \
+            .count()
+        if write_task_count > 0:
+            return None
 
-        self.logger.info("Number of sampling event assay ids: " + str(len(sample_assay_ids)))
+        project_names = self.db_session.query(TaskRun.args['project_name'].astext) \
+            .filter(TaskRun.module_name.like('phenomedb.imports%'),
+                    TaskRun.status == TaskRun.Status.success,
+                    TaskRun.datetime_finished >= since,
+                    TaskRun.args['project_name'].astext != None) \
+            .distinct().all()
+        projects = set([row[0] for row in project_names])
+        projects.update(summary_statistics.get_changed_projects(project_fingerprints, cached_project_fingerprints))
+        return sorted(projects)
+
+    def calculate_project_summaries(self,projects=None):
+        """Calculate the per-project summary statistics of the query.
+
+        :param projects: The project names to calculate, defaults to None (all projects).
+        :type projects: list, optional
+        :return: project name -> per-project summary (JSON safe)
+        :rtype: dict
+        """
 
-        summary['number_of_sample_assays'] = len(sample_assay_ids)
+        # The summary statistics queries join the materialised ids rather than each re-running the query
+        with self.materialised_cohort('SampleAssay'):
+            project_summaries = summary_statistics.calculate_project_summaries(self.db_session,
+                                                                               self.get_ids_select('SampleAssay'),
+                                                                               projects=projects)
+        self.logger.info("Summary statistics calculated for %s projects" % len(project_summaries))
+        return utils.convert_to_json_safe(project_summaries)
 
-        summary['number_samples'] = self.db_session.query(Sample).join(SampleAssay) \
-            .filter(SampleAssay.id.in_(sample_assay_ids)) \
-            .group_by(Sample.id).count()
+    def calculate_summary_statistics(self):
+        """Calculate the summary statistics of the query.
 
-        summary['number_subjects'] = self.db_session.query(Subject).join(Sample, SampleAssay) \
-            .filter(SampleAssay.id.in_(sample_assay_ids)) \
-            .group_by(Subject.id).count()
+        The matching SampleAssay ids are a CTE, and the statistics are calculated per project with grouping sets over
+        it, see :mod:`phenomedb.summary_statistics`.
 
-        summary['number_of_annotated_features'] = self.db_session.query(AnnotatedFeature).join(SampleAssay) \
-            .filter(SampleAssay.id.in_(sample_assay_ids)) \
-            .group_by(AnnotatedFeature.id).count()
+        :return: summary: dictionary of summary statistics.
+        :rtype: dict
+        """
+
+        summary = summary_statistics.combine_project_summaries(self.calculate_project_summaries())
+        self.logger.info("Number of sampling event assay ids: " + str(summary['number_of_sample_assays']))
 
-        if self.db_env == 'TEST':
-            engine = db.test_engine
-        elif self.db_env == 'BETA':
-            engine = db.beta_engine
-        else:
-            engine = db.prod_engine
-
-        import sqlalchemy
-
-        sql = text("select min(sq.subject_annotation_count) from (" + \
-                "select subject_id, count(annotation_id) as subject_annotation_count " + \
-                "from feature_metadata fm inner join annotated_feature af on af.feature_metadata_id = fm.id " + \
-                "inner join sample_assay sa on sa.id = af.sample_assay_id " + \
-                "inner join sample s on s.id = sa.sample_id " + \
-                "where sa.id = ANY(:saids) " + \
-                "group by subject_id) sq;")# % (",".join([str(sample_id) for sample_id in sample_assay_ids]))
-
-        summary['min_annotated_feature_count'] = engine.execute(sql,saids=sample_assay_ids).fetchall()[0][0]
-
-      #  sql = "select min(sq.subject_annotation_count) from (" + \
-      #        "select subject_id, count(annotation_id) as subject_annotation_count " + \
-      #        "from feature_metadata fm inner join annotated_feature af on af.feature_metadata_id = fm.id " + \
-      #        "inner join sample_assay sa on sa.id = af.sample_assay_id " + \
-      #        "inner join sample s on s.id = sa.sample_id " + \
-      #        "group by subject_id) sq;"#
-
-        #summary['unique_annotated_features'] = engine.execute(sql).fetchall()[0][0]
-
-        summary['project_counts'] = {x[0]: x[1] for x in
-                                     self.db_session.query(Project.name, func.count(SampleAssay.id)).join(Subject,
-                                                                                                          Sample,
-                                                                                                          SampleAssay) \
-                                         .filter(SampleAssay.id.in_(sample_assay_ids)) \
-                                         .group_by(Project.name).order_by(Project.name).all()}
-
-        summary['assay_counts'] = {x[0]: x[1] for x in
-                                   self.db_session.query(Assay.name, func.count(SampleAssay.id)).join(SampleAssay) \
-                                       .filter(SampleAssay.id.in_(sample_assay_ids)) \
-                                       .group_by(Assay.name).all()}
-
-      #  summary['annotation_method_counts'] = {'%s-%s' % (x[0],x[1]): x[2] for x in
-      #                             self.db_session.query(Assay.name, AnnotationMethod.name, func.count(SampleAssay.id)).join(SampleAssay,AnnotatedFeature,Annotation,HarmonisedAnnotation,AnnotationMethod) \
-      #                                 .filter(SampleAssay.id.in_(sample_assay_ids)) \
-      #                                 .group_by(Assay.name,AnnotationMethod.name).all()}
-
-        summary['sample_matrix_counts'] = {x[0]: x[1] for x in self.db_session.query(Sample.sample_matrix,
-                                                                                     func.count(
-                                                                                         SampleAssay.id)).join(
-            SampleAssay) \
-            .filter(SampleAssay.id.in_(sample_assay_ids)) \
-            .group_by(Sample.sample_matrix).all()}
-
-        summary['sample_type_counts'] = {x[0].value: x[1] for x in
-                                         self.db_session.query(Sample.sample_type, func.count(SampleAssay.id)).join(
-                                             SampleAssay) \
-                                             .filter(SampleAssay.id.in_(sample_assay_ids)) \
-                                             .group_by(Sample.sample_type).all()}
-
-        raw_counts = self.db_session.query(MetadataField.name,
-                              MetadataValue.raw_value,
-                              func.count(MetadataValue.raw_value)) \
-            .join(MetadataValue, Sample, SampleAssay) \
-            .filter(SampleAssay.id.in_(sample_assay_ids)) \
-            .group_by(MetadataField.name, MetadataValue.raw_value) \
-            .order_by(MetadataField.name,MetadataValue.raw_value).all()
-
-        summary['metadata_counts_raw'] = {}
-        for result in raw_counts:
-            if result[0] not in summary['metadata_counts_raw'].keys():
-                summary['metadata_counts_raw'][result[0]] = {}
-            if result[1] not in summary['metadata_counts_raw'][result[0]].keys():
-                summary['metadata_counts_raw'][result[0]][result[1]] = {}
-            summary['metadata_counts_raw'][result[0]][result[1]] = result[2]
-
-        harmonised_text_counts = self.db_session.query(HarmonisedMetadataField.name,
-                                           MetadataValue.harmonised_text_value,
-                                           func.count(MetadataValue.harmonised_text_value)) \
-            .select_from(HarmonisedMetadataField,MetadataField,MetadataValue,Sample,SampleAssay) \
-            .join(MetadataField, MetadataField.harmonised_metadata_field_id == HarmonisedMetadataField.id) \
-            .join(MetadataValue, MetadataValue.metadata_field_id == MetadataField.id) \
-            .join(Sample, MetadataValue.sample_id == Sample.id) \
-            .join(SampleAssay, SampleAssay.sample_id == Sample.id) \
-            .filter(SampleAssay.id.in_(sample_assay_ids)) \
-            .group_by(HarmonisedMetadataField.name, MetadataValue.harmonised_text_value).all()
-        summary['metadata_counts_harmonised_text'] = {}
-        for result in harmonised_text_counts:
-            if result[0] not in summary['metadata_counts_harmonised_text'].keys():
-                summary['metadata_counts_harmonised_text'][result[0]] = {}
-            if result[1] not in summary['metadata_counts_harmonised_text'][result[0]].keys():
-                summary['metadata_counts_harmonised_text'][result[0]][result[1]] = {}
-            summary['metadata_counts_harmonised_text'][result[0]][result[1]] = result[2]
-
-        harmonised_numeric_counts = self.db_session.query(HarmonisedMetadataField.name,
-                                                       MetadataValue.harmonised_numeric_value,
-                                                       func.count(MetadataValue.harmonised_numeric_value)) \
-            .select_from(HarmonisedMetadataField, MetadataField, MetadataValue, Sample, SampleAssay) \
-            .join(MetadataField, MetadataField.harmonised_metadata_field_id == HarmonisedMetadataField.id) \
-            .join(MetadataValue, MetadataValue.metadata_field_id == MetadataField.id) \
-            .join(Sample, MetadataValue.sample_id == Sample.id) \
-            .join(SampleAssay, SampleAssay.sample_id == Sample.id) \
-            .filter(SampleAssay.id.in_(sample_assay_ids)) \
-            .group_by(HarmonisedMetadataField.name, MetadataValue.harmonised_numeric_value).all()
-        summary['metadata_counts_harmonised_numeric'] = {}
-        for result in harmonised_numeric_counts:
-            if result[0] not in summary['metadata_counts_harmonised_numeric'].keys():
-                summary['metadata_counts_harmonised_numeric'][result[0]] = {}
-            if result[1] not in summary['metadata_counts_harmonised_numeric'][result[0]].keys():
-                summary['metadata_counts_harmonised_numeric'][result[0]][result[1]] = {}
-            summary['metadata_counts_harmonised_numeric'][result[0]][result[1]] = result[2]
-
-        harmonised_datetime_counts = self.db_session.query(HarmonisedMetadataField.name,
-                                                          MetadataValue.harmonised_datetime_value,
-                                                          func.count(MetadataValue.harmonised_datetime_value)) \
-            .select_from(HarmonisedMetadataField, MetadataField, MetadataValue, Sample, SampleAssay) \
-            .join(MetadataField, MetadataField.harmonised_metadata_field_id == HarmonisedMetadataField.id) \
-            .join(MetadataValue, MetadataValue.metadata_field_id == MetadataField.id) \
-            .join(Sample, MetadataValue.sample_id == Sample.id) \
-            .join(SampleAssay, SampleAssay.sample_id == Sample.id) \
-            .filter(SampleAssay.id.in_(sample_assay_ids)) \
-            .filter(MetadataValue.harmonised_datetime_value!=None) \
-            .group_by(HarmonisedMetadataField.name, MetadataValue.harmonised_datetime_value).all()
-        
-        summary['metadata_counts_harmonised_datetime'] = {}
-        for result in harmonised_datetime_counts:
-            if result[0] not in summary['metadata_counts_harmonised_datetime'].keys():
-                summary['metadata_counts_harmonised_datetime'][result[0]] = {}
-            if result[1] not in summary['metadata_counts_harmonised_datetime'][result[0]].keys():
-                summary['metadata_counts_harmonised_datetime'][result[0]][result[1]] = {}
-            summary['metadata_counts_harmonised_datetime'][result[0]][result[1]] = result[2]
-
-        harmonised_text_counts_by_project = self.db_session.query(Project.name,
-                                                       HarmonisedMetadataField.name,
-                                                       MetadataValue.harmonised_text_value,
-                                                       func.count(MetadataValue.harmonised_text_value)) \
-            .select_from(HarmonisedMetadataField, MetadataField, MetadataValue, Sample, SampleAssay, Subject, Project) \
-            .join(MetadataField, MetadataField.harmonised_metadata_field_id == HarmonisedMetadataField.id) \
-            .join(MetadataValue, MetadataValue.metadata_field_id == MetadataField.id) \
-            .join(Sample, MetadataValue.sample_id == Sample.id) \
-            .join(SampleAssay, SampleAssay.sample_id == Sample.id) \
-            .join(Subject, Subject.id == Sample.subject_id) \
-            .join(Project, Project.id == Subject.project_id) \
-            .filter(SampleAssay.id.in_(sample_assay_ids)) \
-            .filter(MetadataValue.harmonised_text_value != None) \
-            .group_by(Project.name, HarmonisedMetadataField.name, MetadataValue.harmonised_text_value)\
-            .order_by(Project.name,HarmonisedMetadataField.name).all()
-
-        summary['metadata_counts_harmonised_text_by_project'] = {}
-        for result in harmonised_text_counts_by_project:
-            if result[1] not in summary['metadata_counts_harmonised_text_by_project'].keys():
-                summary['metadata_counts_harmonised_text_by_project'][result[1]] = {}
-            if result[0] not in summary['metadata_counts_harmonised_text_by_project'][result[1]].keys():
-                summary['metadata_counts_harmonised_text_by_project'][result[1]][result[0]] = {}
-            if result[2] not in summary['metadata_counts_harmonised_text_by_project'][result[1]][result[0]].keys():
-               summary['metadata_counts_harmonised_text_by_project'][result[1]][result[0]][result[2]] = {}
-            summary['metadata_counts_harmonised_text_by_project'][result[1]][result[0]][result[2]] = result[3]
-
-        harmonised_numeric_counts_by_project = self.db_session.query(Project.name,
-                                                       HarmonisedMetadataField.name,
-                                                       MetadataValue.harmonised_numeric_value,
-                                                       func.count(MetadataValue.harmonised_numeric_value)) \
-            .select_from(HarmonisedMetadataField, MetadataField, MetadataValue, Sample, SampleAssay, Subject, Project) \
-            .join(MetadataField, MetadataField.harmonised_metadata_field_id == HarmonisedMetadataField.id) \
-            .join(MetadataValue, MetadataValue.metadata_field_id == MetadataField.id) \
-            .join(Sample, MetadataValue.sample_id == Sample.id) \
-            .join(SampleAssay, SampleAssay.sample_id == Sample.id) \
-            .join(Subject, Subject.id == Sample.subject_id) \
-            .join(Project, Project.id == Subject.project_id) \
-            .filter(SampleAssay.id.in_(sample_assay_ids)) \
-            .filter(MetadataValue.harmonised_numeric_value != None) \
-            .group_by(Project.name,HarmonisedMetadataField.name, MetadataValue.harmonised_numeric_value)\
-            .order_by(Project.name,HarmonisedMetadataField.name).all()
-        summary['metadata_counts_harmonised_numeric_by_project'] = {}
-        for result in harmonised_numeric_counts_by_project:
-            if result[1] not in summary['metadata_counts_harmonised_numeric_by_project'].keys():
-                summary['metadata_counts_harmonised_numeric_by_project'][result[1]] = {}
-            if result[0] not in summary['metadata_counts_harmonised_numeric_by_project'][result[1]].keys():
-                summary['metadata_counts_harmonised_numeric_by_project'][result[1]][result[0]] = {}
-            if result[2] not in summary['metadata_counts_harmonised_numeric_by_project'][result[1]][result[0]].keys():
-                summary['metadata_counts_harmonised_numeric_by_project'][result[1]][result[0]][result[2]] = {}
-            summary['metadata_counts_harmonised_numeric_by_project'][result[1]][result[0]][result[2]] = result[3]
-
-        harmonised_datetime_counts_by_project = self.db_session.query(Project.name,
-                                                                     HarmonisedMetadataField.name,
-                                                                     MetadataValue.harmonised_numeric_value,
-                                                                     func.count(MetadataValue.harmonised_numeric_value)) \
-            .select_from(HarmonisedMetadataField, MetadataField, MetadataValue, Sample, SampleAssay, Subject, Project) \
-            .join(MetadataField, MetadataField.harmonised_metadata_field_id == HarmonisedMetadataField.id) \
-            .join(MetadataValue, MetadataValue.metadata_field_id == MetadataField.id) \
-            .join(Sample, MetadataValue.sample_id == Sample.id) \
-            .join(SampleAssay, SampleAssay.sample_id == Sample.id) \
-            .join(Subject, Subject.id == Sample.subject_id) \
-            .join(Project, Project.id == Subject.project_id) \
-            .filter(SampleAssay.id.in_(sample_assay_ids)) \
-            .filter(MetadataValue.harmonised_numeric_value != None) \
-            .group_by(Project.name, HarmonisedMetadataField.name, MetadataValue.harmonised_numeric_value)\
-            .order_by(Project.name,HarmonisedMetadataField.name).all()
-        summary['metadata_counts_harmonised_datetime_by_project'] = {}
-        for result in harmonised_datetime_counts_by_project:
-            if result[1] not in summary['metadata_counts_harmonised_datetime_by_project'].keys():
-                summary['metadata_counts_harmonised_datetime_by_project'][result[1]] = {}
-            if result[0] not in summary['metadata_counts_harmonised_datetime_by_project'][result[1]].keys():
-                summary['metadata_counts_harmonised_datetime_by_project'][result[1]][result[0]] = {}
-            if result[2] not in summary['metadata_counts_harmonised_datetime_by_project'][result[1]][result[0]].keys():
-                summary['metadata_counts_harmonised_datetime_by_project'][result[1]][result[0]][result[2]] = {}
-            summary['metadata_counts_harmonised_datetime_by_project'][result[1]][result[0]][result[2]] = result[3]
         self.query_results = None
         self.summary = summary
         return summary
 
     def execute_and_build_annotated_feature_dataframe(self,convert_units=True,zero_lloq=True,inf_uloq=True,
-                                                        master_unit='mmol/L',correction_type=None):
-
-        self.generate_query(output_model='SampleAssay')
-        sample_assays = self.execute_query()
-        self.generate_query(output_model='HarmonisedAnnotation')
-        harmonised_annotations = self.execute_query()
-        harmonised_annotation_ids = []
-        # harmonised_annotation_ids = [harmonised_annotation.id for harmonised_annotation in harmonised_annotations]
-        sample_assay_ids = []
-        sample_ids = []
-        for sample_assay in sample_assays:
-            sample_assay_ids.append(sample_assay.id)
-            if sample_assay.sample.id not in sample_ids:
-                sample_ids.append(sample_assay.sample.id)
-
-        del sample_assays
-        gc.collect()
-
-        # dataframe = pd.DataFrame(columns=['Project', 'Acquired Time', 'Sample ID', 'Unique Name','Unique Batch',])
+                                                        master_unit='mmol/L',correction_type=None,chunksize=None):
+        """Build the HarmonisedAnnotation combined dataframe column-wise, with one row per SampleAssay.
+
+        The intensities of every HarmonisedAnnotation in the query are fetched in a single query and pivoted once into
+        a (SampleAssay x HarmonisedAnnotation) matrix. The matching ids are joined from the materialised cohort when
+        called within :meth:`materialised_cohort`, as :meth:`execute_and_build_dataframe` does. Harmonised metadata is fetched with one query per datatype and raw metadata (single project queries only) with
+        one query, each pivoted on field name. Units are converted with one multiplier per (unit, master_unit) pair.
+
+        :param convert_units: Whether to convert the intensities to the master_unit, defaults to True.
+        :type convert_units: bool, optional
+        :param zero_lloq: Set <LLOQ values to 0, defaults to True.
+        :type zero_lloq: bool, optional
+        :param inf_uloq: Set >ULOQ values to inf, defaults to True.
+        :type inf_uloq: bool, optional
+        :param master_unit: The unit to convert to, defaults to 'mmol/L'.
+        :type master_unit: str, optional
+        :param correction_type: The batch correction type, 'SR' or 'LTR', defaults to None.
+        :type correction_type: str, optional
+        :param chunksize: If set, stream the intensities through a server-side cursor in chunks of this many rows, defaults to None.
+        :type chunksize: int, optional
+        :return: The combined dataframe.
+        :rtype: :class:`pandas.DataFrame`
+        """
+
+        connection = self.db_session.connection()
+
         query = self.db_session.query(SampleAssay.id.label('SampleAssay ID'),Sample.name.label('Sample ID'), Subject.name.label('Subject ID'),
                                  Sample.sample_matrix.label('Sample Matrix'), Project.name.label("Project"),
                                  Sample.assay_role.label('AssayRole'),Sample.sample_type.label('SampleType'),
@@ -1081,9 +1077,10 @@ class QueryFactory:
             .filter(Subject.id == Sample.subject_id) \
             .filter(Project.id == Subject.project_id) \
             .filter(Assay.id == SampleAssay.assay_id) \
-            .filter(SampleAssay.id.in_(sample_assay_ids))
+            .filter(self.get_id_filter(SampleAssay.id, 'SampleAssay')) \
+            .order_by(SampleAssay.id)
 
-        combined_data = pd.read_sql(query.statement, query.session.bind)
+        combined_data = pd.read_sql(query.statement, connection)
         combined_data['Unique Name'] = combined_data['Project'] + '-' + combined_data['Sample ID']
         combined_data['Unique ID'] = combined_data['Project'] + '-' + combined_data['SampleAssay ID'].astype(str)
         combined_data['Unique Batch'] = combined_data['Project'] + '-' + combined_data['Assay'] + '-' + combined_data['Batch'].astype(str)
@@ -1099,167 +1096,194 @@ class QueryFactory:
 
         self.logger.info("combined data created with sample info")
 
-        unique_project_names = combined_data['Project'].unique()
-        #metadata_df = pd.DataFrame(columns=['Unique Name'])
-        #metadata_df['Unique Name'] = combined_data['Unique Name']
-
-        #annotated_feature_df = pd.DataFrame(columns=['Unique ID'])
-        #annotated_feature_df['Unique ID'] = combined_data['Unique ID']
-
-        #import tempfile
-        #tmpdir = tempfile.TemporaryDirectory()
-
-        #combined_data.to_csv("%s/main.csv" % tmpdir.name,index=False)
-        #del combined_data
-        #gc.collect()
-
-        harmonised_fields = self.db_session.query(HarmonisedMetadataField)\
-                                .join(MetadataField,Project)\
-                                .filter(Project.name.in_(unique_project_names)).all()
-        for harmonised_field in harmonised_fields:
-            field_name = 'h_metadata::' + harmonised_field.name
-            if harmonised_field.datatype == HarmonisedMetadataField.HarmonisedMetadataFieldDatatype.text:
-                query = self.db_session.query((Project.name + '-' + Sample.name).label('Unique Name'),
-                                         MetadataValue.harmonised_text_value.label(field_name))
-            elif harmonised_field.datatype == HarmonisedMetadataField.HarmonisedMetadataFieldDatatype.numeric:
-                query = self.db_session.query((Project.name + '-' + Sample.name).label('Unique Name'),
-                                         MetadataValue.harmonised_numeric_value.label(field_name))
-            elif harmonised_field.datatype == HarmonisedMetadataField.HarmonisedMetadataFieldDatatype.datetime:
-                query = self.db_session.query((Project.name + '-' + Sample.name).label('Unique Name'),
-                                         MetadataValue.harmonised_datetime_value.label(field_name))
-
-            query = query.join(MetadataField, MetadataField.id == MetadataValue.metadata_field_id) \
-                .filter(MetadataValue.sample_id == Sample.id) \
-                .filter(Project.id == Subject.project_id) \
-                .filter(Sample.subject_id == Subject.id) \
+        unique_project_names = combined_data['Project'].unique().tolist()
+        sample_ids = select(SampleAssay.sample_id).where(self.get_id_filter(SampleAssay.id, 'SampleAssay'))
+        unique_names = combined_data['Unique Name'].unique()
+        unique_name_codes = pd.Index(unique_names).get_indexer(combined_data['Unique Name'])
+
+        # 1. Metadata - one query per harmonised datatype, and one for the raw values, each pivoted on field name
+        metadata_dataframes = []
+        for datatype, value_column in [(HarmonisedMetadataField.HarmonisedMetadataFieldDatatype.text, MetadataValue.harmonised_text_value),
+                                       (HarmonisedMetadataField.HarmonisedMetadataFieldDatatype.numeric, MetadataValue.harmonised_numeric_value),
+                                       (HarmonisedMetadataField.HarmonisedMetadataFieldDatatype.datetime, MetadataValue.harmonised_datetime_value)]:
+            query = self.db_session.query((Project.name + '-' + Sample.name).label('Unique Name'),
+                                          ('h_metadata::' + HarmonisedMetadataField.name).label('field_name'),
+                                          value_column.label('value')) \
+                .join(MetadataField, MetadataField.id == MetadataValue.metadata_field_id) \
+                .join(HarmonisedMetadataField, HarmonisedMetadataField.id == MetadataField.harmonised_metadata_field_id) \
                 .filter(Sample.id == MetadataValue.sample_id) \
+                .filter(Sample.subject_id == Subject.id) \
+                .filter(Project.id == Subject.project_id) \
                 .filter(Sample.id.in_(sample_ids)) \
-                .filter(MetadataField.harmonised_metadata_field_id == harmonised_field.id)
-
-            metadata_column_table = pd.read_sql(query.statement, query.session.bind)
-            #metadata_df = pd.merge(metadata_df,metadata_column_table,how='left',on=['Unique Name'])
-            combined_data = pd.merge(combined_data, metadata_column_table, how='left', on=['Unique Name'])
-            #self.logger.info('metadata_df shape: %s,%s' % metadata_df.shape)
-            #combined_data = pd.merge(combined_data, metadata_column_table, how='left', on=['Unique Name'])
-
-            self.logger.info("%s merged" % field_name)
+                .filter(HarmonisedMetadataField.datatype == datatype) \
+                .order_by(HarmonisedMetadataField.id, MetadataValue.id)
+            metadata_dataframes.append(self.pivot_long_dataframe(pd.read_sql(query.statement, connection),
+                                                                 index='Unique Name', columns='field_name', values='value',
+                                                                 row_keys=unique_names))
+            self.logger.info("%s harmonised metadata fields pivoted" % metadata_dataframes[-1].shape[1])
 
         if len(unique_project_names) == 1:
-            metadata_fields = self.db_session.query(MetadataField)\
-                                    .join(Project)\
-                                    .filter(Project.name.in_(unique_project_names)).all()
-            for metadata_field in metadata_fields:
-                field_name = 'metadata::' + metadata_field.name
-                query = self.db_session.query((Project.name + '-' + Sample.name).label('Unique Name'), MetadataValue.raw_value.label(field_name)) \
-                    .join(MetadataField, MetadataField.id == MetadataValue.metadata_field_id) \
-                    .filter(Sample.id == MetadataValue.sample_id) \
-                    .filter(MetadataField.project_id == Project.id)\
-                    .filter(Sample.id.in_(sample_ids)) \
-                    .filter(MetadataField.id == metadata_field.id)
-
-                metadata_column_table = pd.read_sql(query.statement, query.session.bind)
-                #metadata_df = pd.merge(metadata_df, metadata_column_table, how='left', on=['Unique Name'])
-                combined_data = pd.merge(combined_data, metadata_column_table, how='left', on=['Unique Name'])
-
-                self.logger.info("%s merged" % field_name)
-                #self.logger.info('metadata_df shape: %s,%s' % metadata_df.shape)
-
-
-        #metadata_df.to_csv("%s/metadata.csv" % tmpdir.name,index=False)
-        #del metadata_df
-        #gc.collect()
-
-        units = {}
-        i = 0
-        for harmonised_annotation in harmonised_annotations:
-            self.logger.info("Querying HA %s" % harmonised_annotation.id)
-
-            query = self.db_session.query((Project.name + '-' + cast(SampleAssay.id, sqlalchemy.types.Unicode)).label('Unique ID'),
-                                          AnnotatedFeature.intensity, AnnotatedFeature.sr_corrected_intensity,
-                                     AnnotatedFeature.ltr_corrected_intensity, AnnotatedFeature.below_lloq,
-                                     AnnotatedFeature.above_uloq,
-                                     Unit.name.label('Unit Name')).join(Unit, FeatureMetadata,
-                                                                                          Annotation) \
-                .filter(Sample.id == SampleAssay.sample_id) \
-                .filter(Subject.id == Sample.subject_id) \
-                .filter(Project.id == Subject.project_id) \
-                .filter(SampleAssay.id == AnnotatedFeature.sample_assay_id) \
-                .filter(AnnotatedFeature.sample_assay_id.in_(sample_assay_ids)) \
-                .filter(Annotation.harmonised_annotation_id == harmonised_annotation.id).limit(len(sample_assay_ids))
-
-            intensity_row_table = pd.read_sql(query.statement, query.session.bind)
-
-            #if intensity_row_table.shape[0] != combined_data.shape[0]:
-            #    raise Exception("The intensity table for feature %s is not the same length as expected %s != %s, this is probably due to duplicated AnnotatedFeatures!" % (harmonised_annotation.id,intensity_row_table.shape[0],combined_data.shape[0]))
-
-            if convert_units and master_unit and intensity_row_table.loc[0, 'Unit Name'] != 'noUnit':
-                unit_name = master_unit
-            else:
-                unit_name = intensity_row_table.loc[0, 'Unit Name']
-            if unit_name not in units.keys():
-                units[unit_name] = self.db_session.query(Unit).filter(Unit.name==unit_name).first()
-            column_name = 'feature:ha:%s::%s#%s#%s#%s' % (harmonised_annotation.id, harmonised_annotation.assay.name,
-                                                          harmonised_annotation.annotation_method.name,
-                                                          harmonised_annotation.cpd_name, unit_name)
-
-            feature_df = pd.DataFrame(columns=['Unique ID', column_name])
-            feature_df['Unique ID'] = intensity_row_table['Unique ID']
-
-            if correction_type and harmonised_annotation.assay.quantification_type in [
-                Assay.QuantificationType.relative, Assay.QuantificationType.relative.value]:
+            query = self.db_session.query((Project.name + '-' + Sample.name).label('Unique Name'),
+                                          ('metadata::' + MetadataField.name).label('field_name'),
+                                          MetadataValue.raw_value.label('value')) \
+                .join(MetadataField, MetadataField.id == MetadataValue.metadata_field_id) \
+                .filter(Sample.id == MetadataValue.sample_id) \
+                .filter(MetadataField.project_id == Project.id) \
+                .filter(Sample.id.in_(sample_ids)) \
+                .order_by(MetadataField.id, MetadataValue.id)
+            metadata_dataframes.append(self.pivot_long_dataframe(pd.read_sql(query.statement, connection),
+                                                                 index='Unique Name', columns='field_name', values='value',
+                                                                 row_keys=unique_names))
+            self.logger.info("%s metadata fields pivoted" % metadata_dataframes[-1].shape[1])
+
+        # 2. Intensities - all HarmonisedAnnotations in one query
+        annotation_assay = aliased(Assay)
+        query = self.db_session.query(AnnotatedFeature.id.label('annotated_feature_id'),
+                                      AnnotatedFeature.sample_assay_id,
+                                      Annotation.harmonised_annotation_id,
+                                      AnnotatedFeature.unit_id,
+                                      AnnotatedFeature.intensity,
+                                      AnnotatedFeature.sr_corrected_intensity,
+                                      AnnotatedFeature.ltr_corrected_intensity,
+                                      AnnotatedFeature.below_lloq,
+                                      AnnotatedFeature.above_uloq,
+                                      annotation_assay.quantification_type) \
+            .join(FeatureMetadata, FeatureMetadata.id == AnnotatedFeature.feature_metadata_id) \
+            .join(Annotation, Annotation.id == FeatureMetadata.annotation_id) \
+            .join(annotation_assay, annotation_assay.id == Annotation.assay_id) \
+            .filter(self.get_id_filter(AnnotatedFeature.sample_assay_id, 'SampleAssay')) \
+            .filter(self.get_id_filter(Annotation.harmonised_annotation_id, 'HarmonisedAnnotation')) \
+            .order_by(AnnotatedFeature.id)
+
+        # The session connection, as the cohort tables belong to it
+        if chunksize:
+            intensity_chunks = pd.read_sql(query.statement, connection.execution_options(stream_results=True),
+                                           chunksize=chunksize)
+        else:
+            intensity_chunks = [pd.read_sql(query.statement, connection)]
+
+        intensities = []
+        for intensity_chunk in intensity_chunks:
+            intensity = intensity_chunk['intensity'].to_numpy(dtype=float)
+            if correction_type:
+                relative = intensity_chunk['quantification_type'].isin([Assay.QuantificationType.relative, Assay.QuantificationType.relative.value,
+                                                                        Assay.QuantificationType.relative.name]).to_numpy()
                 if correction_type in [FeatureDataset.CorrectionType.LOESS_SR,
                                        FeatureDataset.CorrectionType.LOESS_SR.value]:
-
-                    feature_df[column_name] = intensity_row_table['sr_corrected_intensity']
+                    intensity = np.where(relative, intensity_chunk['sr_corrected_intensity'].to_numpy(dtype=float), intensity)
                 elif correction_type in [FeatureDataset.CorrectionType.LOESS_LTR,
                                          FeatureDataset.CorrectionType.LOESS_LTR.value]:
-                    feature_df[column_name] = intensity_row_table['ltr_corrected_intensity']
+                    intensity = np.where(relative, intensity_chunk['ltr_corrected_intensity'].to_numpy(dtype=float), intensity)
                 else:
                     raise Exception("Unknown correction_type %s" % correction_type)
-                # if SR is specified and it's not a relative abundance, just use the raw value
-            else:
-                feature_df[column_name] = intensity_row_table['intensity']
             if inf_uloq:
-                feature_df[column_name] = np.where(intensity_row_table['above_uloq'] == True, float('inf'),
-                                                   feature_df[column_name])
+                intensity = np.where(intensity_chunk['above_uloq'] == True, float('inf'), intensity)
             if zero_lloq:
-                feature_df[column_name] = np.where(intensity_row_table['below_lloq'] == True, 0,
-                                                   feature_df[column_name])
-
-            if convert_units and master_unit and master_unit != unit_name and unit_name != 'noUnit':
+                intensity = np.where(intensity_chunk['below_lloq'] == True, 0, intensity)
+            intensities.append(pd.DataFrame({'annotated_feature_id': intensity_chunk['annotated_feature_id'],
+                                             'sample_assay_id': intensity_chunk['sample_assay_id'],
+                                             'harmonised_annotation_id': intensity_chunk['harmonised_annotation_id'],
+                                             'unit_id': intensity_chunk['unit_id'],
+                                             'intensity': intensity}))
+        intensities = pd.concat(intensities, ignore_index=True)
+
+        self.logger.info("%s intensities fetched for %s HarmonisedAnnotations" % (intensities.shape[0], intensities['harmonised_annotation_id'].nunique()))
+
+        # 3. Unit conversion - one vectorised conversion per (unit, master_unit) pair
+        units = {unit.id: unit for unit in self.db_session.query(Unit).filter(Unit.id.in_(intensities['unit_id'].unique().tolist())).all()}
+        column_units = {}
+        from_units = {}
+        for unit_id, unit in units.items():
+            column_units[unit_id] = unit.name
+            if convert_units and master_unit and unit.name != 'noUnit':
                 try:
-                    feature_df[column_name] = feature_df[column_name].apply(units[unit_name].convert,args=(master_unit, self.logger))
+                    unit_conversion.registry.get_conversion(unit.name, master_unit)
+                    column_units[unit_id] = master_unit
+                    from_units[unit_id] = unit.name
                 except NoUnitConversionError:
-                    self.logger.debug("Cannot convert noUnit to %s" % master_unit)
-                    pass
+                    self.logger.debug("Cannot convert %s to %s" % (unit.name, master_unit))
                 except NotImplementedUnitConversionError as err:
                     self.logger.exception(err)
                     raise NotImplementedUnitConversionError(err)
-                except Exception as err:
-                    self.logger.exception(err)
-                    raise Exception(err)
-
-            feature_df[column_name] = feature_df[column_name].astype(float)
-
-            self.logger.info('feature series shape: %s,%s' % feature_df.shape)
-
-            #combined_data = pd.merge(combined_data, feature_df, how='left', on=['Unique ID'],validate='1:1')
-            #self.logger.info('annotated feature dataframe shape: %s,%s' % annotated_feature_df.shape)
-            self.logger.info("%s merged" % column_name)
+        if len(from_units) > 0:
+            # Units without a conversion map to NaN, and are left as they are
+            intensities['intensity'] = unit_conversion.registry.convert_units(intensities['intensity'].to_numpy(dtype=float),
+                                                                              intensities['unit_id'].map(from_units).to_numpy(dtype=object),
+                                                                              master_unit, match_input_precision=True)
+
+        # 4. Pivot once into the (SampleAssay x HarmonisedAnnotation) matrix
+        query = self.db_session.query(HarmonisedAnnotation.id, Assay.name, AnnotationMethod.name, HarmonisedAnnotation.cpd_name) \
+            .filter(Assay.id == HarmonisedAnnotation.assay_id) \
+            .filter(AnnotationMethod.id == HarmonisedAnnotation.annotation_method_id) \
+            .filter(self.get_id_filter(HarmonisedAnnotation.id, 'HarmonisedAnnotation'))
+        harmonised_annotations = {harmonised_annotation_id: (assay_name, annotation_method_name, cpd_name)
+                                  for harmonised_annotation_id, assay_name, annotation_method_name, cpd_name in query.all()}
+        intensities = intensities.sort_values(['harmonised_annotation_id'], kind='stable')
+        column_keys = intensities[['harmonised_annotation_id', 'unit_id']]
+        column_codes = column_keys.groupby(['harmonised_annotation_id', 'unit_id'], sort=False, dropna=False).ngroup().to_numpy()
+        column_names = np.array(['feature:ha:%s::%s#%s#%s#%s' % ((harmonised_annotation_id,) + harmonised_annotations[harmonised_annotation_id] + (column_units[unit_id],))
+                                 for harmonised_annotation_id, unit_id in column_keys.drop_duplicates().itertuples(index=False)], dtype=object)
+        intensities['column_name'] = column_names[column_codes]
+        feature_dataframe = self.pivot_long_dataframe(intensities, index='sample_assay_id', columns='column_name',
+                                                      values='intensity', row_keys=combined_data['SampleAssay ID'].to_numpy(),
+                                                      dtype=float)
+
+        # The AnnotatedFeature ids of the cells, 0 where there is none, as the other builders do
+        feature_id_dataframe = self.pivot_long_dataframe(intensities, index='sample_assay_id', columns='column_name',
+                                                         values='annotated_feature_id', row_keys=combined_data['SampleAssay ID'].to_numpy(),
+                                                         dtype=float).fillna(0)
+
+        self.logger.info("feature dataframe shape: %s,%s" % feature_dataframe.shape)
+
+        combined_data = pd.concat([combined_data] + [metadata_dataframe.take(unique_name_codes).reset_index(drop=True)
+                                                     for metadata_dataframe in metadata_dataframes] + [feature_dataframe], axis=1)
+
+        combined_data['Unique Batch Numeric'] = pd.factorize(combined_data['Unique Batch'])[0] + 1
+        combined_data = combined_data.where(pd.notnull(combined_data), None)
+
+        start_columns = ['Project', 'Acquired Time', 'Sample ID', 'Unique Name', 'Unique Batch']
+        non_feature_columns = [column for column in combined_data.columns
+                               if column not in start_columns and column not in feature_dataframe.columns]
+        feature_id_combined_dataframe_key = self.get_dataframe_key(type='feature_id_combined_dataframe',model='AnnotatedFeature',
+                                                                   db_env=self.db_env,correction_type=correction_type,
+                                                                   harmonise_annotations=True)
+        self.dataframes[feature_id_combined_dataframe_key] = pd.concat([combined_data.loc[:, start_columns], feature_id_dataframe,
+                                                                        combined_data.loc[:, non_feature_columns]], axis=1)
+
+        return combined_data
+
+    def pivot_long_dataframe(self, long_dataframe, index, columns, values, row_keys, dtype=object):
+        """Pivot a long (index, column, value) dataframe into a wide dataframe with one row per row_key.
+
+        Columns are ordered by first appearance in long_dataframe, missing cells are NaN, and where a cell appears more
+        than once the last value wins.
+
+        :param long_dataframe: The long dataframe.
+        :type long_dataframe: :class:`pandas.DataFrame`
+        :param index: The column holding the row keys.
+        :type index: str
+        :param columns: The column holding the column names.
+        :type columns: str
+        :param values: The column holding the values.
+        :type values: str
+        :param row_keys: The unique row keys, in output order.
+        :type row_keys: list or :class:`numpy.ndarray`
+        :param dtype: The dtype of the wide matrix, defaults to object.
+        :type dtype: type, optional
+        :return: The wide dataframe.
+        :rtype: :class:`pandas.DataFrame`
+        """
 
-            i = i + 1
+        row_codes = pd.Index(row_keys).get_indexer(long_dataframe[index])
+        in_rows = row_codes >= 0
+        col_codes, column_names = pd.factorize(long_dataframe[columns].to_numpy()[in_rows])
+        cells = row_codes[in_rows] * len(column_names) + col_codes
+        last = self.last_occurrence(cells)
 
-        unique_batches = combined_data.loc[:, 'Unique Batch'].unique().tolist()
-        unique_batches_numeric = {}
-        p = 0
-        while p < len(unique_batches):
-            unique_batches_numeric[unique_batches[p]] = p + 1
-            p = p + 1
-        for unique_batch, unique_batch_numeric in unique_batches_numeric.items():
-            combined_data.loc[
-                (combined_data['Unique Batch'] == unique_batch), 'Unique Batch Numeric'] = unique_batch_numeric
+        matrix = np.full((len(row_keys), len(column_names)), np.nan, dtype=dtype)
+        matrix.flat[cells[last]] = long_dataframe[values].to_numpy()[in_rows][last]
 
-        return combined_data.where(pd.notnull(combined_data), None)
+        return pd.DataFrame(matrix, columns=column_names)
 
     def execute_and_build_dataframe(self, annotations_only=False, csv_path=None, sort_by=None,
                                     annotation_version='latest', output_model='SampleAssay',
@@ -1278,6 +1302,9 @@ class QueryFactory:
 
             Converts units by default to mmol/L
 
+            The AnnotatedFeature dataframe is built by :func:`build_annotated_feature_dataframe_bulk` unless method is
+            'rowwise' (the original per-object builder) or 'columnwise'.
+
         :return:
         """
 
@@ -1293,29 +1320,44 @@ class QueryFactory:
         #
         #                                                 value=annotation_version))
 
+        parent_key = self.get_dataframe_key(type='combined',model=self.parent_model[output_model], db_env=self.db_env,
+                                                    correction_type=correction_type,convert_units=convert_units,
+                                                    annotation_version=annotation_version,master_unit=master_unit,
+                                                    harmonise_annotations=harmonise_annotations)
+
         if output_model == 'AnnotatedFeature' and harmonise_annotations and method == 'columnwise':
-            dataframe = self.execute_and_build_annotated_feature_dataframe(convert_units=convert_units,zero_lloq=zero_lloq,inf_uloq=inf_uloq,
-                                                                   master_unit=master_unit,correction_type=correction_type)
+            with self.materialised_cohort('SampleAssay','HarmonisedAnnotation'):
+                dataframe = self.execute_and_build_annotated_feature_dataframe(convert_units=convert_units,zero_lloq=zero_lloq,inf_uloq=inf_uloq,
+                                                                               master_unit=master_unit,correction_type=correction_type)
 
-        else:
+            self.dataframes[parent_key] = dataframe
+            feature_id_combined_dataframe_key = self.get_dataframe_key(type='feature_id_combined_dataframe',correction_type=correction_type,
+                                                                       model='AnnotatedFeature', db_env=self.db_env,harmonise_annotations=harmonise_annotations)
+            self.dataframes[feature_id_combined_dataframe_key] = self.dataframes[feature_id_combined_dataframe_key].sort_values(sort_by, ascending=sort_by_ascending, ignore_index=True)
+            if self.saved_query:
+                self.cache.set(self.saved_query.get_cache_dataframe_key(feature_id_combined_dataframe_key),self.dataframes[feature_id_combined_dataframe_key])
 
-            result_set = self.generate_and_execute_query(output_model=self.parent_model[output_model])
+        else:
 
             dataframe = pd.DataFrame(columns=sort_by)
 
-            parent_key = self.get_dataframe_key(type='combined',model=self.parent_model[output_model], db_env=self.db_env,
-                                                        correction_type=correction_type,convert_units=convert_units,
-                                                        annotation_version=annotation_version,master_unit=master_unit,
-                                                        harmonise_annotations=harmonise_annotations)
-
             if output_model == 'AnnotatedFeature' or (self.parent_model[output_model] == 'AnnotatedFeature' and parent_key not in self.dataframes.keys()):
 
-                dataframe = self.build_annotated_feature_dataframe(annotations_only=annotations_only,
-                                                                   convert_units=convert_units,
-                                                                   master_unit=master_unit,
-                                                                   correction_type=correction_type,
-                                                                   zero_lloq=zero_lloq, inf_uloq=inf_uloq,
-                                                                   result_set=result_set,harmonise_annotations=harmonise_annotations)
+                if method == 'rowwise':
+                    result_set = self.generate_and_execute_query(output_model=self.parent_model[output_model])
+                    dataframe = self.build_annotated_feature_dataframe(annotations_only=annotations_only,
+                                                                       convert_units=convert_units,
+                                                                       master_unit=master_unit,
+                                                                       correction_type=correction_type,
+                                                                       zero_lloq=zero_lloq, inf_uloq=inf_uloq,
+                                                                       result_set=result_set,harmonise_annotations=harmonise_annotations)
+                else:
+                    dataframe = self.build_annotated_feature_dataframe_bulk(annotations_only=annotations_only,
+                                                                            convert_units=convert_units,
+                                                                            master_unit=master_unit,
+                                                                            correction_type=correction_type,
+                                                                            zero_lloq=zero_lloq, inf_uloq=inf_uloq,
+                                                                            harmonise_annotations=harmonise_annotations)
 
                 self.dataframes[parent_key] = dataframe
                 feature_id_combined_dataframe_key = self.get_dataframe_key(type='feature_id_combined_dataframe',correction_type=correction_type,
@@ -1543,6 +1585,511 @@ class QueryFactory:
 
         return dataframe
 
+    def build_annotated_feature_dataframe_bulk(self, annotations_only=False, convert_units=True, master_unit='mmol/L',
+                                               correction_type=None, harmonise_annotations=False, zero_lloq=True, inf_uloq=True,
+                                               sample_assay_ids=None):
+        """Columnar equivalent of :func:`build_annotated_feature_dataframe`.
+
+        Rather than iterating the ORM result set, the AnnotatedFeature query is reduced to an id subquery and the
+        intensities, sample keys, feature keys and metadata are each fetched in a single flat projection. The wide
+        combined and feature_id_combined_dataframe frames are then built by scattering the values into preallocated
+        matrices indexed by the categorical codes of the Unique Name (rows) and feature column header (columns).
+
+        The output is identical to the row-wise builder, including column order and the value of cells that are never
+        set: 0 ('' for text metadata) if the row existed when the column was created, otherwise NaN.
+
+        :param annotations_only: Only include features with an Annotation, defaults to False.
+        :type annotations_only: bool, optional
+        :param convert_units: Whether to convert the intensities to the master_unit, defaults to True.
+        :type convert_units: bool, optional
+        :param master_unit: The unit to convert to, defaults to 'mmol/L'.
+        :type master_unit: str, optional
+        :param correction_type: The batch correction type, 'SR' or 'LTR', defaults to None.
+        :type correction_type: str, optional
+        :param harmonise_annotations: Whether to build HarmonisedAnnotation columns, defaults to False.
+        :type harmonise_annotations: bool, optional
+        :param zero_lloq: Set <LLOQ values to 0, defaults to True.
+        :type zero_lloq: bool, optional
+        :param inf_uloq: Set >ULOQ values to inf, defaults to True.
+        :type inf_uloq: bool, optional
+        :param sample_assay_ids: Only build the rows of these SampleAssays, see :meth:`refresh_dataframe`, defaults to None.
+        :type sample_assay_ids: list, optional
+        :return: The combined dataframe.
+        :rtype: :class:`pandas.DataFrame`
+        """
+
+        start_columns = ['Project', 'Acquired Time', 'Sample ID', 'Unique Name','Unique Batch']
+        sample_columns = start_columns + ['Subject ID', 'Sample Matrix', 'SampleType', 'AssayRole', 'Sample File Name',
+                                          'Batch', 'Unique Batch Numeric', 'Correction Batch', 'Run Order',
+                                          'Unique Run Order', 'Dilution', 'Exclusion Details']
+
+        feature_id_combined_dataframe_key = self.get_dataframe_key(type='feature_id_combined_dataframe',model='AnnotatedFeature',
+                                                                   db_env=self.db_env,correction_type=correction_type, harmonise_annotations=harmonise_annotations)
+
+        # 1. Reduce the query to the matching ids and fetch the intensities in one projection
+        self.generate_query(output_model='AnnotatedFeature')
+        self.logger.info(self.get_code_string())
+        annotated_feature_ids = self.compiled_query.select(ids_only=True).order_by(None)
+        if sample_assay_ids is not None:
+            annotated_feature_ids = annotated_feature_ids.where(AnnotatedFeature.sample_assay_id.in_(sample_assay_ids))
+        annotated_feature_ids = annotated_feature_ids.subquery()
+
+        annotated_features = None
+        if sample_assay_ids is None:
+            annotated_features = self.load_annotated_features_from_matrix_stores()
+        if annotated_features is None:
+            query = self.db_session.query(AnnotatedFeature.id.label('annotated_feature_id'),
+                                          AnnotatedFeature.sample_assay_id,
+                                          AnnotatedFeature.feature_metadata_id,
+                                          AnnotatedFeature.unit_id,
+                                          AnnotatedFeature.intensity,
+                                          AnnotatedFeature.sr_corrected_intensity,
+                                          AnnotatedFeature.ltr_corrected_intensity,
+                                          AnnotatedFeature.below_lloq,
+                                          AnnotatedFeature.above_uloq) \
+                .join(annotated_feature_ids, annotated_feature_ids.c.id == AnnotatedFeature.id) \
+                .order_by(AnnotatedFeature.id)
+            annotated_features = pd.read_sql(query.statement, query.session.bind)
+        # The SampleAssays and AnnotatedFeature high-water mark the dataframe is built from, see dataframe_refresh
+        self.build_state = dataframe_refresh.get_build_state(
+            annotated_features.groupby('sample_assay_id')['annotated_feature_id'].max().to_dict())
+
+        # 2. Fetch the sample, feature, and unit keys for the distinct ids
+        query = self.db_session.query(SampleAssay.id.label('sample_assay_id'),
+                                      Sample.id.label('sample_id'),
+                                      Project.name.label('project_name'),
+                                      Sample.name.label('sample_name'),
+                                      Subject.name.label('subject_name'),
+                                      Sample.sample_matrix,
+                                      Sample.sample_type,
+                                      Sample.assay_role,
+                                      SampleAssay.sample_file_name,
+                                      SampleAssay.batch,
+                                      SampleAssay.correction_batch,
+                                      SampleAssay.run_order,
+                                      SampleAssay.dilution,
+                                      SampleAssay.acquired_time,
+                                      SampleAssay.exclusion_details,
+                                      Assay.name.label('assay_name'),
+                                      Assay.quantification_type) \
+            .filter(SampleAssay.sample_id == Sample.id) \
+            .filter(Subject.id == Sample.subject_id) \
+            .filter(Project.id == Subject.project_id) \
+            .filter(Assay.id == SampleAssay.assay_id) \
+            .filter(SampleAssay.id.in_(annotated_features['sample_assay_id'].unique().tolist()))
+        sample_assays = {row.sample_assay_id: row for row in query.all()}
+
+        annotation_assay = aliased(Assay)
+        annotation_method = aliased(AnnotationMethod)
+        harmonised_assay = aliased(Assay)
+        harmonised_method = aliased(AnnotationMethod)
+        query = self.db_session.query(FeatureMetadata.id.label('feature_metadata_id'),
+                                      FeatureMetadata.rt_average,
+                                      FeatureMetadata.mz_average,
+                                      Annotation.id.label('annotation_id'),
+                                      Annotation.cpd_name.label('annotation_cpd_name'),
+                                      Annotation.version.label('annotation_version'),
+                                      annotation_assay.name.label('annotation_assay_name'),
+                                      annotation_method.name.label('annotation_method_name'),
+                                      HarmonisedAnnotation.id.label('harmonised_annotation_id'),
+                                      HarmonisedAnnotation.cpd_name.label('harmonised_cpd_name'),
+                                      harmonised_assay.name.label('harmonised_assay_name'),
+                                      harmonised_method.name.label('harmonised_method_name')) \
+            .outerjoin(Annotation, Annotation.id == FeatureMetadata.annotation_id) \
+            .outerjoin(annotation_assay, annotation_assay.id == Annotation.assay_id) \
+            .outerjoin(annotation_method, annotation_method.id == Annotation.annotation_method_id) \
+            .outerjoin(HarmonisedAnnotation, HarmonisedAnnotation.id == Annotation.harmonised_annotation_id) \
+            .outerjoin(harmonised_assay, harmonised_assay.id == HarmonisedAnnotation.assay_id) \
+            .outerjoin(harmonised_method, harmonised_method.id == HarmonisedAnnotation.annotation_method_id) \
+            .filter(FeatureMetadata.id.in_(annotated_features['feature_metadata_id'].unique().tolist()))
+        feature_metadatas = {row.feature_metadata_id: row for row in query.all()}
+
+        units = {unit.id: unit for unit in self.db_session.query(Unit).filter(Unit.id.in_(annotated_features['unit_id'].unique().tolist())).all()}
+
+        # 3. Select the intensity column and drop the rows the row-wise builder skips
+        intensity = annotated_features['intensity'].to_numpy(dtype=float)
+        if correction_type:
+            relative = annotated_features['sample_assay_id'].map(
+                {sample_assay_id: row.quantification_type in [Assay.QuantificationType.relative, Assay.QuantificationType.relative.value]
+                 for sample_assay_id, row in sample_assays.items()}).to_numpy(dtype=bool)
+            if relative.any():
+                if correction_type in [FeatureDataset.CorrectionType.LOESS_SR,
+                                       FeatureDataset.CorrectionType.LOESS_SR.value]:
+                    corrected_intensity = annotated_features['sr_corrected_intensity'].to_numpy(dtype=float)
+                elif correction_type in [FeatureDataset.CorrectionType.LOESS_LTR,
+                                         FeatureDataset.CorrectionType.LOESS_LTR.value]:
+                    corrected_intensity = annotated_features['ltr_corrected_intensity'].to_numpy(dtype=float)
+                else:
+                    raise Exception("Unknown correction_type %s" % correction_type)
+                intensity = np.where(relative, corrected_intensity, intensity)
+
+        keep = ~np.isnan(intensity)
+        if annotations_only:
+            keep = keep & annotated_features['feature_metadata_id'].map(
+                {feature_metadata_id: row.annotation_id is not None
+                 for feature_metadata_id, row in feature_metadatas.items()}).to_numpy(dtype=bool)
+        annotated_features = annotated_features.loc[keep].reset_index(drop=True)
+        intensity = intensity[keep]
+
+        self.logger.info("Intensities fetched: %s rows, %s skipped" % (len(annotated_features), (~keep).sum()))
+
+        if annotated_features.empty:
+            dataframe = pd.DataFrame(columns=start_columns)
+            self.dataframes[feature_id_combined_dataframe_key] = dataframe.copy()
+            return dataframe
+
+        # 4. Row codes, in order of first appearance, and the sample columns taken from each row's first entry
+        sample_assay_id_array = annotated_features['sample_assay_id'].to_numpy()
+        row_codes = pd.factorize(annotated_features['sample_assay_id'].map(
+            {sample_assay_id: row.project_name + "-" + row.sample_name for sample_assay_id, row in sample_assays.items()}))[0]
+        row_first = np.unique(row_codes, return_index=True)[1]
+
+        sample_rows = []
+        for sample_assay_id in sample_assay_id_array[row_first]:
+            sample_assay = sample_assays[sample_assay_id]
+            sample_rows.append({'Unique Name': sample_assay.project_name + "-" + sample_assay.sample_name,
+                                'Project': sample_assay.project_name,
+                                'Sample ID': sample_assay.sample_name,
+                                'Subject ID': sample_assay.subject_name,
+                                'Sample Matrix': sample_assay.sample_matrix,
+                                'SampleType': sample_assay.sample_type.value,
+                                'AssayRole': sample_assay.assay_role.value,
+                                'Sample File Name': sample_assay.sample_file_name,
+                                'Batch': sample_assay.batch,
+                                'Unique Batch': sample_assay.project_name + "-" + sample_assay.assay_name + "-" + str(sample_assay.batch),
+                                'Unique Batch Numeric': None,
+                                'Correction Batch': sample_assay.correction_batch,
+                                'Run Order': sample_assay.run_order,
+                                'Unique Run Order': sample_assay.project_name + "-" + sample_assay.assay_name + "-" + str(sample_assay.run_order),
+                                'Dilution': sample_assay.dilution,
+                                'Acquired Time': sample_assay.acquired_time,
+                                'Exclusion Details': sample_assay.exclusion_details})
+        sample_dataframe = pd.DataFrame(sample_rows, columns=sample_columns)
+
+        # 5. Column codes - build each distinct header once, then factorize the per-row headers
+        header_keys = pd.DataFrame({'feature_metadata_id': annotated_features['feature_metadata_id'],
+                                    'unit_id': annotated_features['unit_id'],
+                                    'assay_name': annotated_features['sample_assay_id'].map(
+                                        {sample_assay_id: row.assay_name for sample_assay_id, row in sample_assays.items()})})
+        header_group_codes = header_keys.groupby(list(header_keys.columns), sort=False, dropna=False).ngroup().to_numpy()
+        headers = []
+        for feature_metadata_id, unit_id, assay_name in header_keys.drop_duplicates().itertuples(index=False):
+            feature_metadata = feature_metadatas[feature_metadata_id]
+            if convert_units and master_unit and units[unit_id].name != 'noUnit':
+                unit_name = master_unit
+            else:
+                unit_name = units[unit_id].name
+
+            if harmonise_annotations and feature_metadata.harmonised_annotation_id:
+                headers.append('feature:ha:%s::%s#%s#%s#%s' % (feature_metadata.harmonised_annotation_id,
+                                                               feature_metadata.harmonised_assay_name,
+                                                               feature_metadata.harmonised_method_name,
+                                                               feature_metadata.harmonised_cpd_name,
+                                                               unit_name))
+            elif feature_metadata.annotation_id is not None:
+                headers.append('feature:fm:%s::%s#%s#%s#%s#%s' % (feature_metadata_id,
+                                                                  feature_metadata.annotation_assay_name,
+                                                                  feature_metadata.annotation_method_name,
+                                                                  feature_metadata.annotation_cpd_name,
+                                                                  feature_metadata.annotation_version,
+                                                                  unit_name))
+            elif feature_metadata.mz_average and feature_metadata.rt_average:
+                headers.append('feature:fm:%s::%s:rt:%s:mz:%s:%s' % (feature_metadata_id, assay_name,
+                                                                     feature_metadata.rt_average,
+                                                                     feature_metadata.mz_average, unit_name))
+            else:
+                headers.append('feature:fm:%s::%s#%s' % (feature_metadata_id, assay_name, unit_name))
+
+        col_codes, feature_columns = pd.factorize(np.array(headers, dtype=object)[header_group_codes])
+        col_first = np.unique(col_codes, return_index=True)[1]
+        n_cols = len(feature_columns)
+
+        # 6. The cell values: converted intensities, or the LLOQ/ULOQ substitutes for zero intensities
+        below_lloq = annotated_features['below_lloq'].fillna(False).to_numpy(dtype=bool)
+        above_uloq = annotated_features['above_uloq'].fillna(False).to_numpy(dtype=bool)
+        non_zero = intensity != 0
+        values = intensity.copy()
+
+        if convert_units and master_unit:
+            unit_names = annotated_features['unit_id'].map({unit_id: unit.name for unit_id, unit in units.items()}).to_numpy(dtype=object)
+            try:
+                values[non_zero] = unit_conversion.registry.convert_units(intensity[non_zero], unit_names[non_zero], master_unit,
+                                                                          match_input_precision=True)
+            except NotImplementedUnitConversionError as err:
+                self.logger.exception(err)
+                raise NotImplementedUnitConversionError(err)
+
+        lloq_mask = ~non_zero & below_lloq
+        uloq_mask = ~non_zero & ~below_lloq & above_uloq
+        values[lloq_mask] = 0
+        values[uloq_mask] = float('inf')
+        string_values = np.full(len(values), None, dtype=object)
+        if not zero_lloq:
+            string_values[lloq_mask] = "<LLOQ"
+        if not inf_uloq:
+            string_values[uloq_mask] = ">ULOQ"
+        is_set = non_zero | lloq_mask | uloq_mask
+
+        # Where a cell is written more than once the last row (by AnnotatedFeature.id) wins
+        cells = row_codes * n_cols + col_codes
+        last_id = self.last_occurrence(cells)
+        last_value = self.last_occurrence(cells[is_set])
+
+        feature_defaults = row_first[:, None] <= col_first[None, :]
+        intensity_matrix = np.where(feature_defaults, 0.0, np.nan)
+        intensity_matrix.flat[cells[is_set][last_value]] = values[is_set][last_value]
+        annotated_feature_id_matrix = np.where(feature_defaults, 0.0, np.nan)
+        annotated_feature_id_matrix.flat[cells[last_id]] = annotated_features['annotated_feature_id'].to_numpy()[last_id]
+
+        feature_dataframe = pd.DataFrame(intensity_matrix, columns=feature_columns)
+        string_cells = string_values[is_set][last_value]
+        if (string_cells != None).any():
+            string_mask = string_cells != None
+            string_rows, string_cols = np.divmod(cells[is_set][last_value][string_mask], n_cols)
+            for col in np.unique(string_cols):
+                col_mask = string_cols == col
+                column = feature_dataframe.iloc[:, col].astype(object)
+                column.iloc[string_rows[col_mask]] = string_cells[string_mask][col_mask]
+                feature_dataframe[feature_columns[col]] = column
+
+        # 7. Metadata, pivoted on field name with the same creation order as the row-wise builder
+        metadata_dataframe, metadata_columns, metadata_created = self.build_bulk_metadata_columns(
+            sample_ids=[sample_assays[sample_assay_id].sample_id for sample_assay_id in sample_assay_id_array[row_first]],
+            row_first=row_first)
+
+        # Columns are ordered by the annotated_feature that created them; metadata before features
+        created_position = np.concatenate([metadata_created[:, 0], col_first])
+        created_sequence = np.concatenate([metadata_created[:, 1], np.full(n_cols, np.iinfo(np.int64).max)])
+        created_columns = np.concatenate([np.array(metadata_columns, dtype=object), np.array(feature_columns, dtype=object)])
+        created_columns = created_columns[np.lexsort((created_sequence, created_position))].tolist()
+
+        dataframe = pd.concat([sample_dataframe, metadata_dataframe, feature_dataframe], axis=1)[sample_columns + created_columns]
+
+        self.logger.info("Dataframe built: Results: %s  Dataframe shape %s" % (len(annotated_features), dataframe.shape))
+
+        non_feature_columns = [column for column in dataframe.columns if not re.search("feature:", column) and column not in start_columns]
+        feature_id_combined_dataframe = pd.concat([dataframe.loc[:, start_columns],
+                                                   pd.DataFrame(annotated_feature_id_matrix, columns=feature_columns),
+                                                   dataframe.loc[:, non_feature_columns]], axis=1)
+
+        dataframe['Unique Batch Numeric'] = pd.factorize(dataframe['Unique Batch'])[0] + 1
+
+        self.dataframes[feature_id_combined_dataframe_key] = feature_id_combined_dataframe
+
+        return dataframe
+
+    def get_feature_dataset_counts(self, annotated_feature_ids=None):
+        """Get the number of matching AnnotatedFeatures of each FeatureDataset.
+
+        :param annotated_feature_ids: The subquery of the matching AnnotatedFeature ids, defaults to None (the AnnotatedFeature query)
+        :type annotated_feature_ids: :class:`sqlalchemy.sql.Subquery`, optional
+        :return: FeatureDataset id -> number of matching AnnotatedFeatures
+        :rtype: dict
+        """
+
+        if annotated_feature_ids is None:
+            self.generate_query(output_model='AnnotatedFeature')
+            annotated_feature_ids = self.compiled_query.select(ids_only=True).order_by(None).subquery()
+
+        statement = select(FeatureMetadata.feature_dataset_id, func.count(AnnotatedFeature.id)) \
+            .select_from(AnnotatedFeature) \
+            .join(annotated_feature_ids, annotated_feature_ids.c.id == AnnotatedFeature.id) \
+            .join(FeatureMetadata, AnnotatedFeature.feature_metadata_id == FeatureMetadata.id) \
+            .group_by(FeatureMetadata.feature_dataset_id)
+        return {feature_dataset_id: count for feature_dataset_id, count in self.db_session.execute(statement)}
+
+    def split_filters(self):
+        """Split the query_dict filters into the filters on the SampleAssays and the filters on the FeatureMetadatas.
+
+        :return: The SampleAssay filters and FeatureMetadata filters, or None if a filter matches on AnnotatedFeature or on both.
+        :rtype: tuple(list, list)
+        """
+
+        split_filters = {'SampleAssay': [], 'FeatureMetadata': []}
+        for filter in self.query_dict['filters']:
+            sides = set()
+            for sub_filter in filter['sub_filters']:
+                for match in sub_filter['matches']:
+                    join_route = self.join_routes['AnnotatedFeature'].get(match['model'])
+                    if not join_route:
+                        return None
+                    sides.add(join_route[0])
+            if len(sides) > 1:
+                return None
+            elif len(sides) == 1:
+                split_filters[sides.pop()].append(filter)
+        return split_filters['SampleAssay'], split_filters['FeatureMetadata']
+
+    def get_filtered_ids_select(self, output_model, filters):
+        """Get the select of the SampleAssay or FeatureMetadata ids matching a subset of the filters, see :meth:`split_filters`.
+
+        :param output_model: 'SampleAssay' or 'FeatureMetadata'.
+        :type output_model: str
+        :param filters: The filters.
+        :type filters: list
+        :return: The select of the ids.
+        :rtype: :class:`sqlalchemy.sql.Select`
+        """
+
+        joins = []
+        for filter in filters:
+            for sub_filter in filter['sub_filters']:
+                for match in sub_filter['matches']:
+                    for join_model in self.join_routes['AnnotatedFeature'][match['model']][1:]:
+                        if join_model not in joins:
+                            joins.append(join_model)
+        return self.query_compiler.compile({'joins': joins, 'filters': filters}, output_model).select(ids_only=True).order_by(None)
+
+    def load_annotated_features_from_matrix_stores(self):
+        """Load the matching AnnotatedFeatures from the FeatureDataset matrix stores, see :mod:`phenomedb.matrix_store`.
+
+        The stores are used when the filters are either on the SampleAssays or on the FeatureMetadatas, so the query
+        slices the FeatureDatasets by rows and columns. The matching SampleAssays and FeatureMetadatas are selected
+        without the annotated_feature table, and their rows and columns are sliced from the memory-mapped arrays. A
+        store is only used if its AnnotatedFeature count and maximum id match the database, as
+        :meth:`phenomedb.cache.CreateSavedQueryDataframeCache.prepare_matrix_stores` checks, and it has a row for every matching SampleAssay
+        and a column for every matching FeatureMetadata of its FeatureDataset; otherwise the query falls back to SQL.
+
+        :return: The AnnotatedFeatures, as :meth:`build_annotated_feature_dataframe_bulk` fetches them, or None if the stores cannot be used.
+        :rtype: :class:`pandas.DataFrame`
+        """
+
+        if not matrix_store.is_enabled():
+            return None
+
+        split_filters = self.split_filters()
+        if split_filters is None:
+            self.logger.info("Query filters on AnnotatedFeatures, not using the matrix stores")
+            return None
+        sample_filters, feature_filters = split_filters
+
+        # The FeatureDatasets of the matching SampleAssays, by Project, Assay and sample matrix
+        statement = select(SampleAssay.id.label('sample_assay_id'), FeatureDataset.id.label('feature_dataset_id')) \
+            .join(Sample, Sample.id == SampleAssay.sample_id) \
+            .join(Subject, Subject.id == Sample.subject_id) \
+            .join(FeatureDataset, and_(FeatureDataset.project_id == Subject.project_id,
+                                       FeatureDataset.assay_id == SampleAssay.assay_id,
+                                       FeatureDataset.sample_matrix == Sample.sample_matrix)) \
+            .where(SampleAssay.id.in_(self.get_filtered_ids_select('SampleAssay', sample_filters)))
+        sample_assays = pd.read_sql(statement, self.db_session.connection())
+        if sample_assays.empty:
+            return None
+
+        statement = select(FeatureMetadata.id.label('feature_metadata_id'), FeatureMetadata.feature_dataset_id) \
+            .where(FeatureMetadata.feature_dataset_id.in_(sample_assays['feature_dataset_id'].unique().tolist()))
+        if len(feature_filters) > 0:
+            statement = statement.where(FeatureMetadata.id.in_(self.get_filtered_ids_select('FeatureMetadata', feature_filters)))
+        feature_metadatas = pd.read_sql(statement, self.db_session.connection())
+        if feature_metadatas.empty:
+            return None
+
+        # The stores are only current if they match the FeatureDatasets' AnnotatedFeature counts and maximum ids
+        counts = matrix_store.get_feature_dataset_counts(self.db_session, feature_metadatas['feature_dataset_id'].unique().tolist())
+
+        annotated_features = []
+        for feature_dataset_id, feature_metadata_ids in feature_metadatas.groupby('feature_dataset_id')['feature_metadata_id']:
+            store = matrix_store.MatrixStore(feature_dataset_id, logger=self.logger)
+            if not store.exists():
+                self.logger.info("FeatureDataset %s matrix store missing, not using the matrix stores" % feature_dataset_id)
+                return None
+            if feature_dataset_id not in counts or not store.is_current(*counts[feature_dataset_id]):
+                self.logger.info("FeatureDataset %s matrix store out of date, not using the matrix stores" % feature_dataset_id)
+                return None
+            arrays = store.load()
+            sample_assay_ids = sample_assays.loc[sample_assays['feature_dataset_id'] == feature_dataset_id, 'sample_assay_id']
+            if matrix_store.get_positions(arrays['sample_assay_ids'], sample_assay_ids) is None \
+                    or matrix_store.get_positions(arrays['feature_metadata_ids'], feature_metadata_ids) is None:
+                self.logger.info("FeatureDataset %s matrix store out of date, not using the matrix stores" % feature_dataset_id)
+                return None
+            annotated_features.append(matrix_store.unpivot_arrays(arrays, sample_assay_ids=sample_assay_ids.to_numpy(),
+                                                                  feature_metadata_ids=feature_metadata_ids.to_numpy()))
+
+        annotated_features = pd.concat(annotated_features, ignore_index=True)
+        self.logger.info("AnnotatedFeatures sliced from the matrix stores of FeatureDatasets %s" % feature_metadatas['feature_dataset_id'].unique().tolist())
+        return annotated_features.sort_values('annotated_feature_id', ignore_index=True)
+
+    def build_bulk_metadata_columns(self, sample_ids, row_first):
+        """Build the metadata:: and h_metadata:: columns for :func:`build_annotated_feature_dataframe_bulk`.
+
+        :param sample_ids: The Sample ID of each dataframe row.
+        :type sample_ids: list
+        :param row_first: The position of the annotated_feature that created each row.
+        :type row_first: :class:`numpy.ndarray`
+        :return: The metadata dataframe, its column names, and the (position, sequence) each column was created at.
+        :rtype: tuple
+        """
+
+        query = self.db_session.query(MetadataValue.sample_id,
+                                      MetadataField.name.label('field_name'),
+                                      MetadataValue.raw_value,
+                                      HarmonisedMetadataField.name.label('harmonised_field_name'),
+                                      HarmonisedMetadataField.datatype,
+                                      MetadataValue.harmonised_text_value,
+                                      MetadataValue.harmonised_numeric_value,
+                                      MetadataValue.harmonised_datetime_value) \
+            .join(MetadataField, MetadataField.id == MetadataValue.metadata_field_id) \
+            .outerjoin(HarmonisedMetadataField, HarmonisedMetadataField.id == MetadataField.harmonised_metadata_field_id) \
+            .filter(MetadataValue.sample_id.in_(sample_ids)) \
+            .order_by(MetadataValue.sample_id, MetadataValue.id)
+        metadata_values = pd.read_sql(query.statement, query.session.bind)
+
+        if metadata_values.empty:
+            return pd.DataFrame(index=range(len(row_first))), [], np.empty((0, 2), dtype=np.int64)
+
+        metadata_values['row'] = pd.Index(sample_ids).get_indexer(metadata_values['sample_id'])
+        metadata_values['position'] = row_first[metadata_values['row'].to_numpy()]
+        metadata_values['sequence'] = metadata_values.groupby('sample_id', sort=False).cumcount() * 2
+        datatypes = metadata_values['datatype'].map(lambda datatype: getattr(datatype, 'value', datatype))
+
+        raw = pd.DataFrame({'column': "metadata::" + metadata_values['field_name'],
+                            'row': metadata_values['row'],
+                            'position': metadata_values['position'],
+                            'sequence': metadata_values['sequence'],
+                            'value': metadata_values['raw_value'].astype(object),
+                            'default': 0})
+
+        harmonised = []
+        for datatype, value_column, default in [('text', 'harmonised_text_value', ''),
+                                                ('numeric', 'harmonised_numeric_value', 0),
+                                                ('datetime', 'harmonised_datetime_value', np.nan)]:
+            mask = metadata_values['harmonised_field_name'].notnull() & (datatypes == datatype)
+            harmonised.append(pd.DataFrame({'column': "h_metadata::" + metadata_values.loc[mask, 'harmonised_field_name'],
+                                            'row': metadata_values.loc[mask, 'row'],
+                                            'position': metadata_values.loc[mask, 'position'],
+                                            'sequence': metadata_values.loc[mask, 'sequence'] + 1,
+                                            'value': metadata_values.loc[mask, value_column].astype(object),
+                                            'default': datatype}))
+
+        cells = pd.concat([raw] + harmonised).sort_values(['position', 'sequence'], kind='stable')
+        created = cells.drop_duplicates('column', keep='first')
+        cells = cells.drop_duplicates(['row', 'column'], keep='last')
+
+        metadata_columns = {}
+        for column, position, default in created[['column', 'position', 'default']].itertuples(index=False):
+            # The datetime columns are only created on assignment, so every other row is NaN
+            values = np.full(len(row_first), np.nan, dtype=object)
+            if default == 'text':
+                values[row_first <= position] = ''
+            elif default != 'datetime':
+                values[row_first <= position] = 0
+            metadata_columns[column] = values
+
+        for column, column_cells in cells.groupby('column', sort=False):
+            metadata_columns[column][column_cells['row'].to_numpy()] = column_cells['value'].to_numpy()
+
+        return pd.DataFrame(metadata_columns), created['column'].tolist(), created[['position', 'sequence']].to_numpy(dtype=np.int64)
+
+    @staticmethod
+    def last_occurrence(keys):
+        """Get the positions of the last occurrence of each distinct key.
+
+        :param keys: The keys.
+        :type keys: :class:`numpy.ndarray`
+        :return: The positions of the last occurrence of each key.
+        :rtype: :class:`numpy.ndarray`
+        """
+        return len(keys) - 1 - np.unique(keys[::-1], return_index=True)[1]
+
     def build_compound_class_dataframe(self,class_type=CompoundClass.CompoundClassType.classyfire,
                                        class_level='direct_parent',
                                        aggregate_function='mean',
@@ -1551,28 +2098,75 @@ class QueryFactory:
                                        inf_uloq=True,parent_key=None,scaling=None,transform=None,
                                        annotation_version=None,harmonise_annotations=False,
                                        ):
+        """Build a CompoundClass dataframe, aggregating the AnnotatedFeature dataframe by class at one class level.
+
+        See :meth:`build_compound_class_dataframes` for the parameters.
+
+        :return: The CompoundClass dataframe.
+        :rtype: :class:`pandas.DataFrame`
+        """
+
+        dataframes = self.build_compound_class_dataframes(class_type=class_type,class_levels=[class_level],
+                                                          aggregate_functions=[aggregate_function],
+                                                          convert_units=convert_units,master_unit=master_unit,
+                                                          correction_type=correction_type,zero_lloq=zero_lloq,
+                                                          inf_uloq=inf_uloq,parent_key=parent_key,
+                                                          annotation_version=annotation_version,
+                                                          harmonise_annotations=harmonise_annotations)
+        return list(dataframes.values())[0]
+
+    def build_compound_class_dataframes(self,class_type=CompoundClass.CompoundClassType.classyfire,
+                                        class_levels=None,
+                                        aggregate_functions=None,
+                                        convert_units=True, master_unit='mmol/L',
+                                        correction_type=None,zero_lloq=True,
+                                        inf_uloq=True,parent_key=None,
+                                        annotation_version=None,harmonise_annotations=False):
+        """Build CompoundClass dataframes for several class levels and aggregate functions from the same AnnotatedFeature dataframe.
+
+        The class memberships are loaded once per class type, and every class is aggregated at once, see :mod:`phenomedb.class_aggregation`.
+        Each dataframe is stored in self.dataframes under its combined CompoundClass key, as built by
+        :meth:`set_three_file_format_keys` from the same convert_units and master_unit.
+
+        :param class_type: The class type, defaults to CompoundClass.CompoundClassType.classyfire
+        :type class_type: str or :class:`phenomedb.models.CompoundClass.CompoundClassType`, optional
+        :param class_levels: The class levels, defaults to None (all class levels)
+        :type class_levels: list, optional
+        :param aggregate_functions: The aggregate functions, 'sum', 'mean', 'min', 'max' or 'median', defaults to None (['mean'])
+        :type aggregate_functions: list, optional
+        :param convert_units: Whether to convert the units of the AnnotatedFeature dataframe, defaults to True
+        :type convert_units: bool, optional
+        :param master_unit: The unit to convert to, defaults to 'mmol/L'
+        :type master_unit: str, optional
+        :param correction_type: The correction type, defaults to None
+        :type correction_type: str, optional
+        :param zero_lloq: Whether to set <LLOQ values to 0, defaults to True
+        :type zero_lloq: bool, optional
+        :param inf_uloq: Whether to set >ULOQ values to inf, defaults to True
+        :type inf_uloq: bool, optional
+        :param parent_key: The key of the AnnotatedFeature dataframe, defaults to None
+        :type parent_key: str, optional
+        :param annotation_version: The annotation version, defaults to None
+        :type annotation_version: str, optional
+        :param harmonise_annotations: Whether to use the harmonised annotations, defaults to False
+        :type harmonise_annotations: bool, optional
+        :return: The CompoundClass dataframes, key -> dataframe
+        :rtype: dict
+        """
 
         if not parent_key:
             parent_key = self.get_dataframe_key(type='combined',model=self.parent_model['CompoundClass'],
                                                                        db_env=self.db_env,
                                                                        correction_type=correction_type,
                                                                        annotation_version=annotation_version,
-                                                                        harmonise_annotations=harmonise_annotations)
-
-        if isinstance(class_type,str):
-            if class_type == 'hmdb':
-                class_type = CompoundClass.CompoundClassType.hmdb
-            elif class_type == 'lipidmaps':
-                class_type = CompoundClass.CompoundClassType.lipidmaps
-            elif class_type == 'classyfire':
-                class_type = CompoundClass.CompoundClassType.classyfire
-            else:
-                raise Exception("Unknown CompoundClass Type %s" % class_type)
+                                                                        harmonise_annotations=harmonise_annotations,
+                                                                        convert_units=convert_units,master_unit=master_unit)
 
-        class_level = class_level.lower().replace(" ","_")
-        allowed_class_levels = ['kingdom', 'category', 'main_class', 'sub_class', 'direct_parent']
-        if class_level not in allowed_class_levels:
-            raise Exception("Class level %s must be one of %s " % (class_level,allowed_class_levels))
+        if class_levels is None:
+            class_levels = class_aggregation.CLASS_LEVELS
+        class_levels = [class_aggregation.get_class_level(class_level) for class_level in class_levels]
+        if aggregate_functions is None:
+            aggregate_functions = ['mean']
 
         # Relies on the AnnotatedFeature dataframe to exist
         if parent_key not in self.dataframes.keys():
@@ -1580,68 +2174,28 @@ class QueryFactory:
                                 convert_units=convert_units, master_unit=master_unit,harmonise_annotations=harmonise_annotations,
                                 correction_type=correction_type,zero_lloq=zero_lloq,inf_uloq=inf_uloq)
 
-        if 'CompoundClass' not in self.dataframes.keys():
-            self.dataframes['CompoundClass'] = {}
-
-        key = self.get_dataframe_key(type='combined',model='CompoundClass',
-                                                 aggregate_function=aggregate_function,
-                                                 class_type=class_type,class_level=class_level,
-                                                 correction_type=correction_type,harmonise_annotations=harmonise_annotations,
-                                                 annotation_version=annotation_version,db_env=self.db_env)
-        dataframe = pd.DataFrame()
-
-        # Adds all the non-feature columns to the new dataframe
-        for colname in self.dataframes[parent_key].columns:
-
-            if re.search('feature:',colname):
-
-                feature_metadata_id, harmonised_annotation_id, assay, annotation_method, cpd_name, version, unit = utils.breakdown_annotation_id(colname,harmonise_annotations=harmonise_annotations)
-                if harmonised_annotation_id:
-                    compound_class = self.db_session.query(CompoundClass).join(CompoundClassCompound, Compound,
-                                                                               AnnotationCompound, HarmonisedAnnotation).filter(
-                                                                                CompoundClass.type == class_type,
-                                                                                getattr(CompoundClass, class_level) != None,
-                                                                                HarmonisedAnnotation.id == int(harmonised_annotation_id)).first()
-                elif feature_metadata_id:
-                    compound_class = self.db_session.query(CompoundClass).join(CompoundClassCompound,Compound,AnnotationCompound,HarmonisedAnnotation,Annotation,FeatureMetadata).filter(
-                                                                                CompoundClass.type == class_type,
-                                                                                getattr(CompoundClass, class_level) != None,
-                                                                                FeatureMetadata.id==int(feature_metadata_id)).first()
-                if compound_class:
-                    self.logger.info("Class found: %s %s" % (colname, compound_class))
-                    class_column_name = "compound_class:%s::%s:%s:%s:noUnit" % (compound_class.id, compound_class.type.value, class_level, getattr(compound_class, class_level))
-                    if class_column_name not in dataframe.columns:
-                        dataframe[class_column_name] = 0
-                    if class_column_name not in self.compound_class_feature_map.keys():
-                        self.compound_class_feature_map[class_column_name] = []
-                    self.compound_class_feature_map[class_column_name].append(colname)
-
-            if not re.search('feature:', colname) and colname not in dataframe.columns:
-                dataframe[colname] = self.dataframes[parent_key].loc[:,colname]
-
-        # ADD TRANSFORM AND SCALING HERE!!!
-
-        for class_column_name,feature_names in self.compound_class_feature_map.items():
-
-            i = 0
-            while i < dataframe.shape[0]:
-                if aggregate_function == 'sum':
-                    dataframe.loc[i,class_column_name] = self.dataframes[parent_key].loc[i,feature_names].sum()
-                elif aggregate_function == 'min':
-                    dataframe.loc[i,class_column_name] = self.dataframes[parent_key].loc[i,feature_names].min()
-                elif aggregate_function == 'max':
-                    dataframe.loc[i,class_column_name] = self.dataframes[parent_key].loc[i,feature_names].max()
-                elif aggregate_function == 'median':
-                    dataframe.loc[i,class_column_name] = self.dataframes[parent_key].loc[i,feature_names].median()
-                elif aggregate_function == 'mean':
-                    dataframe.loc[i,class_column_name] = self.dataframes[parent_key].loc[i,feature_names].mean()
-                else:
-                    raise Exception("Unknown aggregation function")
-                i = i + 1
-
-        self.dataframes[key] = dataframe
-
-        return dataframe
+        aggregator = class_aggregation.CompoundClassAggregator(self.db_session,class_type,
+                                                               harmonise_annotations=harmonise_annotations,
+                                                               logger=self.logger)
+        memberships = aggregator.load_memberships([colname for colname in self.dataframes[parent_key].columns
+                                                   if re.search('feature:',colname)],class_levels=class_levels)
+        for membership in memberships.values():
+            self.compound_class_feature_map.update(membership.get_feature_map())
+
+        dataframes = {}
+        for (class_level,aggregate_function),dataframe in aggregator.aggregate(self.dataframes[parent_key],
+                                                                               aggregate_functions=aggregate_functions,
+                                                                               memberships=memberships).items():
+            # The key load_dataframe and the 3-file format read the dataframe from
+            key = self.get_dataframe_key(type='combined',model='CompoundClass',
+                                         aggregate_function=aggregate_function,
+                                         class_type=aggregator.class_type,class_level=class_level,
+                                         correction_type=correction_type,harmonise_annotations=harmonise_annotations,
+                                         db_env=self.db_env,convert_units=convert_units,master_unit=master_unit)
+            self.dataframes[key] = dataframe
+            dataframes[key] = dataframe
+
+        return dataframes
 
     def build_intensity_data_sample_metadata_and_feature_metadata(self, output_dir=None,
                                                                   exclude_features_with_na_feature_values=False,
@@ -1772,16 +2326,24 @@ class QueryFactory:
             else:
                 feature_id_combined_dataframe = self.dataframes[feature_id_combined_dataframe_key]
 
+        # Resolve the feature metadata of every feature: column at once
+        feature_colnames = [colname for colname in combined_dataframe.columns if re.search('feature:', colname)]
+        resolved_feature_metadata = pd.DataFrame()
+        if len(feature_colnames) > 0:
+            resolver = FeatureAnnotationResolver(self.db_session, compound_fields_to_include,
+                                                 compound_class_types_to_include, cache=self.cache, logger=self.logger)
+            resolved_colnames, resolved_feature_metadata = resolver.resolve(feature_colnames,
+                                                                            harmonise_annotations=harmonise_annotations)
+            resolved_feature_metadata.index = resolved_colnames
+
+        compound_class_feature_metadata_rows = {}
+        matrix_colnames = []
         matrix_col_i = 0
         for (colname, colval) in combined_dataframe.iteritems():
 
             if re.search('feature:', colname):
                 # Add the column to the X matrix
-                try:
-                    feature_metadata_row = self.build_annotated_feature_feature_metadata_row(colname,
-                                                                  harmonise_annotations=harmonise_annotations)
-                except UnharmonisedAnnotationException as err:
-                    self.logger.exception(err)
+                if colname not in resolved_feature_metadata.index:
                     continue
 
                 intensity_data[:, matrix_col_i] = colval.values
@@ -1790,7 +2352,7 @@ class QueryFactory:
 
                 matrix_col_i = matrix_col_i + 1
 
-                feature_metadata = feature_metadata.append(feature_metadata_row,ignore_index=True)
+                matrix_colnames.append(colname)
 
             elif re.search('compound_class:',colname):
 
@@ -1801,14 +2363,18 @@ class QueryFactory:
 
                     matrix_col_i = matrix_col_i + 1
 
-                    feature_metadata = feature_metadata.append(
-                        self.build_compound_class_feature_metadata_row(colname),
-                        ignore_index=True)
+                    matrix_colnames.append(colname)
+                    compound_class_feature_metadata_rows[colname] = self.build_compound_class_feature_metadata_row(colname)
 
             else:
                 if colname not in sample_metadata.columns:
                     sample_metadata.insert(len(sample_metadata.columns), colname, colval.values)
 
+        if len(matrix_colnames) > 0:
+            feature_metadata = pd.concat([resolved_feature_metadata,
+                                          pd.DataFrame.from_dict(compound_class_feature_metadata_rows, orient='index')])
+            feature_metadata = feature_metadata.loc[matrix_colnames].reset_index(drop=True)
+
        
         intensity_data = np.nan_to_num(intensity_data, copy=False)
 
@@ -1848,6 +2414,8 @@ class QueryFactory:
         summary_key = self.saved_query.get_cache_summary_stats_key()
         if self.cache.exists(summary_key):
             self.cache.delete(summary_key)
+        if self.cache.exists(self.saved_query.get_cache_summary_stats_projects_key()):
+            self.cache.delete(self.saved_query.get_cache_summary_stats_projects_key())
         cache_state = dict(self.saved_query.cache_state)
         if summary_key in cache_state.keys():
             del cache_state[summary_key]
@@ -1856,11 +2424,14 @@ class QueryFactory:
 
             annotated_feature_id_key = self.saved_query.get_cache_annotated_feature_id_key(key)
             cache_key = self.saved_query.get_cache_dataframe_key(key)
+            build_state_key = self.saved_query.get_cache_dataframe_build_state_key(key)
 
             if self.cache.exists(annotated_feature_id_key):
                 self.cache.delete(annotated_feature_id_key)
             if self.cache.exists(cache_key):
                 self.cache.delete(cache_key)
+            if self.cache.exists(build_state_key):
+                self.cache.delete(build_state_key)
 
             if key in cache_state.keys():
                 del cache_state[key]
@@ -1870,6 +2441,174 @@ class QueryFactory:
         self.saved_query.cache_state = cache_state
         self.db_session.commit()
 
+    def get_sample_assay_max_annotated_feature_ids(self):
+        """Get the SampleAssays of the matching AnnotatedFeatures, with the maximum id of their matching AnnotatedFeatures.
+
+        :return: SampleAssay id -> maximum AnnotatedFeature id
+        :rtype: dict
+        """
+
+        self.generate_query(output_model='AnnotatedFeature')
+        annotated_feature_ids = self.compiled_query.select(ids_only=True).order_by(None).subquery()
+        statement = select(AnnotatedFeature.sample_assay_id, func.max(AnnotatedFeature.id)) \
+            .join(annotated_feature_ids, annotated_feature_ids.c.id == AnnotatedFeature.id) \
+            .group_by(AnnotatedFeature.sample_assay_id)
+        return {sample_assay_id: max_id for sample_assay_id, max_id in self.db_session.execute(statement)}
+
+    def refresh_dataframe(self, combined_key, convert_units=True, master_unit='mmol/L', correction_type=None,
+                          harmonise_annotations=False, zero_lloq=True, inf_uloq=True,
+                          sort_by=('Project', 'Acquired Time'), sort_by_ascending=(True, True)):
+        """Incrementally refresh a cached combined AnnotatedFeature dataframe, and its feature_id_combined_dataframe.
+
+        The rows of the samples with new, removed, changed, or stale SampleAssays (see :mod:`phenomedb.dataframe_refresh`)
+        are rebuilt with :meth:`build_annotated_feature_dataframe_bulk` and spliced into the cached dataframes, with the
+        builder's defaults in the other rows of the new columns. The dataframes derived from the combined dataframe are
+        rebuilt from it when next loaded.
+
+        :param combined_key: The key of the combined dataframe.
+        :type combined_key: str
+        :param convert_units: Whether to convert the intensities to the master_unit, defaults to True.
+        :type convert_units: bool, optional
+        :param master_unit: The unit to convert to, defaults to 'mmol/L'.
+        :type master_unit: str, optional
+        :param correction_type: The batch correction type, 'SR' or 'LTR', defaults to None.
+        :type correction_type: str, optional
+        :param harmonise_annotations: Whether to build HarmonisedAnnotation columns, defaults to False.
+        :type harmonise_annotations: bool, optional
+        :param zero_lloq: Set <LLOQ values to 0, defaults to True.
+        :type zero_lloq: bool, optional
+        :param inf_uloq: Set >ULOQ values to inf, defaults to True.
+        :type inf_uloq: bool, optional
+        :param sort_by: The columns to sort by, defaults to ('Project', 'Acquired Time').
+        :type sort_by: tuple, optional
+        :param sort_by_ascending: The sort orders, defaults to (True, True).
+        :type sort_by_ascending: tuple, optional
+        :return: Whether the dataframe was refreshed. If False, it has to be rebuilt.
+        :rtype: bool
+        """
+
+        cache_key = self.saved_query.get_cache_dataframe_key(combined_key)
+        build_state_key = self.saved_query.get_cache_dataframe_build_state_key(combined_key)
+        feature_id_combined_dataframe_key = self.get_dataframe_key(type='feature_id_combined_dataframe',model='AnnotatedFeature',
+                                                                   correction_type=correction_type,db_env=self.db_env,
+                                                                   harmonise_annotations=harmonise_annotations)
+        feature_id_cache_key = self.saved_query.get_cache_dataframe_key(feature_id_combined_dataframe_key)
+
+        if not self.cache.exists(cache_key) or not self.cache.exists(build_state_key) or not self.cache.exists(feature_id_cache_key):
+            self.logger.info("No build state for %s, it cannot be refreshed" % combined_key)
+            return False
+
+        build_state = self.cache.get(build_state_key)
+        sample_assay_max_ids = self.get_sample_assay_max_annotated_feature_ids()
+        changed_sample_assay_ids = dataframe_refresh.get_changed_sample_assay_ids(build_state, sample_assay_max_ids)
+
+        dataframe = self.cache.get(cache_key)
+        feature_id_combined_dataframe = self.cache.get(feature_id_cache_key)
+
+        if len(changed_sample_assay_ids) > 0:
+            changed_samples = self.db_session.execute(select(SampleAssay.id, SampleAssay.sample_id, Project.name, Sample.name)
+                                                      .join(Sample, SampleAssay.sample_id == Sample.id)
+                                                      .join(Subject, Sample.subject_id == Subject.id)
+                                                      .join(Project, Subject.project_id == Project.id)
+                                                      .where(SampleAssay.id.in_(changed_sample_assay_ids))).all()
+            if len(changed_samples) < len(changed_sample_assay_ids):
+                # Deleted SampleAssays cannot be mapped to their rows
+                self.logger.info("SampleAssays of %s have been deleted, it cannot be refreshed" % combined_key)
+                return False
+
+            unique_names = list({project_name + "-" + sample_name for _, _, project_name, sample_name in changed_samples})
+
+            # The rows are samples, so every matching SampleAssay of a changed sample is rebuilt
+            sample_ids = list({sample_id for _, sample_id, _, _ in changed_samples})
+            rebuild_sample_assay_ids = [sample_assay_id for sample_assay_id in self.db_session.execute(
+                                            select(SampleAssay.id).where(SampleAssay.sample_id.in_(sample_ids))).scalars()
+                                        if sample_assay_id in sample_assay_max_ids]
+
+            update = None
+            feature_id_update = None
+            if len(rebuild_sample_assay_ids) > 0:
+                update = self.build_annotated_feature_dataframe_bulk(convert_units=convert_units, master_unit=master_unit,
+                                                                     correction_type=correction_type,
+                                                                     harmonise_annotations=harmonise_annotations,
+                                                                     zero_lloq=zero_lloq, inf_uloq=inf_uloq,
+                                                                     sample_assay_ids=rebuild_sample_assay_ids)
+                feature_id_update = self.dataframes[feature_id_combined_dataframe_key]
+
+            # The defaults of the new h_metadata:: columns depend on their datatypes
+            column_defaults = {}
+            harmonised_field_names = [column[len('h_metadata::'):] for column in (update.columns if update is not None else [])
+                                      if column.startswith('h_metadata::') and column not in dataframe.columns]
+            if len(harmonised_field_names) > 0:
+                for name, datatype in self.db_session.execute(select(HarmonisedMetadataField.name, HarmonisedMetadataField.datatype)
+                                                              .where(HarmonisedMetadataField.name.in_(harmonised_field_names))):
+                    column_defaults['h_metadata::' + name] = dataframe_refresh.get_harmonised_metadata_default(getattr(datatype, 'value', datatype))
+
+            dataframe = dataframe_refresh.splice_dataframe(dataframe, update, unique_names, sort_by=list(sort_by),
+                                                           sort_by_ascending=list(sort_by_ascending),
+                                                           column_defaults=column_defaults)
+            dataframe['Unique Batch Numeric'] = pd.factorize(dataframe['Unique Batch'])[0] + 1
+            feature_id_combined_dataframe = dataframe_refresh.splice_dataframe(feature_id_combined_dataframe, feature_id_update,
+                                                                               unique_names, sort_by=list(sort_by),
+                                                                               sort_by_ascending=list(sort_by_ascending))
+
+            self.cache.set(cache_key, dataframe)
+            self.cache.set(feature_id_cache_key, feature_id_combined_dataframe)
+            self.logger.info("Refreshed %s: %s SampleAssays changed, %s rows rebuilt" % (combined_key, len(changed_sample_assay_ids),
+                                                                                       len(unique_names)))
+
+        self.cache.set(build_state_key, dataframe_refresh.get_build_state(sample_assay_max_ids))
+        self.dataframes[combined_key] = dataframe
+        self.dataframes[feature_id_combined_dataframe_key] = feature_id_combined_dataframe
+
+        cache_state = dict(self.saved_query.cache_state)
+        cache_state[combined_key] = 'exists'
+        self.saved_query.cache_state = cache_state
+        self.db_session.commit()
+        return True
+
+    def mark_cache_stale(self, sample_assay_ids):
+        """Mark the cached dataframes stale if the query matches, or was built from, any of the SampleAssays.
+
+        Called by :meth:`phenomedb.imports.ImportTask.post_commit_actions` with the SampleAssays an import touched.
+        The SampleAssays are added to the build states, so :meth:`refresh_dataframe` rebuilds their rows.
+
+        :param sample_assay_ids: The SampleAssay ids.
+        :type sample_assay_ids: list
+        :return: Whether the cached dataframes were marked stale.
+        :rtype: bool
+        """
+
+        if not self.saved_query or not self.saved_query.cache_state or len(sample_assay_ids) == 0:
+            return False
+
+        cache_state = dict(self.saved_query.cache_state)
+        keys = [key for key in cache_state.keys() if self.cache.exists(self.saved_query.get_cache_dataframe_key(key))]
+        if len(keys) == 0:
+            return False
+
+        stale_sample_assay_ids = set(self.db_session.execute(select(SampleAssay.id)
+                                                             .where(SampleAssay.id.in_(sample_assay_ids))
+                                                             .where(self.get_id_filter(SampleAssay.id, 'SampleAssay'))).scalars())
+        build_states = {}
+        for key in keys:
+            build_state_key = self.saved_query.get_cache_dataframe_build_state_key(key)
+            if self.cache.exists(build_state_key):
+                build_states[build_state_key] = self.cache.get(build_state_key)
+                stale_sample_assay_ids = stale_sample_assay_ids | (set(build_states[build_state_key]['sample_assay_ids'])
+                                                                   & set(sample_assay_ids))
+
+        if len(stale_sample_assay_ids) == 0:
+            return False
+
+        for build_state_key, build_state in build_states.items():
+            self.cache.set(build_state_key, dataframe_refresh.add_stale_sample_assay_ids(build_state, stale_sample_assay_ids))
+        for key in keys:
+            cache_state[key] = 'stale'
+        self.saved_query.cache_state = cache_state
+        self.db_session.commit()
+        self.logger.info("SavedQuery %s cache stale, %s SampleAssays changed" % (self.saved_query.id, len(stale_sample_assay_ids)))
+        return True
+
     def is_unique(self, colvalue):
 
         return (colvalue[0] == colvalue).all(0)
@@ -2233,9 +2972,11 @@ class QueryFactory:
     def load_dataframe(self, type='combined', combined_csv_path=None, convert_units=True, master_unit='mmol/L', reload_cache=False,
                        correction_type=None, annotation_version=None, output_model='AnnotatedFeature',output_dir=None,harmonise_annotations=False,
                        class_level=None,class_type=None,zero_lloq=True, inf_uloq=True,aggregate_function=None,save_cache=True,
-                       sample_label=None,feature_label=None):
+                       sample_label=None,feature_label=None,incremental=True):
         """The main access point for queries. Checks the cache first, if it doesn't exist, executes the query, builds the dataframes and stores them in the cache.
 
+        Cached dataframes marked stale by an import (see :meth:`mark_cache_stale`) are refreshed incrementally, see :meth:`refresh_dataframe`.
+
         :param type: _description_, defaults to 'combined'
         :type type: str, optional
         :param combined_csv_path: _description_, defaults to None
@@ -2272,6 +3013,8 @@ class QueryFactory:
         :type sample_label: _type_, optional
         :param feature_label: _description_, defaults to None
         :type feature_label: _type_, optional
+        :param incremental: Whether to refresh stale dataframes incrementally, rather than serve them from the cache, defaults to True
+        :type incremental: bool, optional
         :return: _description_
         :rtype: _type_
         """
@@ -2325,10 +3068,24 @@ class QueryFactory:
                 feature_id_combined_dataframe_key = self.get_dataframe_key(type='feature_id_combined_dataframe',model='AnnotatedFeature',
                                                                            correction_type=correction_type,db_env=self.db_env,
                                                                            harmonise_annotations=harmonise_annotations)
+            # Stale dataframes are refreshed in place, or if derived from the combined dataframe, rebuilt from it
+            if incremental and not reload_cache and cache_state.get(key) == 'stale':
+                if type == 'combined' and output_model == 'AnnotatedFeature' and \
+                        self.refresh_dataframe(combined_key=key, convert_units=convert_units, master_unit=master_unit,
+                                               correction_type=correction_type, harmonise_annotations=harmonise_annotations,
+                                               zero_lloq=zero_lloq, inf_uloq=inf_uloq):
+                    cache_state = dict(self.saved_query.cache_state)
+                else:
+                    self.logger.info("Stale, rebuilding %s" % key)
+                    self.cache.delete(cache_key)
+                    del cache_state[key]
+
             # If the cache exists, get it from the cache
             if reload_cache and self.cache.exists(cache_key):
                 self.logger.info("Reload cache is true so rebuilding cache")
                 self.cache.delete(cache_key)
+                if self.cache.exists(self.saved_query.get_cache_dataframe_build_state_key(key)):
+                    self.cache.delete(self.saved_query.get_cache_dataframe_build_state_key(key))
                 if key in cache_state:
                     del cache_state[key]
                 if output_model == 'AnnotatedFeature':
@@ -2401,6 +3158,7 @@ class QueryFactory:
                 if not parent_key:
                     # ie AnnotatedFeature
                     if type == 'combined':
+                        self.build_state = None
                         self.dataframes[combined_key] = self.execute_and_build_dataframe(csv_path=combined_csv_path,
                                                                                 convert_units=convert_units,
                                                                                 master_unit=master_unit,
@@ -2414,6 +3172,9 @@ class QueryFactory:
                                                                                 harmonise_annotations=harmonise_annotations)
                         if save_cache:
                             self.cache.set(cache_key, self.dataframes[combined_key])
+                            if self.build_state is not None:
+                                self.cache.set(self.saved_query.get_cache_dataframe_build_state_key(combined_key),
+                                               self.build_state)
                         cache_state[combined_key] = 'exists'
 
                     else:
@@ -2425,7 +3186,7 @@ class QueryFactory:
                                             aggregate_function=aggregate_function, output_dir=output_dir,
                                             class_level=class_level, class_type=class_type, zero_lloq=zero_lloq,
                                             inf_uloq=inf_uloq,save_cache=save_cache,
-                                            harmonise_annotations=harmonise_annotations)
+                                            harmonise_annotations=harmonise_annotations,incremental=incremental)
 
                         sample_metadata,feature_metadata,intensity_data = self.build_intensity_data_sample_metadata_and_feature_metadata(
                                 correction_type=correction_type,
@@ -2474,19 +3235,26 @@ class QueryFactory:
                         # Load the parent combined
                         self.load_dataframe(type='combined',output_model=self.parent_model[output_model],combined_csv_path=combined_csv_path, convert_units=convert_units,
                                             master_unit=master_unit, reload_cache=reload_cache,correction_type=correction_type,harmonise_annotations=harmonise_annotations,
-                                            annotation_version=annotation_version, output_dir=output_dir,zero_lloq=zero_lloq, inf_uloq=inf_uloq,save_cache=save_cache)
+                                            annotation_version=annotation_version, output_dir=output_dir,zero_lloq=zero_lloq, inf_uloq=inf_uloq,save_cache=save_cache,
+                                            incremental=incremental)
 
                     # load the required dataframe
                     #combined_key = self.get_dataframe_key(type='combined',model=output_model,aggregate_function=aggregate_function,
                     #                                      class_type=class_type,class_level=class_level,harmonise_annotations=harmonise_annotations,
                     #                                      correction_type=correction_type,db_env=self.db_env)
-                    self.dataframes[combined_key] = self.build_compound_class_dataframe(aggregate_function=aggregate_function,
-                                                                    class_level=class_level, class_type=class_type,
-                                                                    convert_units=convert_units, zero_lloq=zero_lloq,
-                                                                    inf_uloq=inf_uloq,annotation_version=annotation_version,
-                                                                    master_unit=master_unit, parent_key=parent_key,harmonise_annotations=harmonise_annotations)
-                    self.cache.set(self.saved_query.get_cache_dataframe_key(combined_key), self.dataframes[combined_key])
-                    cache_state[combined_key] = 'exists'
+                    if self.cache.exists(self.saved_query.get_cache_dataframe_key(combined_key)):
+                        self.dataframes[combined_key] = self.cache.get(self.saved_query.get_cache_dataframe_key(combined_key))
+                    else:
+                        # Build every class level at once, so switching class level reads from the cache
+                        class_dataframes = self.build_compound_class_dataframes(aggregate_functions=[aggregate_function],
+                                                                        class_type=class_type,
+                                                                        convert_units=convert_units, zero_lloq=zero_lloq,
+                                                                        inf_uloq=inf_uloq,annotation_version=annotation_version,
+                                                                        master_unit=master_unit, parent_key=parent_key,harmonise_annotations=harmonise_annotations)
+                        for class_key, class_dataframe in class_dataframes.items():
+                            self.cache.set(self.saved_query.get_cache_dataframe_key(class_key), class_dataframe)
+                            cache_state[class_key] = 'exists'
+                        self.dataframes[combined_key] = class_dataframes[combined_key]
                     if type != 'combined':
                         sample_metadata,feature_metadata,intensity_data = self.build_intensity_data_sample_metadata_and_feature_metadata(
                             correction_type=correction_type,
@@ -2621,38 +3389,6 @@ class QueryFactory:
         shutil.rmtree(output_dir)
         return npyc_dataset
 
-    def apply_npyc_masks(self,sample_metadata,feature_metadata,intensity_data,sample_types=None,
-                         assay_platform='MS',for_npyc=False,assay_roles=None,task_run_id=None):
-
-        if (sample_types is not None and isinstance(sample_types, list) and len(sample_types) != 0) \
-            or (assay_roles is not None and isinstance(assay_roles, list) and len(assay_roles) != 0):
-            self.logger.info("Applying Masks %s %s" % (sample_types,assay_roles))
-            self.npyc_dataset = self.load_npyc_dataset(sample_metadata=sample_metadata,
-                                                       feature_metadata=feature_metadata,
-                                                       intensity_data=intensity_data,
-                                                       assay_platform=assay_platform,
-                                                       task_run_id=None)
-            self.npyc_dataset.updateMasks(filterFeatures=False, sampleTypes=sample_types, assayRoles=assay_roles)
-            self.npyc_dataset.applyMasks()
-            self.logger.info("Masks applied!")
-
-            masked_sample_metadata = self.npyc_dataset.sampleMetadata.copy()
-            masked_feature_metadata = self.npyc_dataset.featureMetadata.copy()
-            masked_intensity_data = self.npyc_dataset.intensityData.copy()
-
-        else:
-            masked_sample_metadata = sample_metadata.copy()
-            masked_feature_metadata = feature_metadata.copy()
-            masked_intensity_data = intensity_data.copy()
-
-        if not for_npyc and 'Metadata Available' in masked_sample_metadata:
-            self.logger.info("Dropping the Metadata Available=TRUE column")
-            masked_sample_metadata = masked_sample_metadata.drop(axis=1, columns='Metadata Available')
-
-        self.logger.info("Masked data saved")
-        return masked_sample_metadata,masked_feature_metadata,masked_intensity_data
-
-
     def transform_dataframe(self,type,combined_data=None,intensity_data=None,feature_metadata=None,
                             sample_metadata=None,metaboanalyst_metadata=None,metaboanalyst_data=None,
                             transform=None,scaling=None,sample_label=None,remove_empty_metadata_columns=True,
@@ -2678,63 +3414,77 @@ class QueryFactory:
         if not columns_to_exclude:
             columns_to_exclude = []
 
-        # 1. Apply feature exclusions and sample type and assay role masks
-        if exclude_features_with_na_feature_values:
-            i = 0
-            features_to_exclude = []
-            if type == '3 file format':
-                while i < feature_metadata.shape[0]:
-                    if np.isnan(intensity_data[:,i]).any():
-                        features_to_exclude.append(i)
-                    i = i + 1
-
-                feature_metadata = feature_metadata.drop(index=features_to_exclude)
-                intensity_data = np.delete(intensity_data, features_to_exclude, 1)
+        # The sample metadata the scaling blocks are built from
+        scaling_sample_metadata = sample_metadata
 
-            elif type == 'metaboanalyst':
-                while i < metaboanalyst_data.shape[1]:
-                    if metaboanalyst_data.columns[i] != sample_label and metaboanalyst_data.iloc[:,i].isnull().values.any():
-                        features_to_exclude.append(i)
-                    i = i + 1
-                metaboanalyst_data = metaboanalyst_data.drop(features_to_exclude,axis=1)
-
-        if exclude_features_not_in_all_projects:
-            p = 0
-            features_to_remove = []
-            while p < feature_metadata.shape[0]:
-                feature_name = feature_metadata.loc[p,'feature_name']
-                for project in sample_metadata['Project'].unique():
-                    sample_indices = np.where(sample_metadata['Project'] == project)[0]
-                    if np.all(intensity_data[sample_indices, p] == 0.00):
-                        if p not in features_to_remove:
-                            features_to_remove.append(p)
-                p = p + 1
-            intensity_data = np.delete(intensity_data.copy(), features_to_remove, 1)
-            feature_metadata = feature_metadata.drop(index=features_to_remove).reset_index().drop(columns=['index'])
-            self.logger.info("Removed the following features which are not consistent between projects %s" % features_to_remove )
+        # 1. Apply the feature exclusions, sample type and assay role masks, and metadata column selection
+        if type in ['3 file format','metaboanalyst']:
+            if type == '3 file format':
+                masked_sample_metadata = sample_metadata
+                masked_feature_metadata = feature_metadata
+                masked_intensity_data = intensity_data
+            else:
+                feature_columns = [colname for colname in metaboanalyst_data.columns if colname != sample_label]
+                masked_sample_metadata = metaboanalyst_metadata
+                masked_feature_metadata = pd.DataFrame({'feature_id': feature_columns})
+                masked_intensity_data = metaboanalyst_data.loc[:,feature_columns].to_numpy(dtype=float)
+
+            stages = []
+            if exclude_features_with_na_feature_values:
+                stages.append(transform_pipeline.NAFeatureMask())
+            if exclude_features_not_in_all_projects and 'Project' in masked_sample_metadata.columns:
+                stages.append(transform_pipeline.ProjectZeroFeatureMask())
+            if sample_types is not None and isinstance(sample_types, list) and len(sample_types) != 0 \
+                    and (type == '3 file format' or 'SampleType' in masked_sample_metadata.columns):
+                stages.append(transform_pipeline.SampleValueMask('SampleType',sample_types))
+            if assay_roles is not None and isinstance(assay_roles, list) and len(assay_roles) != 0 \
+                    and (type == '3 file format' or 'AssayRole' in masked_sample_metadata.columns):
+                stages.append(transform_pipeline.SampleValueMask('AssayRole',assay_roles))
+            if type == '3 file format':
+                # Metadata Available is re-added below
+                metadata_columns_to_exclude = columns_to_exclude + ['Metadata Available']
+            else:
+                metadata_columns_to_exclude = columns_to_exclude
+            stages.append(transform_pipeline.MetadataColumnMask(sample_label,columns_to_include=columns_to_include,
+                                                                columns_to_exclude=metadata_columns_to_exclude,
+                                                                remove_empty_metadata_columns=remove_empty_metadata_columns,
+                                                                include_metadata=include_metadata,
+                                                                include_harmonised_metadata=include_harmonised_metadata,
+                                                                only_metadata=only_metadata,
+                                                                only_harmonised_metadata=only_harmonised_metadata,
+                                                                exclude_na_metadata_columns=exclude_na_metadata_columns))
+            if exclude_na_metadata_samples:
+                stages.append(transform_pipeline.NAMetadataSampleMask())
 
-      #  if assay_platform == 'NMR':
-      #      if 'Delta PPM' not in sample_metadata.columns:
-      #          sample_metadata['Delta PPM'] = 0
-      #      if 'Line Width (Hz)' not in sample_metadata.columns:
-      #          sample_metadata['Line Width (Hz)'] = 0
+            pipeline = transform_pipeline.MaskPipeline(stages,sample_label=sample_label,logger=self.logger)
+            masked_sample_metadata, masked_feature_metadata, masked_intensity_data = pipeline.run(masked_sample_metadata,
+                                                                                                 masked_feature_metadata,
+                                                                                                 masked_intensity_data)
+            self.transform_provenance = pipeline.provenance
+            self.logger.debug("transform provenance %s" % self.transform_provenance)
 
-        #if assay_platform == 'MS':
-        sample_metadata, feature_metadata, intensity_data = self.apply_npyc_masks(sample_metadata=sample_metadata,
-                                                                                  feature_metadata=feature_metadata,
-                                                                                intensity_data=intensity_data,
-                                                                                  sample_types=sample_types,
-                                                                                  assay_roles=assay_roles,
-                                                                                  for_npyc=for_npyc,
-                                                                                assay_platform=assay_platform,
-                                                                                  task_run_id=None)
+            if type == '3 file format':
+                # The scaling blocks need the Project and Assay columns, which the metadata column selection may remove
+                scaling_sample_metadata = sample_metadata.iloc[pipeline.sample_indices].reset_index(drop=True)
+                sample_metadata = masked_sample_metadata
+                feature_metadata = masked_feature_metadata
+                intensity_data = masked_intensity_data
+            else:
+                metaboanalyst_metadata = masked_sample_metadata
+                masked_metaboanalyst_data = pd.DataFrame(masked_intensity_data,columns=masked_feature_metadata['feature_id'].tolist())
+                if sample_label in metaboanalyst_data.columns:
+                    masked_metaboanalyst_data.insert(0,sample_label,
+                                                     metaboanalyst_data[sample_label].iloc[pipeline.sample_indices].to_numpy())
+                metaboanalyst_data = masked_metaboanalyst_data
 
         # 2. Apply the transformations (scaling/transform)
         # Scale the intensities
         if type == '3 file format' and isinstance(intensity_data,np.ndarray) and scaling:
             if scaling not in ['uv', 'mc', 'pa',0,1,2,'med']:
                 raise Exception("Scaling type not implemented/recognised: %s" % scaling)
-            intensity_data = self.scaling_per_project_assay(sample_metadata,feature_metadata,intensity_data,scaling,assay_platform)
+            # The mask pipeline returns a copy, so it is scaled in place
+            intensity_data = self.scaling_per_project_assay(scaling_sample_metadata,feature_metadata,intensity_data,scaling,assay_platform,
+                                                            copy=False)
 
         # Transform the intensities
         if type == '3 file format' and isinstance(intensity_data, np.ndarray) and transform:
@@ -2749,73 +3499,6 @@ class QueryFactory:
             else:
                 raise Exception("Unknown transform function %" % transform)
 
-        # Exclude a sample metadata columns as required
-        if type == '3 file format':
-            metadata_dataframe = sample_metadata
-        elif type == 'metaboanalyst':
-            metadata_dataframe = metaboanalyst_metadata
-        if type in ['3 file format','metaboanalyst']:
-            output_dataframe = pd.DataFrame()
-
-            for (colname, colval) in metadata_dataframe.iteritems():
-                if colname == sample_label:
-                    output_dataframe.insert(len(output_dataframe.columns), colname, colval.values)
-                elif len(columns_to_exclude) > 0 and colname in columns_to_exclude:
-                    # ignore these are they are specifically being ignored
-                    pass
-
-                elif remove_empty_metadata_columns and metadata_dataframe[colname].isnull().values.all():
-                    pass
-
-                elif len(columns_to_include) > 0 and colname in columns_to_include:
-                    # include these (unique will be excluded later)
-                    output_dataframe.insert(len(output_dataframe.columns), colname, colval.values)
-
-                elif include_harmonised_metadata and re.search('h_metadata::', colname):
-                    output_dataframe.insert(len(output_dataframe.columns), colname, colval.values)
-
-                elif include_metadata and re.search('metadata::', colname):
-                    output_dataframe.insert(len(output_dataframe.columns), colname, colval.values)
-
-                elif len(columns_to_include) > 0 and colname not in columns_to_include:
-                    # ignore these (unique will be excluded later)
-                    pass
-
-                elif only_metadata and not re.search('metadata::', colname):
-                    # ignore these as we do not want any non-metadata columns
-                    pass
-
-                elif re.search('metadata::', colname) and only_harmonised_metadata and not re.search('h_metadata::',
-                                                                                                     colname):
-                    # ignore these as we only want the harmonised metadata (but keep any fields that not metadata::, ie sample_name)
-                    pass
-
-                elif re.search('metadata::', colname) and exclude_na_metadata_columns and metadata_dataframe[colname].isnull().values.any():
-                    # ignore these as they have null values!
-                    pass
-
-                else:
-                    output_dataframe.insert(len(output_dataframe.columns), colname, colval.values)
-
-            samples_to_drop = []
-            if exclude_na_metadata_samples:
-                i = 0
-                samples_to_drop = []
-                while i < output_dataframe.shape[0]:
-                    if output_dataframe.loc[i,:].isnull().values.any():
-                        samples_to_drop.append(i)
-                    i = i + 1
-
-                output_dataframe = output_dataframe.drop(index=samples_to_drop)
-            if type == '3 file format':
-                if len(samples_to_drop) > 0:
-                    intensity_data = np.delete(intensity_data, samples_to_drop, 1)
-                sample_metadata = output_dataframe
-            elif type == 'metaboanalyst':
-                metaboanalyst_metadata = output_dataframe
-                if len(samples_to_drop) > 0:
-                    metaboanalyst_data = metaboanalyst_data.drop(index=samples_to_drop)
-
         # Add the metadata bins
         if metadata_bin_definition is not None and isinstance(metadata_bin_definition, dict):
 
@@ -2920,72 +3603,43 @@ class QueryFactory:
 
         return filepath
 
-    def scaling_per_project_assay(self,sample_metadata,feature_metadata,intensity_data,scaling,assay_platform='MS'):
-
-        #1. chop up the matrix into projects and assays, and scale each seperately.
+    def scaling_per_project_assay(self,sample_metadata,feature_metadata,intensity_data,scaling,assay_platform='MS',
+                                  copy=True,max_workers=1,return_scaler=False):
+        """Scale the intensity data separately for each project x assay x annotation method block.
+
+        :param sample_metadata: The sample metadata.
+        :type sample_metadata: :class:`pandas.DataFrame`
+        :param feature_metadata: The feature metadata.
+        :type feature_metadata: :class:`pandas.DataFrame`
+        :param intensity_data: The intensity data.
+        :type intensity_data: :class:`numpy.ndarray`
+        :param scaling: The scaling method, 'uv', 'mc', 'pa', 'med', or a pyChemometrics scaling power 0, 1, 2.
+        :type scaling: str or int
+        :param assay_platform: The assay platform, defaults to 'MS'
+        :type assay_platform: str, optional
+        :param copy: Whether to scale a copy of the intensity data, defaults to True
+        :type copy: bool, optional
+        :param max_workers: The number of threads to scale the blocks across, defaults to 1
+        :type max_workers: int, optional
+        :param return_scaler: Whether to also return the fitted :class:`phenomedb.scaling.BlockScaler`, defaults to False
+        :type return_scaler: bool, optional
+        :return: The scaled intensity data, and the scaler if return_scaler.
+        :rtype: :class:`numpy.ndarray` or tuple
+        """
 
         self.logger.debug("scaling %s" % scaling)
         self.logger.debug("assay_platform %s" % assay_platform)
-        #if assay_platform == 'NMR':
-
-        #    if scaling in ['uv', 'mc', 'pa']:
-        #        scaling = utils.get_pyc_scaling(scaling)
-
-        #    if scaling in [0, 1, 2]:
-        #        scaler = ChemometricsScaler(scaling)
-        #        scaler.fit(intensity_data)
-        #        output_intensity_matrix = scaler.transform(intensity_data, copy=True)
-        #        self.logger.info('Intensity data scaled using %s' % scaling)
-        #    elif scaling == 'med':
-        #        output_intensity_matrix = intensity_data / (np.median(intensity_data, axis=0) + (1 - intensity_data.min()))
-        #        self.logger.info('Intensity data scaled using %s' % scaling)
-        #    else:
-        #        raise Exception("Unknown scaling method %" % scaling)
-        #else:
-
-        output_intensity_matrix = intensity_data.copy()
 
-        for project in sample_metadata['Project'].unique():
-
-            sample_indices = np.where(sample_metadata['Project'] == project)[0]
-            sample_intensities = intensity_data[sample_indices,:].copy()
-
-            for assay in feature_metadata['assay'].unique():
-
-                for annotation_method in feature_metadata['annotation_method'].unique():
-                    self.logger.debug("scaling %s %s %s" % (project, assay,annotation_method))
-
-                    feature_indices = np.where((feature_metadata['assay'] == assay) & (feature_metadata['annotation_method'] == annotation_method))[0]
-                    if len(feature_indices) > 0:
-                        feature_intensities = sample_intensities[:, feature_indices].copy()
-
-                        if scaling in ['uv', 'mc', 'pa']:
-                            scaling = utils.get_pyc_scaling(scaling)
-
-                        if scaling in [0,1,2]:
-                            scaler = ChemometricsScaler(scaling)
-                            scaler.fit(feature_intensities)
-                            scaled_intensities = scaler.transform(feature_intensities, copy=True)
-                            self.logger.info('Intensity data scaled using %s' % scaling)
-                        elif scaling == 'med':
-                            scaled_intensities = feature_intensities / (np.median(feature_intensities,axis=0) + (1 - feature_intensities.min()))
-                            self.logger.info('Intensity data scaled using %s' % scaling)
-                        else:
-                            raise Exception("Unknown scaling method %" % scaling)
-
-                        self.logger.debug('scaled... reconstructing matrix')
-
-                        s = 0
-                        for sample_index in sample_indices:
-                            f = 0
-                            for feature_index in feature_indices:
-                                output_intensity_matrix[sample_index,feature_index] = scaled_intensities[s,f]
-                                f = f + 1
-                            s = s + 1
+        partition = scaling_engine.BlockPartition.from_metadata(sample_metadata,feature_metadata)
+        scaler = scaling_engine.BlockScaler(scaling,max_workers=max_workers,logger=self.logger)
+        output_intensity_matrix = scaler.fit_transform(intensity_data,partition,copy=copy)
 
         self.logger.debug('scaling complete')
 
-        return output_intensity_matrix
+        if return_scaler:
+            return output_intensity_matrix, scaler
+        else:
+            return output_intensity_matrix
 
     def output_files(self,type,key,combined_csv_path,output_dir):
 
@@ -0,0 +1,102 @@
+"""Data exchange between :class:`phenomedb.analysis.RAnalysisTask` and the R templates.
+
+Input frames are written to the job folder as Feather (Arrow IPC), one file per frame, and read in R with
+phenomedb_read_frame() (see r_templates/base.r), so the dtypes are kept rather than guessed from CSV text. The R
+templates write their output back as Feather too: a data frame or matrix output as output.feather, and each data frame
+in a list output as <name>.feather, with the rest of the output in results.json.
+"""
+
+import glob
+import json
+import os
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.feather as feather
+
+#: The column R row names are written to, as jsonlite does
+ROW_NAME_COLUMN = '_row'
+
+
+def to_arrow_frame(dataframe):
+    """Get a copy of a frame that Arrow can write: a default index, string column names, and object columns with
+    mixed types as strings.
+
+    :param dataframe: The frame.
+    :type dataframe: :class:`pandas.DataFrame`
+    :return: The frame to write.
+    :rtype: :class:`pandas.DataFrame`
+    """
+
+    dataframe = pd.DataFrame(dataframe).reset_index(drop=True)
+    dataframe.columns = [str(column) for column in dataframe.columns]
+    for column in dataframe.columns[(dataframe.dtypes == object).to_numpy()]:
+        try:
+            pa.array(dataframe[column], from_pandas=True)
+        except (pa.ArrowInvalid, pa.ArrowTypeError):
+            dataframe[column] = dataframe[column].map(lambda value: str(value) if pd.notnull(value) else None)
+    return dataframe
+
+
+def write_frame(dataframe, file_path):
+    """Write a frame as uncompressed Feather.
+
+    :param dataframe: The frame, or a 2D array.
+    :type dataframe: :class:`pandas.DataFrame` or :class:`numpy.ndarray`
+    :param file_path: The file path.
+    :type file_path: str
+    :return: The file path.
+    :rtype: str
+    """
+
+    feather.write_feather(to_arrow_frame(dataframe), file_path, compression='uncompressed')
+    return file_path
+
+
+def read_frame(file_path):
+    """Read a Feather file as a frame.
+
+    :param file_path: The file path.
+    :type file_path: str
+    :return: The frame.
+    :rtype: :class:`pandas.DataFrame`
+    """
+
+    return feather.read_table(file_path, memory_map=True).to_pandas()
+
+
+def read_results_json(file_path):
+    """Read the results.json of an R template.
+
+    Templates rendered before the Feather exchange wrote the JSON as a string inside a JSON array, which is unwrapped.
+    A string output, ie the path RunXCMS returns, is a JSON array with one string that is not JSON, and is kept as it is.
+
+    :param file_path: The file path.
+    :type file_path: str
+    :return: The results.
+    :rtype: dict or list
+    """
+
+    with open(file_path) as json_file:
+        results = json.load(json_file)
+    if isinstance(results, list) and len(results) == 1:
+        if not isinstance(results[0], str):
+            return results[0]
+        try:
+            return json.loads(results[0])
+        except ValueError:
+            return results
+    return results
+
+
+def read_output_frames(output_folder):
+    """Read the Feather files an R template wrote to the output folder.
+
+    :param output_folder: The output folder.
+    :type output_folder: str
+    :return: The frames by name, the file name without .feather.
+    :rtype: dict
+    """
+
+    return {os.path.basename(file_path)[:-len('.feather')]: read_frame(file_path)
+            for file_path in sorted(glob.glob(os.path.join(output_folder, '*.feather')))}
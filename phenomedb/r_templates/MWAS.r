@@ -1,9 +1,9 @@
 {% extends base_template %}
 ### Algorithm
-## 1. open data csv
+## 1. open data feather
 ## 2. import MWASTools
 ## 3. run MWASTools
-## 4. export results to csv
+## 4. export results to feather
 ### Dependencies:
 ## https://rdrr.io/github/skgrange/threadr/
 ## https://github.com/AndreaRMICL/MWASTools
@@ -14,9 +14,9 @@
 
 #BiocManager::install("MWASTools")
 library('MWASTools')
-intensity_data_frame <- read.csv('{{ data_file_path }}')
+intensity_data_frame <- phenomedb_read_frame('{{ data_file_path }}')
 intensity_data <- data.matrix(intensity_data_frame,rownames.force=TRUE)
-sample_metadata_dataframe <- read.csv('{{ sample_metadata_file_path }}',stringsAsFactors=T)
+sample_metadata_dataframe <- phenomedb_read_frame('{{ sample_metadata_file_path }}',strings_as_factors=TRUE)
 sample_metadata <- data.matrix(sample_metadata_dataframe,rownames.force=TRUE)
 v <- integer(dim(intensity_data)[1])
 se <- MWAS_SummarizedExperiment(intensity_data,sample_metadata,v)
@@ -1,12 +1,42 @@
 #update.packages()
 #install.packages("remotes")
 #remotes::install_github("skgrange/threadr")
+#install.packages("arrow")
 library(threadr)
 library(jsonlite)
+library(arrow)
 output_folder = '{{ output_folder }}'
 setwd('{{ job_folder }}')
+# Input frames are Feather files written by phenomedb.r_bridge. Column names are made syntactic, as read.csv does
+phenomedb_read_frame <- function(file_path, strings_as_factors=FALSE) {
+    frame <- as.data.frame(read_feather(file_path))
+    names(frame) <- make.names(names(frame), unique=TRUE)
+    if (strings_as_factors) {
+        frame[] <- lapply(frame, function(column) if (is.character(column)) factor(column) else column)
+    }
+    frame
+}
+# Output frames are written as Feather, with non-default row names in a _row column as toJSON does
+phenomedb_write_frame <- function(frame, name) {
+    if (is.data.frame(frame) && .row_names_info(frame) > 0) {
+        frame <- cbind(data.frame('_row'=rownames(frame), check.names=FALSE), frame)
+    } else {
+        frame <- as.data.frame(frame)
+        rownames(frame) <- NULL
+    }
+    write_feather(frame, file.path(output_folder, paste0(name, '.feather')), compression='uncompressed')
+}
 {% block methodspecific %}{% endblock %}
-results <- toJSON(output,force=T,digits=NA)
-output_file_path <- paste(output_folder,'results.json',sep='/')
-write_json(results,output_file_path,pretty=F)
+if (is.data.frame(output) || is.matrix(output)) {
+    phenomedb_write_frame(output, 'output')
+    output <- list()
+} else if (is.list(output)) {
+    for (name in names(output)) {
+        if (is.data.frame(output[[name]])) {
+            phenomedb_write_frame(output[[name]], name)
+            output[[name]] <- NULL
+        }
+    }
+}
+write(toJSON(output,force=T,digits=NA), file.path(output_folder,'results.json'))
 summary(output)
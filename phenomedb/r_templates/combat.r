@@ -1,9 +1,9 @@
 {% extends base_template %}
 ### Algorithm
-## 1. open data csv
+## 1. open data feather
 ## 2. import SVA
 ## 3. run ComBat
-## 4. export results to csv
+## 4. export results to feather
 ### Dependencies:
 ## https://rdrr.io/github/skgrange/threadr/
 ## https://github.com/JoeRothwell/pcpr2
@@ -14,9 +14,9 @@
 
 #BiocManager::install("sva")
 library('sva')
-intensity_chardata <- read.csv('{{ intensity_data_file_path }}')
+intensity_chardata <- phenomedb_read_frame('{{ intensity_data_file_path }}')
 intensity_data <- data.matrix(intensity_chardata)
-sample_metadata <- read.csv('{{ sample_metadata_file_path }}',stringsAsFactors=T)
+sample_metadata <- phenomedb_read_frame('{{ sample_metadata_file_path }}',strings_as_factors=TRUE)
 #Y_variable =
 #pheno = pData(dat)
 #edata = exprs(dat)
@@ -1,8 +1,8 @@
 {% extends base_template %}
 ### Algorithm
-## 1. open data csV
+## 1. open data feather
 ## 2. run IARC normalization_residualMixedModels
-## 4. export results to csv
+## 4. export results to feather
 
 # This function is reproduced with permission from https://code.iarc.fr/viallonv/pipeline_biocrates
 # Paper: "A New Pipeline for the Normalization and Pooling of Metabolomics Data"
@@ -200,10 +200,10 @@ library(lme4)
 #intensity_data <- data.matrix(read.csv('{{ intensity_data_file_path }}'))
 #sample_metadata <- read.csv('{{ sample_metadata_file_path }}',stringsAsFactors=T)
 
-data.metabo <- read.csv('{{ metabo_file_path }}')
-others <- read.csv('{{ others_file_path }}',stringsAsFactors=T)
+data.metabo <- phenomedb_read_frame('{{ metabo_file_path }}')
+others <- phenomedb_read_frame('{{ others_file_path }}',strings_as_factors=TRUE)
 #aux <- read.csv('{{ aux_file_path }}',stringsAsFactors=T)
-aux <- read.csv('{{ aux_file_path }}')
+aux <- phenomedb_read_frame('{{ aux_file_path }}')
 #sample_ids <- data.frame('Sample.File.Name'=sample_metadata$Sample.File.Name)
 #data.metabo <- cbind(sample_ids,intensity_data)
 #DATA.Imp <- cbind(sample_ids,intensity_data)
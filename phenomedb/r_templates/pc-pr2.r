@@ -1,9 +1,9 @@
 {% extends base_template %}
 ### Algorithm
-## 1. open data csv
+## 1. open data feather
 ## 2. import pcpr2
 ## 3. run pcpr2
-## 4. export results to csv
+## 4. export results to feather
 ### Dependencies:
 ## https://rdrr.io/github/skgrange/threadr/
 ## https://github.com/JoeRothwell/pcpr2
@@ -12,9 +12,9 @@
 #library(devtools)
 #install_github("JoeRothwell/pcpr2")
 library(pcpr2)
-intensity_chardata <- read.csv('{{ intensity_data_file_path }}')
+intensity_chardata <- phenomedb_read_frame('{{ intensity_data_file_path }}')
 intensity_data <- data.matrix(intensity_chardata)
-sample_metadata <- read.csv('{{ sample_metadata_file_path }}',stringsAsFactors=T)
+sample_metadata <- phenomedb_read_frame('{{ sample_metadata_file_path }}',strings_as_factors=TRUE)
 pct_threshold = {{ pct_threshold }}
 pcpr2 <- try(runPCPR2(intensity_data, sample_metadata, pct.threshold = pct_threshold ))
 if (inherits(pcpr2,"try-error")){
@@ -0,0 +1,43 @@
+# R worker for phenomedb.r_worker_pool
+## Loads the packages given as arguments once, then runs the rendered task scripts it is sent on stdin,
+## one JSON line per job: {"script_path": ..., "job_folder": ..., "out_path": ...}.
+## The script output goes to out_path, and each job is answered with one marker line on stdout.
+library(jsonlite)
+for (phenomedb_worker_package in commandArgs(trailingOnly=TRUE)) {
+    suppressPackageStartupMessages(require(phenomedb_worker_package, character.only=TRUE))
+}
+phenomedb_worker_folder <- getwd()
+
+phenomedb_worker_respond <- function(status, message='') {
+    cat(paste0('PHENOMEDB_R_WORKER ', toJSON(list(status=status, message=message), auto_unbox=TRUE), '\n'))
+    flush(stdout())
+}
+
+phenomedb_worker_run_job <- function(job) {
+    out <- file(job$out_path, open='wt')
+    sink(out)
+    sink(out, type='message')
+    on.exit({
+        sink(type='message')
+        while (sink.number() > 0) sink()
+        close(out)
+        setwd(phenomedb_worker_folder)
+    })
+    tryCatch({
+        setwd(job$job_folder)
+        # Each job gets its own environment, so nothing is left over from the previous job
+        source(job$script_path, local=new.env(parent=globalenv()), echo=TRUE, max.deparse.length=Inf)
+        list(status='success', message='')
+    }, error=function(err) {
+        print(err)
+        list(status='error', message=conditionMessage(err))
+    })
+}
+
+phenomedb_worker_respond('ready')
+phenomedb_worker_input <- file('stdin', open='r')
+while (length(phenomedb_worker_line <- readLines(phenomedb_worker_input, n=1)) > 0) {
+    phenomedb_worker_response <- phenomedb_worker_run_job(fromJSON(phenomedb_worker_line))
+    invisible(gc())
+    phenomedb_worker_respond(phenomedb_worker_response$status, phenomedb_worker_response$message)
+}
@@ -0,0 +1,433 @@
+"""Pooled R execution for :class:`phenomedb.analysis.RAnalysisTask`.
+
+Starting Rscript and loading the packages (MWASTools, threadr, ...) takes seconds for every task. The R worker pool
+server keeps long-lived R workers (r_templates/worker.r) with the packages already loaded, and runs the rendered task
+scripts in them. Start it with:
+
+    python -m phenomedb.r_worker_pool
+
+Tasks send their jobs to the server over a local unix socket, one JSON line per job. When the R backend is 'pool' but
+no server is running, :func:`run_script` returns None and the task runs its script with Rscript instead. The socket is
+only accessible to the server's user (pool_socket_mode), as its jobs run any script path they are sent.
+
+To compare the per-task latency of the pool against Rscript:
+
+    python -m phenomedb.r_worker_pool --benchmark 10
+"""
+
+import argparse
+import json
+import os
+import pathlib
+import queue
+import socket
+import socketserver
+import subprocess
+import tempfile
+import threading
+import time
+
+from phenomedb.config import config
+from phenomedb.utilities import configure_logging
+
+#: The prefix of the lines the R workers answer with. Other lines on their stdout are ignored
+WORKER_MARKER = 'PHENOMEDB_R_WORKER '
+WORKER_SCRIPT_PATH = str(pathlib.Path(__file__).parent.absolute()) + '/r_templates/worker.r'
+
+
+def get_socket_path():
+    """Get the path of the R worker pool socket.
+
+    :return: The socket path.
+    :rtype: str
+    """
+
+    return config['R'].get('pool_socket', '/tmp/phenomedb/r_worker_pool.sock')
+
+
+def get_socket_mode():
+    """Get the permissions of the R worker pool socket.
+
+    :return: The mode, defaults to 0o600 (the server's user only).
+    :rtype: int
+    """
+
+    return int(config['R'].get('pool_socket_mode', '600'), 8)
+
+
+def get_timeout():
+    """Get the seconds a job can take on the R worker pool.
+
+    :return: The seconds, or None for no limit.
+    :rtype: float
+    """
+
+    timeout = float(config['R'].get('pool_timeout', '3600'))
+    return timeout if timeout > 0 else None
+
+
+def get_packages():
+    """Get the packages the R workers preload.
+
+    :return: The package names.
+    :rtype: list
+    """
+
+    return [package.strip() for package in config['R'].get('pool_packages', 'threadr,jsonlite,arrow').split(',') if package.strip()]
+
+
+class RWorker:
+    """A long-lived R process running r_templates/worker.r.
+
+    :param packages: The packages to preload.
+    :type packages: list
+    :param rscript: The Rscript executable, defaults to 'Rscript'.
+    :type rscript: str, optional
+    :param timeout: The seconds to wait for start-up or a job before killing the worker, defaults to None (no limit).
+    :type timeout: float, optional
+    """
+
+    def __init__(self, packages, rscript='Rscript', timeout=None):
+
+        self.packages = list(packages)
+        self.rscript = rscript
+        self.timeout = timeout
+        self.process = None
+        self.jobs = 0
+
+    def start(self):
+        """Start the R process and wait until the packages are loaded.
+        """
+
+        self.process = subprocess.Popen([self.rscript, '--no-save', WORKER_SCRIPT_PATH] + self.packages,
+                                        stdin=subprocess.PIPE, stdout=subprocess.PIPE, universal_newlines=True, bufsize=1)
+        self.jobs = 0
+        response = self.read_response()
+        if response['status'] != 'ready':
+            raise Exception("R worker did not start: %s" % response)
+
+    def stop(self):
+        """Stop the R process.
+        """
+
+        if self.is_alive():
+            self.process.kill()
+            self.process.wait()
+
+    def is_alive(self):
+        """Whether the R process is running.
+
+        :return: True if it is running.
+        :rtype: bool
+        """
+
+        return self.process is not None and self.process.poll() is None
+
+    def run(self, script_path, job_folder, out_path):
+        """Run a script.
+
+        :param script_path: The path of the R script.
+        :type script_path: str
+        :param job_folder: The folder to run it in.
+        :type job_folder: str
+        :param out_path: The path to write the R output to.
+        :type out_path: str
+        :return: The response, with status ('success' or 'error') and message.
+        :rtype: dict
+        """
+
+        self.process.stdin.write(json.dumps({'script_path': script_path, 'job_folder': job_folder, 'out_path': out_path}) + '\n')
+        self.process.stdin.flush()
+        self.jobs = self.jobs + 1
+        return self.read_response()
+
+    def read_response(self):
+        """Read the next response of the R process, killing it if it takes longer than the timeout.
+
+        :return: The response.
+        :rtype: dict
+        """
+
+        timer = None
+        if self.timeout:
+            timer = threading.Timer(self.timeout, self.stop)
+            timer.start()
+        try:
+            while True:
+                line = self.process.stdout.readline()
+                if line == '':
+                    raise Exception("R worker exited with code %s" % self.process.wait())
+                if line.startswith(WORKER_MARKER):
+                    return json.loads(line[len(WORKER_MARKER):])
+        finally:
+            if timer:
+                timer.cancel()
+
+
+class RWorkerPool:
+    """A pool of R workers. Each job takes an idle worker, or waits for one.
+
+    Workers that have died are restarted, and workers are restarted after max_jobs_per_worker jobs to release the
+    memory R holds on to.
+
+    :param size: The number of workers.
+    :type size: int
+    :param packages: The packages to preload.
+    :type packages: list
+    :param max_jobs_per_worker: The jobs a worker runs before it is restarted, defaults to 50.
+    :type max_jobs_per_worker: int, optional
+    :param rscript: The Rscript executable, defaults to 'Rscript'.
+    :type rscript: str, optional
+    :param timeout: The seconds a job can take, defaults to None (no limit).
+    :type timeout: float, optional
+    """
+
+    def __init__(self, size, packages, max_jobs_per_worker=50, rscript='Rscript', timeout=None):
+
+        self.max_jobs_per_worker = max_jobs_per_worker
+        self.workers = [RWorker(packages, rscript=rscript, timeout=timeout) for i in range(size)]
+        self.idle_workers = queue.Queue()
+        for worker in self.workers:
+            self.idle_workers.put(worker)
+
+    def start(self):
+        """Start the workers, so the packages are loaded before the first job.
+        """
+
+        for worker in self.workers:
+            worker.start()
+
+    def stop(self):
+        """Stop the workers.
+        """
+
+        for worker in self.workers:
+            worker.stop()
+
+    def run(self, script_path, job_folder, out_path):
+        """Run a script on an idle worker.
+
+        :param script_path: The path of the R script.
+        :type script_path: str
+        :param job_folder: The folder to run it in.
+        :type job_folder: str
+        :param out_path: The path to write the R output to.
+        :type out_path: str
+        :return: The response, with status ('success' or 'error') and message.
+        :rtype: dict
+        """
+
+        worker = self.idle_workers.get()
+        try:
+            if not worker.is_alive() or worker.jobs >= self.max_jobs_per_worker:
+                worker.stop()
+                worker.start()
+            return worker.run(script_path, job_folder, out_path)
+        except Exception as err:
+            worker.stop()
+            return {'status': 'error', 'message': str(err)}
+        finally:
+            self.idle_workers.put(worker)
+
+
+class RWorkerPoolRequestHandler(socketserver.StreamRequestHandler):
+    """Runs one job, sent as a JSON line, and answers with the response as a JSON line.
+    """
+
+    def handle(self):
+
+        line = self.rfile.readline()
+        if not line:
+            # A connection from is_running()
+            return
+        job = json.loads(line)
+        started = time.time()
+        response = self.server.pool.run(job['script_path'], job['job_folder'], job['out_path'])
+        response['seconds'] = time.time() - started
+        self.server.logger.info("R job %s %s in %.2fs %s" % (job['script_path'], response['status'], response['seconds'], response['message']))
+        try:
+            self.wfile.write((json.dumps(response) + '\n').encode())
+        except BrokenPipeError:
+            self.server.logger.info("R job %s client timed out before the response" % job['script_path'])
+
+
+class RWorkerPoolServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """Serves an :class:`RWorkerPool` on a unix socket.
+
+    The socket is bound with the socket_mode permissions, and its directory, if the server creates it, is only
+    accessible to the server's user.
+
+    :param socket_path: The socket path.
+    :type socket_path: str
+    :param pool: The pool.
+    :type pool: :class:`RWorkerPool`
+    :param socket_mode: The permissions of the socket, defaults to None (from the config).
+    :type socket_mode: int, optional
+    """
+
+    daemon_threads = True
+
+    def __init__(self, socket_path, pool, socket_mode=None):
+
+        if os.path.exists(socket_path):
+            if is_running(socket_path):
+                raise Exception("R worker pool already running on %s" % socket_path)
+            os.remove(socket_path)
+        socket_folder = os.path.dirname(socket_path)
+        if not os.path.exists(socket_folder):
+            os.makedirs(socket_folder, mode=0o700)
+            os.chmod(socket_folder, 0o700)
+
+        self.pool = pool
+        self.socket_mode = socket_mode if socket_mode is not None else get_socket_mode()
+        self.logger = configure_logging(identifier='r_worker_pool')
+        super().__init__(socket_path, RWorkerPoolRequestHandler)
+
+    def server_bind(self):
+        """Bind the socket, with no permissions beyond socket_mode between the bind and the chmod.
+        """
+
+        umask = os.umask(0o777 & ~self.socket_mode)
+        try:
+            super().server_bind()
+        finally:
+            os.umask(umask)
+        os.chmod(self.server_address, self.socket_mode)
+
+
+def is_running(socket_path=None):
+    """Whether an R worker pool server is running.
+
+    :param socket_path: The socket path, defaults to None (from the config).
+    :type socket_path: str, optional
+    :return: True if a server accepts connections on the socket.
+    :rtype: bool
+    """
+
+    if not socket_path:
+        socket_path = get_socket_path()
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection:
+        try:
+            connection.connect(socket_path)
+            return True
+        except (FileNotFoundError, ConnectionRefusedError):
+            return False
+
+
+def run_script(script_path, job_folder, out_path, socket_path=None, timeout=None):
+    """Run a script on the R worker pool server.
+
+    If the server does not answer within the timeout, which includes waiting for an idle worker, the job is reported
+    as an error rather than run again with Rscript.
+
+    :param script_path: The path of the R script.
+    :type script_path: str
+    :param job_folder: The folder to run it in.
+    :type job_folder: str
+    :param out_path: The path to write the R output to.
+    :type out_path: str
+    :param socket_path: The socket path, defaults to None (from the config).
+    :type socket_path: str, optional
+    :param timeout: The seconds to wait for the response, defaults to None (the pool_timeout from the config).
+    :type timeout: float, optional
+    :return: The response, with status ('success' or 'error'), message, and seconds, or None if no server is running.
+    :rtype: dict
+    """
+
+    if not socket_path:
+        socket_path = get_socket_path()
+    if timeout is None:
+        timeout = get_timeout()
+    started = time.time()
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection:
+        connection.settimeout(timeout)
+        try:
+            connection.connect(socket_path)
+        except (FileNotFoundError, ConnectionRefusedError):
+            return None
+        try:
+            connection.sendall((json.dumps({'script_path': script_path, 'job_folder': job_folder, 'out_path': out_path}) + '\n').encode())
+            response = connection.makefile('r').readline()
+        except socket.timeout:
+            return {'status': 'error', 'message': "R worker pool job timed out after %ss" % timeout,
+                    'seconds': time.time() - started}
+    if response == '':
+        # The server stopped while running the job
+        return None
+    return json.loads(response)
+
+
+def benchmark(runs=10, packages=None, socket_path=None):
+    """Compare the per-task latency of the R worker pool server against Rscript.
+
+    Each task is a script that loads the preloaded packages and writes a results.json, like the rendered templates.
+
+    :param runs: The number of tasks to time on each backend, defaults to 10.
+    :type runs: int, optional
+    :param packages: The packages the script loads, defaults to None (the pool packages from the config).
+    :type packages: list, optional
+    :param socket_path: The socket path, defaults to None (from the config).
+    :type socket_path: str, optional
+    :return: The mean, min, and max seconds per task of 'subprocess' and 'pool'.
+    :rtype: dict
+    """
+
+    if packages is None:
+        packages = get_packages()
+    if not is_running(socket_path):
+        raise Exception("R worker pool is not running")
+
+    job_folder = tempfile.mkdtemp(prefix='r_worker_pool_benchmark_') + '/'
+    script_path = job_folder + 'script.R'
+    out_path = script_path + 'out'
+    with open(script_path, 'w') as script_file:
+        script_file.write("".join("library('%s')\n" % package for package in packages))
+        script_file.write("library(jsonlite)\noutput <- list(mean=mean(rnorm(1000)))\n")
+        script_file.write("write_json(toJSON(output),'%sresults.json')\n" % job_folder)
+
+    seconds = {'subprocess': [], 'pool': []}
+    for i in range(runs):
+        started = time.time()
+        subprocess.check_output(['Rscript', '--no-save', script_path], cwd=job_folder, stderr=subprocess.STDOUT)
+        seconds['subprocess'].append(time.time() - started)
+
+        started = time.time()
+        response = run_script(script_path, job_folder, out_path, socket_path=socket_path)
+        seconds['pool'].append(time.time() - started)
+        if response is None or response['status'] != 'success':
+            raise Exception("R worker pool job failed: %s" % response)
+
+    return {backend: {'mean': sum(times) / len(times), 'min': min(times), 'max': max(times)}
+            for backend, times in seconds.items()}
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description='Run the R worker pool server for RAnalysisTasks')
+    parser.add_argument('--socket_path', default=get_socket_path(), help='the unix socket to listen on')
+    parser.add_argument('--size', type=int, default=int(config['R'].get('pool_size', '2')), help='the number of R workers')
+    parser.add_argument('--benchmark', type=int, metavar='RUNS',
+                        help='compare the per-task latency of a running server against Rscript, over RUNS tasks')
+    args = parser.parse_args()
+
+    if args.benchmark:
+        for backend, seconds in benchmark(runs=args.benchmark, socket_path=args.socket_path).items():
+            print("%s: mean %.3fs min %.3fs max %.3fs per task" % (backend, seconds['mean'], seconds['min'], seconds['max']))
+        return
+
+    pool = RWorkerPool(args.size, get_packages(),
+                       max_jobs_per_worker=int(config['R'].get('pool_max_jobs_per_worker', '50')),
+                       timeout=get_timeout())
+    server = RWorkerPoolServer(args.socket_path, pool)
+    pool.start()
+    server.logger.info("R worker pool with %s workers listening on %s" % (args.size, args.socket_path))
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        pool.stop()
+        os.remove(args.socket_path)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,204 @@
+"""Block scaling. Scales an intensity matrix separately per project x assay x annotation method block.
+
+The block partition is computed once, as integer sample and feature index arrays, and each block is scaled with
+fancy-indexed NumPy assignment into the intensity matrix. Blocks do not overlap, so they can be scaled across a thread
+pool. The fitted parameters of each block are kept, so the same scaling can be reapplied to new samples.
+
+Scaling methods, each (x - shift) / scale per feature:
+
+- mc: mean centring, shift = mean, scale = 1
+- uv: unit variance, shift = mean, scale = std
+- pa: Pareto, shift = mean, scale = sqrt(std)
+- med: median, shift = 0, scale = median + (1 - block minimum)
+
+The integer pyChemometrics scaling powers 0, 1 and 2 are also accepted, shift = mean, scale = std ** power.
+"""
+
+import logging
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+SCALING_METHODS = ['uv', 'mc', 'pa', 'med']
+
+#: Scaling method -> power of the standard deviation
+SCALE_POWERS = {'mc': 0, 'uv': 1, 'pa': 0.5}
+
+
+def get_scale_power(scaling):
+    """Get the standard deviation power of a scaling method.
+
+    :param scaling: The scaling method, 'mc', 'uv' or 'pa', or a pyChemometrics scaling power 0, 1 or 2.
+    :type scaling: str or int
+    :raises Exception: If the scaling method is not known.
+    :return: The power.
+    :rtype: float
+    """
+
+    if scaling in SCALE_POWERS.keys():
+        return SCALE_POWERS[scaling]
+    elif not isinstance(scaling, str) and scaling in [0, 1, 2]:
+        return scaling
+    else:
+        raise Exception("Unknown scaling method %s" % scaling)
+
+
+class BlockPartition:
+    """The project x assay x annotation method blocks of an intensity matrix.
+
+    :param blocks: (project, assay, annotation_method) -> (sample indices, feature indices)
+    :type blocks: :class:`collections.OrderedDict`
+    """
+
+    def __init__(self, blocks):
+        self.blocks = blocks
+
+    @classmethod
+    def from_metadata(cls, sample_metadata, feature_metadata, sample_column='Project',
+                      feature_columns=('assay', 'annotation_method')):
+        """Build the partition from the sample and feature metadata.
+
+        :param sample_metadata: The sample metadata, one row per intensity matrix row.
+        :type sample_metadata: :class:`pandas.DataFrame`
+        :param feature_metadata: The feature metadata, one row per intensity matrix column.
+        :type feature_metadata: :class:`pandas.DataFrame`
+        :param sample_column: The sample metadata column to partition by, defaults to 'Project'
+        :type sample_column: str, optional
+        :param feature_columns: The feature metadata columns to partition by, defaults to ('assay', 'annotation_method')
+        :type feature_columns: tuple, optional
+        :return: The partition.
+        :rtype: :class:`BlockPartition`
+        """
+
+        sample_groups = pd.Series(np.arange(sample_metadata.shape[0])).groupby(
+            sample_metadata[sample_column].to_numpy(), sort=False).indices
+        feature_groups = pd.Series(np.arange(feature_metadata.shape[0])).groupby(
+            [feature_metadata[column].to_numpy() for column in feature_columns], sort=False).indices
+
+        blocks = OrderedDict()
+        for project, sample_indices in sample_groups.items():
+            for feature_key, feature_indices in feature_groups.items():
+                if not isinstance(feature_key, tuple):
+                    feature_key = (feature_key,)
+                blocks[(project,) + feature_key] = (np.asarray(sample_indices), np.asarray(feature_indices))
+        return cls(blocks)
+
+
+class BlockScaler:
+    """Fits and applies per-block scaling.
+
+    :param scaling: The scaling method, see :data:`SCALING_METHODS`
+    :type scaling: str or int
+    :param max_workers: The number of threads to scale blocks across, defaults to 1 (no thread pool)
+    :type max_workers: int, optional
+    :param logger: The logger, defaults to None
+    :type logger: :class:`logging.Logger`, optional
+    """
+
+    def __init__(self, scaling, max_workers=1, logger=None):
+        if scaling != 'med':
+            get_scale_power(scaling)
+        self.scaling = scaling
+        self.max_workers = max_workers
+        self.logger = logger if logger is not None else logging.getLogger(__name__)
+        #: (project, assay, annotation_method) -> {'feature_indices','shift','scale'}
+        self.params = OrderedDict()
+
+    def fit_block(self, intensities):
+        """Fit the scaling parameters of a block.
+
+        :param intensities: The samples x features intensities of the block.
+        :type intensities: :class:`numpy.ndarray`
+        :return: The per-feature shift and scale.
+        :rtype: tuple(:class:`numpy.ndarray`, :class:`numpy.ndarray`)
+        """
+
+        if self.scaling == 'med':
+            shift = np.zeros(intensities.shape[1])
+            scale = np.median(intensities, axis=0) + (1 - intensities.min())
+        else:
+            shift = np.nanmean(intensities, axis=0)
+            std = np.nanstd(intensities, axis=0)
+            # As sklearn/pyChemometrics, constant features are not scaled
+            std[std == 0] = 1
+            scale = std ** get_scale_power(self.scaling)
+        return shift, scale
+
+    def apply(self, intensity_data, partition, fit, copy=False):
+        """Fit and/or apply the scaling of each block.
+
+        :param intensity_data: The samples x features intensity matrix.
+        :type intensity_data: :class:`numpy.ndarray`
+        :param partition: The block partition of the matrix.
+        :type partition: :class:`BlockPartition`
+        :param fit: Whether to fit the parameters, or use the fitted ones.
+        :type fit: bool
+        :param copy: Whether to scale a copy, defaults to False (scaled in place)
+        :type copy: bool, optional
+        :raises Exception: If not fitting and a block has no fitted parameters.
+        :return: The scaled intensity matrix.
+        :rtype: :class:`numpy.ndarray`
+        """
+
+        if copy or not np.issubdtype(intensity_data.dtype, np.floating):
+            intensity_data = intensity_data.astype(float)
+
+        def scale_block(item):
+            block_key, (sample_indices, feature_indices) = item
+            if len(sample_indices) == 0 or len(feature_indices) == 0:
+                return
+            index = np.ix_(sample_indices, feature_indices)
+            intensities = intensity_data[index]
+            if fit:
+                shift, scale = self.fit_block(intensities)
+                self.params[block_key] = {'feature_indices': feature_indices, 'shift': shift, 'scale': scale}
+            elif block_key in self.params:
+                shift, scale = self.params[block_key]['shift'], self.params[block_key]['scale']
+            else:
+                raise Exception("No fitted scaling parameters for block %s" % (block_key,))
+            intensity_data[index] = (intensities - shift) / scale
+            self.logger.debug("scaled %s %s x %s" % (block_key, len(sample_indices), len(feature_indices)))
+
+        if self.max_workers and self.max_workers > 1:
+            with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                # list() raises any exception from the workers
+                list(executor.map(scale_block, partition.blocks.items()))
+        else:
+            for item in partition.blocks.items():
+                scale_block(item)
+
+        self.logger.info('Intensity data scaled using %s, %s blocks' % (self.scaling, len(partition.blocks)))
+        return intensity_data
+
+    def fit_transform(self, intensity_data, partition, copy=False):
+        """Fit the scaling of each block and scale it.
+
+        :param intensity_data: The samples x features intensity matrix.
+        :type intensity_data: :class:`numpy.ndarray`
+        :param partition: The block partition of the matrix.
+        :type partition: :class:`BlockPartition`
+        :param copy: Whether to scale a copy, defaults to False (scaled in place)
+        :type copy: bool, optional
+        :return: The scaled intensity matrix.
+        :rtype: :class:`numpy.ndarray`
+        """
+
+        self.params = OrderedDict()
+        return self.apply(intensity_data, partition, fit=True, copy=copy)
+
+    def transform(self, intensity_data, partition, copy=False):
+        """Scale new samples with the fitted parameters. The features must be in the same order as when fitted.
+
+        :param intensity_data: The samples x features intensity matrix.
+        :type intensity_data: :class:`numpy.ndarray`
+        :param partition: The block partition of the matrix.
+        :type partition: :class:`BlockPartition`
+        :param copy: Whether to scale a copy, defaults to False (scaled in place)
+        :type copy: bool, optional
+        :return: The scaled intensity matrix.
+        :rtype: :class:`numpy.ndarray`
+        """
+
+        return self.apply(intensity_data, partition, fit=False, copy=copy)
@@ -0,0 +1,297 @@
+"""SavedQuery summary statistics.
+
+The matching SampleAssay ids are selected once, as a CTE, and the statistics are computed per Project with grouping
+sets over that CTE in three queries: the SampleAssay counts, the AnnotatedFeature counts, and the metadata value
+counts. The per-project summaries are then combined into the summary.
+
+Every Sample, Subject and MetadataValue belongs to one Project, so the summary of a query is exactly the combination of
+its per-project summaries, and the summaries of the projects that have changed can be recomputed on their own. The
+projects that have changed are found from their fingerprints, the counts and maximum ids of their rows.
+"""
+
+import copy
+
+from sqlalchemy import func, select, tuple_
+
+from phenomedb.models import Assay, AnnotatedFeature, FeatureDataset, FeatureMetadata, HarmonisedMetadataField, \
+    MetadataField, MetadataValue, Project, Sample, SampleAssay, Subject
+
+COUNT_FIELDS = ['number_of_sample_assays', 'number_samples', 'number_subjects', 'number_of_annotated_features']
+
+VALUE_COUNT_FIELDS = ['assay_counts', 'sample_matrix_counts', 'sample_type_counts']
+
+METADATA_COUNT_FIELDS = {'metadata_counts_raw': MetadataValue.raw_value,
+                         'metadata_counts_harmonised_text': MetadataValue.harmonised_text_value,
+                         'metadata_counts_harmonised_numeric': MetadataValue.harmonised_numeric_value,
+                         'metadata_counts_harmonised_datetime': MetadataValue.harmonised_datetime_value}
+
+
+def get_grouping_id(grouped_columns, columns):
+    """Get the Postgres GROUPING() value of a grouping set, 1 bits for the columns not grouped, first column highest.
+
+    :param grouped_columns: The columns of the grouping set.
+    :type grouped_columns: list
+    :param columns: The GROUPING() arguments.
+    :type columns: list
+    :return: The GROUPING() value.
+    :rtype: int
+    """
+
+    grouping_id = 0
+    for column in columns:
+        grouping_id = (grouping_id << 1) | (0 if any(column is grouped for grouped in grouped_columns) else 1)
+    return grouping_id
+
+
+def get_empty_project_summary():
+    """Get an empty per-project summary.
+
+    :return: The per-project summary.
+    :rtype: dict
+    """
+
+    project_summary = {field: 0 for field in COUNT_FIELDS}
+    project_summary['min_annotated_feature_count'] = None
+    for field in VALUE_COUNT_FIELDS + list(METADATA_COUNT_FIELDS.keys()):
+        project_summary[field] = {}
+    return project_summary
+
+
+def build_sample_assay_ids_cte(sample_assay_ids_select, projects=None):
+    """Build the CTE of matching SampleAssay ids, with their project.
+
+    :param sample_assay_ids_select: The select of the matching SampleAssay ids.
+    :type sample_assay_ids_select: :class:`sqlalchemy.sql.Select`
+    :param projects: The project names to restrict to, defaults to None (all projects)
+    :type projects: list, optional
+    :return: The CTE, with sample_assay_id, sample_id, subject_id and project columns.
+    :rtype: :class:`sqlalchemy.sql.expression.CTE`
+    """
+
+    ids = sample_assay_ids_select.order_by(None).subquery('matching_ids')
+    statement = select(SampleAssay.id.label('sample_assay_id'), SampleAssay.sample_id.label('sample_id'),
+                       Sample.subject_id.label('subject_id'), Project.name.label('project')) \
+        .join(ids, ids.c.id == SampleAssay.id) \
+        .join(Sample, SampleAssay.sample_id == Sample.id) \
+        .join(Subject, Sample.subject_id == Subject.id) \
+        .join(Project, Subject.project_id == Project.id)
+    if projects is not None:
+        statement = statement.where(Project.name.in_(projects))
+    return statement.cte('matching_sample_assays')
+
+
+def calculate_project_summaries(db_session, sample_assay_ids_select, projects=None):
+    """Calculate the per-project summaries of the matching SampleAssays.
+
+    :param db_session: The db_session.
+    :type db_session: :class:`sqlalchemy.orm.Session`
+    :param sample_assay_ids_select: The select of the matching SampleAssay ids.
+    :type sample_assay_ids_select: :class:`sqlalchemy.sql.Select`
+    :param projects: The project names to calculate, defaults to None (all projects)
+    :type projects: list, optional
+    :return: project name -> per-project summary
+    :rtype: dict
+    """
+
+    ids = build_sample_assay_ids_cte(sample_assay_ids_select, projects=projects)
+    project_summaries = {}
+
+    def get_project_summary(project):
+        if project not in project_summaries:
+            project_summaries[project] = get_empty_project_summary()
+        return project_summaries[project]
+
+    # 1. SampleAssay, Sample and Subject counts, by project and by assay, sample matrix and sample type
+    grouping_columns = [Assay.name, Sample.sample_matrix, Sample.sample_type]
+    grouping_ids = {get_grouping_id([], grouping_columns): None,
+                    get_grouping_id([Assay.name], grouping_columns): 'assay_counts',
+                    get_grouping_id([Sample.sample_matrix], grouping_columns): 'sample_matrix_counts',
+                    get_grouping_id([Sample.sample_type], grouping_columns): 'sample_type_counts'}
+    statement = select(ids.c.project, Assay.name, Sample.sample_matrix, Sample.sample_type,
+                       func.grouping(*grouping_columns),
+                       func.count(ids.c.sample_assay_id),
+                       func.count(ids.c.sample_id.distinct()),
+                       func.count(ids.c.subject_id.distinct())) \
+        .select_from(ids) \
+        .join(SampleAssay, SampleAssay.id == ids.c.sample_assay_id) \
+        .join(Assay, SampleAssay.assay_id == Assay.id) \
+        .join(Sample, Sample.id == ids.c.sample_id) \
+        .group_by(func.grouping_sets(tuple_(ids.c.project), tuple_(ids.c.project, Assay.name),
+                                     tuple_(ids.c.project, Sample.sample_matrix), tuple_(ids.c.project, Sample.sample_type)))
+    for project, assay, sample_matrix, sample_type, grouping_id, sample_assay_count, sample_count, subject_count \
+            in db_session.execute(statement):
+        project_summary = get_project_summary(project)
+        field = grouping_ids[grouping_id]
+        if field is None:
+            project_summary['number_of_sample_assays'] = sample_assay_count
+            project_summary['number_samples'] = sample_count
+            project_summary['number_subjects'] = subject_count
+        elif field == 'assay_counts':
+            project_summary[field][assay] = sample_assay_count
+        elif field == 'sample_matrix_counts':
+            project_summary[field][sample_matrix] = sample_assay_count
+        elif field == 'sample_type_counts':
+            project_summary[field][sample_type.value if sample_type is not None else None] = sample_assay_count
+
+    # 2. AnnotatedFeature counts, and the minimum number of annotations of a subject
+    subject_counts = select(ids.c.project, ids.c.subject_id,
+                            func.count(AnnotatedFeature.id).label('annotated_feature_count'),
+                            func.count(FeatureMetadata.annotation_id).label('annotation_count')) \
+        .select_from(ids) \
+        .join(AnnotatedFeature, AnnotatedFeature.sample_assay_id == ids.c.sample_assay_id) \
+        .join(FeatureMetadata, AnnotatedFeature.feature_metadata_id == FeatureMetadata.id) \
+        .group_by(ids.c.project, ids.c.subject_id).subquery('subject_counts')
+    statement = select(subject_counts.c.project,
+                       func.sum(subject_counts.c.annotated_feature_count),
+                       func.min(subject_counts.c.annotation_count)) \
+        .group_by(subject_counts.c.project)
+    for project, annotated_feature_count, min_annotation_count in db_session.execute(statement):
+        project_summary = get_project_summary(project)
+        project_summary['number_of_annotated_features'] = int(annotated_feature_count)
+        project_summary['min_annotated_feature_count'] = min_annotation_count
+
+    # 3. Metadata value counts, raw by MetadataField and harmonised by HarmonisedMetadataField
+    grouping_columns = [MetadataField.name, HarmonisedMetadataField.name] + list(METADATA_COUNT_FIELDS.values())
+    grouping_sets = {'metadata_counts_raw': [MetadataField.name, MetadataValue.raw_value]}
+    for field, value_column in METADATA_COUNT_FIELDS.items():
+        if field != 'metadata_counts_raw':
+            grouping_sets[field] = [HarmonisedMetadataField.name, value_column]
+    grouping_ids = {get_grouping_id(columns, grouping_columns): field for field, columns in grouping_sets.items()}
+    statement = select(ids.c.project, *grouping_columns, func.grouping(*grouping_columns),
+                       *[func.count(value_column) for value_column in METADATA_COUNT_FIELDS.values()]) \
+        .select_from(ids) \
+        .join(MetadataValue, MetadataValue.sample_id == ids.c.sample_id) \
+        .join(MetadataField, MetadataValue.metadata_field_id == MetadataField.id) \
+        .outerjoin(HarmonisedMetadataField, MetadataField.harmonised_metadata_field_id == HarmonisedMetadataField.id) \
+        .group_by(func.grouping_sets(*[tuple_(ids.c.project, *columns) for columns in grouping_sets.values()]))
+    for row in db_session.execute(statement):
+        project, field_name, harmonised_field_name = row[0], row[1], row[2]
+        values = dict(zip(METADATA_COUNT_FIELDS.keys(), row[3:7]))
+        counts = dict(zip(METADATA_COUNT_FIELDS.keys(), row[8:12]))
+        field = grouping_ids[row[7]]
+        if field != 'metadata_counts_raw':
+            if harmonised_field_name is None:
+                # MetadataFields that are not harmonised
+                continue
+            field_name = harmonised_field_name
+        if field == 'metadata_counts_harmonised_datetime' and values[field] is None:
+            continue
+        project_summary = get_project_summary(project)
+        project_summary[field].setdefault(field_name, {})[values[field]] = counts[field]
+
+    return project_summaries
+
+
+def combine_project_summaries(project_summaries):
+    """Combine the per-project summaries into the summary.
+
+    :param project_summaries: project name -> per-project summary, see :func:`calculate_project_summaries`
+    :type project_summaries: dict
+    :return: The summary.
+    :rtype: dict
+    """
+
+    summary = {field: 0 for field in COUNT_FIELDS}
+    summary['min_annotated_feature_count'] = None
+    summary['project_counts'] = {}
+    for field in VALUE_COUNT_FIELDS + list(METADATA_COUNT_FIELDS.keys()):
+        summary[field] = {}
+    for field in METADATA_COUNT_FIELDS.keys():
+        if field != 'metadata_counts_raw':
+            summary[field + '_by_project'] = {}
+
+    for project in sorted(project_summaries.keys()):
+        project_summary = project_summaries[project]
+        if project_summary['number_of_sample_assays'] == 0:
+            continue
+
+        for field in COUNT_FIELDS:
+            summary[field] = summary[field] + project_summary[field]
+        if project_summary['min_annotated_feature_count'] is not None:
+            if summary['min_annotated_feature_count'] is None:
+                summary['min_annotated_feature_count'] = project_summary['min_annotated_feature_count']
+            else:
+                summary['min_annotated_feature_count'] = min(summary['min_annotated_feature_count'],
+                                                             project_summary['min_annotated_feature_count'])
+        summary['project_counts'][project] = project_summary['number_of_sample_assays']
+
+        for field in VALUE_COUNT_FIELDS:
+            for value, count in project_summary[field].items():
+                summary[field][value] = summary[field].get(value, 0) + count
+
+        for field in METADATA_COUNT_FIELDS.keys():
+            for field_name, value_counts in project_summary[field].items():
+                field_counts = summary[field].setdefault(field_name, {})
+                for value, count in value_counts.items():
+                    field_counts[value] = field_counts.get(value, 0) + count
+                    if field != 'metadata_counts_raw' and value is not None and value != 'null':
+                        summary[field + '_by_project'].setdefault(field_name, {}).setdefault(project, {})[value] = count
+
+    return summary
+
+
+def calculate_project_fingerprints(db_session):
+    """Calculate the fingerprint of each Project's data, its SampleAssay, MetadataValue and AnnotatedFeature counts and maximum ids.
+
+    A Project whose fingerprint has changed has had rows added or deleted, by a task or otherwise.
+
+    :param db_session: The db_session.
+    :type db_session: :class:`sqlalchemy.orm.Session`
+    :return: project name -> [SampleAssay count, max id, MetadataValue count, max id, AnnotatedFeature count, max id]
+    :rtype: dict
+    """
+
+    statements = [select(Project.name, func.count(SampleAssay.id), func.max(SampleAssay.id))
+                      .join(Subject, Subject.project_id == Project.id)
+                      .join(Sample, Sample.subject_id == Subject.id)
+                      .join(SampleAssay, SampleAssay.sample_id == Sample.id),
+                  select(Project.name, func.count(MetadataValue.id), func.max(MetadataValue.id))
+                      .join(Subject, Subject.project_id == Project.id)
+                      .join(Sample, Sample.subject_id == Subject.id)
+                      .join(MetadataValue, MetadataValue.sample_id == Sample.id),
+                  select(Project.name, func.count(AnnotatedFeature.id), func.max(AnnotatedFeature.id))
+                      .join(FeatureDataset, FeatureDataset.project_id == Project.id)
+                      .join(FeatureMetadata, FeatureMetadata.feature_dataset_id == FeatureDataset.id)
+                      .join(AnnotatedFeature, AnnotatedFeature.feature_metadata_id == FeatureMetadata.id)]
+
+    project_fingerprints = {}
+    for i, statement in enumerate(statements):
+        for project, count, max_id in db_session.execute(statement.group_by(Project.name)):
+            project_fingerprints.setdefault(project, [0, None] * len(statements))[i * 2:i * 2 + 2] = [count, max_id]
+    return project_fingerprints
+
+
+def get_changed_projects(project_fingerprints, cached_project_fingerprints):
+    """Get the Projects whose fingerprints have changed, including those added or removed.
+
+    :param project_fingerprints: The current fingerprints, see :func:`calculate_project_fingerprints`.
+    :type project_fingerprints: dict
+    :param cached_project_fingerprints: The fingerprints when the summaries were calculated.
+    :type cached_project_fingerprints: dict
+    :return: The project names.
+    :rtype: list
+    """
+
+    projects = set(project_fingerprints.keys()) | set(cached_project_fingerprints.keys())
+    return sorted([project for project in projects
+                   if list(project_fingerprints.get(project, [])) != list(cached_project_fingerprints.get(project, []))])
+
+
+def update_project_summaries(project_summaries, updated_project_summaries, projects):
+    """Replace the summaries of the recalculated projects.
+
+    :param project_summaries: The cached per-project summaries.
+    :type project_summaries: dict
+    :param updated_project_summaries: The recalculated per-project summaries.
+    :type updated_project_summaries: dict
+    :param projects: The recalculated projects. Those not in updated_project_summaries no longer match.
+    :type projects: list
+    :return: The updated per-project summaries.
+    :rtype: dict
+    """
+
+    project_summaries = copy.deepcopy(project_summaries)
+    for project in projects:
+        project_summaries.pop(project, None)
+    project_summaries.update(updated_project_summaries)
+    return project_summaries
@@ -14,6 +14,7 @@ import datetime
 import redis
 from phenomedb.config import config
 from phenomedb.exceptions import *
+from phenomedb.task_data import TaskData
 import re
 
 class Task(ABC):
@@ -73,7 +74,7 @@ class Task(ABC):
                      'debug': debug,
                      'upstream_task_run_id':upstream_task_run_id}
         self.validation_failures = []
-        self.data = {}
+        self.data = TaskData()
         self.rerun_task = False     # overwritten in start_task_run if output exists and task_run_id is set
         self.task_run_output = None
 
@@ -445,7 +446,11 @@ class Task(ABC):
         self.task_run.datetime_finished = datetime.datetime.now()
         self.task_run.run_time = (self.task_run.datetime_finished - self.task_run.datetime_started).total_seconds()
         self.task_run.status = status
-        self.task_run.output = utils.convert_to_json_safe(self.clean_data_for_jsonb(self.saved_output))
+        if isinstance(self.saved_output,TaskData):
+            # Kept native, converted to JSON by the views
+            self.task_run.output = self.saved_output
+        else:
+            self.task_run.output = utils.convert_to_json_safe(self.clean_data_for_jsonb(self.saved_output))
         self.cache.set(self.task_run.get_task_output_cache_key(),self.task_run.output)
         self.task_run.output = None
 
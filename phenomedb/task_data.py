@@ -0,0 +1,146 @@
+"""Typed task data.
+
+:class:`TaskData` holds the data a task works on (sample_metadata, feature_metadata, intensity_data, ...) with the
+DataFrames and NumPy arrays kept as they are. Through the :class:`phenomedb.cache.Cache` they are written as Feather and
+NPY blobs (see :class:`phenomedb.cache_serializers.TaskDataSerializer`), so reading them back gives views onto the
+cached buffer rather than rebuilding them from lists and dicts. Conversion to JSON only happens at the web boundary,
+with :meth:`TaskData.to_json_safe`.
+
+Task data cached before this container existed, and JSON task outputs, hold DataFrames as to_dict() dictionaries
+and arrays as nested lists. :meth:`TaskData.get_dataframe` and :meth:`TaskData.get_array` read both forms.
+
+Downstream tasks load only the artefacts they use from upstream task data, by name (see
+:meth:`phenomedb.cache.Cache.get_task_data`); the blobs of the other artefacts are not read.
+"""
+
+import numpy as np
+import pandas as pd
+
+
+class TaskData(dict):
+    """A dictionary of task data, with DataFrames and NumPy arrays stored natively.
+    """
+
+    def get_dataframe(self, key):
+        """Get a DataFrame.
+
+        :param key: The key, ie 'sample_metadata'.
+        :type key: str
+        :return: The DataFrame, the cached one itself if stored natively.
+        :rtype: :class:`pandas.DataFrame`
+        """
+
+        value = self[key]
+        if isinstance(value, pd.DataFrame):
+            return value
+
+        dataframe = pd.DataFrame.from_dict(value)
+        # JSON turns the row index of to_dict() into strings
+        if len(dataframe.index) > 0 and all(isinstance(index, str) and index.isdigit() for index in dataframe.index):
+            dataframe.index = dataframe.index.astype(int)
+        return dataframe
+
+    def get_array(self, key, writable=False):
+        """Get a NumPy array.
+
+        Arrays read from the cache are read-only views onto the cached buffer. Set writable to get a copy that can
+        be changed in place.
+
+        :param key: The key, ie 'intensity_data'.
+        :type key: str
+        :param writable: Whether the array has to be writable, defaults to False.
+        :type writable: bool, optional
+        :return: The array.
+        :rtype: :class:`numpy.ndarray`
+        """
+
+        value = self[key]
+        if isinstance(value, pd.DataFrame):
+            array = value.to_numpy()
+        else:
+            array = np.asarray(value)
+        if array.dtype.hasobject:
+            # Nested lists with None for missing values
+            array = array.astype(float)
+        if writable and not array.flags.writeable:
+            array = array.copy()
+        return array
+
+    def to_json_safe(self):
+        """Convert to JSON-safe values, for the web views.
+
+        DataFrames become to_dict() dictionaries and arrays nested lists, with None for missing and infinite values.
+
+        :return: The JSON-safe dictionary.
+        :rtype: dict
+        """
+
+        from phenomedb import utilities as utils
+
+        return utils.convert_to_json_safe({key: to_json_safe_value(value) for key, value in self.items()})
+
+
+def to_json_safe_value(value):
+    """Convert a DataFrame or NumPy array to its JSON-safe form. Other values are returned as they are.
+
+    :param value: The value.
+    :type value: object
+    :return: The converted value.
+    :rtype: object
+    """
+
+    if isinstance(value, pd.DataFrame):
+        value = value.copy()
+        for column in value.columns:
+            if pd.api.types.is_datetime64_any_dtype(value.dtypes[column]):
+                value[column] = value[column].dt.strftime('%Y-%m-%d %H:%M:%S')
+        value = value.replace([np.inf, -np.inf], np.nan)
+        return value.astype(object).where(pd.notnull(value), None).to_dict()
+
+    elif isinstance(value, np.ndarray):
+        value = np.asarray(value)
+        if value.dtype.kind == 'f':
+            return np.where(np.isfinite(value), value, None).tolist()
+        return value.tolist()
+
+    return value
+
+
+def align_sample_metadata(sample_metadata, untransformed_sample_metadata):
+    """Put the columns a task dropped from the sample metadata back in, from the untransformed sample metadata.
+
+    If the rows match, the columns are joined on the index. Otherwise they are merged on 'Sample File Name' or
+    'Sample ID', and rows without a match get None.
+
+    :param sample_metadata: The transformed sample metadata.
+    :type sample_metadata: :class:`pandas.DataFrame`
+    :param untransformed_sample_metadata: The untransformed sample metadata.
+    :type untransformed_sample_metadata: :class:`pandas.DataFrame`
+    :return: The sample metadata, in the column order of the untransformed sample metadata.
+    :rtype: :class:`pandas.DataFrame`
+    """
+
+    missing_columns = [column for column in untransformed_sample_metadata.columns if column not in sample_metadata.columns]
+    if len(missing_columns) == 0:
+        return sample_metadata
+
+    if sample_metadata.shape[0] == untransformed_sample_metadata.shape[0]:
+        aligned = sample_metadata.join(untransformed_sample_metadata[missing_columns])
+    else:
+        lookup_key = None
+        for column in ['Sample File Name', 'Sample ID']:
+            if column in sample_metadata.columns and column in untransformed_sample_metadata.columns:
+                lookup_key = column
+                break
+
+        if lookup_key:
+            lookup = untransformed_sample_metadata[[lookup_key] + missing_columns].drop_duplicates(lookup_key)
+            aligned = sample_metadata.merge(lookup, on=lookup_key, how='left')
+            aligned.index = sample_metadata.index
+        else:
+            aligned = sample_metadata.assign(**{column: None for column in missing_columns})
+
+        columns = list(untransformed_sample_metadata.columns)
+        aligned = aligned[columns + [column for column in aligned.columns if column not in columns]]
+
+    return aligned
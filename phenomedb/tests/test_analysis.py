@@ -239,9 +239,9 @@ class TestAnalysisTasks:
         task_run = db_session.query(TaskRun).filter(TaskRun.class_name == 'RunPCA').first()
         data_dict = cache.get(task_run.get_task_data_cache_key())
 
-        intensity_data = np.matrix(data_dict['intensity_data'])
-        sample_metadata = pd.DataFrame.from_dict(data_dict['sample_metadata'])
-        feature_metadata = pd.DataFrame.from_dict(data_dict['feature_metadata'])
+        intensity_data = np.asmatrix(data_dict.get_array('intensity_data'))
+        sample_metadata = data_dict.get_dataframe('sample_metadata')
+        feature_metadata = data_dict.get_dataframe('feature_metadata')
         # query_factory.build_intensity_data_sample_metadata_and_feature_metadata()
         combined = utils.build_combined_dataframe_from_seperate(
             intensity_data,
@@ -275,6 +275,39 @@ class TestAnalysisTasks:
         task2.run()
         print("task: %s" % task2.task_run.id)
 
+    def test_mwas_python_backend(self,create_min_database,
+                         create_pipeline_testing_project,
+                         create_lab,
+                         create_nmr_assays,
+                         create_annotation_methods,
+                         import_devset_sample_manifest,
+                         import_devset_ivdr_bilisa_annotations,
+                         create_age_sex_harmonised_fields,
+                         dummy_harmonise_annotations,
+                         create_saved_queries):
+        saved_query = test_db_session.query(SavedQuery).filter(SavedQuery.name == 'test_query_lpos').first()
+
+        for method in ['linear','pearson','spearman']:
+            task_r = RunMWAS(saved_query_id=saved_query.id,correction_type='SR',scaling='uv',transform='log',method=method,
+                             model_Y_variable='h_metadata::Age',model_X_variables=['h_metadata::Sex'],backend='R')
+            task_r.run()
+            task_python = RunMWAS(saved_query_id=saved_query.id,correction_type='SR',scaling='uv',transform='log',method=method,
+                                  model_Y_variable='h_metadata::Age',model_X_variables=['h_metadata::Sex'],backend='python')
+            task_python.run()
+
+            r_results = task_r.saved_output.get_dataframe('mwas_results').set_index('_row')
+            python_results = task_python.saved_output.get_dataframe('mwas_results').set_index('_row')
+            assert sorted(r_results.index) == sorted(python_results.index)
+            python_results = python_results.loc[r_results.index]
+            assert np.allclose(python_results['estimates'],r_results['estimates'],rtol=1e-4,atol=1e-8,equal_nan=True)
+            # R's cor.test uses the exact spearman distribution for small samples without ties, here the t approximation
+            rtol = 5e-2 if method == 'spearman' else 1e-4
+            for column in ['pvalues','adjusted_pvalues']:
+                assert np.allclose(python_results[column],r_results[column],rtol=rtol,atol=1e-8,equal_nan=True)
+
+        with pytest.raises(Exception):
+            RunMWAS(saved_query_id=saved_query.id,model_Y_variable='h_metadata::Age',method='logistic',backend='python')
+
     def test_mwas_2_projects(self,create_min_database,
                          create_pipeline_testing_project,
                          create_lab,
@@ -292,9 +325,53 @@ class TestAnalysisTasks:
         task.run()
         print("task: %s" % task.task_run.id)
 
-
-
-
-
-
-
+    def test_r_worker_pool_reuse(self,tmp_path):
+
+        import json
+        import stat
+        import threading
+        from phenomedb import r_worker_pool
+
+        socket_path = str(tmp_path / 'r_worker_pool.sock')
+        pool = r_worker_pool.RWorkerPool(1,['threadr','jsonlite'])
+        server = r_worker_pool.RWorkerPoolServer(socket_path,pool)
+        # Only the server's user can connect
+        assert stat.S_IMODE(os.stat(socket_path).st_mode) == 0o600
+        pool.start()
+        threading.Thread(target=server.serve_forever,daemon=True).start()
+        try:
+            # Each job writes its result and the pid of the R process that ran it
+            pids = []
+            for i in range(3):
+                job_folder = tmp_path / ('job_%s' % i)
+                job_folder.mkdir()
+                script_path = str(job_folder / 'script.R')
+                with open(script_path,'w') as script_file:
+                    script_file.write("library(jsonlite)\n")
+                    script_file.write("write_json(list(pid=Sys.getpid(),value=%s * 2),'results.json',auto_unbox=TRUE)\n" % i)
+                response = r_worker_pool.run_script(script_path,str(job_folder) + '/',script_path + 'out',socket_path=socket_path)
+                assert response['status'] == 'success'
+                with open(str(job_folder / 'results.json')) as results_file:
+                    results = json.load(results_file)
+                assert results['value'] == i * 2
+                pids.append(results['pid'])
+
+            # The same worker served every job, without restarting
+            assert len(set(pids)) == 1
+            assert pool.workers[0].jobs == 3
+            assert pool.workers[0].is_alive()
+
+            failing_script_path = str(tmp_path / 'failing.R')
+            with open(failing_script_path,'w') as script_file:
+                script_file.write("stop('failing job')\n")
+            response = r_worker_pool.run_script(failing_script_path,str(tmp_path),failing_script_path + 'out',socket_path=socket_path)
+            assert response['status'] == 'error'
+            assert 'failing job' in response['message']
+            # the same worker is still usable after a failing job
+            assert r_worker_pool.run_script(script_path,str(job_folder) + '/',script_path + 'out',socket_path=socket_path)['status'] == 'success'
+            with open(str(job_folder / 'results.json')) as results_file:
+                assert json.load(results_file)['pid'] == pids[0]
+        finally:
+            server.shutdown()
+            server.server_close()
+            pool.stop()
@@ -58,6 +58,9 @@ class TestBatchCorrection:
         task = SaveBatchCorrection(correction_data_task_run_id=task.task_run.id,db_env='TEST')
         output = task.run()
 
+        assert output['updated_annotated_features'] > 0
+        assert test_db_session.query(AnnotatedFeature).filter(AnnotatedFeature.sr_corrected_intensity != None).count() > 0
+
      #   task = SaveBatchCorrection(correction_data_task_run_id=task.task_run.id,db_env='TEST')
      #   output = task.run()
 
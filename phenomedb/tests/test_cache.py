@@ -30,11 +30,9 @@ class TestCache:
         # Check the cache directory exists
         assert os.path.exists(self.cache_directory)
 
-        # Check if the file_cache_list is in redis
-        assert self.redis_cache.exists(cache.file_cache_key)
-
-        # Check the file_cache_list has loaded correctly
-        assert cache.file_cache_list is not None
+        # Check the key index is in redis
+        assert self.redis_cache.exists(cache.index_key)
+        assert cache.get_index() is not None
 
     def test_set_dataframe_cache(self,delete_test_cache):
         """Test setting and getting a dataframe in the cache
@@ -58,13 +56,11 @@ class TestCache:
         # Check that the set and got dataframe->to_dict() is the same as the original
         assert df.equals(cache.get(test_key))
 
-        # Check the file cache list has been updated in the Cache object and redis
-        assert self.redis_cache.exists(cache.file_cache_key)
-        assert test_key in cache.file_cache_list
-
-        context = pa.default_serialization_context()
-        file_cache_list = context.deserialize(self.redis_cache.get(cache.file_cache_key))
-        assert test_key in file_cache_list
+        # Check the key index has been updated
+        index_entry = cache.get_index_entry(test_key)
+        assert index_entry['size'] == os.path.getsize(cache.key_file_path(test_key))
+        assert index_entry['format'] == cache.dataframe_format
+        assert test_key in cache.get_keys_dict()
 
         # test cache.exists method
         assert cache.exists(test_key)
@@ -78,9 +74,7 @@ class TestCache:
         # delete the key from both redis and the file cache
         cache.delete(test_key)
 
-        # Todo: test the file and redis cache are deleted
-        file_cache_list = context.deserialize(self.redis_cache.get(cache.file_cache_key))
-        assert test_key not in file_cache_list
+        assert cache.get_index_entry(test_key) is None
 
         assert not os.path.exists(str(Path(self.cache_directory + cache.key_filename(test_key))))
 
@@ -139,6 +133,187 @@ class TestCache:
         assert pd.DataFrame(matrix).equals(pd.DataFrame(cache.get(test_key)))
         cache.delete(test_key)
 
+    def test_dataframe_dtypes_round_trip(self,delete_test_cache):
+        """Test a dataframe keeps its dtypes and index when loaded back from the file cache
+        """
+
+        df = pd.DataFrame({'Sample ID':['s1','s2','s3'],
+                           'Age':[31,45,52],
+                           'BMI':[22.5,np.nan,30.1],
+                           'Acquired Time':pd.to_datetime(['2020-01-01 10:00','2020-01-02 11:00','2020-01-03 12:00']),
+                           'feature':[1.5,'<LLOQ','>ULOQ']},index=[3,5,7])
+
+        cache = Cache()
+        test_key = 'test_dtypes_dataframe'
+        cache.set(test_key,df)
+
+        self.redis_cache.delete(test_key)
+        loaded = cache.get(test_key)
+        pd.testing.assert_frame_equal(df,loaded)
+        assert self.redis_cache.exists(test_key)
+        pd.testing.assert_frame_equal(df,cache.get(test_key))
+
+        numeric = df.drop(columns=['feature'])
+        cache.set(test_key,numeric)
+        with open(cache.key_file_path(test_key),'rb') as f:
+            assert cache_serializers.get_format(f.read()) == cache.dataframe_format
+        self.redis_cache.delete(test_key)
+        pd.testing.assert_frame_equal(numeric,cache.get(test_key))
+
+        cache.delete(test_key)
+
+    def test_ndarray_round_trip(self,delete_test_cache):
+        """Test an intensity matrix is stored as npy and read back from the file cache
+        """
+
+        intensity_data = np.random.rand(20,10)
+        intensity_data[0,0] = np.nan
+
+        cache = Cache()
+        test_key = 'test_intensity_data'
+        cache.set(test_key,intensity_data)
+        self.redis_cache.delete(test_key)
+        loaded = cache.get(test_key)
+        assert cache_serializers.get_format(self.redis_cache.get(test_key)) == 'npy'
+        assert np.array_equal(intensity_data,loaded,equal_nan=True)
+        assert loaded.dtype == intensity_data.dtype
+
+        cache.delete(test_key)
+
+    def test_task_data_round_trip(self,delete_test_cache):
+        """Test task data keeps its DataFrames and arrays native, read back as views onto the cached value
+        """
+
+        from phenomedb.task_data import TaskData
+
+        sample_metadata = pd.DataFrame({'Sample ID':['s1','s2','s3'],
+                                        'Age':[31.0,np.nan,52.0],
+                                        'Acquired Time':pd.to_datetime(['2020-01-01 10:00','2020-01-02 11:00','2020-01-03 12:00'])})
+        intensity_data = np.random.rand(3,4)
+        task_data = TaskData({'sample_metadata':sample_metadata,
+                              'intensity_data':np.asmatrix(intensity_data),
+                              'query_factory_dict':{'model':'AnnotatedFeature'}})
+
+        cache = Cache()
+        test_key = 'test_task_data'
+        cache.set(test_key,task_data)
+        self.redis_cache.delete(test_key)
+        loaded = cache.get(test_key)
+        assert cache_serializers.get_format(self.redis_cache.get(test_key)) == 'taskdat'
+        assert isinstance(loaded,TaskData)
+        assert list(loaded.keys()) == ['sample_metadata','intensity_data','query_factory_dict']
+        pd.testing.assert_frame_equal(sample_metadata,loaded.get_dataframe('sample_metadata'))
+        assert np.array_equal(intensity_data,loaded.get_array('intensity_data'))
+        assert not loaded.get_array('intensity_data').flags.writeable
+        assert loaded.get_array('intensity_data',writable=True).flags.writeable
+        assert loaded['query_factory_dict'] == {'model':'AnnotatedFeature'}
+
+        json_safe = loaded.to_json_safe()
+        assert json_safe['sample_metadata']['Age'] == {'0':31.0,'1':None,'2':52.0}
+        assert len(json_safe['intensity_data']) == 3
+
+        # Task data cached as JSON before TaskData
+        legacy = TaskData(json_safe)
+        assert legacy.get_dataframe('sample_metadata').index.tolist() == [0,1,2]
+        assert np.allclose(legacy.get_array('intensity_data'),intensity_data)
+
+        cache.delete(test_key)
+
+    def test_chunked_redis_value(self,delete_test_cache):
+        """Test large values are written to redis in chunks under a manifest, and read back whole
+        """
+
+        intensity_data = np.random.rand(100,50)
+
+        cache = Cache()
+        cache.redis_chunk_threshold = 10000
+        cache.redis_chunk_size = 3000
+        test_key = 'test_chunked_intensity_data'
+        cache.set(test_key,intensity_data)
+
+        manifest = cache.get_manifest(test_key)
+        chunks = manifest['chunks']
+        assert chunks == int(np.ceil(cache.get_index_entry(test_key)['size'] / 3000))
+        assert all(self.redis_cache.exists(cache.chunk_key(test_key,chunk,manifest['generation'])) for chunk in range(chunks))
+        assert np.array_equal(intensity_data,cache.get(test_key))
+
+        # an overwrite writes a new generation of chunks, and deletes the previous one
+        cache.set(test_key,intensity_data * 2)
+        new_manifest = cache.get_manifest(test_key)
+        assert new_manifest['generation'] != manifest['generation']
+        assert not any(self.redis_cache.exists(cache.chunk_key(test_key,chunk,manifest['generation'])) for chunk in range(chunks))
+        assert np.array_equal(intensity_data * 2,cache.get(test_key))
+
+        # a smaller value replaces the chunks
+        cache.set(test_key,intensity_data[:2,:2])
+        assert cache.get_chunk_count(test_key) == 0
+        assert not self.redis_cache.exists(cache.chunk_key(test_key,0,new_manifest['generation']))
+        assert np.array_equal(intensity_data[:2,:2],cache.get(test_key))
+
+        # an expired chunk falls back to the file
+        cache.set(test_key,intensity_data)
+        manifest = cache.get_manifest(test_key)
+        self.redis_cache.delete(cache.chunk_key(test_key,1,manifest['generation']))
+        assert np.array_equal(intensity_data,cache.get(test_key))
+
+        cache.delete(test_key)
+        assert not any(self.redis_cache.exists(cache.chunk_key(test_key,chunk,manifest['generation'])) for chunk in range(chunks))
+
+    def test_reconcile_index(self,delete_test_cache):
+        """Test the key index picks up files written without it, and drops files removed without it
+        """
+
+        cache = Cache()
+        test_key = 'test_reconcile::dict'
+        cache.set(test_key,{'a':1})
+
+        self.redis_cache.hdel(cache.index_key,test_key)
+        assert cache.get_index_entry(test_key) is None
+        counts = cache.reconcile_index()
+        assert counts['added'] >= 1
+        assert cache.get_index_entry(test_key)['format'] == 'pickle'
+
+        os.remove(cache.key_file_path(test_key))
+        self.redis_cache.delete(test_key)
+        counts = cache.reconcile_index()
+        assert counts['removed'] >= 1
+        assert cache.get_index_entry(test_key) is None
+        assert not cache.exists(test_key)
+
+    def test_quota_eviction(self,delete_test_cache):
+        """Test the least recently used keys are evicted first, and the stats are recorded
+        """
+
+        from phenomedb.cache_policies import QuotaEvictionPolicy, CacheStats
+
+        cache = Cache()
+        keys = ['TaskData::TEST%s' % i for i in range(3)]
+        for key in keys:
+            cache.set(key,np.zeros(1000))
+        # read the first key, so the second is the least recently used
+        cache.get(keys[0])
+        cache.get('TaskData::TESTmissing')
+
+        size = cache.get_index_entry(keys[0])['size']
+        policy = QuotaEvictionPolicy('task_data',memory_quota=size,disk_quota=size*2)
+        # only consider the test keys
+        policy.get_keys = lambda cache: {key: cache.get_index_entry(key) for key in keys}
+        result = policy.apply(cache)
+        assert result['disk_evicted_keys'] == 1
+        assert result['memory_evicted_keys'] == 1
+        assert cache.exists(keys[0])
+        assert not cache.exists(keys[1])
+        # keys[2] is only on disk
+        assert cache.file_exists(keys[2])
+        assert not self.redis_cache.exists(keys[2])
+        assert self.redis_cache.exists(keys[0])
+
+        stats = CacheStats(cache).collect()
+        assert stats['task_data']['redis_hits'] >= 1
+        assert stats['task_data']['misses'] >= 1
+
+        cache.delete_test_keys()
+
     def test_setting_dataframe_without_dataframe_in_key(self,delete_test_cache):
 
         df_dict = {'col1':['col1_row1','col1_row2'],'col2':['col2_row1','col2_row2']}
@@ -179,6 +354,31 @@ class TestCache:
 
         assert cache.get(dataframe_cache_key) is not None
 
+    def test_generate_query_factory_cache_batch(self,delete_test_cache,create_min_database,create_ms_assays,create_annotation_methods):
+
+        from .conftest import import_devset_project_lpos_peakpanther_annotations
+
+        import_devset_project_lpos_peakpanther_annotations("PipelineTesting",validate=False)
+
+        saved_queries = []
+        for assay in ['LPOS','LNEG']:
+            query_factory = QueryFactory(query_name='test_query_%s' % assay.lower(), query_description='test description', db_env='TEST')
+            query_factory.add_filter(
+                query_filter=QueryFilter(model='Project', property='name', operator='eq', value='PipelineTesting'))
+            query_factory.add_filter(query_filter=QueryFilter(model='Assay', property='name', operator='eq', value=assay))
+            saved_queries.append((query_factory, query_factory.save_query()))
+
+        task = CreateSavedQueryDataframeCache(saved_query_ids=",".join(str(saved_query.id) for query_factory, saved_query in saved_queries),
+                                              db_env='TEST')
+        output = task.run()
+        assert output['completed'] == 2
+        assert [saved_query['status'] for saved_query in output['saved_queries']] == ['success','success']
+
+        cache = Cache()
+        for query_factory, saved_query in saved_queries:
+            assert cache.exists(saved_query.get_cache_dataframe_key(
+                query_factory.get_dataframe_key(type='combined',model='AnnotatedFeature',db_env='TEST',harmonise_annotations=True)))
+
     def test_load_from_file(self):
 
         query_factory = QueryFactory(saved_query_id=69)
@@ -243,4 +443,20 @@ class TestCache:
    #     cache = Cache()
    #     prod_db_session = db.get_db_session()
    #     saved_query = prod_db_session.query(SavedQuery).filter(SavedQuery.id==2).first()
-   #     assert cache.exists(saved_query.get_cache_dataframe_key(saved_query.get_dataframe_key('combined',model='AnnotatedFeature')))
\ No newline at end of file
+   #     assert cache.exists(saved_query.get_cache_dataframe_key(saved_query.get_dataframe_key('combined',model='AnnotatedFeature')))
+
+
+class TestCacheBatch:
+    """TestCacheBatch class. Tests the SavedQuery admission of CreateSavedQueryDataframeCache batches
+    """
+
+    def test_get_next_saved_query_id(self):
+
+        estimated_bytes = {1: 600, 2: 500, 3: 300}
+        assert get_next_saved_query_id([1, 2, 3], estimated_bytes, [], memory_budget_bytes=1000) == 1
+        # 2 does not fit alongside 1, 3 does
+        assert get_next_saved_query_id([2, 3], estimated_bytes, [1], memory_budget_bytes=1000) == 3
+        assert get_next_saved_query_id([2], estimated_bytes, [1, 3], memory_budget_bytes=1000) is None
+        # A SavedQuery over the budget still runs, on its own
+        assert get_next_saved_query_id([2], estimated_bytes, [], memory_budget_bytes=100) == 2
+        assert get_next_saved_query_id([2], estimated_bytes, [1, 3]) == 2
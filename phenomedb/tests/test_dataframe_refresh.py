@@ -0,0 +1,56 @@
+import numpy as np
+import pandas as pd
+from phenomedb import dataframe_refresh
+
+
+class TestDataframeRefresh:
+    """TestDataframeRefresh class. Tests the build state and splicing of phenomedb.dataframe_refresh
+    """
+
+    def test_dataframe_refresh(self):
+
+        build_state = dataframe_refresh.get_build_state({1: 10, 2: 20, 3: 30})
+        assert build_state == {'sample_assay_ids': [1, 2, 3], 'annotated_feature_max_id': 30, 'stale_sample_assay_ids': []}
+
+        # 3 removed, 4 added, 2 has new AnnotatedFeatures, 1 unchanged
+        assert dataframe_refresh.get_changed_sample_assay_ids(build_state, {1: 10, 2: 35, 4: 40}) == [2, 3, 4]
+        # Stale SampleAssays from an import, unless they neither match nor were built from
+        build_state = dataframe_refresh.add_stale_sample_assay_ids(build_state, [1, 9])
+        assert build_state['stale_sample_assay_ids'] == [1, 9]
+        assert dataframe_refresh.get_changed_sample_assay_ids(build_state, {1: 10, 2: 20, 3: 30}) == [1]
+
+        dataframe = pd.DataFrame({'Project': ['P', 'P', 'P'], 'Acquired Time': [1, 2, 3], 'Unique Name': ['P-a', 'P-b', 'P-c'],
+                                  'feature:fm:1::A': [1.0, 2.0, 3.0], 'feature:fm:2::A': [np.nan, 5.0, np.nan]})
+        update = pd.DataFrame({'Project': ['P', 'P'], 'Acquired Time': [4, 2], 'Unique Name': ['P-d', 'P-b'],
+                               'feature:fm:1::A': [7.0, 8.0], 'feature:fm:3::A': [9.0, 0.0]})
+
+        spliced = dataframe_refresh.splice_dataframe(dataframe, update, ['P-b', 'P-d'], sort_by=['Project', 'Acquired Time'])
+        # feature:fm:2 only had a value in the replaced row
+        assert list(spliced.columns) == ['Project', 'Acquired Time', 'Unique Name', 'feature:fm:1::A', 'feature:fm:3::A']
+        assert spliced['Unique Name'].tolist() == ['P-a', 'P-b', 'P-c', 'P-d']
+        assert spliced['feature:fm:1::A'].tolist() == [1.0, 8.0, 3.0, 7.0]
+        # feature:fm:3 is new, and the existing rows get the builder's default
+        assert spliced['feature:fm:3::A'].tolist() == [0.0, 0.0, 0.0, 9.0]
+
+        # Removing rows only
+        spliced = dataframe_refresh.splice_dataframe(dataframe, None, ['P-b'])
+        assert spliced['Unique Name'].tolist() == ['P-a', 'P-c']
+        assert 'feature:fm:2::A' not in spliced.columns
+
+    def test_splice_dataframe_matches_rebuild(self):
+
+        dataframe = pd.DataFrame({'Project': ['P', 'P'], 'Acquired Time': [1, 2], 'Unique Name': ['P-a', 'P-b'],
+                                  'metadata::Age': [30, 40], 'feature:fm:1::A': [1.0, 2.0]})
+        # P-c is imported with a new raw and harmonised metadata field, and a new feature
+        update = pd.DataFrame({'Project': ['P'], 'Acquired Time': [3], 'Unique Name': ['P-c'],
+                               'metadata::Age': [50], 'metadata::Sex': ['F'], 'h_metadata::Sex': ['female'],
+                               'feature:fm:1::A': [3.0], 'feature:fm:2::A': [4.0]})
+        # As build_annotated_feature_dataframe_bulk builds it from all three samples
+        rebuilt = pd.DataFrame({'Project': ['P', 'P', 'P'], 'Acquired Time': [1, 2, 3], 'Unique Name': ['P-a', 'P-b', 'P-c'],
+                                'metadata::Age': [30, 40, 50], 'feature:fm:1::A': [1.0, 2.0, 3.0],
+                                'metadata::Sex': [0, 0, 'F'], 'h_metadata::Sex': ['', '', 'female'],
+                                'feature:fm:2::A': [0.0, 0.0, 4.0]})
+
+        spliced = dataframe_refresh.splice_dataframe(dataframe, update, ['P-c'], sort_by=['Project', 'Acquired Time'],
+                                                     column_defaults={'h_metadata::Sex': dataframe_refresh.get_harmonised_metadata_default('text')})
+        pd.testing.assert_frame_equal(spliced, rebuilt)
@@ -102,6 +102,44 @@ class TestImports:
 
         #assert expected_dataframe.equals(actual_dataframe) == True
 
+    def test_ea_reimport_peakpanther_annotations(self,create_min_database,
+                                                add_single_task_pipelines,
+                                                create_pipeline_testing_project,
+                                                import_devset_sample_manifest,
+                                                create_lab,
+                                                create_ms_assays,
+                                                create_annotation_methods,
+                                                import_devset_lpos_peakpanther_annotations):
+        """Re-imports the peakPantheR annotations, in bulk and one at a time. Both update the existing AnnotatedFeatures, so the counts do not change and the values validate.
+        """
+
+        import_counts = {
+            "project_id": 1,
+            "subjects": 8,
+            "samples": 115,
+            "sample_assays": 64,
+            "metadata_values": 312,
+            "annotated_features": 10816}
+
+        for bulk_import in [True, False]:
+            task = ImportPeakPantherAnnotations(project_name=PROJECT_NAME,
+                                                username=USERNAME,
+                                                feature_metadata_csv_path=config['DATA']['test_data'] + 'DEVSET P LPOS PeakPantheR_featureMetadata.csv',
+                                                sample_metadata_csv_path=config['DATA']['test_data'] + 'DEVSET P LPOS PeakPantheR_sampleMetadata_SMALL.csv',
+                                                intensity_data_csv_path=config['DATA']['test_data'] + 'DEVSET P LPOS PeakPantheR_intensityData.csv',
+                                                batch_corrected_data_csv_path=config['DATA']['test_data'] + 'DEVSET P LPOS PeakPantheR_intensityData_batchcorrected.csv',
+                                                ppr_annotation_parameters_csv_path=config['DATA']['test_data'] + 'DEVSET_P_LPOS_annotationParameters_summary.csv',
+                                                ppr_mz_csv_path=config['DATA']['test_data'] + 'DEVSET_P_LPOS_PPR_mz.csv',
+                                                ppr_rt_csv_path=config['DATA']['test_data'] + 'DEVSET_P_LPOS_PPR_rt_with_extra_paths.csv',
+                                                sample_matrix="plasma",
+                                                assay_name="LPOS",
+                                                bulk_import=bulk_import,
+                                                db_env=DB_ENV)
+            output = task.run()
+
+            assert 'validation_error' not in output
+            assert output['counts'] == import_counts
+
 
     def test_f_import_ivdr_biquant_annotations(self,create_min_database,
                                                     add_single_task_pipelines,
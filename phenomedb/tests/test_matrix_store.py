@@ -0,0 +1,57 @@
+import os
+import numpy as np
+import pandas as pd
+from phenomedb import matrix_store
+
+
+class TestMatrixStore:
+    """TestMatrixStore class. Tests the persisted matrices of phenomedb.matrix_store
+    """
+
+    def test_matrix_store(self, tmp_path):
+
+        annotated_features = pd.DataFrame({'id': [11, 12, 13, 14],
+                                           'sample_assay_id': [5, 5, 7, 7],
+                                           'feature_metadata_id': [2, 3, 2, 3],
+                                           'unit_id': [1, 1, 1, None],
+                                           'intensity': [1.5, 0.0, 2.5, None],
+                                           'sr_corrected_intensity': [None, None, None, None],
+                                           'ltr_corrected_intensity': [None, None, None, None],
+                                           'below_lloq': [False, True, None, False],
+                                           'above_uloq': [False, False, False, True]}).drop(index=3)
+
+        arrays = matrix_store.pivot_annotated_features(annotated_features)
+        assert arrays['sample_assay_ids'].tolist() == [5, 7]
+        assert arrays['feature_metadata_ids'].tolist() == [2, 3]
+        assert arrays['annotated_feature_id'].tolist() == [[11, 12], [13, 0]]
+        assert arrays['below_lloq'].tolist() == [[False, True], [False, False]]
+
+        store = matrix_store.MatrixStore(1, base_path=str(tmp_path))
+        assert not store.exists()
+        manifest = store.write(arrays)
+        assert manifest['shape'] == [2, 2]
+        assert store.is_current(3, 13)
+        assert not store.is_current(4, 14)
+
+        loaded = store.load()
+        assert isinstance(loaded['intensity'], np.memmap)
+        unpivoted = matrix_store.unpivot_arrays(loaded)
+        assert unpivoted['annotated_feature_id'].tolist() == [11, 12, 13]
+        assert unpivoted['sample_assay_id'].tolist() == [5, 5, 7]
+        assert unpivoted['intensity'].tolist() == [1.5, 0.0, 2.5]
+        assert matrix_store.unpivot_arrays(loaded, sample_assay_ids=[7])['annotated_feature_id'].tolist() == [13]
+        assert matrix_store.unpivot_arrays(loaded, feature_metadata_ids=[3])['annotated_feature_id'].tolist() == [12]
+        assert matrix_store.get_positions(loaded['sample_assay_ids'], [7]).tolist() == [1]
+        assert matrix_store.get_positions(loaded['sample_assay_ids'], [7, 8]) is None
+
+        # The id matrix of a batch correction, with an id not in the store and an infinite value skipped
+        assert store.update_corrected_intensities(np.array([[11, 13], [99, 12]]), np.array([[1.0, 2.0], [3.0, np.inf]]), 'SR') == 2
+        assert np.array_equal(store.load()['sr_corrected_intensity'], np.array([[1.0, np.nan], [2.0, np.nan]]), equal_nan=True)
+        # The update is swapped in as a new version, the arrays already loaded are unchanged
+        assert np.isnan(loaded['sr_corrected_intensity']).all()
+        assert os.path.islink(store.path)
+        assert len(os.listdir(str(tmp_path))) == 2
+
+        store.delete()
+        assert not store.exists()
+        assert os.listdir(str(tmp_path)) == []
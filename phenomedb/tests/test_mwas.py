@@ -0,0 +1,64 @@
+import numpy as np
+import pandas as pd
+from scipy import stats
+from phenomedb import mwas
+
+
+class TestMWAS:
+    """TestMWAS class. Tests the vectorised MWAS backend of phenomedb.mwas
+    """
+
+    def test_mwas_engine(self):
+
+        rng = np.random.default_rng(0)
+        sample_metadata = pd.DataFrame({'h_metadata::Age': rng.normal(50, 10, 80),
+                                        'h_metadata::Sex': rng.choice(['F', 'M'], 80),
+                                        'h_metadata::BMI': rng.normal(25, 3, 80)})
+        sample_metadata.loc[5, 'h_metadata::BMI'] = None
+        intensity_data = rng.normal(size=(80, 4))
+        intensity_data[:, 0] += 0.1 * sample_metadata['h_metadata::Age']
+        intensity_data[3, 2] = np.nan
+        y = sample_metadata['h_metadata::Age'].to_numpy()
+        covariates = mwas.encode_covariates(sample_metadata, ['h_metadata::Sex', 'h_metadata::BMI'])
+        assert sorted(set(covariates[:, 0])) == [1.0, 2.0]
+
+        # Each feature's linear model, fitted on its own, matches the batched fit
+        results = mwas.run_mwas(intensity_data, sample_metadata, [11, 12, 13, 14], 'h_metadata::Age',
+                                model_X_variables=['h_metadata::Sex', 'h_metadata::BMI'], method='linear')
+        assert results['mwastable']['_row'].tolist() == ['X11', 'X12', 'X13', 'X14']
+        for j in range(4):
+            samples = ~np.isnan(covariates).any(axis=1) & ~np.isnan(intensity_data[:, j])
+            design = np.column_stack([np.ones(samples.sum()), intensity_data[samples, j], covariates[samples]])
+            coefficients = np.linalg.lstsq(design, y[samples], rcond=None)[0]
+            df = samples.sum() - design.shape[1]
+            std_errors = np.sqrt(np.diag(np.linalg.inv(design.T @ design)) * np.sum((y[samples] - design @ coefficients) ** 2) / df)
+            pvalues = 2 * stats.t.sf(np.abs(coefficients / std_errors), df)
+            estimates = np.array(results['mwasestimates']['X%s' % (11 + j)])
+            assert np.allclose(estimates[:, 0], coefficients, rtol=1e-8)
+            assert np.allclose(estimates[:, 1], std_errors, rtol=1e-8)
+            assert np.allclose(estimates[:, 3], pvalues, rtol=1e-6)
+            assert results['mwassummaries']['X%s' % (11 + j)]['df.residual'] == [df]
+        assert results['mwastable']['pvalues'][0] < 1e-6
+
+        for method, correlation_test in [('pearson', stats.pearsonr), ('spearman', stats.spearmanr)]:
+            results = mwas.run_mwas(intensity_data, sample_metadata, [11, 12, 13, 14], 'h_metadata::Age', method=method)
+            for j in range(4):
+                samples = ~np.isnan(intensity_data[:, j])
+                correlation, pvalue = correlation_test(y[samples], intensity_data[samples, j])
+                assert np.isclose(results['mwastable']['estimates'][j], correlation, rtol=1e-8)
+                assert np.isclose(results['mwastable']['pvalues'][j], pvalue, rtol=1e-6)
+
+        # R: p.adjust(c(0.01, 0.04, 0.03, 0.2, NA, 0.04), method)
+        pvalues = np.array([0.01, 0.04, 0.03, 0.2, np.nan, 0.04])
+        assert np.allclose(mwas.adjust_pvalues(pvalues, 'BH'), [0.05, 0.05, 0.05, 0.2, np.nan, 0.05], equal_nan=True)
+        assert np.allclose(mwas.adjust_pvalues(pvalues, 'bonferroni'), [0.05, 0.2, 0.15, 1, np.nan, 0.2], equal_nan=True)
+        assert np.allclose(mwas.adjust_pvalues(pvalues, 'holm'), [0.05, 0.12, 0.12, 0.2, np.nan, 0.12], equal_nan=True)
+
+        # The bootstrap intervals for a seed do not depend on the number of processes
+        in_process = mwas.run_mwas(intensity_data, sample_metadata, [11, 12, 13, 14], 'h_metadata::Age', method='linear',
+                                   bootstrap=True, bootstrap_resamples=120, max_workers=1, seed=1)['mwasbootstraps']
+        in_pool = mwas.run_mwas(intensity_data, sample_metadata, [11, 12, 13, 14], 'h_metadata::Age', method='linear',
+                                bootstrap=True, bootstrap_resamples=120, max_workers=2, seed=1)['mwasbootstraps']
+        assert in_process['_row'].tolist() == ['X11']
+        assert np.allclose(in_process[['lower_ci', 'upper_ci']].to_numpy(), in_pool[['lower_ci', 'upper_ci']].to_numpy())
+        assert in_process.loc[0, 'lower_ci'] < in_process.loc[0, 'estimates'] < in_process.loc[0, 'upper_ci']
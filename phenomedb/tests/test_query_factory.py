@@ -868,6 +868,50 @@ class TestQueryFactory():
 
         assert isinstance(rows,list) == True
 
+    def test_compiled_query(self,create_min_database,
+                            create_pipeline_testing_project):
+
+        query_factory = QueryFactory(query_name='test_compiled_query',db_env='TEST')
+        query_factory.add_filter(query_filter=QueryFilter(model='Project',property='name',operator='eq',value=self.project_name))
+        query_factory.generate_query(output_model='SampleAssay')
+
+        sql, params = query_factory.get_sql(ids_only=True)
+        assert self.project_name not in sql
+        assert self.project_name in params.values()
+        assert 'JOIN project' in sql
+
+        ids = query_factory.execute_query(type='ids')
+        query_factory.generate_query(output_model='SampleAssay')
+        assert ids == [sample_assay.id for sample_assay in query_factory.execute_query(type='all')]
+        assert len(ids) == query_factory.db_session.query(SampleAssay).join(Sample).join(Subject).join(Project) \
+                                                    .filter(Project.name==self.project_name).count()
+
+        # The compiled query is cached per query_dict
+        compiled_query = query_factory.compiled_query
+        query_factory.generate_query(output_model='SampleAssay')
+        assert query_factory.compiled_query is compiled_query
+
+    def test_materialised_cohort(self,create_min_database,
+                                 create_pipeline_testing_project):
+
+        query_factory = QueryFactory(query_name='test_materialised_cohort',db_env='TEST')
+        query_factory.add_filter(query_filter=QueryFilter(model='Project',property='name',operator='eq',value=self.project_name))
+        query_factory.generate_query(output_model='SampleAssay')
+        ids = query_factory.execute_query(type='ids')
+
+        with query_factory.materialised_cohort('SampleAssay') as cohort_tables:
+            cohort_table = cohort_tables['SampleAssay']
+            assert cohort_table.row_count == len(ids)
+            assert query_factory.db_session.execute(query_factory.get_ids_select('SampleAssay')
+                                                    .order_by(cohort_table.table.c.id)).scalars().all() == ids
+            # Nested contexts reuse the table
+            with query_factory.materialised_cohort('SampleAssay') as nested_cohort_tables:
+                assert nested_cohort_tables['SampleAssay'] is cohort_table
+            assert 'SampleAssay' in query_factory.cohort_tables
+
+        assert query_factory.cohort_tables == {}
+        assert query_factory.db_session.execute(text("select to_regclass('%s')" % cohort_table.name)).scalar() is None
+
     def test_build_save_retrieve_and_execute_query(self,create_min_database,
                                                    delete_saved_queries,
                                                     create_pipeline_testing_project):
@@ -1133,7 +1177,143 @@ class TestQueryFactory():
         df = query_factory.execute_and_build_dataframe(output_model='AnnotatedFeature')
         assert df.empty != True
 
+    def test_aaae_bulk_builder_matches_rowwise(self,create_min_database,
+                                                create_lab,
+                                                create_pipeline_testing_project,
+                                                create_ms_assays,
+                                                create_annotation_methods,
+                                                import_devset_sample_manifest,
+                                                import_devset_bile_acid_targeted_annotations,
+                                                dummy_harmonise_annotations):
+        """Check the bulk builder output is identical to the row-wise builder"""
+
+        for harmonise_annotations in [True, False]:
+
+            query_factory = QueryFactory(output_model='AnnotatedFeature',query_name='test query',query_description='test description',db_env='TEST')
+            query_factory.add_filter(query_filter=QueryFilter(model='Project',property='name',operator='eq',value='PipelineTesting'))
+            query_factory.add_filter(query_filter=QueryFilter(model='AnnotationMethod',property='name',operator='eq',value='TargetLynx'))
+            feature_id_key = query_factory.get_dataframe_key(type='feature_id_combined_dataframe',model='AnnotatedFeature',
+                                                             db_env='TEST',harmonise_annotations=harmonise_annotations)
+
+            rowwise = query_factory.execute_and_build_dataframe(output_model='AnnotatedFeature',method='rowwise',
+                                                                harmonise_annotations=harmonise_annotations)
+            rowwise_feature_ids = query_factory.dataframes[feature_id_key]
+
+            bulk = query_factory.execute_and_build_dataframe(output_model='AnnotatedFeature',method='bulk',
+                                                             harmonise_annotations=harmonise_annotations)
+            bulk_feature_ids = query_factory.dataframes[feature_id_key]
+
+            assert bulk.empty is False
+            assert list(bulk.columns) == list(rowwise.columns)
+            pd.testing.assert_frame_equal(bulk, rowwise, check_dtype=False)
+            assert list(bulk_feature_ids.columns) == list(rowwise_feature_ids.columns)
+            pd.testing.assert_frame_equal(bulk_feature_ids, rowwise_feature_ids, check_dtype=False)
+
+    def test_aaaf_build_columnwise_dataframe(self,create_min_database,
+                                            create_lab,
+                                            create_pipeline_testing_project,
+                                            create_ms_assays,
+                                            create_annotation_methods,
+                                            import_devset_sample_manifest,
+                                            import_devset_bile_acid_targeted_annotations,
+                                            dummy_harmonise_annotations):
+
+        query_factory = QueryFactory(output_model='AnnotatedFeature',query_name='test query',query_description='test description',db_env='TEST')
+        query_factory.add_filter(query_filter=QueryFilter(model='Project',property='name',operator='eq',value='PipelineTesting'))
+        query_factory.add_filter(query_filter=QueryFilter(model='AnnotationMethod',property='name',operator='eq',value='TargetLynx'))
+
+        columnwise = query_factory.execute_and_build_dataframe(output_model='AnnotatedFeature',method='columnwise',
+                                                               harmonise_annotations=True,sort_by=['Unique Name'])
+        bulk = query_factory.execute_and_build_dataframe(output_model='AnnotatedFeature',method='bulk',
+                                                         harmonise_annotations=True,sort_by=['Unique Name'])
+
+        feature_columns = [column for column in bulk.columns if column.startswith('feature:ha:')]
+        assert sorted(feature_columns) == sorted([column for column in columnwise.columns if column.startswith('feature:ha:')])
+        assert len([column for column in columnwise.columns if column.startswith('metadata::')]) > 0
+        assert columnwise.shape[0] == bulk.shape[0]
+        assert list(columnwise['Unique Name']) == list(bulk['Unique Name'])
+        columnwise_intensities = columnwise[feature_columns].astype(float).to_numpy()
+        measured = ~np.isnan(columnwise_intensities)
+        assert measured.any()
+        assert np.allclose(columnwise_intensities[measured], bulk[feature_columns].astype(float).to_numpy()[measured])
+
+    def test_aaag_feature_annotation_resolver(self,create_min_database,
+                                              create_lab,
+                                              create_pipeline_testing_project,
+                                              create_ms_assays,
+                                              create_annotation_methods,
+                                              import_devset_sample_manifest,
+                                              import_devset_bile_acid_targeted_annotations,
+                                              dummy_harmonise_annotations):
+        """Check the resolved feature metadata matches the per-column rows, and the compound fields are memoised"""
+
+        from phenomedb.annotation_resolver import FeatureAnnotationResolver
 
+        query_factory = QueryFactory(output_model='AnnotatedFeature',query_name='test query',query_description='test description',db_env='TEST')
+        query_factory.add_filter(query_filter=QueryFilter(model='Project',property='name',operator='eq',value='PipelineTesting'))
+        query_factory.add_filter(query_filter=QueryFilter(model='AnnotationMethod',property='name',operator='eq',value='TargetLynx'))
+        query_factory.save_query()
+        query_factory.execute_and_build_dataframe(output_model='AnnotatedFeature',harmonise_annotations=True)
+        sample_metadata, feature_metadata, intensity_data = query_factory.build_intensity_data_sample_metadata_and_feature_metadata(
+                                                                harmonise_annotations=True,save_cache=False)
+
+        assert intensity_data.shape == (sample_metadata.shape[0], feature_metadata.shape[0])
+
+        resolver = FeatureAnnotationResolver(query_factory.db_session, query_factory.compound_fields_to_include,
+                                             query_factory.compound_class_types_to_include, cache=query_factory.cache)
+        for i, row in feature_metadata.iterrows():
+            expected_row = query_factory.build_annotated_feature_feature_metadata_row(row['feature_id'],harmonise_annotations=True)
+            assert row['feature_name'] == expected_row['feature_name']
+            assert row['QuantificationType'] == expected_row['QuantificationType']
+            assert int(row['harmonised_annotation_id']) == int(expected_row['harmonised_annotation_id'])
+            if 'PhenomeDB ID' in expected_row:
+                assert int(row['PhenomeDB ID']) == int(expected_row['PhenomeDB ID'])
+                assert str(int(row['harmonised_annotation_id'])) in query_factory.cache.get(resolver.get_cache_key())
+
+        # Resolving again reads the compound fields from the cache
+        resolved_colnames, cached_feature_metadata = resolver.resolve(feature_metadata['feature_id'].tolist(),harmonise_annotations=True)
+        assert resolved_colnames == feature_metadata['feature_id'].tolist()
+        pd.testing.assert_frame_equal(cached_feature_metadata.reset_index(drop=True), feature_metadata, check_dtype=False)
+
+    def test_aaah_compound_class_aggregation(self,create_min_database,
+                                             create_lab,
+                                             create_pipeline_testing_project,
+                                             create_ms_assays,
+                                             create_annotation_methods,
+                                             import_devset_sample_manifest,
+                                             import_devset_bile_acid_targeted_annotations,
+                                             dummy_harmonise_annotations):
+        """Check every class level and aggregate function built in one call matches the per-class pandas aggregates"""
+
+        query_factory = QueryFactory(output_model='AnnotatedFeature',query_name='test query',query_description='test description',db_env='TEST')
+        query_factory.add_filter(query_filter=QueryFilter(model='Project',property='name',operator='eq',value='PipelineTesting'))
+        query_factory.add_filter(query_filter=QueryFilter(model='AnnotationMethod',property='name',operator='eq',value='TargetLynx'))
+        parent = query_factory.execute_and_build_dataframe(output_model='AnnotatedFeature',harmonise_annotations=True)
+        parent_key = query_factory.get_dataframe_key(type='combined',model='AnnotatedFeature',db_env='TEST',harmonise_annotations=True)
+        query_factory.dataframes[parent_key] = parent
+
+        aggregate_functions = ['sum','mean','min','max','median']
+        dataframes = query_factory.build_compound_class_dataframes(class_type='hmdb',aggregate_functions=aggregate_functions,
+                                                                   parent_key=parent_key,harmonise_annotations=True)
+        assert len(dataframes) == 5 * len(aggregate_functions)
+
+        for class_level in ['kingdom','category','main_class','sub_class','direct_parent']:
+            for aggregate_function in aggregate_functions:
+                key = query_factory.get_dataframe_key(type='combined',model='CompoundClass',class_type='hmdb',class_level=class_level,
+                                                      aggregate_function=aggregate_function,db_env='TEST',harmonise_annotations=True)
+                dataframe = dataframes[key]
+                assert query_factory.dataframes[key] is dataframe
+                assert dataframe.shape[0] == parent.shape[0]
+                for colname in [colname for colname in dataframe.columns if colname.startswith('compound_class:')]:
+                    feature_names = query_factory.compound_class_feature_map[colname]
+                    expected = getattr(parent.loc[:,feature_names].astype(float),aggregate_function)(axis=1)
+                    assert np.allclose(dataframe[colname].to_numpy(dtype=float),expected.to_numpy(dtype=float),equal_nan=True)
+
+        single = query_factory.build_compound_class_dataframe(class_type='hmdb',class_level='Main Class',aggregate_function='sum',
+                                                              parent_key=parent_key,harmonise_annotations=True)
+        key = query_factory.get_dataframe_key(type='combined',model='CompoundClass',class_type='hmdb',class_level='main_class',
+                                              aggregate_function='sum',db_env='TEST',harmonise_annotations=True)
+        pd.testing.assert_frame_equal(single, dataframes[key])
 
     def test_summary_stats(self,create_min_database,
                                 delete_test_cache,
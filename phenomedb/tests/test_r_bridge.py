@@ -0,0 +1,35 @@
+import json
+import numpy as np
+import pandas as pd
+from phenomedb import r_bridge
+
+
+class TestRBridge:
+    """TestRBridge class. Tests the Feather exchange of phenomedb.r_bridge
+    """
+
+    def test_r_bridge(self, tmp_path):
+
+        # Mixed object columns are written as strings, the other dtypes are kept
+        sample_metadata = pd.DataFrame({'Sample ID': ['s1', 's2', 's3'], 'h_metadata::Age': [30.5, None, 50.0],
+                                        'Batch': [1, 'B2', None], 'Count': [1, 2, 3]}, index=[4, 5, 6])
+        r_bridge.write_frame(sample_metadata, str(tmp_path / 'sample_metadata.feather'))
+        loaded = r_bridge.read_frame(str(tmp_path / 'sample_metadata.feather'))
+        assert list(loaded.columns) == ['Sample ID', 'h_metadata::Age', 'Batch', 'Count']
+        assert loaded['Count'].dtype == np.int64
+        assert loaded['Batch'].tolist()[:2] == ['1', 'B2']
+        assert pd.isnull(loaded.loc[1, 'h_metadata::Age'])
+
+        r_bridge.write_frame(np.arange(6, dtype=float).reshape(3, 2), str(tmp_path / 'intensity.feather'))
+        assert r_bridge.read_output_frames(str(tmp_path))['intensity'].to_numpy().tolist() == [[0.0, 1.0], [2.0, 3.0], [4.0, 5.0]]
+
+        # results.json written before the Feather exchange held the JSON as a string in an array
+        with open(str(tmp_path / 'legacy.json'), 'w') as json_file:
+            json.dump([json.dumps({'pR2': [0.1, 0.2]})], json_file)
+        assert r_bridge.read_results_json(str(tmp_path / 'legacy.json')) == {'pR2': [0.1, 0.2]}
+        with open(str(tmp_path / 'results.json'), 'w') as json_file:
+            json.dump({'pR2': [0.1, 0.2]}, json_file)
+        assert r_bridge.read_results_json(str(tmp_path / 'results.json')) == {'pR2': [0.1, 0.2]}
+        with open(str(tmp_path / 'xcms.json'), 'w') as json_file:
+            json.dump(['/tmp/peak_table.csv'], json_file)
+        assert r_bridge.read_results_json(str(tmp_path / 'xcms.json')) == ['/tmp/peak_table.csv']
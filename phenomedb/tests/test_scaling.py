@@ -0,0 +1,50 @@
+import numpy as np
+import pandas as pd
+from phenomedb.scaling import BlockPartition, BlockScaler
+
+
+class TestScaling:
+    """TestScaling class. Tests the block partitions and scalers of phenomedb.scaling
+    """
+
+    def test_block_scaler(self):
+
+        rng = np.random.default_rng(0)
+        intensity_data = rng.random((6, 4)) * 10
+        sample_metadata = pd.DataFrame({'Project': ['A', 'B', 'A', 'B', 'A', 'B']})
+        feature_metadata = pd.DataFrame({'assay': ['LPOS', 'LPOS', 'HPOS', 'LPOS'],
+                                         'annotation_method': ['PPR', 'PPR', 'PPR', 'TargetLynx']})
+        partition = BlockPartition.from_metadata(sample_metadata, feature_metadata)
+        assert sorted(partition.blocks.keys()) == [('A', 'HPOS', 'PPR'), ('A', 'LPOS', 'PPR'), ('A', 'LPOS', 'TargetLynx'),
+                                                   ('B', 'HPOS', 'PPR'), ('B', 'LPOS', 'PPR'), ('B', 'LPOS', 'TargetLynx')]
+        assert partition.blocks[('B', 'LPOS', 'PPR')][0].tolist() == [1, 3, 5]
+        assert partition.blocks[('B', 'LPOS', 'PPR')][1].tolist() == [0, 1]
+
+        for scaling, expected_scale in [('mc', lambda block: 1),
+                                        ('uv', lambda block: block.std(axis=0)),
+                                        ('pa', lambda block: np.sqrt(block.std(axis=0)))]:
+            scaled = BlockScaler(scaling).fit_transform(intensity_data, partition, copy=True)
+            for sample_indices, feature_indices in partition.blocks.values():
+                block = intensity_data[np.ix_(sample_indices, feature_indices)]
+                assert np.allclose(scaled[np.ix_(sample_indices, feature_indices)], (block - block.mean(axis=0)) / expected_scale(block))
+
+        block = intensity_data[np.ix_([0, 2, 4], [0, 1])]
+        scaled = BlockScaler('med').fit_transform(intensity_data, partition, copy=True)
+        assert np.allclose(scaled[np.ix_([0, 2, 4], [0, 1])], block / (np.median(block, axis=0) + (1 - block.min())))
+
+        # The thread pool scales the same blocks in place
+        scaler = BlockScaler('uv', max_workers=3)
+        in_place = intensity_data.copy()
+        assert scaler.fit_transform(in_place, partition) is in_place
+        assert np.allclose(in_place, BlockScaler('uv').fit_transform(intensity_data, partition, copy=True))
+
+        # The fitted parameters are reapplied to new samples
+        new_samples = intensity_data[[0, 1]]
+        new_partition = BlockPartition.from_metadata(sample_metadata.iloc[[0, 1]], feature_metadata)
+        assert np.allclose(scaler.transform(new_samples, new_partition, copy=True), in_place[[0, 1]])
+
+        try:
+            scaler.transform(new_samples, BlockPartition.from_metadata(pd.DataFrame({'Project': ['C', 'C']}), feature_metadata))
+            assert False
+        except Exception as err:
+            assert 'No fitted scaling parameters' in str(err)
@@ -0,0 +1,50 @@
+from phenomedb import summary_statistics
+from phenomedb.models import Assay, Sample
+
+
+class TestSummaryStatistics:
+    """TestSummaryStatistics class. Tests the per-project summaries of phenomedb.summary_statistics
+    """
+
+    def test_combine_project_summaries(self):
+
+        assert summary_statistics.get_grouping_id([], [Assay.name, Sample.sample_matrix, Sample.sample_type]) == 7
+        assert summary_statistics.get_grouping_id([Sample.sample_matrix], [Assay.name, Sample.sample_matrix, Sample.sample_type]) == 5
+
+        project_a = summary_statistics.get_empty_project_summary()
+        project_a.update({'number_of_sample_assays': 3, 'number_samples': 2, 'number_subjects': 1,
+                          'number_of_annotated_features': 30, 'min_annotated_feature_count': 10,
+                          'assay_counts': {'LPOS': 3}, 'sample_type_counts': {'Study Sample': 3},
+                          'metadata_counts_raw': {'Age': {'10': 3}},
+                          'metadata_counts_harmonised_text': {'Sex': {'F': 3, 'null': 0}}})
+        project_b = summary_statistics.get_empty_project_summary()
+        project_b.update({'number_of_sample_assays': 2, 'number_samples': 2, 'number_subjects': 2,
+                          'number_of_annotated_features': 12, 'min_annotated_feature_count': 5,
+                          'assay_counts': {'LPOS': 1, 'NOESY': 1}, 'sample_type_counts': {'Study Sample': 2},
+                          'metadata_counts_raw': {'Age': {'10': 1, '20': 1}},
+                          'metadata_counts_harmonised_text': {'Sex': {'F': 1, 'M': 1}}})
+
+        summary = summary_statistics.combine_project_summaries({'B': project_b, 'A': project_a})
+        assert summary['number_of_sample_assays'] == 5
+        assert summary['number_subjects'] == 3
+        assert summary['number_of_annotated_features'] == 42
+        assert summary['min_annotated_feature_count'] == 5
+        assert summary['project_counts'] == {'A': 3, 'B': 2}
+        assert summary['assay_counts'] == {'LPOS': 4, 'NOESY': 1}
+        assert summary['metadata_counts_raw'] == {'Age': {'10': 4, '20': 1}}
+        assert summary['metadata_counts_harmonised_text'] == {'Sex': {'F': 4, 'M': 1, 'null': 0}}
+        assert summary['metadata_counts_harmonised_text_by_project'] == {'Sex': {'A': {'F': 3}, 'B': {'F': 1, 'M': 1}}}
+
+        # Recalculating project B, which no longer matches, leaves project A
+        project_summaries = summary_statistics.update_project_summaries({'A': project_a, 'B': project_b}, {}, ['B'])
+        assert summary_statistics.combine_project_summaries(project_summaries)['project_counts'] == {'A': 3}
+
+    def test_get_changed_projects(self):
+
+        cached = {'A': [3, 12, 6, 40, 30, 900], 'B': [2, 7, 4, 20, 12, 500], 'C': [1, 2, 0, None, 0, None]}
+        # A imported into, B deleted from, C unchanged, D added, and E removed
+        current = {'A': [4, 13, 6, 40, 40, 910], 'B': [1, 7, 2, 20, 6, 500], 'C': [1, 2, 0, None, 0, None],
+                   'D': [1, 14, 0, None, 0, None]}
+        cached['E'] = [1, 1, 0, None, 0, None]
+        assert summary_statistics.get_changed_projects(current, cached) == ['A', 'B', 'D', 'E']
+        assert summary_statistics.get_changed_projects(current, current) == []
@@ -0,0 +1,42 @@
+import numpy as np
+import pandas as pd
+from phenomedb import cache_serializers
+from phenomedb.task_data import TaskData, align_sample_metadata
+
+
+class TestTaskData:
+    """TestTaskData class. Tests the upstream handoff of phenomedb.task_data
+    """
+
+    def test_task_data_handoff(self):
+
+        untransformed = pd.DataFrame({'Sample File Name': ['f1', 'f2', 'f3'], 'Project': ['P', 'P', 'Q'], 'Age': [30.0, 40.0, 50.0]})
+
+        # The rows match, so the dropped column is joined on the index
+        aligned = align_sample_metadata(untransformed[['Sample File Name', 'Project']], untransformed)
+        assert aligned['Age'].tolist() == [30.0, 40.0, 50.0]
+
+        # A sample was excluded upstream and the rest reordered, so the dropped columns are merged on Sample File Name
+        sample_metadata = pd.DataFrame({'Sample File Name': ['f3', 'f1'], 'Extra': [1, 2]}, index=[5, 6])
+        aligned = align_sample_metadata(sample_metadata, untransformed)
+        assert list(aligned.columns) == ['Sample File Name', 'Project', 'Age', 'Extra']
+        assert aligned.index.tolist() == [5, 6]
+        assert aligned['Project'].tolist() == ['Q', 'P']
+        assert aligned['Age'].tolist() == [50.0, 30.0]
+        # Samples without a match get no values
+        aligned = align_sample_metadata(pd.DataFrame({'Sample File Name': ['f9']}), untransformed)
+        assert pd.isnull(aligned.loc[0, 'Age'])
+
+        task_data = TaskData({'sample_metadata': untransformed,
+                              'intensity_data': np.arange(6, dtype=float).reshape(3, 2),
+                              'scores': np.zeros((3, 2)),
+                              'ncomps': 2})
+        serialized = cache_serializers.serialize(task_data)
+        loaded = cache_serializers.deserialize_task_data(serialized, names=['sample_metadata', 'intensity_data'])
+        assert list(loaded.keys()) == ['sample_metadata', 'intensity_data']
+        assert loaded.get_array('intensity_data').tolist() == [[0.0, 1.0], [2.0, 3.0], [4.0, 5.0]]
+        assert list(cache_serializers.deserialize_task_data(serialized).keys()) == ['sample_metadata', 'intensity_data', 'scores', 'ncomps']
+
+        # Task outputs cached as JSON are filtered after they are deserialized
+        legacy = cache_serializers.serialize({'sample_metadata': {'Age': {'0': 30.0}}, 'scores': [[0.0]]})
+        assert list(cache_serializers.deserialize_task_data(legacy, names=['sample_metadata']).keys()) == ['sample_metadata']
@@ -0,0 +1,45 @@
+import numpy as np
+import pandas as pd
+from phenomedb import transform_pipeline
+
+
+class TestTransformPipeline:
+    """TestTransformPipeline class. Tests the mask stages of phenomedb.transform_pipeline
+    """
+
+    def test_mask_pipeline(self):
+
+        intensity_data = np.array([[1.0, 0.0, 2.0, np.nan],
+                                   [2.0, 0.0, 3.0, 1.0],
+                                   [3.0, 5.0, 0.0, 1.0],
+                                   [4.0, 6.0, 0.0, 1.0]])
+        sample_metadata = pd.DataFrame({'Sample ID': ['s1', 's2', 's3', 's4'],
+                                        'Project': ['A', 'A', 'B', 'B'],
+                                        'SampleType': ['StudySample', 'StudyPool', 'StudySample', 'StudySample'],
+                                        'metadata::Age': [30, 40, None, 50],
+                                        'h_metadata::Sex': ['F', 'M', 'F', 'M'],
+                                        'metadata::Empty': [None, None, None, None]})
+        feature_metadata = pd.DataFrame({'feature_id': ['f1', 'f2', 'f3', 'f4']})
+
+        pipeline = transform_pipeline.MaskPipeline([transform_pipeline.NAFeatureMask(),
+                                                    transform_pipeline.ProjectZeroFeatureMask(),
+                                                    transform_pipeline.SampleValueMask('SampleType', ['StudySample']),
+                                                    transform_pipeline.MetadataColumnMask('Sample ID', only_harmonised_metadata=True),
+                                                    transform_pipeline.NAMetadataSampleMask()])
+        masked_sample_metadata, masked_feature_metadata, masked_intensity_data = pipeline.run(sample_metadata,
+                                                                                              feature_metadata,
+                                                                                              intensity_data)
+
+        assert [(entry['stage'], entry['removed']) for entry in pipeline.provenance] == \
+               [('na_features', ['f4']),
+                ('features_not_in_all_projects', ['f2', 'f3']),
+                ('SampleType', ['s2']),
+                ('metadata_columns', ['metadata::Empty']),
+                ('na_metadata_samples', ['s3'])]
+        assert masked_sample_metadata['Sample ID'].tolist() == ['s1', 's4']
+        assert masked_sample_metadata.columns.tolist() == ['Sample ID', 'Project', 'SampleType', 'metadata::Age', 'h_metadata::Sex']
+        assert masked_feature_metadata['feature_id'].tolist() == ['f1']
+        assert masked_intensity_data.tolist() == [[1.0], [4.0]]
+        # The masked intensities are a copy
+        masked_intensity_data[0, 0] = 100
+        assert intensity_data[0, 0] == 1.0
@@ -0,0 +1,41 @@
+import math
+import numpy as np
+import phenomedb.utilities as utils
+from phenomedb.exceptions import NoUnitConversionError, NotImplementedUnitConversionError
+from phenomedb.unit_conversion import UnitConversionRegistry
+
+
+class TestUnitConversion:
+    """TestUnitConversion class. Tests the vectorised conversions of phenomedb.unit_conversion
+    """
+
+    def test_unit_conversion_registry(self):
+
+        registry = UnitConversionRegistry()
+        values = np.array([18.0, 36.0, 9.0])
+        assert np.allclose(registry.convert(values, 'mg/dL', 'mmol/L'), [1.0, 2.0, 0.5])
+        assert np.array_equal(registry.convert(values, 'mmol/L', 'mmol/L'), values)
+
+        units = np.array(['mg/dL', 'noUnit', 'mmol/L'], dtype=object)
+        assert np.allclose(registry.convert_units(values, units, 'mmol/L'), [1.0, 36.0, 9.0])
+
+        try:
+            registry.convert_units(values, units, 'mmol/L', skip_no_unit=False)
+            assert False
+        except NoUnitConversionError:
+            pass
+
+        for i in range(2):
+            try:
+                registry.convert(values, 'g/dL', 'nM')
+                assert False
+            except NotImplementedUnitConversionError:
+                pass
+        assert list(registry.failures.keys()) == [('noUnit', 'mmol/L'), ('g/dL', 'nM')]
+
+        registry.register('degC', 'degF', 1.8, offset=32)
+        assert np.allclose(registry.convert(np.array([0.0, 100.0]), 'degC', 'degF'), [32.0, 212.0])
+
+        # match_input_precision is Unit.convert's rounding
+        converted = registry.convert(np.array([12.345]), 'mg/dL', 'mmol/L', match_input_precision=True)
+        assert math.isclose(converted[0], utils.precision_round(12.345 / 18, digits=len(str(12.345))), rel_tol=1e-12)
@@ -5,6 +5,7 @@ from phenomedb.config import config
 import phenomedb.utilities as utils
 import math
 import re
+import numpy as np
 class TestCache:
     """TestCache class. Tests the output of the cache task classes with test configurations
     """
@@ -56,9 +57,58 @@ class TestCache:
             rounded_str = utils.precision_round(number,type='str')
             print("%s %s %s" % (number,rounded_float, rounded_str))
 
+
+class TestUtilities:
+    """TestUtilities class. Tests the array helpers of phenomedb.utilities
+    """
+
+    def test_precision_round_array(self):
+
+        test_numbers = np.array([4.33734343434e-24, 3.6070000000000003e-25, 0.00000023452324, 1.265e-17, -1.265e-17,
+                                 9.9999999, 123.456, 0.0, np.nan])
+        rounded = utils.precision_round_array(test_numbers)
+        for number, rounded_number in zip(test_numbers.tolist(), rounded.tolist()):
+            if math.isnan(number):
+                assert math.isnan(rounded_number)
+            else:
+                # np.round scales by a power of ten, so can differ from round() in the last place
+                assert math.isclose(rounded_number, utils.precision_round(number), rel_tol=1e-12)
+
+        assert utils.get_string_lengths(np.array([0.123, 12.5, 1e-05])).tolist() == [5, 4, 5]
+
+    def test_parse_intensity_array(self):
+
+        values = np.array([[1.5, '<LLOQ', None],
+                           ['nan', float('inf'), '>ULOQ'],
+                           ['2', 'not detected', ' 3 ']], dtype=object)
+
+        intensities, below_lloq, above_uloq, comments = utils.parse_intensity_array(values)
+
+        assert np.array_equal(intensities, np.array([[1.5, np.nan, np.nan], [np.nan, np.nan, np.nan], [2.0, np.nan, 3.0]]), equal_nan=True)
+        assert below_lloq.tolist() == [[False, True, True], [True, False, False], [False, False, False]]
+        assert above_uloq.tolist() == [[False, False, False], [False, True, True], [False, False, False]]
+        assert comments == {(0, 1): '<LLOQ', (1, 2): '>ULOQ', (2, 1): 'not detected'}
+        assert utils.get_parsed_intensity((intensities, below_lloq, above_uloq, comments), (0, 1)) == (None, True, False, '<LLOQ')
+        assert utils.get_parsed_intensity((intensities, below_lloq, above_uloq, comments), (2, 2)) == (3.0, False, False, None)
+        assert utils.parse_intensity('<LLOQ') == (None, True, False, '<LLOQ')
+
+        # The unified importers keep missing cells as unmeasured, not below the LLOQ
+        intensities, below_lloq, above_uloq, comments = utils.parse_intensity_array(values, missing_below_lloq=False)
+        assert below_lloq.tolist() == [[False, True, False], [False, False, False], [False, False, False]]
+        assert above_uloq.tolist() == [[False, False, False], [False, True, True], [False, False, False]]
+        assert comments == {(0, 1): '<LLOQ', (1, 2): '>ULOQ', (2, 1): 'not detected'}
+        assert utils.parse_intensity(float('nan'), missing_below_lloq=False) == (None, False, False, None)
+        assert utils.parse_intensity(float('nan')) == (None, True, False, None)
+
     def test_parse_intensity_metabolights(self):
 
         assert utils.parse_intensity_metabolights(1) == 1.0
         assert utils.parse_intensity_metabolights('1') == 1.0
         assert utils.parse_intensity_metabolights('1,2') == 1.2
-        assert utils.parse_intensity_metabolights('111,111,111') == 111111111.0
\ No newline at end of file
+        assert utils.parse_intensity_metabolights('111,111,111') == 111111111.0
+        assert utils.parse_intensity_metabolights('12 mg') == 12.0
+        assert utils.parse_intensity_metabolights('not detected') is None
+
+        values = np.array([[1, '1'], ['1,2', '111,111,111'], ['12 mg', None]], dtype=object)
+        intensities = utils.parse_intensity_metabolights_array(values)
+        assert np.array_equal(intensities, np.array([[1.0, 1.0], [1.2, 111111111.0], [12.0, np.nan]]), equal_nan=True)
@@ -0,0 +1,257 @@
+"""Mask pipeline for :meth:`phenomedb.query_factory.QueryFactory.transform_dataframe`.
+
+A :class:`MaskPipeline` runs a list of mask stages over sample metadata, feature metadata and an intensity matrix. Each
+stage computes a vectorised boolean keep mask over samples, features or metadata columns, given the masks of the
+stages before it. The masks are combined and applied together, with one fancy-index copy of the intensity matrix,
+and what each stage removed is recorded in :attr:`MaskPipeline.provenance`.
+"""
+
+import logging
+
+import numpy as np
+import pandas as pd
+
+import phenomedb.utilities as utils
+
+SAMPLES = 'samples'
+FEATURES = 'features'
+COLUMNS = 'columns'
+
+
+class MaskContext:
+    """The data being masked, and the keep masks so far.
+
+    :param sample_metadata: The sample metadata, one row per intensity matrix row.
+    :type sample_metadata: :class:`pandas.DataFrame`
+    :param feature_metadata: The feature metadata, one row per intensity matrix column.
+    :type feature_metadata: :class:`pandas.DataFrame`
+    :param intensity_data: The samples x features intensity matrix.
+    :type intensity_data: :class:`numpy.ndarray`
+    """
+
+    def __init__(self, sample_metadata, feature_metadata, intensity_data):
+        self.sample_metadata = sample_metadata
+        self.feature_metadata = feature_metadata
+        self.intensity_data = intensity_data
+        self.masks = {SAMPLES: np.ones(sample_metadata.shape[0], dtype=bool),
+                      FEATURES: np.ones(feature_metadata.shape[0], dtype=bool),
+                      COLUMNS: np.ones(sample_metadata.shape[1], dtype=bool)}
+
+
+class MaskStage:
+    """Base class for mask stages.
+
+    Subclasses set name and axis (samples, features or columns) and implement mask().
+    """
+
+    name = None
+    axis = None
+
+    def mask(self, context):
+        """Compute the keep mask of the stage.
+
+        :param context: The data and the masks of the previous stages.
+        :type context: :class:`MaskContext`
+        :return: The boolean keep mask over the axis.
+        :rtype: :class:`numpy.ndarray`
+        """
+
+        raise NotImplementedError
+
+
+class NAFeatureMask(MaskStage):
+    """Removes features with any missing intensity."""
+
+    name = 'na_features'
+    axis = FEATURES
+
+    def mask(self, context):
+        return ~np.isnan(context.intensity_data).any(axis=0)
+
+
+class ProjectZeroFeatureMask(MaskStage):
+    """Removes features that are all zero in any project.
+
+    :param project_column: The sample metadata project column, defaults to 'Project'
+    :type project_column: str, optional
+    """
+
+    name = 'features_not_in_all_projects'
+    axis = FEATURES
+
+    def __init__(self, project_column='Project'):
+        self.project_column = project_column
+
+    def mask(self, context):
+        projects, project_index = np.unique(context.sample_metadata[self.project_column].astype(str).to_numpy(),
+                                            return_inverse=True)
+        # projects x samples indicator . samples x features non-zero = projects x features non-zero counts
+        indicator = (project_index.ravel()[np.newaxis, :] == np.arange(len(projects))[:, np.newaxis]).astype(float)
+        non_zero = indicator @ (context.intensity_data != 0)
+        return (non_zero > 0).all(axis=0)
+
+
+class SampleValueMask(MaskStage):
+    """Keeps samples whose nPYc SampleType or AssayRole is one of the given values.
+
+    :param column: The sample metadata column, 'SampleType' or 'AssayRole'
+    :type column: str
+    :param values: The nPYc enums, or their names, to keep.
+    :type values: list
+    """
+
+    axis = SAMPLES
+
+    def __init__(self, column, values):
+        self.column = column
+        self.name = column
+        self.values = [utils.get_npyc_enum_from_value(value) for value in values]
+
+    def mask(self, context):
+        if self.column not in context.sample_metadata.columns:
+            raise Exception("Cannot mask by %s, it is not in the sample metadata" % self.column)
+        column = context.sample_metadata[self.column].astype(str)
+        # Convert each distinct value once, ie 'StudySample' and 'SampleType.StudySample' -> SampleType.StudySample
+        keep = {value: utils.get_npyc_enum_from_value(value) in self.values for value in column.unique()}
+        return column.map(keep).to_numpy(dtype=bool)
+
+
+class MetadataColumnMask(MaskStage):
+    """Selects the sample metadata columns to keep, see transform_dataframe for the parameters."""
+
+    name = 'metadata_columns'
+    axis = COLUMNS
+
+    def __init__(self, sample_label, columns_to_include=None, columns_to_exclude=None,
+                 remove_empty_metadata_columns=True, include_metadata=True, include_harmonised_metadata=True,
+                 only_metadata=None, only_harmonised_metadata=None, exclude_na_metadata_columns=False):
+        self.sample_label = sample_label
+        self.columns_to_include = columns_to_include if columns_to_include else []
+        self.columns_to_exclude = columns_to_exclude if columns_to_exclude else []
+        self.remove_empty_metadata_columns = remove_empty_metadata_columns
+        self.include_metadata = include_metadata
+        self.include_harmonised_metadata = include_harmonised_metadata
+        self.only_metadata = only_metadata
+        self.only_harmonised_metadata = only_harmonised_metadata
+        self.exclude_na_metadata_columns = exclude_na_metadata_columns
+
+    def mask(self, context):
+        sample_metadata = context.sample_metadata.loc[context.masks[SAMPLES], :]
+        colnames = pd.Index(sample_metadata.columns.astype(str))
+        nulls = sample_metadata.isnull()
+        all_null = nulls.all(axis=0).to_numpy()
+        any_null = nulls.any(axis=0).to_numpy()
+        is_metadata = colnames.str.contains('metadata::', regex=False)
+        is_harmonised_metadata = colnames.str.contains('h_metadata::', regex=False)
+        is_included = colnames.isin(self.columns_to_include)
+        is_excluded = colnames.isin(self.columns_to_exclude)
+
+        # The same precedence as the previous per-column branches; the first matching rule decides each column
+        rules = [(colnames == self.sample_label, True),
+                 (is_excluded, False),
+                 (all_null if self.remove_empty_metadata_columns else False, False),
+                 (is_included, True),
+                 (is_harmonised_metadata if self.include_harmonised_metadata else False, True),
+                 (is_metadata if self.include_metadata else False, True),
+                 (~is_included if len(self.columns_to_include) > 0 else False, False),
+                 (~is_metadata if self.only_metadata else False, False),
+                 (is_metadata & ~is_harmonised_metadata if self.only_harmonised_metadata else False, False),
+                 (is_metadata & any_null if self.exclude_na_metadata_columns else False, False)]
+        keep = np.ones(len(colnames), dtype=bool)
+        decided = np.zeros(len(colnames), dtype=bool)
+        for matches, value in rules:
+            matches = np.asarray(matches, dtype=bool) & ~decided
+            keep[matches] = value
+            decided |= matches
+        return keep
+
+
+class NAMetadataSampleMask(MaskStage):
+    """Removes samples with any missing value in the kept metadata columns."""
+
+    name = 'na_metadata_samples'
+    axis = SAMPLES
+
+    def mask(self, context):
+        return ~context.sample_metadata.loc[:, context.masks[COLUMNS]].isnull().any(axis=1).to_numpy()
+
+
+class MaskPipeline:
+    """Runs mask stages in order and applies their masks together.
+
+    :param stages: The mask stages.
+    :type stages: list
+    :param sample_label: The sample metadata column used to label removed samples, defaults to 'Sample ID'
+    :type sample_label: str, optional
+    :param feature_label: The feature metadata column used to label removed features, defaults to 'feature_id'
+    :type feature_label: str, optional
+    :param logger: The logger, defaults to None
+    :type logger: :class:`logging.Logger`, optional
+    """
+
+    def __init__(self, stages, sample_label='Sample ID', feature_label='feature_id', logger=None):
+        self.stages = stages
+        self.sample_label = sample_label
+        self.feature_label = feature_label
+        self.logger = logger if logger is not None else logging.getLogger(__name__)
+        #: One entry per stage, {'stage', 'axis', 'removed'}
+        self.provenance = []
+        #: The kept sample and feature indices of the last run
+        self.sample_indices = None
+        self.feature_indices = None
+
+    def get_labels(self, context, axis, indices):
+        """Get the labels of removed samples, features or columns.
+
+        :param context: The mask context.
+        :type context: :class:`MaskContext`
+        :param axis: The axis.
+        :type axis: str
+        :param indices: The removed indices.
+        :type indices: :class:`numpy.ndarray`
+        :return: The labels, or the indices if there is no label column.
+        :rtype: list
+        """
+
+        if axis == SAMPLES and self.sample_label in context.sample_metadata.columns:
+            return context.sample_metadata[self.sample_label].iloc[indices].tolist()
+        elif axis == FEATURES and self.feature_label in context.feature_metadata.columns:
+            return context.feature_metadata[self.feature_label].iloc[indices].tolist()
+        elif axis == COLUMNS:
+            return context.sample_metadata.columns[indices].tolist()
+        else:
+            return indices.tolist()
+
+    def run(self, sample_metadata, feature_metadata, intensity_data):
+        """Compute every mask, then apply them together.
+
+        :param sample_metadata: The sample metadata.
+        :type sample_metadata: :class:`pandas.DataFrame`
+        :param feature_metadata: The feature metadata.
+        :type feature_metadata: :class:`pandas.DataFrame`
+        :param intensity_data: The intensity matrix.
+        :type intensity_data: :class:`numpy.ndarray`
+        :return: The masked sample metadata, feature metadata and intensity data.
+        :rtype: tuple
+        """
+
+        context = MaskContext(sample_metadata, feature_metadata, intensity_data)
+        self.provenance = []
+        self.sample_indices = None
+        self.feature_indices = None
+        for stage in self.stages:
+            stage_mask = np.asarray(stage.mask(context), dtype=bool)
+            removed = np.flatnonzero(context.masks[stage.axis] & ~stage_mask)
+            context.masks[stage.axis] &= stage_mask
+            self.provenance.append({'stage': stage.name, 'axis': stage.axis,
+                                    'removed': self.get_labels(context, stage.axis, removed)})
+            if len(removed) > 0:
+                self.logger.info("%s removed %s %s" % (stage.name, len(removed), stage.axis))
+
+        self.sample_indices = np.flatnonzero(context.masks[SAMPLES])
+        self.feature_indices = np.flatnonzero(context.masks[FEATURES])
+        masked_intensity_data = intensity_data[np.ix_(self.sample_indices, self.feature_indices)]
+        masked_sample_metadata = sample_metadata.iloc[self.sample_indices, np.flatnonzero(context.masks[COLUMNS])].reset_index(drop=True)
+        masked_feature_metadata = feature_metadata.iloc[self.feature_indices].reset_index(drop=True)
+
+        return masked_sample_metadata, masked_feature_metadata, masked_intensity_data
@@ -0,0 +1,171 @@
+"""Unit conversion registry. Converts whole arrays of intensities between :class:`phenomedb.models.Unit` names.
+
+Each conversion is a (from_unit, to_unit) -> (factor, offset) pair, applied as value * factor + offset. Conversions
+that fail are remembered, so a conversion is looked up (and an unconvertible pair logged and raised) once per pair,
+not once per value.
+"""
+
+import logging
+
+import numpy as np
+import pandas as pd
+
+import phenomedb.utilities as utils
+from phenomedb.exceptions import NoUnitConversionError, NotImplementedUnitConversionError
+
+#: Units that have no dimension, and so cannot be converted
+NO_UNITS = ['noUnit', '-/-']
+
+#: (from_unit, to_unit) -> (factor, offset)
+CONVERSIONS = {('mg/dL', 'g/dL'): (0.001, 0),
+               ('g/dL', 'mg/dL'): (1000, 0),
+               ('mg/dL', 'mmol/L'): (1 / 18, 0),
+               ('mmol/L', 'mg/dL'): (18, 0),
+               ('nmol/L', 'mmol/L'): (0.000001, 0),
+               ('mmol/L', 'nmol/L'): (1000000, 0),
+               ('ng/mL', 'mmol/L'): (0.001, 0),
+               ('mmol/L', 'ng/mL'): (1000, 0),
+               ('nM', 'mmol/L'): (0.000001, 0),
+               ('mmol/L', 'nM'): (1000000, 0),
+               ('fg/µL', 'mmol/L'): (0.000001, 0),
+               ('mmol/L', 'fg/µL'): (1000000, 0),
+               ('µM', 'mmol/L'): (0.001, 0)}
+
+
+class UnitConversionRegistry:
+    """Registry of unit conversions.
+
+    :param conversions: (from_unit, to_unit) -> (factor, offset), defaults to None (:data:`CONVERSIONS`)
+    :type conversions: dict, optional
+    :param logger: The logger, defaults to None
+    :type logger: :class:`logging.Logger`, optional
+    """
+
+    def __init__(self, conversions=None, logger=None):
+        self.conversions = dict(CONVERSIONS if conversions is None else conversions)
+        self.failures = {}
+        self.logger = logger if logger is not None else logging.getLogger(__name__)
+
+    def register(self, from_unit, to_unit, factor, offset=0):
+        """Register a conversion.
+
+        :param from_unit: The unit name to convert from.
+        :type from_unit: str
+        :param to_unit: The unit name to convert to.
+        :type to_unit: str
+        :param factor: The multiplier.
+        :type factor: float
+        :param offset: The offset added after multiplying, defaults to 0
+        :type offset: float, optional
+        """
+
+        self.conversions[(from_unit, to_unit)] = (factor, offset)
+        self.failures.pop((from_unit, to_unit), None)
+
+    def get_conversion(self, from_unit, to_unit):
+        """Get the (factor, offset) for a conversion.
+
+        :param from_unit: The unit name to convert from.
+        :type from_unit: str
+        :param to_unit: The unit name to convert to.
+        :type to_unit: str
+        :raises NoUnitConversionError: If from_unit has no dimension (noUnit or -/-).
+        :raises NotImplementedUnitConversionError: If the conversion has not been registered.
+        :return: (factor, offset)
+        :rtype: tuple
+        """
+
+        if from_unit == to_unit:
+            return (1, 0)
+        elif (from_unit, to_unit) in self.conversions:
+            return self.conversions[(from_unit, to_unit)]
+        elif (from_unit, to_unit) not in self.failures:
+            if from_unit in NO_UNITS:
+                self.failures[(from_unit, to_unit)] = NoUnitConversionError('Cannot convert %s to %s' % (from_unit, to_unit))
+            else:
+                self.failures[(from_unit, to_unit)] = NotImplementedUnitConversionError(
+                    'Unit conversion has not been implemented: %s -> %s' % (from_unit, to_unit))
+                self.logger.info(self.failures[(from_unit, to_unit)])
+        raise self.failures[(from_unit, to_unit)]
+
+    def can_convert(self, from_unit, to_unit):
+        """Whether a conversion exists.
+
+        :param from_unit: The unit name to convert from.
+        :type from_unit: str
+        :param to_unit: The unit name to convert to.
+        :type to_unit: str
+        :rtype: bool
+        """
+
+        try:
+            self.get_conversion(from_unit, to_unit)
+            return True
+        except (NoUnitConversionError, NotImplementedUnitConversionError):
+            return False
+
+    def convert(self, values, from_unit, to_unit, match_input_precision=False):
+        """Convert an array of values from one unit to another.
+
+        :param values: The values.
+        :type values: :class:`numpy.ndarray` or :class:`pandas.Series`
+        :param from_unit: The unit name to convert from.
+        :type from_unit: str
+        :param to_unit: The unit name to convert to.
+        :type to_unit: str
+        :param match_input_precision: Round each converted value to the number of digits of its input value (as
+            :meth:`phenomedb.models.Unit.convert` has always done), defaults to False
+        :type match_input_precision: bool, optional
+        :raises NoUnitConversionError: If from_unit has no dimension (noUnit or -/-).
+        :raises NotImplementedUnitConversionError: If the conversion has not been registered.
+        :return: The converted values, a Series if values was a Series.
+        :rtype: :class:`numpy.ndarray` or :class:`pandas.Series`
+        """
+
+        factor, offset = self.get_conversion(from_unit, to_unit)
+        array = np.asarray(values, dtype=float)
+        converted = array * factor + offset
+        if match_input_precision:
+            converted = utils.precision_round_array(converted, digits=utils.get_string_lengths(array))
+        if isinstance(values, pd.Series):
+            return pd.Series(converted, index=values.index, name=values.name)
+        return converted
+
+    def convert_units(self, values, from_units, to_unit, match_input_precision=False, skip_no_unit=True):
+        """Convert an array of values, each with its own unit, to one unit. Each distinct unit is converted in one
+        vectorised operation.
+
+        :param values: The values.
+        :type values: :class:`numpy.ndarray` or :class:`pandas.Series`
+        :param from_units: The unit name of each value.
+        :type from_units: :class:`numpy.ndarray` or :class:`pandas.Series`
+        :param to_unit: The unit name to convert to.
+        :type to_unit: str
+        :param match_input_precision: Round each converted value to the number of digits of its input value,
+            defaults to False
+        :type match_input_precision: bool, optional
+        :param skip_no_unit: Leave values in noUnit or -/- unconverted rather than raising, defaults to True
+        :type skip_no_unit: bool, optional
+        :raises NoUnitConversionError: If a unit has no dimension and skip_no_unit is False.
+        :raises NotImplementedUnitConversionError: If a conversion has not been registered.
+        :return: The converted values, a Series if values was a Series.
+        :rtype: :class:`numpy.ndarray` or :class:`pandas.Series`
+        """
+
+        array = np.asarray(values, dtype=float)
+        converted = array.copy()
+        unit_codes, unit_names = pd.factorize(np.asarray(from_units, dtype=object))
+        for unit_code, unit_name in enumerate(unit_names):
+            mask = unit_codes == unit_code
+            try:
+                converted[mask] = self.convert(array[mask], unit_name, to_unit, match_input_precision=match_input_precision)
+            except NoUnitConversionError:
+                if not skip_no_unit:
+                    raise
+        if isinstance(values, pd.Series):
+            return pd.Series(converted, index=values.index, name=values.name)
+        return converted
+
+
+#: The default registry
+registry = UnitConversionRegistry()
@@ -478,44 +478,120 @@ def clean_task_id(task_id):
     return task_id.lower().replace("-","_").replace(" ","_").replace(".","_").replace(")","_").replace("(","_")
 
 def parse_intensity_metabolights(intensity):
+    """Parse a MetaboLights intensity. See :func:`parse_intensity_metabolights_array`.
 
-    try:
-        if re.search(r'^[0-9]+[^0-9]+$', str(intensity)):
-            value_match = re.match(r'^[0-9]+', intensity)
-            value = float(intensity[value_match.regs[0],value_match.regs[1]])
-        elif re.search(r',',str(intensity)):
-            if len(re.findall(r',', intensity)) == 1:
-                value = float(str(intensity).replace(',','.'))
-            else:
-                value = float(str(intensity).replace(',', ''))
-        else:
-            value = float(intensity)
-    except Exception as err:
-        value = None
-    return value
-def parse_intensity(intensity):
-    # Try casting the value to a float, if it doesn't work, its <LLOQ or >ULOQ
-
-    above_uloq = False
-    below_lloq = False
-    comment = None
-    try:
-        intensity = float(intensity)
-        if math.isnan(intensity):
-            below_lloq = True
-            intensity = None
-        elif math.isinf(intensity):
-            above_uloq = True
-            intensity = None
-    except:
+    :param intensity: The raw intensity.
+    :type intensity: str or float
+    :return: The intensity, or None if it cannot be parsed.
+    :rtype: float
+    """
+
+    value = parse_intensity_metabolights_array([intensity])[0]
+    if np.isnan(value):
+        return None
+    return float(value)
+
+def parse_intensity_metabolights_array(values):
+    """Vectorised :func:`parse_intensity_metabolights`. Parses a whole column or matrix of MetaboLights intensities.
+
+    Numeric cells are parsed as they are. Otherwise a cell of digits followed by a suffix (ie '12 mg') is its leading
+    digits, a cell with one comma uses it as the decimal point, and a cell with several commas uses them as thousands
+    separators.
+
+    :param values: The raw intensity cells.
+    :type values: :class:`pandas.DataFrame`, :class:`pandas.Series`, or :class:`numpy.ndarray`
+    :return: The intensities, NaN where a cell is missing or cannot be parsed.
+    :rtype: :class:`numpy.ndarray`
+    """
+
+    raw = np.asarray(values,dtype=object)
+    flat = raw.ravel()
+    intensities = pd.to_numeric(pd.Series(flat),errors='coerce').to_numpy(dtype=float,copy=True)
+    unparsed = np.isnan(intensities) & ~pd.isnull(flat)
+    if unparsed.any():
+        strings = pd.Series(flat[unparsed]).astype(str).str.strip()
+        leading_digits = strings.str.extract(r'^([0-9]+)[^0-9]+$',expand=False)
+        decimal_commas = strings.str.replace(',','.',regex=False)
+        thousands_commas = strings.str.replace(',','',regex=False)
+        candidates = leading_digits.where(leading_digits.notnull(),
+                                          decimal_commas.where(strings.str.count(',') == 1,thousands_commas))
+        intensities[unparsed] = pd.to_numeric(candidates,errors='coerce').to_numpy(dtype=float)
+
+    return intensities.reshape(raw.shape)
+
+def parse_intensity(intensity,missing_below_lloq=True):
+    """Parse an intensity. See :func:`parse_intensity_array`.
+
+    :param intensity: The raw intensity.
+    :type intensity: str or float
+    :param missing_below_lloq: Whether a missing intensity is below the LLOQ, defaults to True
+    :type missing_below_lloq: bool, optional
+    :return: intensity (None where there is no intensity), below_lloq, above_uloq, comment
+    :rtype: tuple
+    """
+
+    return get_parsed_intensity(parse_intensity_array([intensity],missing_below_lloq=missing_below_lloq),(0,))
+
+def get_parsed_intensity(parsed_intensities,index):
+    """Get one cell of :func:`parse_intensity_array` as a :func:`parse_intensity` tuple.
+
+    :param parsed_intensities: The output of :func:`parse_intensity_array`.
+    :type parsed_intensities: tuple
+    :param index: The cell index, ie (row, column).
+    :type index: tuple
+    :return: intensity (None where there is no intensity), below_lloq, above_uloq, comment
+    :rtype: tuple
+    """
+
+    intensities, below_lloq, above_uloq, comments = parsed_intensities
+    intensity = intensities[index]
+    if np.isnan(intensity):
         intensity = None
-        comment = str(intensity)
-        if comment == '<LLOQ':
-            below_lloq = True
-        if comment == '>ULOQ':
-            above_uloq = True
+    else:
+        intensity = float(intensity)
 
-    return intensity,below_lloq,above_uloq,comment
+    return intensity,bool(below_lloq[index]),bool(above_uloq[index]),comments.get(tuple(index))
+
+def parse_intensity_array(values,missing_below_lloq=True):
+    """Vectorised :func:`parse_intensity`. Parses a whole intensity matrix at once.
+
+    Numeric cells are intensities. Missing cells (NaN, None, or 'nan') are below the LLOQ, unless missing_below_lloq
+    is False, when they are unmeasured, and infinite cells are above the ULOQ. Any other cell is a comment, and '<LLOQ'
+    and '>ULOQ' comments set the masks.
+
+    The unified (Bruker IVDr and TargetLynx) importers pass missing_below_lloq=False, as their empty cells were never
+    measured, where the peakPantheR NaN cells are below the LLOQ.
+
+    :param values: The raw intensity cells.
+    :type values: :class:`pandas.DataFrame` or :class:`numpy.ndarray`
+    :param missing_below_lloq: Whether missing cells are below the LLOQ, defaults to True
+    :type missing_below_lloq: bool, optional
+    :return: intensities (float, NaN where there is no intensity), below_lloq, above_uloq, and comments, a dict of
+        index tuple -> comment for the cells that are comments.
+    :rtype: tuple
+    """
+
+    raw = np.asarray(values,dtype=object)
+    flat = raw.ravel()
+    intensities = pd.to_numeric(pd.Series(flat),errors='coerce').to_numpy(dtype=float,copy=True)
+    missing = pd.isnull(flat)
+    below_lloq = np.isnan(intensities)
+    above_uloq = np.isinf(intensities)
+    comments = {}
+    # Cells which are neither numeric nor missing are comments. These are sparse, so are parsed one by one.
+    for flat_index in np.flatnonzero(below_lloq & ~missing):
+        comment = str(flat[flat_index]).strip()
+        if comment.lower() == 'nan':
+            missing[flat_index] = True
+            continue
+        below_lloq[flat_index] = comment == '<LLOQ'
+        above_uloq[flat_index] = comment == '>ULOQ'
+        comments[tuple(int(i) for i in np.unravel_index(flat_index,raw.shape))] = comment
+    intensities[above_uloq] = np.nan
+    if not missing_below_lloq:
+        below_lloq[missing] = False
+
+    return intensities.reshape(raw.shape),below_lloq.reshape(raw.shape),above_uloq.reshape(raw.shape),comments
 
 def parse_ion_id(ion_id):
     return ion_id.strip().replace('.1', '').replace('.2', '').replace('.3', '').replace('.4', '')
@@ -619,6 +695,52 @@ def precision_round(number,digits=3,type='float'):
             value = 'nan'
         return value
 
+def precision_round_array(values,digits=3):
+    """Vectorised :func:`precision_round`. Rounds each value to (digits - its decimal exponent) decimal places.
+
+    :param values: The values to round.
+    :type values: :class:`numpy.ndarray`
+    :param digits: The digits, either one for all values or one per value, defaults to 3
+    :type digits: int or :class:`numpy.ndarray`, optional
+    :return: The rounded values, as floats. NaN and inf are left as they are. Values can differ from
+        :func:`precision_round` in the last place, as np.round scales by a power of ten.
+    :rtype: :class:`numpy.ndarray`
+    """
+
+    values = np.asarray(values,dtype=float)
+    rounded = values.copy()
+    finite = np.isfinite(values) & (values != 0)
+    if not finite.any():
+        return rounded
+
+    absolute = np.abs(values[finite])
+    power = np.floor(np.log10(absolute))
+    # "{:e}" rounds the mantissa to 6 decimals, so 9.9999999 is formatted as 1.000000e+01
+    power[np.round(absolute / 10.0 ** power,6) >= 10] += 1
+    significant_digits = np.broadcast_to(digits,values.shape)[finite]
+    decimals = (significant_digits - power).astype(int)
+
+    finite_values = values[finite]
+    # 17 significant digits round-trip a float exactly, so rounding to them is a no-op
+    finite_rounded = finite_values.copy()
+    # np.round takes one decimals value, and there are only a few distinct ones
+    for decimal in np.unique(decimals[significant_digits < 16]):
+        mask = (decimals == decimal) & (significant_digits < 16)
+        finite_rounded[mask] = np.round(finite_values[mask],decimal)
+    rounded[finite] = finite_rounded
+    return rounded
+
+def get_string_lengths(values):
+    """Get len(str(value)) of each value, vectorised. Used as the digits of :func:`precision_round_array` to round
+    a converted value to the precision of the original.
+
+    :param values: The values.
+    :type values: :class:`numpy.ndarray`
+    :return: The string lengths.
+    :rtype: :class:`numpy.ndarray`
+    """
+    return np.char.str_len(np.asarray(values,dtype=float).astype(str))
+
 def clear_task_view_cache(task_run_id):
     return
     #session = requests.session()
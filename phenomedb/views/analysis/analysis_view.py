@@ -24,6 +24,7 @@ import pandas as pd
 import numpy as np
 from flask import send_file
 from phenomedb.pipeline_factory import PipelineFactory
+from phenomedb.task_data import TaskData
 from copy import deepcopy
 import ast
 import re
@@ -195,6 +196,12 @@ class AnalysisView(PhenomeDBBaseView):
             task_run_output = task_run.get_task_output(self.cache)
             #print("TaskRun output %s" % task_run_output)
 
+            # The templates render the task data and output as JSON
+            if isinstance(task_data,TaskData):
+                task_data = task_data.to_json_safe()
+            if isinstance(task_run_output,TaskData):
+                task_run_output = task_run_output.to_json_safe()
+
         if task_data:
             #self.logger.debug("Task.data %s" % task_data)
             self.logger.debug("Task.data.keys() %s" % task_data.keys())
@@ -601,13 +608,13 @@ class AnalysisView(PhenomeDBBaseView):
                     summary['min_significant_pvalue'] = utils.precision_round(min_values['adjusted_pvalues'],type='str')
                     max_values = task_run_dataframe[(task_run_dataframe['adjusted_pvalues'] < 0.05)].max()
                     summary['max_significant_pvalue'] = utils.precision_round(max_values['adjusted_pvalues'],type='str')
-                    task_data = self.cache.get(task_run.get_task_data_cache_key())
-                    sample_metadata = pd.DataFrame.from_dict(task_data['sample_metadata'])
+                    task_data = TaskData(self.cache.get(task_run.get_task_data_cache_key()))
+                    sample_metadata = task_data.get_dataframe('sample_metadata')
                     summary['n_samples'] = sample_metadata.shape[0]
                     model_Y_variable = task_run.args['model_Y_variable']
                     summary['min_y'] = sample_metadata[model_Y_variable].min()
                     summary['max_y'] = sample_metadata[model_Y_variable].max()
-                    summary['n_features'] = pd.DataFrame.from_dict(task_data['feature_metadata']).shape[0]
+                    summary['n_features'] = task_data.get_dataframe('feature_metadata').shape[0]
                     mwas_summary[task_run.id] = summary
                 except Exception as err:
                     self.logger.exception(err)
@@ -1097,17 +1104,17 @@ class AnalysisView(PhenomeDBBaseView):
             harmonised_annotation = self.db_session.query(HarmonisedAnnotation).filter(
                 HarmonisedAnnotation.id == int(float(harmonised_annotation_id))).first()
             task_run = self.db_session.query(TaskRun).filter(TaskRun.id == int(float(request_data['task_run_id']))).first()
-            task_data = self.cache.get(task_run.get_task_data_cache_key())
+            task_data = TaskData(self.cache.get(task_run.get_task_data_cache_key()))
             task_run_output = task_run.get_task_output(self.cache)
-            feature_metadata = pd.DataFrame.from_dict(task_data['feature_metadata'])
-            sample_metadata = pd.DataFrame.from_dict(task_data['sample_metadata'])
+            feature_metadata = task_data.get_dataframe('feature_metadata')
+            sample_metadata = task_data.get_dataframe('sample_metadata')
             model_y_variable = task_run.args['model_Y_variable']
             feature_row = int(feature_metadata.loc[feature_metadata.loc[:, 'harmonised_annotation_id'] == int(
                 harmonised_annotation_id)].index[0])
            # if 'mwas_estimates' in task_run_output.keys() and 'mwas_summaries' in task_run_output.keys():
            #     data['feature_estimates'] = task_run_output['mwas_estimates'][("X%s" % harmonised_annotation_id)]
            #     data['feature_summary'] = task_run_output['mwas_summaries'][("X%s" % harmonised_annotation_id)]
-            intensity_data = np.matrix(task_data['intensity_data'])
+            intensity_data = task_data.get_array('intensity_data')
             output_dataframe = pd.DataFrame(columns=['Y', 'feature intensity'])
             #output_dataframe = output_dataframe.where(pd.notnull(output_dataframe), None)
             self.logger.debug('TaskRun.arg keys %s' % task_run.args.keys())
@@ -1353,6 +1360,8 @@ class AnalysisView(PhenomeDBBaseView):
                         os.makedirs('/tmp/phenomedb/')
                     results_json_path = '/tmp/phenomedb/task_run_' + str(task_run.id) + '_results.json'
                     f = open(results_json_path,'w')
+                    if isinstance(task_run_output,TaskData):
+                        task_run_output = task_run_output.to_json_safe()
                     f.write(json.dumps(task_run_output))
                     f.close()
                     self.db_session.close()
@@ -1388,13 +1397,13 @@ class AnalysisView(PhenomeDBBaseView):
                     if task_run_data_type == 'data':
                         if not self.cache.exists(task_run.get_task_data_cache_key()):
                             raise Exception("Cache does not exist - please reload page!")
-                        data_dict = self.cache.get(task_run.get_task_data_cache_key())
+                        data_dict = TaskData(self.cache.get(task_run.get_task_data_cache_key()))
                     elif task_run_data_type == 'args' and task_run.args is not None:
-                        data_dict = dict(task_run.args)
+                        data_dict = TaskData(task_run.args)
                     elif task_run_data_type == 'output' and task_run_output is not None:
-                        data_dict = dict(task_run_output)
+                        data_dict = TaskData(task_run_output)
                     else:
-                        data_dict = {}
+                        data_dict = TaskData()
                     self.logger.debug(type(data_dict))
                     self.logger.debug(data_dict.keys())
 
@@ -1403,20 +1412,20 @@ class AnalysisView(PhenomeDBBaseView):
                             data = data_dict[property]
                         else:
                             raise Exception("Unexpected field")
-                        if format == 'table' and re.search('intensity_data', property) and isinstance(data, list):
-                            df = pd.DataFrame(np.matrix(data))
+                        if format == 'table' and re.search('intensity_data', property) and not isinstance(data, (dict,pd.DataFrame)):
+                            df = pd.DataFrame(data_dict.get_array(property))
                             df.to_csv(filepath, header=None, index=None)
                         elif format == 'table':
-                            df = pd.DataFrame.from_dict(data)
+                            df = data_dict.get_dataframe(property)
                             df.to_csv(filepath, index=None)
 
                     elif property == 'combined':
                         if 'sample_metadata' in data_dict.keys() \
                                 and 'feature_metadata' in data_dict.keys() \
                                 and 'intensity_data' in data_dict.keys():
-                            intensity_data = np.matrix(data_dict['intensity_data'])
-                            feature_metadata = pd.DataFrame.from_dict(data_dict['feature_metadata'])
-                            sample_metadata = pd.DataFrame.from_dict(data_dict['sample_metadata'])
+                            intensity_data = np.asmatrix(data_dict.get_array('intensity_data'))
+                            feature_metadata = data_dict.get_dataframe('feature_metadata')
+                            sample_metadata = data_dict.get_dataframe('sample_metadata')
                         else:
                             raise Exception("Necessary fields do not exist")
 
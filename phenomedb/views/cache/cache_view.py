@@ -105,6 +105,8 @@ class CacheView(PhenomeDBBaseView):
         if type == 'redis':
             self.logger.info('redis cache flushed')
             self.cache.redis_cache.flushall()
+            # the key index lives in redis, so rebuild it from the files
+            self.cache.reconcile_index()
         else:
             self.logger.info('redis and file cache flushed and saved queries reset. (Not task files)' )
             self.cache.flushall(include_task_cache=False)
@@ -114,7 +116,7 @@ class CacheView(PhenomeDBBaseView):
     @has_access
     def refresh(self):
 
-        self.cache.generate_file_cache_list()
+        self.cache.reconcile_index()
         return redirect(url_for('CacheView.list'))
 
 cache_bp = Blueprint(
@@ -13,6 +13,7 @@ from phenomedb.config import config
 
 import phenomedb.database as db
 import phenomedb.utilities as utils
+from phenomedb import annotation_resolver
 from phenomedb.models import *
 from phenomedb.base_view import *
 
@@ -738,6 +739,7 @@ class CompoundView(PhenomeDBBaseView):
             self.db_session.rollback()
 
         self.db_session.commit()
+        annotation_resolver.delete_cache(self.cache)
 
     def remove_compound_from_compound_class(self,compound_id,compound_class_id):
 
@@ -757,6 +759,7 @@ class CompoundView(PhenomeDBBaseView):
             raise
 
         self.db_session.commit()
+        annotation_resolver.delete_cache(self.cache)
 
 
     def insert_multiple_compounds(self,file_name):
@@ -952,6 +955,7 @@ class CompoundView(PhenomeDBBaseView):
 
 
             self.db_session.commit()
+            annotation_resolver.delete_cache(self.cache)
 
 
         report.append("Updated {} compounds".format(len(old_compounds)))